@@ -0,0 +1,398 @@
+"""Admission control, rate limits and retries for the vendor APIs.
+
+Every STT, LLM and TTS call goes through its provider's VendorGate:
+
+- `admit()` takes one of the provider's `{PROVIDER}_MAX_CONCURRENCY` slots on
+  this worker. At most `{PROVIDER}_MAX_QUEUE` calls wait for a slot, each for
+  up to `{PROVIDER}_QUEUE_TIMEOUT` seconds; anything beyond that is rejected
+  right away with Busy. The calls that were admitted keep their latency
+  instead of every call slowing down together behind an unbounded queue.
+  With `{PROVIDER}_RATE` set, the slot also needs a token from a bucket in
+  Redis that all workers share (`{PROVIDER}_RATE` calls per second, bursts of
+  `{PROVIDER}_BURST`), so the vendor's rate limit holds for the deployment.
+- `call()` and `stream()` give the call a deadline (`{PROVIDER}_DEADLINE`
+  seconds; for streams, until the first chunk) and retry 429s, 5xx responses
+  and connection errors up to `{PROVIDER}_RETRIES` times, with full-jitter
+  exponential backoff that honours Retry-After, while the deadline allows.
+  A stream is only retried before it has produced anything.
+- Background calls (e.g. summarizing a conversation) come after the rest:
+  `admit(background=True)` only takes a slot that is free with nobody
+  waiting for it, and a `call(..., preemptible=True)` holding a slot is
+  cancelled, with Busy, as soon as another call has to wait. With a single
+  slot (llama.cpp), a background call never holds up a turn.
+
+Settings fall back to `VENDOR_MAX_CONCURRENCY`, `VENDOR_DEADLINE`, ... for
+every provider, like the pool settings in clients.py. `check_session()`
+applies a token bucket per session (`SESSION_RATE` turns per second, bursts
+of `SESSION_BURST`; off by default), also in Redis, so one client cannot
+flood the vendors.
+
+The rate limits fail open: if Redis is unreachable, calls are admitted.
+"""
+import asyncio
+import logging
+import os
+import random
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Awaitable, Callable, Dict, Mapping, Optional, Set, TypeVar
+
+import httpx
+import redis.asyncio
+import redis.exceptions
+
+import metrics
+from metrics import span
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+# How often a background call looks for a free slot
+BACKGROUND_POLL = 0.05
+
+# Refills a bucket for the time since it was last used, then takes `cost` tokens if it has them.
+# Returns {1, 0} when admitted, else {0, seconds until enough tokens}. Uses the Redis clock so
+# every worker sees the same time.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'at')
+local tokens = tonumber(state[1]) or burst
+local at = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - at) * rate)
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+if wait > 0 then
+    return {0, tostring(wait)}
+end
+return {1, '0'}
+"""
+
+
+def _env(provider: str, name: str, default: str) -> str:
+    return os.getenv(f"{provider.upper()}_{name}", os.getenv(f"VENDOR_{name}", default))
+
+
+class Busy(Exception):
+    """A call or turn was not admitted; the client may try again after `retry_after` seconds."""
+
+    def __init__(self, scope: str, reason: str, retry_after: float):
+        super().__init__(f"{scope} is busy ({reason}), retry after {retry_after:.1f}s")
+        self.scope = scope
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def status_code(self) -> int:
+        # The client went over its own rate limit (429), or the service is out of capacity (503)
+        return 429 if self.scope == "session" else 503
+
+
+class VendorError(Exception):
+    """A vendor API answered with an error status (for clients that do not raise their own)."""
+
+    def __init__(self, message: str, status_code: int, headers: Optional[Mapping[str, str]] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.headers = headers
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    headers = getattr(error, "headers", None) or getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(error: Exception) -> bool:
+    # Status errors of the OpenAI and ElevenLabs SDKs and VendorError carry status_code;
+    # the SDKs wrap connection failures, so look at the cause as well
+    status_code = getattr(error, "status_code", None)
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS
+    return isinstance(error, httpx.TransportError) or isinstance(error.__cause__, httpx.TransportError)
+
+
+@dataclass
+class GateSettings:
+    max_concurrency: int = 16
+    max_queue: int = 32
+    queue_timeout: float = 5.0
+    # Calls per second across all workers; 0 disables the shared rate limit
+    rate: float = 0.0
+    burst: int = 10
+    deadline: float = 30.0
+    retries: int = 2
+    retry_base_delay: float = 0.25
+    retry_max_delay: float = 4.0
+
+    @classmethod
+    def from_env(cls, provider: str, **defaults) -> "GateSettings":
+        base = cls(**defaults)
+        return cls(
+            max_concurrency=int(_env(provider, "MAX_CONCURRENCY", str(base.max_concurrency))),
+            max_queue=int(_env(provider, "MAX_QUEUE", str(base.max_queue))),
+            queue_timeout=float(_env(provider, "QUEUE_TIMEOUT", str(base.queue_timeout))),
+            rate=float(_env(provider, "RATE", str(base.rate))),
+            burst=int(_env(provider, "BURST", str(base.burst))),
+            deadline=float(_env(provider, "DEADLINE", str(base.deadline))),
+            retries=int(_env(provider, "RETRIES", str(base.retries))),
+            retry_base_delay=float(_env(provider, "RETRY_BASE_DELAY", str(base.retry_base_delay))),
+            retry_max_delay=float(_env(provider, "RETRY_MAX_DELAY", str(base.retry_max_delay))),
+        )
+
+
+class RateLimiter:
+    """Token buckets in Redis, shared by every worker."""
+
+    def __init__(self, redis_client: redis.asyncio.Redis, prefix: str = "ratelimit:"):
+        self.prefix = prefix
+        self.script = redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+        self.redis_errors = 0
+
+    async def take(self, key: str, rate: float, burst: int, cost: int = 1) -> float:
+        """Take `cost` tokens; returns 0 if they were available, else the seconds to wait for them."""
+        try:
+            admitted, wait = await self.script(keys=[self.prefix + key], args=[rate, burst, cost])
+        except redis.exceptions.RedisError as e:
+            self.redis_errors += 1
+            log.warning(f"Rate limiter unavailable, admitting: {e}")
+            return 0.0
+        return 0.0 if int(admitted) else float(wait)
+
+
+class VendorGate:
+    def __init__(self, provider: str, stage: str, settings: GateSettings, limiter: RateLimiter):
+        self.provider = provider
+        # Prefix of the admission span in the turn traces, e.g. llm_admission
+        self.stage = stage
+        self.settings = settings
+        self.limiter = limiter
+        self.semaphore = asyncio.Semaphore(settings.max_concurrency)
+        self.waiting = 0
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected: Dict[str, int] = {"queue_full": 0, "queue_timeout": 0, "rate_limited": 0, "preempted": 0}
+        # Background calls that give up their slot when another call has to wait for one
+        self.preemptible: Set[asyncio.Task] = set()
+        self.retries = 0
+        self.deadline_exceeded = 0
+
+    def reject(self, reason: str, retry_after: float) -> Busy:
+        self.rejected[reason] += 1
+        metrics.admission_rejected.inc(self.provider, reason)
+        return Busy(self.provider, reason, retry_after)
+
+    def preempt(self):
+        # Cancel one background call; its slot goes to the calls waiting
+        for task in self.preemptible:
+            if not task.done():
+                self.preemptible.discard(task)
+                task.cancel()
+                return
+
+    @asynccontextmanager
+    async def admit(self, background: bool = False):
+        """Hold one of the provider's slots for the duration of the block; raises Busy.
+
+        A `background` call waits until a slot is free and no other call is waiting.
+        """
+        settings = self.settings
+        async with span(f"{self.stage}_admission", expected=(Busy,)):
+            loop = asyncio.get_running_loop()
+            give_up = loop.time() + settings.queue_timeout
+            if background:
+                while self.semaphore.locked() or self.waiting:
+                    if loop.time() >= give_up:
+                        raise self.reject("queue_timeout", settings.queue_timeout)
+                    await asyncio.sleep(BACKGROUND_POLL)
+                await self.semaphore.acquire()
+            else:
+                if self.semaphore.locked():
+                    self.preempt()
+                    if self.waiting >= settings.max_queue:
+                        raise self.reject("queue_full", settings.queue_timeout)
+                self.waiting += 1
+                try:
+                    async with asyncio.timeout_at(give_up):
+                        await self.semaphore.acquire()
+                except TimeoutError:
+                    raise self.reject("queue_timeout", settings.queue_timeout) from None
+                finally:
+                    self.waiting -= 1
+            try:
+                while settings.rate > 0:
+                    wait = await self.limiter.take(f"vendor:{self.provider}", settings.rate, settings.burst)
+                    if not wait:
+                        break
+                    if loop.time() + wait > give_up:
+                        raise self.reject("rate_limited", wait)
+                    await asyncio.sleep(wait)
+            except BaseException:
+                self.semaphore.release()
+                raise
+        self.admitted += 1
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self.semaphore.release()
+
+    def retry_delay(self, error: Exception, attempt: int) -> Optional[float]:
+        if attempt >= self.settings.retries or not is_retryable(error):
+            return None
+        delay = random.uniform(0, min(self.settings.retry_max_delay, self.settings.retry_base_delay * 2 ** attempt))
+        return max(delay, retry_after(error) or 0.0)
+
+    async def _backoff(self, error: Exception, attempt: int, deadline: float):
+        # Re-raises the error when it should not be retried or the deadline does not allow it
+        delay = self.retry_delay(error, attempt)
+        if delay is None or asyncio.get_running_loop().time() + delay >= deadline:
+            raise error
+        self.retries += 1
+        metrics.vendor_retries.inc(self.provider)
+        log.warning(f"{self.provider} call failed ({error}), retry {attempt + 1} in {delay:.2f}s")
+        await asyncio.sleep(delay)
+
+    async def call(self, make_call: Callable[[], Awaitable[T]], retry: bool = True, preemptible: bool = False) -> T:
+        """Run `make_call()` under the deadline, retrying transient failures unless `retry` is off.
+
+        A `preemptible` call is cancelled, raising Busy, when another call has to wait for a slot.
+        """
+        if preemptible:
+            return await self._preemptible(self.call(make_call, retry))
+        deadline = asyncio.get_running_loop().time() + self.settings.deadline
+        attempt = 0
+        while True:
+            timeout = asyncio.timeout_at(deadline)
+            try:
+                async with timeout:
+                    return await make_call()
+            except TimeoutError:
+                if timeout.expired():
+                    self.deadline_exceeded += 1
+                raise
+            except Exception as e:
+                if not retry:
+                    raise
+                await self._backoff(e, attempt, deadline)
+                attempt += 1
+
+    async def _preemptible(self, call: Awaitable[T]) -> T:
+        # In a task of its own, so that preempt() cancels the call and not its caller
+        task = asyncio.ensure_future(call)
+        self.preemptible.add(task)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if task.cancelled() and not asyncio.current_task().cancelling():
+                raise self.reject("preempted", 0.0) from None
+            raise
+        finally:
+            self.preemptible.discard(task)
+
+    async def stream(self, open_stream: Callable[[], AsyncIterator[T]]) -> AsyncIterator[T]:
+        """Iterate `open_stream()`; the deadline and retries apply until its first item."""
+        deadline = asyncio.get_running_loop().time() + self.settings.deadline
+        attempt = 0
+        while True:
+            iterator = open_stream().__aiter__()
+            timeout = asyncio.timeout_at(deadline)
+            try:
+                async with timeout:
+                    first = await anext(iterator)
+                break
+            except StopAsyncIteration:
+                return
+            except TimeoutError:
+                await _aclose(iterator)
+                if timeout.expired():
+                    self.deadline_exceeded += 1
+                raise
+            except Exception as e:
+                await _aclose(iterator)
+                await self._backoff(e, attempt, deadline)
+                attempt += 1
+            except BaseException:
+                await _aclose(iterator)
+                raise
+        try:
+            yield first
+            async for item in iterator:
+                yield item
+        finally:
+            # Closing early (e.g. a cancelled turn) closes the vendor's stream too
+            await _aclose(iterator)
+
+    def report(self) -> dict:
+        return {
+            "max_concurrency": self.settings.max_concurrency,
+            "max_queue": self.settings.max_queue,
+            "rate": self.settings.rate or None,
+            "deadline": self.settings.deadline,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "retries": self.retries,
+            "deadline_exceeded": self.deadline_exceeded,
+        }
+
+
+async def _aclose(iterator):
+    aclose = getattr(iterator, "aclose", None)
+    if aclose is not None:
+        await aclose()
+
+
+class Admission:
+    """The vendor gates of this worker and the per-session rate limit."""
+
+    def __init__(self, redis_client: redis.asyncio.Redis, session_rate: float = 0.0, session_burst: int = 5):
+        self.limiter = RateLimiter(redis_client)
+        self.session_rate = session_rate
+        self.session_burst = session_burst
+        self.gates: Dict[str, VendorGate] = {}
+        self.sessions_rejected = 0
+
+    def gate(self, provider: str, stage: str, **defaults) -> VendorGate:
+        gate = self.gates.get(provider)
+        if gate is None:
+            gate = self.gates[provider] = VendorGate(
+                provider, stage, GateSettings.from_env(provider, **defaults), self.limiter)
+        return gate
+
+    async def check_session(self, key: str):
+        """Charge one turn or request to a session (or client); raises Busy over the limit."""
+        if self.session_rate <= 0:
+            return
+        wait = await self.limiter.take(f"session:{key}", self.session_rate, self.session_burst)
+        if wait:
+            self.sessions_rejected += 1
+            metrics.admission_rejected.inc("session", "rate_limited")
+            raise Busy("session", "rate_limited", wait)
+
+    def report(self) -> dict:
+        return {
+            "session_rate": self.session_rate or None,
+            "session_burst": self.session_burst,
+            "sessions_rejected": self.sessions_rejected,
+            "redis_errors": self.limiter.redis_errors,
+            "vendors": {provider: gate.report() for provider, gate in self.gates.items()},
+        }
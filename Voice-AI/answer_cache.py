@@ -0,0 +1,166 @@
+"""Answer cache for document questions.
+
+With `temperature=0`, the same question over the same documents gets the same
+answer, so answers are stored in Redis under a fingerprint of the session's
+current file set (the content hashes recorded by session_store.py) plus the
+model and instructions. Uploading or deleting a file changes the fingerprint,
+so the answers cached for the old file set are no longer found and expire
+with their TTL. Sessions that upload the same documents share answers.
+
+Within a fingerprint, questions are matched on a normalized form (case,
+punctuation and whitespace folded). Optionally a question that is a near
+duplicate of a cached one, by character trigram similarity, is also a hit.
+Trigrams barely see a one-character difference ("price of plan A" and "price
+of plan B" score about 0.8), so a near duplicate must also have exactly the
+same key tokens: numbers and single letters, which name plans, sections,
+tables and years. Other names that differ ("Acme" and "Apex") are left to the
+threshold, which is why near-duplicate matching is off by default.
+"""
+import hashlib
+import json
+import logging
+import re
+import time
+from dataclasses import dataclass
+from typing import Iterable, List, Optional, Set
+
+import redis
+import redis.asyncio
+
+log = logging.getLogger(__name__)
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+# Dropped rather than spaced, so "what's" does not leave a stray "s" key token
+_APOSTROPHES = re.compile(r"['\u2019]")
+_WHITESPACE = re.compile(r"\s+")
+# Tokens of a normalized query that identify what it asks about: any with a digit, and single letters
+_KEY_TOKEN = re.compile(r"\b(?:\w*\d\w*|\w)\b")
+
+
+def normalize_query(text: str) -> str:
+    text = _APOSTROPHES.sub("", text.lower())
+    return _WHITESPACE.sub(" ", _PUNCTUATION.sub(" ", text)).strip()
+
+
+def trigrams(text: str) -> Set[str]:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def key_tokens(text: str) -> List[str]:
+    return sorted(_KEY_TOKEN.findall(text))
+
+
+def similarity(a: str, b: str) -> float:
+    """Jaccard similarity of the character trigrams of two normalized queries."""
+    grams_a, grams_b = trigrams(a), trigrams(b)
+    if not grams_a or not grams_b:
+        return 0.0
+    return len(grams_a & grams_b) / len(grams_a | grams_b)
+
+
+def file_set_fingerprint(file_hashes: Iterable[str], model: str, instructions: str) -> str:
+    material = json.dumps([sorted(file_hashes), model, instructions])
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class AnswerCacheStats:
+    exact_hits: int = 0
+    near_hits: int = 0
+    misses: int = 0
+    # Latency from the start of the turn's LLM step to having the answer, split by outcome
+    hit_samples: int = 0
+    hit_seconds_total: float = 0.0
+    hit_seconds_max: float = 0.0
+    miss_samples: int = 0
+    miss_seconds_total: float = 0.0
+    miss_seconds_max: float = 0.0
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.exact_hits + self.near_hits + self.misses
+        return (self.exact_hits + self.near_hits) / lookups if lookups else 0.0
+
+
+class AnswerCache:
+    def __init__(self, redis_client: redis.asyncio.Redis, ttl: int = 3600, max_entries: int = 500,
+                 near_duplicate_threshold: float = 0.0, prefix: str = "answers:"):
+        self.redis = redis_client
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # 0 disables near-duplicate matching; otherwise the minimum trigram similarity for a hit
+        self.near_duplicate_threshold = near_duplicate_threshold
+        self.prefix = prefix
+        self.stats = AnswerCacheStats()
+
+    async def get(self, fingerprint: str, query: str) -> Optional[str]:
+        key = self.prefix + fingerprint
+        normalized = normalize_query(query)
+        try:
+            answer = await self.redis.hget(key, normalized)
+            if answer is not None:
+                self.stats.exact_hits += 1
+                return answer
+            if self.near_duplicate_threshold > 0:
+                answer = await self._get_near_duplicate(key, normalized)
+                if answer is not None:
+                    self.stats.near_hits += 1
+                    return answer
+        except redis.RedisError as e:
+            log.warning(f"Answer cache Redis error: {e}")
+        self.stats.misses += 1
+        return None
+
+    async def _get_near_duplicate(self, key: str, normalized: str) -> Optional[str]:
+        best_query, best_score = None, self.near_duplicate_threshold
+        keys = key_tokens(normalized)
+        for cached_query in await self.redis.hkeys(key):
+            # "plan a" is not a near duplicate of "plan b", however similar the rest
+            if key_tokens(cached_query) != keys:
+                continue
+            score = similarity(normalized, cached_query)
+            if score >= best_score:
+                best_query, best_score = cached_query, score
+        if best_query is None:
+            return None
+        return await self.redis.hget(key, best_query)
+
+    async def put(self, fingerprint: str, query: str, answer: str):
+        key = self.prefix + fingerprint
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.hset(key, normalize_query(query), answer)
+                pipe.expire(key, self.ttl)
+                pipe.hlen(key)
+                _, _, entries = await pipe.execute()
+            if entries > self.max_entries:
+                # Keep the per-file-set hash bounded; near-duplicate matching scans it
+                await self.redis.hdel(key, await self.redis.hrandfield(key))
+        except redis.RedisError as e:
+            log.warning(f"Answer cache Redis error: {e}")
+
+    def record(self, hit: bool, started: float):
+        elapsed = time.perf_counter() - started
+        if hit:
+            self.stats.hit_samples += 1
+            self.stats.hit_seconds_total += elapsed
+            self.stats.hit_seconds_max = max(self.stats.hit_seconds_max, elapsed)
+        else:
+            self.stats.miss_samples += 1
+            self.stats.miss_seconds_total += elapsed
+            self.stats.miss_seconds_max = max(self.stats.miss_seconds_max, elapsed)
+
+    def report(self) -> dict:
+        stats = self.stats
+        return {
+            "exact_hits": stats.exact_hits,
+            "near_hits": stats.near_hits,
+            "misses": stats.misses,
+            "hit_ratio": round(stats.hit_ratio, 4),
+            "hit_latency_ms_avg": round(stats.hit_seconds_total / stats.hit_samples * 1000, 3) if stats.hit_samples else 0.0,
+            "hit_latency_ms_max": round(stats.hit_seconds_max * 1000, 3),
+            "miss_latency_ms_avg": round(stats.miss_seconds_total / stats.miss_samples * 1000, 3) if stats.miss_samples else 0.0,
+            "miss_latency_ms_max": round(stats.miss_seconds_max * 1000, 3),
+            "near_duplicate_threshold": self.near_duplicate_threshold,
+        }
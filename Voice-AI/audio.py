@@ -0,0 +1,225 @@
+"""Audio pre-processing ahead of speech-to-text.
+
+A recording is decoded to 16-bit mono PCM, downmixed and resampled to
+`sample_rate`. It then goes through a frame-based voice activity detector
+that combines short-time energy with zero-crossing rate, vectorized with
+NumPy. Leading and trailing silence is trimmed, keeping `pad_ms` around the
+speech, and the result is re-encoded as WAV. A recording without enough
+speech raises NoSpeechError, so the caller can skip the vendor call.
+
+WAV is decoded with the standard library; any other container (webm, ogg,
+mp3, ...) is decoded with ffmpeg when it is on the PATH. Audio that cannot be
+decoded is passed through unchanged. The browser records webm, so ffmpeg is
+needed for pre-processing to do anything on that path; main.py says so at
+startup when it is missing, and /api/status/audio reports it.
+"""
+import asyncio
+import io
+import logging
+import shutil
+import wave
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+FFMPEG = shutil.which("ffmpeg")
+
+
+class NoSpeechError(Exception):
+    pass
+
+
+def pcm_to_wav(pcm: bytes, sample_rate: int) -> bytes:
+    out = io.BytesIO()
+    with wave.open(out, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(pcm)
+    return out.getvalue()
+
+
+def decode_wav(data: bytes) -> Optional[Tuple[np.ndarray, int]]:
+    """Samples as float32 in [-1, 1] with shape (frames, channels), and the sample rate."""
+    try:
+        with wave.open(io.BytesIO(data), "rb") as wav:
+            channels, width, rate = wav.getnchannels(), wav.getsampwidth(), wav.getframerate()
+            frames = wav.readframes(wav.getnframes())
+    except (wave.Error, EOFError):
+        return None
+    if width == 1:
+        samples = (np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif width == 2:
+        samples = np.frombuffer(frames, dtype="<i2").astype(np.float32) / 32768
+    elif width == 4:
+        samples = np.frombuffer(frames, dtype="<i4").astype(np.float32) / 2147483648
+    else:
+        return None
+    return samples[:len(samples) - len(samples) % channels].reshape(-1, channels), rate
+
+
+async def decode_with_ffmpeg(data: bytes, sample_rate: int) -> Optional[np.ndarray]:
+    if FFMPEG is None:
+        return None
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG, "-hide_banner", "-loglevel", "error", "-i", "pipe:0",
+        "-f", "s16le", "-ac", "1", "-ar", str(sample_rate), "pipe:1",
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+    )
+    pcm, error = await process.communicate(data)
+    if process.returncode != 0:
+        log.warning(f"ffmpeg could not decode audio: {error.decode(errors='replace').strip()}")
+        return None
+    return np.frombuffer(pcm, dtype="<i2").astype(np.float32) / 32768
+
+
+def lowpass_kernel(cutoff: float, taps: int = 63) -> np.ndarray:
+    """Windowed-sinc FIR low-pass; cutoff as a fraction of the sample rate."""
+    n = np.arange(taps) - (taps - 1) / 2
+    kernel = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(taps)
+    return (kernel / kernel.sum()).astype(np.float32)
+
+
+def to_mono(samples: np.ndarray, rate: int, sample_rate: int) -> np.ndarray:
+    """Downmix (frames, channels) audio and resample it to sample_rate."""
+    mono = samples.mean(axis=1) if samples.ndim == 2 else samples
+    if rate == sample_rate or len(mono) == 0:
+        return mono.astype(np.float32, copy=False)
+    if rate > sample_rate:
+        # Filter out what the target rate cannot represent before dropping samples
+        mono = np.convolve(mono, lowpass_kernel(0.45 * sample_rate / rate), mode="same")
+    positions = np.arange(int(len(mono) * sample_rate / rate)) * (rate / sample_rate)
+    return np.interp(positions, np.arange(len(mono)), mono).astype(np.float32)
+
+
+@dataclass
+class VADSettings:
+    frame_ms: int = 20
+    # A frame is voiced when its energy is margin_db above the noise floor (the
+    # quietest frames of the recording, but never assumed louder than max_floor_db)
+    margin_db: float = 10.0
+    max_floor_db: float = -45.0
+    min_energy_db: float = -60.0
+    # Unvoiced speech (s, f, sh) is quieter but has a high zero-crossing rate
+    unvoiced_margin_db: float = 8.0
+    unvoiced_zcr: float = 0.25
+    # Smoothing window in frames, minimum total speech, and padding kept around it
+    smoothing_frames: int = 5
+    min_speech_ms: int = 150
+    pad_ms: int = 200
+
+
+def speech_frames(samples: np.ndarray, sample_rate: int, settings: VADSettings) -> np.ndarray:
+    """Boolean speech decision for each frame of mono float samples."""
+    frame_length = sample_rate * settings.frame_ms // 1000
+    count = len(samples) // frame_length
+    if count == 0:
+        return np.zeros(0, dtype=bool)
+    frames = samples[:count * frame_length].reshape(count, frame_length)
+
+    energy_db = 10 * np.log10(np.mean(frames * frames, axis=1) + 1e-10)
+    signs = np.signbit(frames)
+    zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / (frame_length - 1)
+
+    floor = min(np.percentile(energy_db, 10), settings.max_floor_db)
+    threshold = max(floor + settings.margin_db, settings.min_energy_db)
+    voiced = energy_db > threshold
+    unvoiced = (energy_db > threshold - settings.unvoiced_margin_db) & (zcr > settings.unvoiced_zcr)
+    speech = voiced | unvoiced
+
+    # Majority vote over a short window removes clicks and fills short dropouts
+    window = settings.smoothing_frames
+    votes = np.convolve(speech.astype(np.int8), np.ones(window, dtype=np.int8), mode="same")
+    return votes > window // 2
+
+
+@dataclass
+class PreprocessResult:
+    audio: bytes
+    decoded: bool = False
+    input_bytes: int = 0
+    input_ms: float = 0.0
+    output_ms: float = 0.0
+    speech_ms: float = 0.0
+
+
+def speech_span(samples: np.ndarray, sample_rate: int, settings: VADSettings) -> Tuple[int, int, float]:
+    """Start and end sample of the speech in mono float samples (with padding), and the
+    total speech duration in ms; raises NoSpeechError when there is too little speech."""
+    speech = speech_frames(samples, sample_rate, settings)
+    speech_ms = float(np.count_nonzero(speech) * settings.frame_ms)
+    if speech_ms < settings.min_speech_ms:
+        raise NoSpeechError(f"No speech detected ({speech_ms:.0f} ms of voice activity)")
+    frame_length = sample_rate * settings.frame_ms // 1000
+    pad = sample_rate * settings.pad_ms // 1000
+    voiced = np.flatnonzero(speech)
+    start = max(0, voiced[0] * frame_length - pad)
+    end = min(len(samples), (voiced[-1] + 1) * frame_length + pad)
+    return start, end, speech_ms
+
+
+class AudioPreprocessor:
+    def __init__(self, sample_rate: int = 16000, settings: Optional[VADSettings] = None):
+        self.sample_rate = sample_rate
+        self.settings = settings or VADSettings()
+        self.recordings = 0
+        self.rejected = 0
+        self.undecodable = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.input_ms = 0.0
+        self.output_ms = 0.0
+
+    def process_samples(self, samples: np.ndarray, rate: int) -> PreprocessResult:
+        mono = to_mono(samples, rate, self.sample_rate)
+        start, end, speech_ms = speech_span(mono, self.sample_rate, self.settings)
+        trimmed = mono[start:end]
+        pcm = (np.clip(trimmed, -1, 1) * 32767).astype("<i2").tobytes()
+        return PreprocessResult(
+            audio=pcm_to_wav(pcm, self.sample_rate),
+            decoded=True,
+            input_ms=len(mono) * 1000 / self.sample_rate,
+            output_ms=len(trimmed) * 1000 / self.sample_rate,
+            speech_ms=speech_ms,
+        )
+
+    async def process(self, data: bytes) -> PreprocessResult:
+        """Trimmed 16 kHz mono WAV for a recording; raises NoSpeechError for silence."""
+        self.recordings += 1
+        self.input_bytes += len(data)
+        decoded = decode_wav(data)
+        if decoded is not None:
+            samples, rate = decoded
+        else:
+            samples, rate = await decode_with_ffmpeg(data, self.sample_rate), self.sample_rate
+        if samples is None:
+            self.undecodable += 1
+            self.output_bytes += len(data)
+            return PreprocessResult(audio=data, input_bytes=len(data))
+
+        try:
+            # The NumPy work is short but CPU-bound; keep it off the event loop
+            result = await asyncio.to_thread(self.process_samples, samples, rate)
+        except NoSpeechError:
+            self.rejected += 1
+            raise
+        result.input_bytes = len(data)
+        self.output_bytes += len(result.audio)
+        self.input_ms += result.input_ms
+        self.output_ms += result.output_ms
+        return result
+
+    def report(self) -> dict:
+        return {
+            "recordings": self.recordings,
+            "rejected_no_speech": self.rejected,
+            "undecodable": self.undecodable,
+            "input_bytes": self.input_bytes,
+            "output_bytes": self.output_bytes,
+            "input_seconds": round(self.input_ms / 1000, 3),
+            "output_seconds": round(self.output_ms / 1000, 3),
+            "ffmpeg": FFMPEG is not None,
+        }
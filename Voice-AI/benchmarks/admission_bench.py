@@ -0,0 +1,164 @@
+"""Overload: turn latency with and without admission control.
+
+The stub LLM is given a fixed capacity (`--llm-capacity` requests at once;
+more wait, like at a saturated vendor) and `--sessions` /ws sessions send
+text turns back to back for `--duration` seconds, well over that capacity.
+The app runs twice:
+
+- unbounded: every turn is let through (huge OPENAI_MAX_CONCURRENCY and
+  OPENAI_MAX_QUEUE), so all sessions queue at the vendor and every turn slows
+  down together
+- admission: OPENAI_MAX_CONCURRENCY matches the vendor's capacity with a short
+  queue (`--queue`), so the excess is answered `busy` right away and the
+  admitted turns keep their latency
+
+For each it reports turns completed, refused (`busy`) and failed, turns per
+second and the latency percentiles of the completed turns. `--error-rate`
+makes the stub answer that share of vendor requests with a 429, to exercise
+the retries. A last check floods one session with text messages to show the
+per-session rate limit (SESSION_RATE/SESSION_BURST).
+
+Requires a Redis server on localhost:6379 (used by main.py).
+
+    cd Voice-AI && python benchmarks/admission_bench.py --sessions 40 --llm-capacity 4 --duration 15
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+import redis
+import websockets
+
+from load_test import free_port, percentile, start_app, start_stubs, wait_until_up
+from stub_servers import StubConfig
+
+ERROR_ANSWER = "An error occurred while processing your request."
+
+
+async def run_session(ws_url: str, session_id: str, stop_at: float, results: list):
+    async with websockets.connect(ws_url, max_size=None) as ws:
+        while time.monotonic() < stop_at:
+            started = time.perf_counter()
+            await ws.send(json.dumps({"type": "text", "message": "What is latency?", "session_id": session_id}))
+            outcome = None
+            while outcome is None:
+                reply = json.loads(await ws.recv())
+                if reply["type"] == "llm_response" and reply["text"] == ERROR_ANSWER:
+                    outcome = "error"
+                elif reply["type"] == "tts":
+                    outcome = "completed"
+                elif reply["type"] in ("busy", "error"):
+                    outcome = reply["type"]
+            results.append((outcome, time.perf_counter() - started))
+            if outcome == "busy":
+                # A real client would tell the user; here, back off briefly and try again
+                await asyncio.sleep(min(reply["retry_after"], 0.5))
+
+
+async def flood(env: dict, messages: int) -> int:
+    """Send `messages` text turns at once on one session; returns how many were refused."""
+    port = free_port()
+    app = start_app(port, env)
+    refused = 0
+    try:
+        await wait_until_up(f"http://127.0.0.1:{port}")
+        async with websockets.connect(f"ws://127.0.0.1:{port}/ws", max_size=None) as ws:
+            for _ in range(messages):
+                await ws.send(json.dumps({"type": "text", "message": "Hi", "session_id": "bench-flood"}))
+            # Admitted turns cancel each other (barge-in); refused ones are answered with busy
+            try:
+                while True:
+                    reply = json.loads(await asyncio.wait_for(ws.recv(), 2))
+                    if reply["type"] == "busy" and reply["scope"] == "session":
+                        refused += 1
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        app.terminate()
+        app.wait()
+    return refused
+
+
+async def run_config(name: str, env: dict, args) -> dict:
+    port = free_port()
+    app = start_app(port, env)
+    base_url = f"http://127.0.0.1:{port}"
+    ws_url = f"ws://127.0.0.1:{port}/ws"
+    try:
+        await wait_until_up(base_url)
+        results = []
+        stop_at = time.monotonic() + args.duration
+        started = time.perf_counter()
+        await asyncio.gather(*(run_session(ws_url, f"bench-{i}", stop_at, results) for i in range(args.sessions)))
+        elapsed = time.perf_counter() - started
+        async with httpx.AsyncClient() as http:
+            status = (await http.get(f"{base_url}/api/status/admission")).json()
+    finally:
+        app.terminate()
+        app.wait()
+
+    latencies = [latency for outcome, latency in results if outcome == "completed"]
+    counts = {outcome: sum(1 for o, _ in results if o == outcome) for outcome in ("completed", "busy", "error")}
+    print(f"{name:>10} {counts['completed']:>9} {counts['busy']:>6} {counts['error']:>6} "
+          f"{counts['completed'] / elapsed:>7.1f} "
+          + " ".join(f"{percentile(latencies, pct) * 1000:>7.0f}ms" for pct in (50, 95, 99)))
+    return status
+
+
+async def main(args):
+    config = StubConfig(stt_latency=0.02, llm_latency=args.llm_latency, llm_token_interval=0.005,
+                        tts_latency=0.02, tts_char_latency=0, llm_capacity=args.llm_capacity,
+                        error_rate=args.error_rate)
+    stub, env = start_stubs(config)
+    store = redis.Redis(host="localhost", port=6379)
+    for i in range(args.sessions):
+        store.hset(f"session:bench-{i}", "vector_store_id", "vs_bench")
+        store.expire(f"session:bench-{i}", 3600)
+    store.hset("session:bench-flood", "vector_store_id", "vs_bench")
+
+    # Every turn should reach the LLM; the session rate limit is only exercised by the flood check
+    base_env = {**env, "ANSWER_CACHE": "0", "TTS_CACHE_MAX_BYTES": "0", "TTS_CACHE_REDIS": "0",
+                "SESSION_RATE": "0", "VENDOR_RETRIES": str(args.retries)}
+    configs = {
+        "unbounded": {**base_env, "OPENAI_MAX_CONCURRENCY": "10000", "OPENAI_MAX_QUEUE": "10000",
+                      "OPENAI_QUEUE_TIMEOUT": "600"},
+        "admission": {**base_env, "OPENAI_MAX_CONCURRENCY": str(args.llm_capacity),
+                      "OPENAI_MAX_QUEUE": str(args.queue), "OPENAI_QUEUE_TIMEOUT": str(args.queue_timeout)},
+    }
+
+    print(f"sessions={args.sessions} llm_capacity={args.llm_capacity} llm_latency={args.llm_latency}s "
+          f"duration={args.duration}s error_rate={args.error_rate}")
+    print(f"{'config':>10} {'completed':>9} {'busy':>6} {'failed':>6} {'turns/s':>7} "
+          f"{'p50':>9} {'p95':>9} {'p99':>9}")
+    reports = {}
+    try:
+        for name, app_env in configs.items():
+            reports[name] = await run_config(name, app_env, args)
+        refused = await flood({**base_env, "SESSION_RATE": "1", "SESSION_BURST": "5"}, args.flood)
+        async with httpx.AsyncClient() as http:
+            stub_stats = (await http.get(f"{env['ASSEMBLYAI_BASE_URL']}/stub/stats")).json()
+    finally:
+        stub.terminate()
+        stub.wait()
+
+    for name, status in reports.items():
+        print(f"--- {name} /api/status/admission: {json.dumps(status['vendors'].get('openai'))}")
+    print(f"flood: {args.flood} turns sent at once on one session (SESSION_RATE=1, SESSION_BURST=5): "
+          f"{args.flood - refused} admitted, {refused} refused")
+    print(f"stub: {json.dumps(stub_stats)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark admission control under overload")
+    parser.add_argument("--sessions", type=int, default=40)
+    parser.add_argument("--duration", type=float, default=15)
+    parser.add_argument("--llm-capacity", type=int, default=4)
+    parser.add_argument("--llm-latency", type=float, default=0.3)
+    parser.add_argument("--queue", type=int, default=4, help="OPENAI_MAX_QUEUE with admission control")
+    parser.add_argument("--queue-timeout", type=float, default=1.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--retries", type=int, default=2)
+    parser.add_argument("--flood", type=int, default=20)
+    asyncio.run(main(parser.parse_args()))
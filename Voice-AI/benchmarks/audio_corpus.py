@@ -0,0 +1,151 @@
+"""Synthetic test corpus for the VAD and silence trimming in audio.py.
+
+Generates labelled clips without needing recorded speech. The speech-like
+signal is voiced syllables (a glottal pulse train with a wandering pitch,
+shaped by vowel formants, with a syllable-rate envelope) mixed with unvoiced
+fricative bursts. The corpus also has the cases that must be rejected:
+digital silence, hiss, hum and clicks. Clips are rendered at several sample
+rates and channel counts, placed inside leading and trailing silence or
+noise, and returned as WAV bytes with the true speech span.
+
+    cd Voice-AI && python benchmarks/audio_corpus.py --out /tmp/vad-corpus
+"""
+import argparse
+import io
+import os
+import wave
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+VOWELS = [(730, 1090, 2440), (270, 2290, 3010), (300, 870, 2240), (530, 1840, 2480), (640, 1190, 2390)]
+
+
+@dataclass
+class Clip:
+    name: str
+    wav: bytes
+    sample_rate: int
+    channels: int
+    duration: float
+    # True speech span in seconds, or None for clips without speech
+    speech: Optional[Tuple[float, float]]
+
+
+def db_to_amplitude(db: float) -> float:
+    return 10 ** (db / 20)
+
+
+def voiced_syllable(rng, rate: int, duration: float) -> np.ndarray:
+    n = int(rate * duration)
+    t = np.arange(n) / rate
+    f0 = rng.uniform(90, 220) * (1 + 0.08 * np.sin(2 * np.pi * rng.uniform(2, 5) * t))
+    phase = 2 * np.pi * np.cumsum(f0) / rate
+    formants = VOWELS[rng.integers(len(VOWELS))]
+    signal = np.zeros(n)
+    for harmonic in range(1, 30):
+        frequency = f0 * harmonic
+        # Harmonics near a formant are loud, the others fall off with frequency
+        gain = sum(1 / (1 + ((frequency - f) / 90) ** 2) for f in formants) / harmonic ** 0.7
+        signal += np.where(frequency < rate / 2, gain, 0) * np.sin(harmonic * phase)
+    envelope = np.sin(np.pi * np.arange(n) / n) ** 0.6
+    return signal * envelope / (np.max(np.abs(signal)) + 1e-9)
+
+
+def fricative(rng, rate: int, duration: float) -> np.ndarray:
+    n = int(rate * duration)
+    noise = rng.standard_normal(n)
+    # First difference is a cheap high-pass: fricatives are mostly above 3 kHz
+    hissy = np.diff(noise, prepend=0)
+    return hissy * np.hanning(n) / (np.max(np.abs(hissy)) + 1e-9)
+
+
+def utterance(rng, rate: int, duration: float, level_db: float) -> np.ndarray:
+    parts = []
+    total = 0
+    while total < int(rate * duration):
+        if rng.random() < 0.25:
+            part = 0.5 * fricative(rng, rate, rng.uniform(0.06, 0.15))
+        else:
+            part = voiced_syllable(rng, rate, rng.uniform(0.12, 0.3))
+        parts.append(part)
+        # Short pauses between syllables, occasionally a longer one between words
+        parts.append(np.zeros(int(rate * (rng.uniform(0.2, 0.4) if rng.random() < 0.15 else rng.uniform(0.0, 0.05)))))
+        total += sum(len(p) for p in parts[-2:])
+    # Start and end on sound so the labelled span is exactly the speech
+    speech = np.trim_zeros(np.concatenate(parts)[:int(rate * duration)])
+    return speech * db_to_amplitude(level_db) / (np.sqrt(np.mean(speech ** 2)) + 1e-9)
+
+
+def background(rng, rate: int, n: int, kind: str, level_db: float) -> np.ndarray:
+    if kind == "silence":
+        return np.zeros(n)
+    if kind == "hiss":
+        noise = rng.standard_normal(n)
+    elif kind == "room":
+        # Brownish noise: integrated white noise, mostly low frequencies
+        noise = np.cumsum(rng.standard_normal(n))
+        noise -= np.convolve(noise, np.ones(rate // 50) / (rate // 50), mode="same")
+    elif kind == "hum":
+        t = np.arange(n) / rate
+        noise = sum(np.sin(2 * np.pi * 50 * k * t) / k for k in (1, 2, 3))
+    elif kind == "clicks":
+        noise = np.zeros(n)
+        noise[rng.integers(0, n, size=max(1, n // rate * 3))] = 1.0
+        return noise * db_to_amplitude(level_db + 20)
+    else:
+        raise ValueError(kind)
+    return noise * db_to_amplitude(level_db) / (np.sqrt(np.mean(noise ** 2)) + 1e-9)
+
+
+def to_wav(samples: np.ndarray, rate: int, channels: int) -> bytes:
+    pcm = (np.clip(samples, -1, 1) * 32767).astype("<i2")
+    if channels > 1:
+        pcm = np.repeat(pcm[:, None], channels, axis=1)
+    out = io.BytesIO()
+    with wave.open(out, "wb") as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(pcm.tobytes())
+    return out.getvalue()
+
+
+def build_corpus(seed: int = 7) -> List[Clip]:
+    rng = np.random.default_rng(seed)
+    clips = []
+    formats = [(16000, 1), (44100, 1), (48000, 2)]
+    for rate, channels in formats:
+        # Recordings that must be rejected
+        for kind, level in (("silence", 0), ("hiss", -60), ("hiss", -45), ("room", -50), ("hum", -40), ("clicks", -60)):
+            duration = 3.0
+            samples = background(rng, rate, int(rate * duration), kind, level)
+            clips.append(Clip(f"{kind}{level}_{rate}x{channels}", to_wav(samples, rate, channels),
+                              rate, channels, duration, None))
+        # Speech inside silence or noise, at several levels and signal-to-noise ratios
+        for kind, noise_db, speech_db in (("silence", 0, -20), ("silence", 0, -35), ("hiss", -55, -25),
+                                          ("room", -50, -25), ("hum", -45, -25), ("hiss", -40, -22)):
+            lead, speech_seconds, tail = rng.uniform(0.5, 2.0), rng.uniform(1.0, 4.0), rng.uniform(0.5, 2.0)
+            duration = lead + speech_seconds + tail
+            samples = background(rng, rate, int(rate * duration), kind, noise_db)
+            speech = utterance(rng, rate, speech_seconds, speech_db)
+            start = int(rate * lead)
+            samples[start:start + len(speech)] += speech
+            clips.append(Clip(f"speech{speech_db}_{kind}{noise_db}_{rate}x{channels}",
+                              to_wav(samples, rate, channels), rate, channels, duration,
+                              (lead, lead + len(speech) / rate)))
+    return clips
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write the synthetic VAD corpus as WAV files")
+    parser.add_argument("--out", required=True)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+    os.makedirs(args.out, exist_ok=True)
+    for clip in build_corpus(args.seed):
+        with open(os.path.join(args.out, f"{clip.name}.wav"), "wb") as out:
+            out.write(clip.wav)
+        span = f"{clip.speech[0]:.2f}-{clip.speech[1]:.2f}s" if clip.speech else "no speech"
+        print(f"{clip.name:<40} {clip.duration:5.2f}s  {span}")
@@ -0,0 +1,124 @@
+"""Barge-in: how fast a reply stops, and how much work the cancellation saves.
+
+Runs streamed text turns over /ws against the stub vendor server. Each turn
+is interrupted once its first audio segment has arrived, either with an
+explicit `interrupt` message or by sending the next text message (the user
+talking over the reply), after a few complete turns that give the app its
+average answer length. It reports how long the server took to confirm the
+cancellation (`turn_cancelled`), checks that no audio of the interrupted turn
+arrives after that, and prints the app's /api/status/turns next to what the
+stub actually did (/stub/stats): LLM streams it was able to abandon and TTS
+requests it was asked for.
+
+Requires a Redis server on localhost:6379 (used by main.py).
+
+    cd Voice-AI && python benchmarks/barge_in_bench.py --turns 20 --mode interrupt
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+import redis
+import websockets
+
+from load_test import free_port, percentile, start_app, start_stubs, wait_until_up
+from stub_servers import StubConfig
+
+SESSION_ID = "bench-barge-in"
+
+
+def text_turn() -> str:
+    return json.dumps({"type": "text", "message": "What is latency?", "session_id": SESSION_ID, "stream": True})
+
+
+async def run_turns(ws_url: str, turns: int, mode: str, warmup: int):
+    confirm_ms, stale_audio, uninterrupted = [], 0, 0
+    async with websockets.connect(ws_url, max_size=None) as ws:
+        # A few complete replies first, so the app knows how long an answer usually is
+        for _ in range(warmup):
+            await ws.send(text_turn())
+            while json.loads(await ws.recv())["type"] not in ("tts_end", "error"):
+                pass
+        await ws.send(text_turn())
+        for i in range(turns):
+            # Wait for the turn to start speaking
+            turn_id = None
+            while True:
+                reply = json.loads(await ws.recv())
+                if reply["type"] == "turn_start":
+                    turn_id = reply["turn_id"]
+                if reply["type"] == "tts_chunk" and reply.get("turn_id") == turn_id:
+                    break
+                if reply["type"] == "tts_end" and reply.get("turn_id") == turn_id:
+                    uninterrupted += 1
+                    break
+
+            last = i == turns - 1
+            interrupted_at = time.perf_counter()
+            await ws.send(json.dumps({"type": "interrupt"}) if mode == "interrupt" or last else text_turn())
+            while True:
+                reply = json.loads(await ws.recv())
+                if reply["type"] == "turn_cancelled" and reply["turn_id"] == turn_id:
+                    confirm_ms.append((time.perf_counter() - interrupted_at) * 1000)
+                    break
+                if reply["type"] == "tts_end" and reply.get("turn_id") == turn_id:
+                    # Finished before the interrupt got there
+                    break
+            if mode == "interrupt" and not last:
+                await ws.send(text_turn())
+
+        # Anything the interrupted turns still send now would be stale audio
+        try:
+            while True:
+                reply = json.loads(await asyncio.wait_for(ws.recv(), 1.0))
+                if reply["type"] in ("tts", "tts_chunk"):
+                    stale_audio += 1
+        except asyncio.TimeoutError:
+            pass
+    return confirm_ms, stale_audio, uninterrupted
+
+
+async def main(args):
+    config = StubConfig(llm_latency=args.llm_latency, llm_token_interval=args.token_interval,
+                        tts_latency=args.tts_latency, tts_char_latency=args.tts_char_latency)
+    stub, env = start_stubs(config)
+    redis.Redis(host="localhost", port=6379).hset(f"session:{SESSION_ID}", "vector_store_id", "vs_bench")
+
+    port = free_port()
+    # Keep the answer cache out of the way: every turn should reach the stub LLM
+    app = start_app(port, {**env, "ANSWER_CACHE": "0", "TTS_CACHE_MAX_BYTES": "0", "TTS_CACHE_REDIS": "0"})
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        await wait_until_up(base_url)
+        confirm_ms, stale_audio, uninterrupted = await run_turns(f"ws://127.0.0.1:{port}/ws", args.turns, args.mode,
+                                                                 args.warmup)
+        async with httpx.AsyncClient() as http:
+            turn_status = (await http.get(f"{base_url}/api/status/turns")).json()
+            stub_stats = (await http.get(f"{env['ASSEMBLYAI_BASE_URL']}/stub/stats")).json()
+
+        print(f"--- {args.turns} turns interrupted by {args.mode!r}, after {args.warmup} complete one(s)")
+        if confirm_ms:
+            print(f"cancel confirmed        p50 {percentile(confirm_ms, 50):>7.1f}ms "
+                  f"p95 {percentile(confirm_ms, 95):>7.1f}ms  max {max(confirm_ms):.1f}ms")
+        print(f"finished before cancel  {uninterrupted}")
+        print(f"stale audio messages    {stale_audio}")
+        print(f"app  /api/status/turns  {json.dumps(turn_status)}")
+        print(f"stub /stub/stats        {json.dumps(stub_stats)}")
+    finally:
+        for process in (app, stub):
+            process.terminate()
+            process.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark barge-in cancellation")
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--mode", choices=("interrupt", "text"), default="interrupt")
+    parser.add_argument("--warmup", type=int, default=2, help="complete turns before the interrupted ones")
+    parser.add_argument("--llm-latency", type=float, default=StubConfig.llm_latency)
+    parser.add_argument("--token-interval", type=float, default=StubConfig.llm_token_interval)
+    parser.add_argument("--tts-latency", type=float, default=StubConfig.tts_latency)
+    parser.add_argument("--tts-char-latency", type=float, default=StubConfig.tts_char_latency)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,156 @@
+"""Reply audio per format: bytes on the wire and time to the first playable audio.
+
+Asks the same streamed question over /ws once per client setup, against the
+stub vendor servers with the ElevenLabs stub streaming its audio as it is
+synthesized (see stub_servers.py):
+
+- json mp3: a client without binary frames, which gets the default
+  mp3_44100_128 sentence by sentence as base64 JSON (as before negotiation)
+- mp3, pcm_16000, opus_48000_32: binary clients that ask for that format;
+  pcm and opus come in frames sized to the client's link (see delivery.py)
+
+The client emulates a link of `--link-kbit` (0: unlimited): a frame arrives
+once the frames before it and its own bytes have gone through, and is
+acknowledged then. Per setup it reports the WebSocket payload bytes per turn,
+audio bytes per second of speech, the time from sending the question to the
+first audio the client can play (a whole sentence for mp3, the first frame
+for pcm and opus), and the frame count and size.
+
+Requires a Redis server on localhost:6379 (used by main.py).
+
+    cd Voice-AI && python benchmarks/delivery_bench.py --turns 10 --link-kbit 0,512
+"""
+import argparse
+import asyncio
+import base64
+import json
+import time
+
+import httpx
+import redis
+import websockets
+
+from load_test import free_port, percentile, start_app, start_stubs, wait_until_up
+from stub_servers import StubConfig
+
+SESSION_ID = "bench-delivery"
+SETUPS = [
+    ("json mp3", ""),
+    ("mp3", "protocol=1&formats=mp3_44100_128"),
+    ("pcm_16000", "protocol=1&formats=pcm_16000"),
+    ("opus_48000_32", "protocol=1&formats=opus_48000_32"),
+]
+# Header bytes of a binary frame ahead of the session id (see protocol.py)
+FRAME_HEADER = 8
+
+
+class Link:
+    """A client link of `kbit` kbit/s: when each received message has fully arrived."""
+
+    def __init__(self, kbit: float):
+        self.bytes_per_second = kbit * 1000 / 8
+        self.free_at = 0.0
+
+    async def arrive(self, size: int) -> float:
+        now = time.perf_counter()
+        if not self.bytes_per_second:
+            return now
+        self.free_at = max(self.free_at, now) + size / self.bytes_per_second
+        await asyncio.sleep(max(0.0, self.free_at - now))
+        return self.free_at
+
+
+async def run_turn(ws, link: Link):
+    wire = audio = frames = 0
+    first_audio = None
+    turn_id = None
+    started = time.perf_counter()
+    await ws.send(json.dumps({"type": "text", "message": "What does the document say about latency?",
+                              "session_id": SESSION_ID, "stream": True}))
+    while True:
+        message = await ws.recv()
+        wire += len(message)
+        arrived = await link.arrive(len(message))
+        if isinstance(message, bytes):
+            frames += 1
+            audio += len(message) - FRAME_HEADER - message[3]
+            seq = int.from_bytes(message[4:8], "big")
+            await ws.send(json.dumps({"type": "audio_ack", "turn_id": turn_id, "seq": seq}))
+            if first_audio is None:
+                first_audio = arrived - started
+            continue
+        reply = json.loads(message)
+        if reply["type"] == "turn_start":
+            turn_id = reply["turn_id"]
+        elif reply["type"] == "tts_chunk":
+            frames += 1
+            audio += len(base64.b64decode(reply["audio_data"]))
+            if first_audio is None:
+                first_audio = arrived - started
+        elif reply["type"] in ("tts_end", "error"):
+            return wire, audio, frames, first_audio, reply
+
+
+async def run_setup(base_url: str, name: str, query: str, kbit: float, args):
+    wires, audios, frame_counts, firsts = [], [], [], []
+    async with websockets.connect(f"{base_url.replace('http', 'ws')}/ws?{query}", max_size=None) as ws:
+        for _ in range(args.turns):
+            wire, audio, frames, first_audio, reply = await run_turn(ws, Link(kbit))
+            if reply["type"] == "error" or first_audio is None:
+                print(f"turn failed: {reply}")
+                continue
+            wires.append(wire)
+            audios.append(audio)
+            frame_counts.append(frames)
+            firsts.append(first_audio)
+    if not wires:
+        return
+    seconds = args.speech_seconds
+    print(f"{name:<14} {percentile(wires, 50) / 1024:>8.1f}KB {percentile(audios, 50) / seconds / 1024:>8.1f}KB/s "
+          f"{percentile(firsts, 50) * 1000:>8.0f}ms {percentile(firsts, 95) * 1000:>8.0f}ms "
+          f"{percentile(frame_counts, 50):>7.0f} {percentile(audios, 50) / percentile(frame_counts, 50):>9.0f}B")
+
+
+async def main(args):
+    config = StubConfig(llm_latency=args.llm_latency, tts_latency=args.tts_latency,
+                        tts_char_latency=args.tts_char_latency, tts_stream=True)
+    # Three sentences of stub audio per reply, each as long as audio_bytes of 128 kbit/s MP3
+    args.speech_seconds = 3 * config.audio_bytes / (128000 / 8)
+    stub, env = start_stubs(config)
+    redis.Redis(host="localhost", port=6379).hset(f"session:{SESSION_ID}", "vector_store_id", "vs_bench")
+    port = free_port()
+    app = start_app(port, {
+        **env,
+        # Every turn should reach the stub vendors
+        "ANSWER_CACHE": "0", "TTS_CACHE_MAX_BYTES": "0", "TTS_CACHE_REDIS": "0", "SESSION_RATE": "0",
+        "AUDIO_FRAME_MIN_MS": str(args.min_ms), "AUDIO_FRAME_MAX_MS": str(args.max_ms),
+    })
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        await wait_until_up(base_url)
+        for kbit in [float(value) for value in args.link_kbit.split(",")]:
+            print(f"--- {args.turns} turns, link {'unlimited' if not kbit else f'{kbit:.0f} kbit/s'}, "
+                  f"{args.speech_seconds:.1f}s of speech per reply")
+            print(f"{'client':<14} {'wire/turn':>10} {'audio rate':>10} {'first p50':>10} {'first p95':>10} "
+                  f"{'frames':>7} {'frame size':>10}")
+            for name, query in SETUPS:
+                await run_setup(base_url, name, query, kbit, args)
+        async with httpx.AsyncClient() as http:
+            print(json.dumps((await http.get(f"{base_url}/api/status/delivery")).json()))
+    finally:
+        app.terminate()
+        app.wait()
+        stub.terminate()
+        stub.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark reply audio formats and adaptive framing")
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--link-kbit", default="0,512", help="emulated client links, 0 for unlimited")
+    parser.add_argument("--min-ms", type=int, default=60, help="AUDIO_FRAME_MIN_MS")
+    parser.add_argument("--max-ms", type=int, default=1000, help="AUDIO_FRAME_MAX_MS")
+    parser.add_argument("--llm-latency", type=float, default=StubConfig.llm_latency)
+    parser.add_argument("--tts-latency", type=float, default=StubConfig.tts_latency)
+    parser.add_argument("--tts-char-latency", type=float, default=0.01)
+    asyncio.run(main(parser.parse_args()))
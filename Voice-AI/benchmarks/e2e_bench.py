@@ -0,0 +1,370 @@
+"""End to end: per-stage latency, time to first audio, throughput and memory per session.
+
+Starts the stub vendor servers (see stub_servers.py; `--jitter` and
+`--error-rate` make them vary and fail like real vendors) and the app, and
+drives both of its faces at once:
+
+- `--sessions` /ws sessions of `--turns` streamed turns each, spread over
+  text turns, whole-recording audio turns and audio streamed as it is spoken.
+  The recordings are a synthetic speech-like utterance (audio_corpus.py), so
+  the VAD and resampling in audio.py do their real work.
+- `--rest-clients` clients calling /api/transcribe, /api/llm and /api/tts in
+  turn, `--rest-requests` requests each.
+
+The per-stage numbers come from the app's own traces of the /ws turns
+(/api/status/traces, with TRACE_HISTORY raised to hold the whole run): the
+p50/p95/p99 of every stage, the first byte of the LLM and TTS streams, time
+to first audio and the whole turn. Two rows take the vendors out:
+
+- app: the part of each turn during which no vendor call (STT, LLM, TTS) was
+  in flight: queueing, session load, retrieval, audio processing, framing
+  and everything in between
+- app to first audio: the same, up to the first audio sent
+
+Those are the rows that move when the app's own overhead regresses, whatever
+the vendor latency and jitter. The client side adds turn latency and time to
+first audio per kind of turn (streamed audio timed from `audio_end`), REST
+latency per endpoint and the throughput of both.
+
+Memory is the RSS of the app process (from /proc, Linux only): idle after a
+warm-up turn, the peak during the run, and with every session still
+connected after its turns; the last, less idle, over the session count is
+the memory per session.
+
+`--save FILE` keeps the results as JSON; `--compare FILE` prints them next to
+a saved run and exits with 1 when the app rows' p95 or the memory per session
+grew by more than `--tolerance`.
+
+Requires a Redis server on localhost:6379 (used by main.py).
+
+    cd Voice-AI && python benchmarks/e2e_bench.py --sessions 20 --turns 5 --jitter 0.3 --save /tmp/e2e.json
+"""
+import argparse
+import asyncio
+import base64
+import json
+import sys
+import time
+from typing import Optional
+
+import httpx
+import numpy as np
+import redis
+import websockets
+
+from audio_corpus import to_wav, utterance
+from load_test import free_port, percentile, start_app, start_stubs, wait_until_up
+from stub_servers import StubConfig
+
+SESSION_PREFIX = "e2e-"
+MODES = ("text", "audio", "audio-stream")
+# Stages that are a call to a vendor (or, with the in-process providers, the model itself)
+VENDOR_STAGES = {"stt_upload", "stt_poll", "stt_local", "stt_stream_connect", "stt_stream_finish", "llm", "tts"}
+FRAME_SECONDS = 0.1
+# Regression checks of --compare: (section, row, value, smallest change that counts)
+CHECKS = [
+    ("stages", "app", "p95", 5.0),
+    ("stages", "app to first audio", "p95", 5.0),
+    ("memory", "per session", "kb", 64.0),
+]
+
+
+def rss_kb(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def speech_pcm(seconds: float) -> bytes:
+    samples = utterance(np.random.default_rng(11), 16000, seconds, level_db=-20)
+    return (np.clip(samples, -1, 1) * 32767).astype("<i2").tobytes()
+
+
+def vendor_ms(spans: list, until: Optional[float] = None) -> float:
+    """Milliseconds during which at least one vendor call was in flight (up to `until`)."""
+    intervals = sorted((span["start_ms"], span["start_ms"] + span["duration_ms"])
+                       for span in spans if span["stage"] in VENDOR_STAGES)
+    covered, reach = 0.0, float("-inf")
+    for start, stop in intervals:
+        if until is not None:
+            stop = min(stop, until)
+        if stop <= max(start, reach):
+            continue
+        covered += stop - max(start, reach)
+        reach = stop
+    return covered
+
+
+def summarize(values: list) -> dict:
+    return {"n": len(values), **{f"p{pct}": round(percentile(values, pct), 1) for pct in (50, 95, 99)}}
+
+
+def stage_rows(traces: list) -> dict:
+    samples = {}
+
+    def add(name, value):
+        samples.setdefault(name, []).append(value)
+
+    for trace in traces:
+        for span in trace["spans"]:
+            add(span["stage"], span["duration_ms"])
+            if "first_byte_ms" in span:
+                add(f"{span['stage']} first byte", span["first_byte_ms"])
+        if trace["outcome"] != "completed":
+            continue
+        add("app", trace["total_ms"] - vendor_ms(trace["spans"]))
+        first_audio = trace.get("time_to_first_audio_ms")
+        if first_audio is not None:
+            add("app to first audio", first_audio - vendor_ms(trace["spans"], until=first_audio))
+            add("first audio", first_audio)
+        add("turn", trace["total_ms"])
+    return {name: summarize(values) for name, values in samples.items()}
+
+
+class Run:
+    """What the clients measured, in milliseconds."""
+
+    def __init__(self, sessions: int):
+        self.turns = {mode: [] for mode in MODES}
+        self.first_audio = {mode: [] for mode in MODES}
+        self.rest = {}
+        self.rest_errors = 0
+        self.turn_errors = 0
+        self.sessions_left = sessions
+        self.all_turned = asyncio.Event()
+        self.release = asyncio.Event()
+
+
+async def run_turn(ws, session_id: str, mode: str, wav: bytes, pcm: bytes, run: Run):
+    if mode == "audio-stream":
+        await ws.send(json.dumps({"type": "audio_start", "session_id": session_id}))
+        chunk_bytes = int(32000 * FRAME_SECONDS)
+        paced = time.perf_counter()
+        for index, offset in enumerate(range(0, len(pcm), chunk_bytes)):
+            chunk = base64.b64encode(pcm[offset:offset + chunk_bytes]).decode()
+            await ws.send(json.dumps({"type": "audio_chunk", "audio_data": chunk}))
+            # Paced like a microphone
+            await asyncio.sleep(max(0.0, paced + (index + 1) * FRAME_SECONDS - time.perf_counter()))
+        message = {"type": "audio_end", "session_id": session_id, "stream": True}
+    elif mode == "audio":
+        message = {"type": "audio", "audio_data": base64.b64encode(wav).decode(),
+                   "session_id": session_id, "stream": True}
+    else:
+        message = {"type": "text", "message": "What does the document say about latency?",
+                   "session_id": session_id, "stream": True}
+    started = time.perf_counter()
+    await ws.send(json.dumps(message))
+    first_audio = None
+    while True:
+        reply = json.loads(await ws.recv())
+        if reply["type"] in ("tts_chunk", "tts") and first_audio is None:
+            first_audio = time.perf_counter() - started
+        if reply["type"] in ("tts", "tts_end", "error", "no_speech"):
+            break
+    if reply["type"] in ("error", "no_speech") or first_audio is None:
+        run.turn_errors += 1
+        return
+    run.turns[mode].append((time.perf_counter() - started) * 1000)
+    run.first_audio[mode].append(first_audio * 1000)
+
+
+async def run_session(ws_url: str, index: int, args, wav: bytes, pcm: bytes, run: Run):
+    session_id = f"{SESSION_PREFIX}{index}"
+    mode = MODES[index % len(MODES)]
+    async with websockets.connect(ws_url, max_size=None) as ws:
+        for _ in range(args.turns):
+            await run_turn(ws, session_id, mode, wav, pcm, run)
+        # Stay connected until every session is done, for the memory sample
+        run.sessions_left -= 1
+        if not run.sessions_left:
+            run.all_turned.set()
+        await run.release.wait()
+
+
+async def run_rest_client(http: httpx.AsyncClient, base_url: str, index: int, args, wav: bytes, run: Run):
+    requests = [
+        ("/api/transcribe", {"audio_data": base64.b64encode(wav).decode()}),
+        ("/api/llm", {"message": "What does the document say about latency?",
+                      "session_id": f"{SESSION_PREFIX}rest-{index}"}),
+        ("/api/tts", {"text": "Streaming the output shortens the time until the first result arrives."}),
+    ]
+    for number in range(args.rest_requests):
+        path, body = requests[(index + number) % len(requests)]
+        started = time.perf_counter()
+        response = await http.post(f"{base_url}{path}", json=body, timeout=60)
+        if response.status_code != 200:
+            run.rest_errors += 1
+            continue
+        run.rest.setdefault(path, []).append((time.perf_counter() - started) * 1000)
+
+
+async def sample_rss(pid: int, stop: asyncio.Event, peak: list):
+    while not stop.is_set():
+        peak[0] = max(peak[0], rss_kb(pid))
+        await asyncio.sleep(0.1)
+
+
+async def measure(base_url: str, pid: int, args) -> dict:
+    ws_url = base_url.replace("http", "ws", 1) + "/ws"
+    wav = to_wav(utterance(np.random.default_rng(7), 16000, args.speech, level_db=-20), 16000, 1)
+    pcm = speech_pcm(args.speech)
+    run = Run(args.sessions)
+    async with httpx.AsyncClient() as http:
+        # One turn first, so lazy imports and connection pools are not charged to the run
+        async with websockets.connect(ws_url, max_size=None) as ws:
+            await run_turn(ws, f"{SESSION_PREFIX}warmup", "text", wav, pcm, Run(1))
+        idle = rss_kb(pid)
+        peak = [idle]
+        stop = asyncio.Event()
+        sampler = asyncio.create_task(sample_rss(pid, stop, peak))
+        started = time.perf_counter()
+        sessions = asyncio.gather(*(run_session(ws_url, i, args, wav, pcm, run) for i in range(args.sessions)))
+        rest = asyncio.gather(*(run_rest_client(http, base_url, i, args, wav, run) for i in range(args.rest_clients)))
+        await run.all_turned.wait()
+        turns_elapsed = time.perf_counter() - started
+        connected = rss_kb(pid)
+        run.release.set()
+        await sessions
+        await rest
+        rest_elapsed = time.perf_counter() - started
+        stop.set()
+        await sampler
+        traces = (await http.get(f"{base_url}/api/status/traces")).json()["traces"]
+
+    traces = [trace for trace in traces if trace["session_id"].startswith(SESSION_PREFIX)
+              and trace["session_id"] != f"{SESSION_PREFIX}warmup"]
+    turn_count = sum(len(values) for values in run.turns.values())
+    rest_count = sum(len(values) for values in run.rest.values())
+    return {
+        "stages": stage_rows(traces),
+        "client": {
+            **{f"{mode} turn": summarize(values) for mode, values in run.turns.items() if values},
+            **{f"{mode} first audio": summarize(values) for mode, values in run.first_audio.items() if values},
+            **{f"REST {path}": summarize(values) for path, values in run.rest.items()},
+        },
+        "throughput": {
+            "turns_per_second": round(turn_count / turns_elapsed, 2),
+            "rest_per_second": round(rest_count / rest_elapsed, 2),
+            "turn_errors": run.turn_errors,
+            "rest_errors": run.rest_errors,
+        },
+        "memory": {
+            "idle": {"kb": idle},
+            "peak": {"kb": peak[0]},
+            "connected": {"kb": connected},
+            "per session": {"kb": round((connected - idle) / args.sessions, 1)},
+        },
+    }
+
+
+def print_results(results: dict, baseline: Optional[dict] = None):
+    def against(section, row, key, value):
+        if baseline is None:
+            return ""
+        before = baseline.get(section, {}).get(row, {}).get(key)
+        if before is None:
+            return f"{'(new)':>18}"
+        change = f"{(value - before) / before * 100:+.0f}%" if before else ""
+        return f"{before:>10.1f} {change:>7}"
+
+    for section, title in (("stages", "stage (server traces, ms)"), ("client", "client (ms)")):
+        print(f"{title:<28} {'n':>5} {'p50':>9} {'p95':>9} {'p99':>9}" + ("   baseline p95" if baseline else ""))
+        for row, stats in results[section].items():
+            print(f"{row:<28} {stats['n']:>5} {stats['p50']:>9.1f} {stats['p95']:>9.1f} {stats['p99']:>9.1f}"
+                  + (" " + against(section, row, "p95", stats["p95"]) if baseline else ""))
+    throughput = results["throughput"]
+    print(f"throughput: {throughput['turns_per_second']} turns/s, {throughput['rest_per_second']} REST requests/s, "
+          f"errors: {throughput['turn_errors']} turns, {throughput['rest_errors']} REST")
+    print("memory (RSS): " + ", ".join(
+        f"{row} {stats['kb'] / 1024:.1f} MB" if row != "per session" else f"{row} {stats['kb']:.0f} KB"
+        for row, stats in results["memory"].items())
+        + (f" (baseline {' '.join(against('memory', 'per session', 'kb', results['memory']['per session']['kb']).split())})"
+           if baseline else ""))
+
+
+def regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    found = []
+    for section, row, key, floor in CHECKS:
+        before = baseline.get(section, {}).get(row, {}).get(key)
+        after = results.get(section, {}).get(row, {}).get(key)
+        if before is None or after is None:
+            continue
+        if after > before * (1 + tolerance) and after - before > floor:
+            found.append(f"{row} {key}: {before} -> {after}")
+    return found
+
+
+async def main(args):
+    config = StubConfig(stt_latency=args.stt_latency, llm_latency=args.llm_latency,
+                        tts_latency=args.tts_latency, tts_stream=True, jitter=args.jitter,
+                        error_rate=args.error_rate)
+    stub, env = start_stubs(config)
+    store = redis.Redis(host="localhost", port=6379)
+    # get_llm_response only calls the LLM when the session has a vector store (or local files)
+    for session_id in ([f"{SESSION_PREFIX}{i}" for i in range(args.sessions)]
+                       + [f"{SESSION_PREFIX}rest-{i}" for i in range(args.rest_clients)]
+                       + [f"{SESSION_PREFIX}warmup"]):
+        store.hset(f"session:{session_id}", mapping={"vector_store_id": "vs_bench", "file:local_bench": "bench.txt"})
+        store.expire(f"session:{session_id}", 3600)
+    env = {
+        **env,
+        # Every turn should reach the vendors, and one run's traces should all be kept
+        "ANSWER_CACHE": "0", "TTS_CACHE_MAX_BYTES": "0", "TTS_CACHE_REDIS": "0", "SESSION_RATE": "0",
+        "TRACE_HISTORY": str(args.sessions * args.turns + 100),
+    }
+    if args.providers == "stub":
+        env = {**env, "STT_PROVIDER": "stub", "LLM_PROVIDER": "stub", "TTS_PROVIDER": "stub"}
+    port = free_port()
+    app = start_app(port, env)
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        await wait_until_up(base_url)
+        print(f"--- {args.sessions} sessions x {args.turns} turns ({'/'.join(MODES)}), "
+              f"{args.rest_clients} REST clients x {args.rest_requests}, providers {args.providers}, "
+              f"stub jitter {args.jitter}, error rate {args.error_rate}")
+        results = await measure(base_url, app.pid, args)
+        async with httpx.AsyncClient() as http:
+            results["stub"] = (await http.get(f"{env['ASSEMBLYAI_BASE_URL']}/stub/stats")).json()
+    finally:
+        app.terminate()
+        app.wait()
+        stub.terminate()
+        stub.wait()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    print(f"stub: {json.dumps(results['stub'])}")
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if baseline is not None:
+        found = regressions(results, baseline, args.tolerance)
+        for line in found:
+            print(f"REGRESSION {line}")
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of /ws and REST against stub vendors")
+    parser.add_argument("--sessions", type=int, default=12)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--rest-clients", type=int, default=3)
+    parser.add_argument("--rest-requests", type=int, default=6)
+    parser.add_argument("--speech", type=float, default=1.5, help="seconds of speech per recorded utterance")
+    parser.add_argument("--providers", choices=["vendor", "stub"], default="vendor",
+                        help="stub vendor servers, or the app's in-process stub backends")
+    parser.add_argument("--jitter", type=float, default=0.3, help="sigma of the stub's log-normal latency factor")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of vendor requests answered with 429")
+    parser.add_argument("--stt-latency", type=float, default=StubConfig.stt_latency)
+    parser.add_argument("--llm-latency", type=float, default=StubConfig.llm_latency)
+    parser.add_argument("--tts-latency", type=float, default=StubConfig.tts_latency)
+    parser.add_argument("--save", help="write the results as JSON")
+    parser.add_argument("--compare", help="a saved run to compare with; exits with 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="growth of a checked value that is a regression")
+    asyncio.run(main(parser.parse_args()))
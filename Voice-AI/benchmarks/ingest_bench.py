@@ -0,0 +1,114 @@
+"""Wall time and server memory of a multi-file /api/upload.
+
+Starts the stub vendor server and the app once per INGEST_CONCURRENCY
+setting, uploads the same set of files in one request and reports how long
+the request took to be accepted (the files are only spooled; see ingest.py)
+and how long until its ingest job had finished (polling /api/jobs), next to
+the sum and maximum of the stub's per-file upload latency, plus the app's
+peak resident memory (VmHWM, Linux only). With parallel ingestion the job
+time tracks the slowest file, the request time does not depend on the
+vendor at all, and peak memory stays flat as files grow.
+
+Requires a Redis server on localhost:6379 (used by main.py).
+
+    cd Voice-AI && python benchmarks/ingest_bench.py --files 8 --size-mb 20 --concurrency 1,4,8
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+import uuid
+
+import httpx
+
+from load_test import free_port, start_app, start_stubs, wait_until_up
+from stub_servers import StubConfig
+
+
+def peak_rss_mb(pid: int) -> float:
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return float("nan")
+
+
+async def upload(base_url: str, paths, session_id: str) -> dict:
+    handles = [open(path, "rb") for path in paths]
+    try:
+        async with httpx.AsyncClient(timeout=600) as http:
+            response = await http.post(
+                f"{base_url}/api/upload",
+                data={"session_id": session_id},
+                files=[("files", (os.path.basename(path), handle, "text/plain"))
+                       for path, handle in zip(paths, handles)],
+            )
+            response.raise_for_status()
+            return response.json()
+    finally:
+        for handle in handles:
+            handle.close()
+
+
+async def wait_for_job(base_url: str, job_id: str, poll: float = 0.05) -> dict:
+    async with httpx.AsyncClient() as http:
+        while True:
+            job = (await http.get(f"{base_url}/api/jobs/{job_id}")).json()
+            if job["status"] in ("completed", "failed"):
+                return job
+            await asyncio.sleep(poll)
+
+
+async def main(args):
+    config = StubConfig(file_latency=args.file_latency, file_mb_latency=args.file_mb_latency)
+    stub, env = start_stubs(config)
+    workdir = tempfile.mkdtemp(prefix="ingest-bench-")
+    paths = []
+    for i in range(args.files):
+        path = os.path.join(workdir, f"doc-{i}.txt")
+        with open(path, "wb") as out:
+            for _ in range(int(args.size_mb)):
+                out.write(os.urandom(1024 * 1024))
+        paths.append(path)
+
+    per_file = args.file_latency + args.file_mb_latency * int(args.size_mb)
+    print(f"{args.files} files of {int(args.size_mb)} MB, stub upload latency {per_file:.2f}s per file "
+          f"(sum {per_file * args.files:.2f}s)")
+    print(f"{'concurrency':>11} {'request s':>10} {'ingest s':>9} {'peak RSS MB':>12}")
+    try:
+        for concurrency in (int(n) for n in args.concurrency.split(",")):
+            port = free_port()
+            app = start_app(port, {**env, "INGEST_CONCURRENCY": str(concurrency)})
+            base_url = f"http://127.0.0.1:{port}"
+            try:
+                await wait_until_up(base_url)
+                started = time.perf_counter()
+                accepted = await upload(base_url, paths, f"ingest-bench-{uuid.uuid4().hex}")
+                request = time.perf_counter() - started
+                job = await wait_for_job(base_url, accepted["job_id"])
+                elapsed = time.perf_counter() - started
+                if job["status"] != "completed":
+                    print(f"ingest job failed: {job['error']}")
+                print(f"{concurrency:>11} {request:>10.2f} {elapsed:>9.2f} {peak_rss_mb(app.pid):>12.1f}")
+            finally:
+                app.terminate()
+                app.wait()
+    finally:
+        stub.terminate()
+        for path in paths:
+            os.remove(path)
+        os.rmdir(workdir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark multi-file document ingestion")
+    parser.add_argument("--files", type=int, default=8)
+    parser.add_argument("--size-mb", type=float, default=20)
+    parser.add_argument("--concurrency", default="1,4,8", help="comma-separated INGEST_CONCURRENCY values")
+    parser.add_argument("--file-latency", type=float, default=StubConfig.file_latency)
+    parser.add_argument("--file-mb-latency", type=float, default=StubConfig.file_mb_latency)
+    asyncio.run(main(parser.parse_args()))
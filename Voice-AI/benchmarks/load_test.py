@@ -0,0 +1,187 @@
+"""Concurrent /ws sessions against stubbed STT/LLM/TTS backends.
+
+Starts the stub vendor server and the app (one uvicorn worker), then for each
+session count opens that many WebSocket sessions, runs a few turns on each and
+reports turn latency percentiles. A side task keeps probing `/api/config` so
+any blocking of the event loop shows up as REST latency.
+
+With a non-blocking pipeline the turn latency stays close to the sum of the
+stub latencies, and the probe latency stays flat, as the session count grows.
+`--providers stub` runs the app with the in-process stub backends instead
+(STT_PROVIDER=stub and so on, see providers.py): no vendor latency at all, so
+what is left is the app's own overhead.
+
+Requires a Redis server on localhost:6379 (used by main.py).
+
+    cd Voice-AI && python benchmarks/load_test.py --sessions 1,10,50,100,200
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+import redis
+import websockets
+
+from stub_servers import StubConfig, start_stub_process, stub_env
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, pct):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def start_stubs(config: StubConfig):
+    """Start the stub vendor servers in a subprocess; return it with the env for the app."""
+    port, ws_port = free_port(), free_port()
+    process = start_stub_process(config, port, ws_port)
+    return process, stub_env(f"http://127.0.0.1:{port}", f"ws://127.0.0.1:{ws_port}/v3/ws")
+
+
+def start_app(port: int, env: dict, workers: int = 1) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1",
+         "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+        cwd=APP_DIR,
+        env={**os.environ, **env},
+        stdout=subprocess.DEVNULL,
+    )
+
+
+async def wait_until_up(base_url: str, timeout: float = 30):
+    # Until the app reports ready, so the warm-up is not part of what is measured
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as http:
+        while time.monotonic() < deadline:
+            try:
+                if (await http.get(f"{base_url}/api/status/ready")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("App did not start")
+
+
+async def run_session(ws_url: str, session_id: str, turns: int, mode: str, latencies: list):
+    # One second of 16 kHz PCM silence, sent whole or as 100 ms frames
+    pcm = b"\x00" * 32000
+    audio = base64.b64encode(pcm).decode()
+    async with websockets.connect(ws_url, max_size=None) as ws:
+        for _ in range(turns):
+            if mode == "audio-stream":
+                # The utterance is streamed first; the turn is timed from the end of speech
+                await ws.send(json.dumps({"type": "audio_start", "session_id": session_id}))
+                for offset in range(0, len(pcm), 3200):
+                    chunk = base64.b64encode(pcm[offset:offset + 3200]).decode()
+                    await ws.send(json.dumps({"type": "audio_chunk", "audio_data": chunk}))
+                message = {"type": "audio_end", "session_id": session_id}
+            elif mode == "audio":
+                message = {"type": "audio", "audio_data": audio, "session_id": session_id}
+            else:
+                message = {"type": "text", "message": "What is latency?", "session_id": session_id}
+            started = time.perf_counter()
+            await ws.send(json.dumps(message))
+            # A turn is complete once its audio has arrived
+            while True:
+                reply = json.loads(await ws.recv())
+                if reply["type"] in ("tts", "tts_end", "error"):
+                    break
+            latencies.append(time.perf_counter() - started)
+
+
+async def probe(base_url: str, stop: asyncio.Event, latencies: list):
+    async with httpx.AsyncClient() as http:
+        while not stop.is_set():
+            started = time.perf_counter()
+            await http.get(f"{base_url}/api/config")
+            latencies.append(time.perf_counter() - started)
+            await asyncio.sleep(0.05)
+
+
+async def run_level(base_url: str, sessions: int, turns: int, mode: str):
+    ws_url = base_url.replace("http", "ws", 1) + "/ws"
+    turn_latencies, probe_latencies = [], []
+    stop = asyncio.Event()
+    prober = asyncio.create_task(probe(base_url, stop, probe_latencies))
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        run_session(ws_url, f"bench-{i}", turns, mode, turn_latencies) for i in range(sessions)
+    ))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await prober
+    return turn_latencies, probe_latencies, elapsed
+
+
+async def main(args):
+    config = StubConfig(stt_latency=args.stt_latency, llm_latency=args.llm_latency, tts_latency=args.tts_latency)
+    stub, env = start_stubs(config)
+    levels = [int(n) for n in args.sessions.split(",")]
+
+    # get_llm_response only calls the LLM when the session has a vector store (or, for
+    # backends that retrieve locally, files)
+    store = redis.Redis(host="localhost", port=6379)
+    for i in range(max(levels)):
+        store.hset(f"session:bench-{i}", mapping={"vector_store_id": "vs_bench", "file:local_bench": "bench.txt"})
+        store.expire(f"session:bench-{i}", 3600)
+    if args.providers == "stub":
+        env = {**env, "STT_PROVIDER": "stub", "LLM_PROVIDER": "stub", "TTS_PROVIDER": "stub"}
+        config = StubConfig(stt_latency=0, llm_latency=0, tts_latency=0, stt_final_latency=0)
+
+    # The recordings are silence, which the audio pre-processing would answer with no_speech, and
+    # the levels reuse the sessions, which would run into the per-session turn rate limit
+    env = {**env, "AUDIO_PREPROCESS": "0", "SESSION_RATE": "0"}
+
+    port = free_port()
+    app = start_app(port, env, workers=args.workers)
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        await wait_until_up(base_url)
+        floor = (config.stt_latency if args.mode == "audio" else 0) + config.llm_latency + config.tts_latency
+        if args.mode == "audio-stream":
+            floor += config.stt_final_latency
+        print(f"mode={args.mode} turns/session={args.turns} vendor floor={floor * 1000:.0f} ms")
+        print(f"{'sessions':>8} {'turn p50':>10} {'turn p95':>10} {'turn p99':>10} {'probe p99':>10} {'turns/s':>8}")
+        for sessions in levels:
+            turn, probe_lat, elapsed = await run_level(base_url, sessions, args.turns, args.mode)
+            print(f"{sessions:>8} "
+                  f"{percentile(turn, 50) * 1000:>8.0f}ms "
+                  f"{percentile(turn, 95) * 1000:>8.0f}ms "
+                  f"{percentile(turn, 99) * 1000:>8.0f}ms "
+                  f"{percentile(probe_lat, 99) * 1000:>8.1f}ms "
+                  f"{len(turn) / elapsed:>8.1f}")
+    finally:
+        for process in (app, stub):
+            process.terminate()
+            process.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the /ws voice pipeline")
+    parser.add_argument("--sessions", default="1,10,50,100,200")
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--mode", choices=["text", "audio", "audio-stream"], default="text")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--providers", choices=["vendor", "stub"], default="vendor",
+                        help="stub vendor servers, or the app's in-process stub backends")
+    parser.add_argument("--stt-latency", type=float, default=StubConfig.stt_latency)
+    parser.add_argument("--llm-latency", type=float, default=StubConfig.llm_latency)
+    parser.add_argument("--tts-latency", type=float, default=StubConfig.tts_latency)
+    asyncio.run(main(parser.parse_args()))
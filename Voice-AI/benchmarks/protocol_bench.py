@@ -0,0 +1,89 @@
+"""Bytes on the wire and server CPU per turn: base64-in-JSON vs binary frames.
+
+Models one voice turn as the server sees it: an utterance sent either whole
+or as 100 ms PCM frames, and a reply whose audio goes out whole or as
+sentence segments. For each encoding it reports the WebSocket payload bytes
+and the CPU time the server spends decoding the input and encoding the
+output (the same calls main.py makes), averaged over many turns.
+
+    cd Voice-AI && python benchmarks/protocol_bench.py --utterance 5 --reply 20
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protocol import FLAG_STREAM, FRAME_AUDIO, FRAME_AUDIO_CHUNK, FRAME_TTS_CHUNK, pack_frame, unpack_frame  # noqa: E402
+
+SESSION_ID = "session_1718000000000_k3j5h2g8f9d1"
+PCM_BYTES_PER_SECOND = 16000 * 2
+MP3_BYTES_PER_SECOND = 128000 // 8
+
+
+def client_frames_json(utterance: bytes, chunked: bool):
+    if not chunked:
+        return [json.dumps({"type": "audio", "audio_data": base64.b64encode(utterance).decode(),
+                            "session_id": SESSION_ID, "stream": True})]
+    return [json.dumps({"type": "audio_chunk", "audio_data": base64.b64encode(utterance[i:i + 3200]).decode()})
+            for i in range(0, len(utterance), 3200)]
+
+
+def client_frames_binary(utterance: bytes, chunked: bool):
+    if not chunked:
+        return [pack_frame(FRAME_AUDIO, utterance, session_id=SESSION_ID, flags=FLAG_STREAM)]
+    return [pack_frame(FRAME_AUDIO_CHUNK, utterance[i:i + 3200], seq=seq, session_id=SESSION_ID)
+            for seq, i in enumerate(range(0, len(utterance), 3200))]
+
+
+def server_turn_json(frames, segments):
+    for frame in frames:
+        base64.b64decode(json.loads(frame)["audio_data"])
+    return [json.dumps({"type": "tts_chunk", "seq": seq, "audio_data": base64.b64encode(audio).decode("utf-8")})
+            for seq, audio in enumerate(segments)]
+
+
+def server_turn_binary(frames, segments):
+    for frame in frames:
+        bytes(unpack_frame(frame).payload)
+    return [pack_frame(FRAME_TTS_CHUNK, audio, seq=seq, session_id=SESSION_ID) for seq, audio in enumerate(segments)]
+
+
+def measure(turn, frames, segments, repeat):
+    started = time.process_time()
+    for _ in range(repeat):
+        out = turn(frames, segments)
+    return (time.process_time() - started) / repeat, out
+
+
+def main(args):
+    utterance = os.urandom(int(args.utterance * PCM_BYTES_PER_SECOND))
+    reply = os.urandom(int(args.reply * MP3_BYTES_PER_SECOND))
+    segment_size = -(-len(reply) // args.segments)
+    segments = [reply[i:i + segment_size] for i in range(0, len(reply), segment_size)]
+
+    print(f"utterance {args.utterance:.0f}s PCM ({len(utterance)} B), "
+          f"reply {args.reply:.0f}s MP3 in {len(segments)} segment(s) ({len(reply)} B)")
+    print(f"{'input':<8} {'encoding':<8} {'bytes in':>10} {'bytes out':>10} {'vs raw':>8} {'server CPU':>11}")
+    for chunked in (False, True):
+        for name, encode, turn in (("json", client_frames_json, server_turn_json),
+                                   ("binary", client_frames_binary, server_turn_binary)):
+            frames = encode(utterance, chunked)
+            cpu, out = measure(turn, frames, segments, args.repeat)
+            bytes_in = sum(len(f) for f in frames)
+            bytes_out = sum(len(f) for f in out)
+            overhead = (bytes_in + bytes_out) / (len(utterance) + len(reply)) - 1
+            print(f"{'frames' if chunked else 'whole':<8} {name:<8} {bytes_in:>10} {bytes_out:>10} "
+                  f"{overhead:>+7.1%} {cpu * 1000:>9.3f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare audio encodings on /ws")
+    parser.add_argument("--utterance", type=float, default=5, help="seconds of 16 kHz PCM from the user")
+    parser.add_argument("--reply", type=float, default=20, help="seconds of 128 kbps MP3 in the reply")
+    parser.add_argument("--segments", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=200)
+    main(parser.parse_args())
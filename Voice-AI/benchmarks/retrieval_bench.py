@@ -0,0 +1,145 @@
+"""Local retrieval (retrieval.py): search latency and recall as a session's corpus grows.
+
+Builds a synthetic corpus in one session's index: documents of
+`--paragraphs` paragraphs, each about a topic (a set of topic words) over
+Zipf-distributed background words, and each paragraph carrying a few words
+of its own (its "facts"). A query asks about one paragraph: some of its fact
+words and topic words plus background noise. It is a hit when the
+paragraph's document is among the top `--k` passages.
+
+At each corpus size (in chunks) it reports, over `--queries` queries:
+
+- exact: every row scored; the latency includes embedding the question
+- ivf: only the `--nprobe` closest IVF lists scored, once the index has
+  `--ivf-min-rows` chunks, and how many of the exact top k it still finds
+- the time to add documents, and the index size on disk per chunk
+
+    cd Voice-AI && python benchmarks/retrieval_bench.py --sizes 1000,5000,20000,50000
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from retrieval import DocumentStore, HashingEmbedder  # noqa: E402
+
+
+def percentile(values, pct):
+    return float(np.percentile(values, pct)) if len(values) else 0.0
+
+
+class Corpus:
+    def __init__(self, seed: int, vocabulary: int = 30000, topics: int = 200, topic_words: int = 40):
+        self.rng = np.random.default_rng(seed)
+        syllables = ["ka", "lo", "mi", "ne", "ru", "sa", "ti", "vo", "ze", "pa", "do", "gu", "be", "fi", "ho"]
+        self.words = sorted({"".join(self.rng.choice(syllables, self.rng.integers(2, 5)))
+                             for _ in range(vocabulary * 2)})[:vocabulary]
+        self.topics = [self.rng.choice(len(self.words), topic_words, replace=False) for _ in range(topics)]
+        self.paragraphs = []  # (document number, topic, fact word indexes)
+
+    def background(self, count: int):
+        return np.minimum(self.rng.zipf(1.3, count) - 1, len(self.words) - 1)
+
+    def document(self, number: int, paragraphs: int, paragraph_words: int) -> str:
+        topic = int(self.rng.integers(len(self.topics)))
+        parts = []
+        for _ in range(paragraphs):
+            facts = self.rng.choice(len(self.words), 5, replace=False)
+            self.paragraphs.append((number, topic, facts))
+            indexes = np.concatenate([
+                self.background(paragraph_words // 2),
+                self.rng.choice(self.topics[topic], paragraph_words // 2 - 10),
+                facts, facts,
+            ])
+            self.rng.shuffle(indexes)
+            parts.append(" ".join(self.words[i] for i in indexes) + ".")
+        return "\n\n".join(parts)
+
+    def query(self):
+        document, topic, facts = self.paragraphs[int(self.rng.integers(len(self.paragraphs)))]
+        indexes = np.concatenate([self.rng.choice(facts, 3, replace=False),
+                                  self.rng.choice(self.topics[topic], 2), self.background(3)])
+        self.rng.shuffle(indexes)
+        return f"doc{document}", " ".join(self.words[i] for i in indexes)
+
+
+def index_bytes(directory: str) -> int:
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+
+async def measure(store: DocumentStore, corpus: Corpus, args):
+    exact_ms, ivf_ms = [], []
+    exact_hits = ivf_hits = 0
+    agreement = []
+    index = store.index("bench")
+    has_ivf = index.ivf is not None
+    for _ in range(args.queries):
+        document, question = corpus.query()
+        started = time.perf_counter()
+        exact = await store.search("bench", question, args.k, nprobe=0)
+        exact_ms.append((time.perf_counter() - started) * 1000)
+        exact_hits += any(passage.filename == document for passage in exact)
+        if has_ivf:
+            started = time.perf_counter()
+            approximate = await store.search("bench", question, args.k, nprobe=args.nprobe)
+            ivf_ms.append((time.perf_counter() - started) * 1000)
+            ivf_hits += any(passage.filename == document for passage in approximate)
+            found = {passage.text for passage in approximate}
+            agreement.append(sum(passage.text in found for passage in exact) / max(1, len(exact)))
+    return exact_ms, ivf_ms, exact_hits, ivf_hits, agreement, has_ivf
+
+
+async def main(args):
+    sizes = [int(size) for size in args.sizes.split(",")]
+    root = tempfile.mkdtemp(prefix="retrieval-bench-")
+    store = DocumentStore(root, HashingEmbedder(args.dim), chunk_chars=args.chunk_chars,
+                          ivf_min_rows=args.ivf_min_rows, nprobe=args.nprobe)
+    corpus = Corpus(args.seed)
+    index = store.index("bench")
+    documents = 0
+    add_seconds = 0.0
+    print(f"embedder={store.embedder.name} k={args.k} nprobe={args.nprobe} ivf_min_rows={args.ivf_min_rows} "
+          f"queries={args.queries}")
+    print(f"{'chunks':>7} {'add/s':>7} {'B/chunk':>7} {'exact p50':>9} {'exact p95':>9} {'recall':>6} "
+          f"{'ivf p50':>8} {'ivf p95':>8} {'recall':>6} {'vs exact':>8}")
+    try:
+        for size in sizes:
+            while len(index) < size:
+                text = corpus.document(documents, args.paragraphs, args.paragraph_words)
+                started = time.perf_counter()
+                await store.add("bench", f"file{documents}", f"doc{documents}", text.encode())
+                add_seconds += time.perf_counter() - started
+                documents += 1
+            index.refresh()
+            exact_ms, ivf_ms, exact_hits, ivf_hits, agreement, has_ivf = await measure(store, corpus, args)
+            ivf = (f"{percentile(ivf_ms, 50):>6.2f}ms {percentile(ivf_ms, 95):>6.2f}ms "
+                   f"{ivf_hits / args.queries:>6.2f} {np.mean(agreement):>8.2f}") if has_ivf else f"{'-':>8} " * 3 + f"{'-':>8}"
+            print(f"{len(index):>7} {len(index) / add_seconds:>7.0f} "
+                  f"{index_bytes(store.session_dir('bench')) / len(index):>7.0f} "
+                  f"{percentile(exact_ms, 50):>7.2f}ms {percentile(exact_ms, 95):>7.2f}ms "
+                  f"{exact_hits / args.queries:>6.2f} {ivf}")
+    finally:
+        shutil.rmtree(root)
+    print(f"store: {store.report()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark local retrieval latency and recall")
+    parser.add_argument("--sizes", default="1000,5000,20000,50000", help="corpus sizes in chunks")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--nprobe", type=int, default=16)
+    parser.add_argument("--ivf-min-rows", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--chunk-chars", type=int, default=1200)
+    parser.add_argument("--paragraphs", type=int, default=8)
+    parser.add_argument("--paragraph-words", type=int, default=150)
+    parser.add_argument("--seed", type=int, default=7)
+    asyncio.run(main(parser.parse_args()))
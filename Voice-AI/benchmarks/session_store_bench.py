@@ -0,0 +1,169 @@
+"""Redis cost of session bookkeeping: per-command sync calls vs session_store.py.
+
+Replays the Redis side of an /api/upload with many files, a turn's vector
+store lookup and a file delete, once with the access pattern main.py used
+before session_store.py (a synchronous client, one round trip per command,
+three key families) and once through SessionStore. Reports round trips and
+wall time per operation. The sync variant also blocks the event loop for all
+of that time.
+
+Runs against a Redis server when --redis-url is given, otherwise against an
+in-process fakeredis. Every round trip is delayed by --rtt-ms to model the
+network between the app and Redis.
+
+    cd Voice-AI && python benchmarks/session_store_bench.py --files 50 --uploads 20 --rtt-ms 0.5
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import sys
+import time
+
+import redis
+import redis.asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from session_store import SessionStore  # noqa: E402
+
+round_trips = 0
+rtt = 0.0
+
+
+def counting_connection(base, is_async: bool):
+    """Connection class that counts and delays every packet sent (one per command or pipeline)."""
+    if is_async:
+        class AsyncCountingConnection(base):
+            async def send_packed_command(self, *args, **kwargs):
+                global round_trips
+                round_trips += 1
+                await asyncio.sleep(rtt)
+                return await super().send_packed_command(*args, **kwargs)
+        return AsyncCountingConnection
+
+    class CountingConnection(base):
+        def send_packed_command(self, *args, **kwargs):
+            global round_trips
+            round_trips += 1
+            time.sleep(rtt)
+            return super().send_packed_command(*args, **kwargs)
+    return CountingConnection
+
+
+def make_clients(url: str):
+    if url:
+        sync_pool = redis.ConnectionPool.from_url(
+            url, decode_responses=True, connection_class=counting_connection(redis.Connection, False))
+        async_pool = redis.asyncio.ConnectionPool.from_url(
+            url, decode_responses=True, connection_class=counting_connection(redis.asyncio.Connection, True))
+        return redis.Redis(connection_pool=sync_pool), redis.asyncio.Redis(connection_pool=async_pool)
+
+    import fakeredis
+    import fakeredis.aioredis
+    from fakeredis._clients._sync import FakeRedisConnection
+
+    server = fakeredis.FakeServer()
+    sync_client = fakeredis.FakeRedis(server=server, decode_responses=True,
+                                      connection_class=counting_connection(FakeRedisConnection, False))
+    async_client = fakeredis.aioredis.FakeRedis(
+        server=server, decode_responses=True,
+        connection_class=counting_connection(fakeredis.aioredis.FakeAsyncRedisConnection, True))
+    return sync_client, async_client
+
+
+def legacy_upload(r: redis.Redis, session_id: str, files):
+    vector_store_id = r.get(session_id)
+    if not vector_store_id:
+        r.set(session_id, "vs_bench", ex=3600)
+    for file_id, filename, file_hash in files:
+        if r.hget(f"session:{session_id}:file_hashes", file_hash):
+            continue
+        r.hset(f"session:{session_id}:files", file_id, filename)
+        r.hset(f"session:{session_id}:file_hashes", file_hash, file_id)
+
+
+def legacy_lookup(r: redis.Redis, session_id: str):
+    if r.exists(session_id):
+        return r.get(session_id)
+
+
+def legacy_delete(r: redis.Redis, session_id: str, file_hash: str):
+    r.get(session_id)
+    file_id = r.hget(f"session:{session_id}:file_hashes", file_hash)
+    r.hdel(f"session:{session_id}:files", file_id)
+    r.hdel(f"session:{session_id}:file_hashes", file_hash)
+
+
+async def store_upload(sessions: SessionStore, session_id: str, files):
+    vector_store_id, existing = await sessions.find_files(session_id, [f[2] for f in files])
+    if not vector_store_id:
+        await sessions.claim_vector_store(session_id, "vs_bench")
+    await sessions.add_files(session_id, [f for f, file_id in zip(files, existing) if not file_id])
+
+
+async def store_delete(sessions: SessionStore, session_id: str, file_id: str, file_hash: str):
+    await sessions.find_files(session_id, [file_hash])
+    await sessions.remove_file(session_id, file_id, file_hash)
+
+
+def make_files(upload: int, count: int):
+    return [(f"file-{upload}-{i}", f"doc-{i}.pdf", hashlib.sha256(f"{upload}/{i}".encode()).hexdigest())
+            for i in range(count)]
+
+
+def report(name, timings, round_trips, operations):
+    timings.sort()
+    print(f"{name:<22} {round_trips / operations:>11.1f} {sum(timings) / len(timings) * 1000:>10.3f} "
+          f"{timings[int(len(timings) * 0.95) - 1] * 1000:>10.3f}")
+
+
+async def main(args):
+    global round_trips, rtt
+    sync_client, async_client = make_clients(args.redis_url)
+    sessions = SessionStore(async_client, prefix="bench-session:")
+    # Open the connections before counting
+    sync_client.ping()
+    await async_client.ping()
+    rtt = args.rtt_ms / 1000
+
+    print(f"{args.uploads} uploads of {args.files} files, {args.turns} turn lookups, "
+          f"{args.rtt_ms} ms per round trip, against {args.redis_url or 'fakeredis'}")
+    print(f"{'operation':<22} {'round trips':>11} {'avg ms':>10} {'p95 ms':>10}")
+    for label, count in (("upload", args.uploads), ("lookup", args.turns), ("delete", args.uploads)):
+        for variant in ("legacy", "session store"):
+            timings = []
+            round_trips = 0
+            for n in range(count):
+                session_id = f"bench-{variant.replace(' ', '-')}-{n % args.uploads}"
+                files = make_files(n % args.uploads, args.files)
+                started = time.perf_counter()
+                if variant == "legacy":
+                    if label == "upload":
+                        legacy_upload(sync_client, session_id, files)
+                    elif label == "lookup":
+                        legacy_lookup(sync_client, session_id)
+                    else:
+                        legacy_delete(sync_client, session_id, files[0][2])
+                else:
+                    if label == "upload":
+                        await store_upload(sessions, session_id, files)
+                    elif label == "lookup":
+                        await sessions.load(session_id)
+                    else:
+                        await store_delete(sessions, session_id, files[0][0], files[0][2])
+                timings.append(time.perf_counter() - started)
+            report(f"{label} ({variant})", timings, round_trips, count)
+
+    sync_client.close()
+    await async_client.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark session state access patterns in Redis")
+    parser.add_argument("--files", type=int, default=50, help="files per upload")
+    parser.add_argument("--uploads", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--rtt-ms", type=float, default=0.5, help="added latency per round trip")
+    parser.add_argument("--redis-url", default="", help="e.g. redis://localhost:6379/15 (default: fakeredis)")
+    asyncio.run(main(parser.parse_args()))
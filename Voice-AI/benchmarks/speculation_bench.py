@@ -0,0 +1,128 @@
+"""Speculative replies: latency from the end of speech, with and without SPECULATION.
+
+Streams utterances over /ws in real time against the stub vendor servers
+(streaming STT, LLM and TTS): `--speech` seconds of audio during which the
+stub reveals the transcript two words per partial result, then `--pause`
+seconds of trailing silence before `audio_end` (the client's end-of-speech
+detection). Each utterance is timed from `audio_end` to the first LLM text
+and to the first audio, once with the app started with SPECULATION=0 and
+once with SPECULATION=1 and the given `--window`.
+
+With enough speech for the whole transcript (the stub's needs 2 s) the
+speculative reply matches and starts up to `--pause` earlier; with less, the
+final transcript differs and the guess is wasted. The app's
+/api/status/speculation and the stub's LLM stream counts show the hit rate
+and the cost.
+
+Requires a Redis server on localhost:6379 (used by main.py).
+
+    cd Voice-AI && python benchmarks/speculation_bench.py --turns 10 --speech 2.5 --pause 0.6
+"""
+import argparse
+import asyncio
+import base64
+import json
+import time
+
+import httpx
+import redis
+import websockets
+
+from load_test import free_port, percentile, start_app, start_stubs, wait_until_up
+from stub_servers import StubConfig
+
+SESSION_ID = "bench-speculation"
+FRAME_SECONDS = 0.1
+
+
+async def stream_utterance(ws, seconds: float):
+    # 16 kHz 16-bit mono frames, paced like a microphone
+    chunk = base64.b64encode(b"\x00" * int(32000 * FRAME_SECONDS)).decode()
+    started = time.perf_counter()
+    for i in range(round(seconds / FRAME_SECONDS)):
+        await ws.send(json.dumps({"type": "audio_chunk", "audio_data": chunk}))
+        await asyncio.sleep(max(0.0, started + (i + 1) * FRAME_SECONDS - time.perf_counter()))
+
+
+async def run_turns(ws_url: str, args):
+    first_text, first_audio = [], []
+    async with websockets.connect(ws_url, max_size=None) as ws:
+        for _ in range(args.turns):
+            await ws.send(json.dumps({"type": "audio_start", "session_id": SESSION_ID}))
+            await stream_utterance(ws, args.speech + args.pause)
+            ended = time.perf_counter()
+            await ws.send(json.dumps({"type": "audio_end", "session_id": SESSION_ID, "stream": True}))
+            text_at = None
+            while True:
+                reply = json.loads(await ws.recv())
+                if reply["type"] == "llm_delta" and text_at is None:
+                    text_at = time.perf_counter() - ended
+                if reply["type"] == "tts_chunk":
+                    first_text.append(text_at)
+                    first_audio.append(time.perf_counter() - ended)
+                if reply["type"] in ("tts_chunk", "error", "no_speech"):
+                    break
+            if reply["type"] != "tts_chunk":
+                print(f"turn failed: {reply}")
+                continue
+            # Let the rest of the reply play out before the next utterance
+            while json.loads(await ws.recv())["type"] not in ("tts_end", "error"):
+                pass
+    return first_text, first_audio
+
+
+async def run(args, env: dict, speculate: bool):
+    port = free_port()
+    app = start_app(port, {
+        **env,
+        "SPECULATION": "1" if speculate else "0",
+        "SPECULATION_WINDOW_MS": str(args.window),
+        # Every turn should reach the stub LLM, and silence is speech as far as the app cares
+        "ANSWER_CACHE": "0", "TTS_CACHE_MAX_BYTES": "0", "TTS_CACHE_REDIS": "0",
+        "AUDIO_PREPROCESS": "0", "SESSION_RATE": "0",
+    })
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        await wait_until_up(base_url)
+        async with httpx.AsyncClient() as http:
+            before = (await http.get(f"{env['ASSEMBLYAI_BASE_URL']}/stub/stats")).json()
+            first_text, first_audio = await run_turns(f"ws://127.0.0.1:{port}/ws", args)
+            status = (await http.get(f"{base_url}/api/status/speculation")).json()
+            after = (await http.get(f"{env['ASSEMBLYAI_BASE_URL']}/stub/stats")).json()
+    finally:
+        app.terminate()
+        app.wait()
+    streams = after.get("llm_streams", 0) - before.get("llm_streams", 0)
+    aborted = after.get("llm_streams_aborted", 0) - before.get("llm_streams_aborted", 0)
+    label = f"speculation {'on' if speculate else 'off'}"
+    print(f"{label:<16} first text p50 {percentile(first_text, 50) * 1000:>6.0f}ms "
+          f"p95 {percentile(first_text, 95) * 1000:>6.0f}ms   first audio p50 "
+          f"{percentile(first_audio, 50) * 1000:>6.0f}ms p95 {percentile(first_audio, 95) * 1000:>6.0f}ms   "
+          f"LLM streams {streams} (aborted {aborted})")
+    if speculate:
+        print(f"{'':<16} {json.dumps(status)}")
+
+
+async def main(args):
+    config = StubConfig(llm_latency=args.llm_latency, tts_latency=args.tts_latency)
+    stub, env = start_stubs(config)
+    redis.Redis(host="localhost", port=6379).hset(f"session:{SESSION_ID}", "vector_store_id", "vs_bench")
+    try:
+        print(f"--- {args.turns} utterances: {args.speech}s of speech, {args.pause}s pause, "
+              f"window {args.window}ms, stub LLM latency {args.llm_latency}s")
+        for speculate in (False, True):
+            await run(args, env, speculate)
+    finally:
+        stub.terminate()
+        stub.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark speculative replies on partial transcripts")
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--speech", type=float, default=2.5, help="seconds of audio before the pause")
+    parser.add_argument("--pause", type=float, default=0.6, help="trailing silence before audio_end")
+    parser.add_argument("--window", type=int, default=300, help="SPECULATION_WINDOW_MS")
+    parser.add_argument("--llm-latency", type=float, default=StubConfig.llm_latency)
+    parser.add_argument("--tts-latency", type=float, default=StubConfig.tts_latency)
+    asyncio.run(main(parser.parse_args()))
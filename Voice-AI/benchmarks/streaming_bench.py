@@ -0,0 +1,84 @@
+"""Time to first audio: whole-reply TTS vs sentence-level streaming.
+
+Runs text turns over /ws against the stub vendor server, once with the
+classic single `tts` message and once with `stream: true`, and reports how
+long the client waits for the first playable audio and for the whole turn.
+
+Requires a Redis server on localhost:6379 (used by main.py).
+
+    cd Voice-AI && python benchmarks/streaming_bench.py --turns 20
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import redis
+import websockets
+
+from load_test import free_port, percentile, start_app, start_stubs, wait_until_up
+from stub_servers import StubConfig
+
+
+async def run_turns(ws_url: str, turns: int, stream: bool):
+    first_audio, total, server_ttfa = [], [], []
+    async with websockets.connect(ws_url, max_size=None) as ws:
+        for _ in range(turns):
+            started = time.perf_counter()
+            await ws.send(json.dumps({
+                "type": "text",
+                "message": "What is latency?",
+                "session_id": "bench-stream",
+                "stream": stream,
+            }))
+            first = None
+            while True:
+                reply = json.loads(await ws.recv())
+                if reply["type"] in ("tts", "tts_chunk") and first is None:
+                    first = time.perf_counter() - started
+                if reply["type"] == "tts_end" and reply.get("time_to_first_audio_ms") is not None:
+                    server_ttfa.append(reply["time_to_first_audio_ms"] / 1000)
+                if reply["type"] in ("tts", "tts_end", "error"):
+                    break
+            first_audio.append(first if first is not None else float("nan"))
+            total.append(time.perf_counter() - started)
+    return first_audio, total, server_ttfa
+
+
+def report(label, values):
+    return (f"{label:<22} p50 {percentile(values, 50) * 1000:>7.0f}ms "
+            f"p95 {percentile(values, 95) * 1000:>7.0f}ms")
+
+
+async def main(args):
+    config = StubConfig(llm_latency=args.llm_latency, llm_token_interval=args.token_interval,
+                        tts_latency=args.tts_latency, tts_char_latency=args.tts_char_latency)
+    stub, env = start_stubs(config)
+    redis.Redis(host="localhost", port=6379).hset("session:bench-stream", "vector_store_id", "vs_bench")
+
+    port = free_port()
+    app = start_app(port, env)
+    try:
+        await wait_until_up(f"http://127.0.0.1:{port}")
+        ws_url = f"ws://127.0.0.1:{port}/ws"
+        for stream in (False, True):
+            first_audio, total, server_ttfa = await run_turns(ws_url, args.turns, stream)
+            print(f"--- {'streaming' if stream else 'whole reply'} ({args.turns} turns)")
+            print(report("time to first audio", first_audio))
+            if server_ttfa:
+                print(report("  (server measured)", server_ttfa))
+            print(report("turn complete", total))
+    finally:
+        for process in (app, stub):
+            process.terminate()
+            process.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark streaming TTS time to first audio")
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--llm-latency", type=float, default=StubConfig.llm_latency)
+    parser.add_argument("--token-interval", type=float, default=StubConfig.llm_token_interval)
+    parser.add_argument("--tts-latency", type=float, default=StubConfig.tts_latency)
+    parser.add_argument("--tts-char-latency", type=float, default=StubConfig.tts_char_latency)
+    asyncio.run(main(parser.parse_args()))
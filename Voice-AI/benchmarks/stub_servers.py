@@ -0,0 +1,508 @@
+"""Local stand-ins for the AssemblyAI, OpenAI and ElevenLabs HTTP APIs.
+
+Only the endpoints main.py talks to are implemented, and every response is
+canned (uploaded files are counted and discarded; deleting files and vector
+stores is counted too). Each vendor has its own configurable latency so the benchmarks can
+measure the app's own overhead separately from the vendors', and can vary
+from request to request (`jitter`: every wait is scaled by a log-normal factor
+with that sigma and a median of 1, so the tail grows like a real vendor's). The LLM streams
+its answer word by word when asked to (`stream: true`), and TTS latency grows
+with the length of the text, like the real services. TTS audio comes in the
+requested `output_format` (sized by its byte rate; opus as Ogg pages of
+20 ms packets), and can be streamed as it is "synthesized" (`tts_stream`). GET /stub/stats reports
+how much work the stub actually did (LLM tokens streamed, TTS requests) and
+how many responses the app abandoned half way, to check cancellation.
+
+To test the app's admission control, the LLM can be given a capacity (requests
+beyond it wait, like at a saturated vendor) and a share of the STT upload, LLM
+and TTS requests can be answered with 429 Too Many Requests.
+
+A second, WebSocket server speaks enough of AssemblyAI's Universal Streaming
+protocol to drive the live transcription path: it emits a growing partial
+transcript as PCM frames arrive and the final transcript on Terminate.
+
+Run standalone with `python benchmarks/stub_servers.py --port 9000` and start
+the app with:
+
+    ASSEMBLYAI_BASE_URL=http://127.0.0.1:9000
+    ASSEMBLYAI_STREAMING_URL=ws://127.0.0.1:9001/v3/ws
+    LLM_BASE_URL=http://127.0.0.1:9000/v1
+    ELEVENLABS_BASE_URL=http://127.0.0.1:9000
+"""
+import argparse
+import json
+import os
+import random
+import struct
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from websockets.sync.server import serve
+
+STUB_TRANSCRIPT = "What does the document say about latency?"
+STUB_ANSWER = (
+    "The document explains that latency is the time between a request and its response. "
+    "It recommends measuring every stage separately. "
+    "Streaming the output shortens the time until the first result arrives."
+)
+# A fake MP3 frame header followed by padding; the app never decodes it
+STUB_AUDIO = b"\xff\xfb\x90\x64" + b"\x00" * 4092
+# audio_bytes is the size of the reply in the default mp3_44100_128; other formats scale by byte rate
+STUB_AUDIO_FORMAT = "mp3_44100_128"
+
+# Work done by the stub, reported by GET /stub/stats
+stats_lock = threading.Lock()
+stats = {"llm_streams": 0, "llm_streams_aborted": 0, "llm_tokens_sent": 0,
+         "tts_requests": 0, "tts_requests_aborted": 0, "errors_injected": 0, "llm_requests_waited": 0,
+         "files_uploaded": 0, "files_deleted": 0, "vector_stores_created": 0, "vector_stores_deleted": 0,
+         "vector_store_files_deleted": 0}
+
+
+def count(name: str, amount: int = 1):
+    with stats_lock:
+        stats[name] += amount
+
+
+@dataclass
+class StubConfig:
+    stt_latency: float = 0.3
+    # Streaming STT: a partial result per stt_partial_every seconds of audio,
+    # and the final transcript stt_final_latency seconds after Terminate
+    stt_partial_every: float = 0.5
+    stt_final_latency: float = 0.05
+    # Time to first token, then one word every llm_token_interval seconds
+    llm_latency: float = 0.5
+    llm_token_interval: float = 0.02
+    # Fixed synthesis latency plus a per-character cost
+    tts_latency: float = 0.3
+    tts_char_latency: float = 0.002
+    # Stream the audio as it is "synthesized" rather than all of it after the whole latency
+    tts_stream: bool = False
+    audio_bytes: int = 32 * 1024
+    chunk_size: int = 4096
+    # OpenAI file uploads: fixed latency plus a per-MB cost once the body has arrived
+    file_latency: float = 0.2
+    file_mb_latency: float = 0.05
+    # LLM requests served at once (0: unlimited), and the share of requests answered with a 429
+    llm_capacity: int = 0
+    error_rate: float = 0.0
+    # Sigma of the log-normal factor every wait is scaled by (0: fixed latencies); 0.5 makes p95 about 2.3x the median
+    jitter: float = 0.0
+
+
+def pause(config: StubConfig, seconds: float):
+    if config.jitter and seconds > 0:
+        seconds *= random.lognormvariate(0, config.jitter)
+    time.sleep(seconds)
+
+
+def make_handler(config: StubConfig):
+    llm_slots = threading.Semaphore(config.llm_capacity) if config.llm_capacity else None
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _read_body(self) -> bytes:
+            length = int(self.headers.get("content-length") or 0)
+            return self.rfile.read(length) if length else b""
+
+        def _send_json(self, payload, status=200, headers=None):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("content-type", "application/json")
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("content-length", str(len(body)))
+            try:
+                self.end_headers()
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                # The client gave up on the request (e.g. a cancelled turn)
+                self.close_connection = True
+
+        def _send_audio(self, text: str, output_format: str):
+            count("tts_requests")
+            audio = stub_audio(output_format, config.audio_bytes)
+            chunks = [audio[offset:offset + config.chunk_size] for offset in range(0, len(audio), config.chunk_size)]
+            # The first chunk after the fixed latency; with tts_stream the per-character cost is
+            # spread over the chunks, like a vendor that streams audio as it is synthesized
+            generation = config.tts_char_latency * len(text)
+            pause(config, config.tts_latency + (0 if config.tts_stream else generation))
+            try:
+                self.send_response(200)
+                self.send_header("content-type", "audio/mpeg")
+                self.send_header("transfer-encoding", "chunked")
+                self.end_headers()
+                for index, chunk in enumerate(chunks):
+                    if config.tts_stream and index:
+                        pause(config, generation / len(chunks))
+                    self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+                    self.wfile.flush()
+                self.wfile.write(b"0\r\n\r\n")
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                count("tts_requests_aborted")
+                self.close_connection = True
+
+        def _stream_response(self, text: str):
+            self.send_response(200)
+            self.send_header("content-type", "text/event-stream")
+            self.send_header("transfer-encoding", "chunked")
+            self.end_headers()
+            response = stub_response(text)
+            events = [{"type": "response.created", "response": {**response, "status": "in_progress", "output": []}}]
+            events += [{
+                "type": "response.output_text.delta",
+                "item_id": response["output"][0]["id"],
+                "output_index": 0,
+                "content_index": 0,
+                "delta": token,
+                "logprobs": [],
+            } for token in stub_tokens(text)]
+            events.append({"type": "response.completed", "response": response})
+            count("llm_streams")
+            try:
+                for seq, event in enumerate(events):
+                    if event["type"] == "response.output_text.delta":
+                        pause(config, config.llm_token_interval)
+                    payload = f"event: {event['type']}\ndata: {json.dumps({**event, 'sequence_number': seq})}\n\n".encode()
+                    self.wfile.write(f"{len(payload):x}\r\n".encode() + payload + b"\r\n")
+                    self.wfile.flush()
+                    if event["type"] == "response.output_text.delta":
+                        count("llm_tokens_sent")
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                # The client closed the stream: a real LLM stops generating here
+                count("llm_streams_aborted")
+                self.close_connection = True
+
+        def _rate_limited(self) -> bool:
+            if random.random() >= config.error_rate:
+                return False
+            count("errors_injected")
+            self._send_json({"error": {"message": "Rate limit reached", "type": "rate_limit_exceeded",
+                                       "code": "rate_limit_exceeded", "param": None}},
+                            status=429, headers={"retry-after": "0"})
+            return True
+
+        def _respond_llm(self, request: dict):
+            pause(config, config.llm_latency)
+            if request.get("stream"):
+                self._stream_response(STUB_ANSWER)
+            else:
+                pause(config, config.llm_token_interval * len(stub_tokens(STUB_ANSWER)))
+                self._send_json(stub_response(STUB_ANSWER))
+
+        def _read_body_discarding(self) -> int:
+            # Uploads can be large; count them without keeping them in memory
+            remaining = int(self.headers.get("content-length") or 0)
+            received = 0
+            while remaining > 0:
+                chunk = self.rfile.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break
+                received += len(chunk)
+                remaining -= len(chunk)
+            return received
+
+        def do_GET(self):
+            if self.path == "/stub/stats":
+                with stats_lock:
+                    self._send_json(dict(stats))
+            # AssemblyAI: poll a transcript
+            elif self.path.startswith("/v2/transcript/"):
+                pause(config, config.stt_latency)
+                self._send_json({
+                    "id": self.path.rsplit("/", 1)[-1],
+                    "status": "completed",
+                    "text": STUB_TRANSCRIPT,
+                })
+            # OpenAI: poll a vector store file batch (indexing is instant)
+            elif "/file_batches/" in self.path:
+                parts = self.path.split("?")[0].split("/")
+                self._send_json(stub_file_batch(parts[3], parts[5], "completed"))
+            else:
+                self._send_json({"error": f"Unknown path {self.path}"}, status=404)
+
+        def do_POST(self):
+            # OpenAI: file upload (multipart)
+            if self.path == "/v1/files":
+                size = self._read_body_discarding()
+                pause(config, config.file_latency + config.file_mb_latency * size / (1024 * 1024))
+                count("files_uploaded")
+                self._send_json({
+                    "id": f"file-{uuid.uuid4().hex}",
+                    "object": "file",
+                    "bytes": size,
+                    "created_at": int(time.time()),
+                    "filename": "upload",
+                    "purpose": "assistants",
+                    "status": "processed",
+                })
+                return
+            body = self._read_body()
+            if self.path in ("/v2/upload", "/v1/responses") or self.path.startswith("/v1/text-to-speech/"):
+                if self._rate_limited():
+                    return
+            # AssemblyAI: upload and create transcript
+            if self.path == "/v2/upload":
+                self._send_json({"upload_url": f"stub://upload/{uuid.uuid4()}"})
+            elif self.path == "/v2/transcript":
+                self._send_json({"id": str(uuid.uuid4()), "status": "queued"})
+            # OpenAI: Responses API
+            elif self.path == "/v1/responses":
+                request = json.loads(body or b"{}")
+                if llm_slots is None:
+                    self._respond_llm(request)
+                else:
+                    # Over capacity, requests wait for a free slot
+                    if not llm_slots.acquire(blocking=False):
+                        count("llm_requests_waited")
+                        llm_slots.acquire()
+                    try:
+                        self._respond_llm(request)
+                    finally:
+                        llm_slots.release()
+            # OpenAI: vector stores and file batches
+            elif self.path == "/v1/vector_stores":
+                count("vector_stores_created")
+                self._send_json({
+                    "id": f"vs_{uuid.uuid4().hex}",
+                    "object": "vector_store",
+                    "created_at": int(time.time()),
+                    "name": json.loads(body or b"{}").get("name"),
+                    "status": "completed",
+                    "file_counts": stub_file_counts(0, 0),
+                })
+            elif self.path.endswith("/file_batches"):
+                file_ids = json.loads(body or b"{}").get("file_ids", [])
+                batch = stub_file_batch(self.path.split("/")[3], f"vsfb_{uuid.uuid4().hex}", "in_progress")
+                batch["file_counts"] = stub_file_counts(len(file_ids), 0)
+                self._send_json(batch)
+            # ElevenLabs: convert and stream
+            elif self.path.split("?")[0].startswith("/v1/text-to-speech/"):
+                query = parse_qs(urlparse(self.path).query)
+                self._send_audio(json.loads(body or b"{}").get("text", ""),
+                                 query.get("output_format", [STUB_AUDIO_FORMAT])[0])
+            else:
+                self._send_json({"error": f"Unknown path {self.path}", "body_bytes": len(body)}, status=404)
+
+        def do_DELETE(self):
+            # OpenAI: delete a file, a vector store, or a file from a vector store
+            parts = self.path.split("?")[0].strip("/").split("/")
+            if parts[:2] == ["v1", "files"] and len(parts) == 3:
+                count("files_deleted")
+                self._send_json({"id": parts[2], "object": "file", "deleted": True})
+            elif parts[:2] == ["v1", "vector_stores"] and len(parts) == 3:
+                count("vector_stores_deleted")
+                self._send_json({"id": parts[2], "object": "vector_store.deleted", "deleted": True})
+            elif parts[:2] == ["v1", "vector_stores"] and len(parts) == 5 and parts[3] == "files":
+                count("vector_store_files_deleted")
+                self._send_json({"id": parts[4], "object": "vector_store.file.deleted", "deleted": True})
+            else:
+                self._send_json({"error": f"Unknown path {self.path}"}, status=404)
+
+    return StubHandler
+
+
+def ogg_page(packets: list, header_type: int = 0, granule: int = 0, sequence: int = 0) -> bytes:
+    lacing = b""
+    for packet in packets:
+        lacing += b"\xff" * (len(packet) // 255) + bytes([len(packet) % 255])
+    # The checksum is left at zero; the app does not verify it
+    return (b"OggS" + struct.pack("<BBqIII", 0, header_type, granule, 1, sequence, 0)
+            + bytes([len(lacing)]) + lacing + b"".join(packets))
+
+
+def stub_ogg_opus(seconds: float, bitrate: int) -> bytes:
+    """An Ogg Opus stream of silent-looking 20 ms packets at `bitrate`, ten packets per page."""
+    head = b"OpusHead" + struct.pack("<BBHIhB", 1, 1, 312, 48000, 0, 0)
+    pages = [ogg_page([head], header_type=0x02), ogg_page([b"OpusTags" + bytes(8)], sequence=1)]
+    packet = b"\xf8" + bytes(max(1, bitrate // 8 // 50 - 1))
+    packets = max(1, round(seconds * 50))
+    for sequence, start in enumerate(range(0, packets, 10), start=2):
+        end = min(start + 10, packets)
+        pages.append(ogg_page([packet] * (end - start), header_type=0x04 if end == packets else 0,
+                              granule=end * 960, sequence=sequence))
+    return b"".join(pages)
+
+
+def stub_audio(output_format: str, mp3_bytes: int) -> bytes:
+    """Audio in `output_format` as long as `mp3_bytes` of the default mp3_44100_128 would play."""
+    seconds = mp3_bytes / (128000 / 8)
+    codec, rate, bitrate = (output_format.split("_") + ["", ""])[:3]
+    if codec == "opus" and bitrate.isdigit():
+        return stub_ogg_opus(seconds, int(bitrate) * 1000)
+    if codec == "pcm" and rate.isdigit():
+        return bytes(2 * int(seconds * int(rate)))
+    size = int(seconds * int(bitrate) * 1000 / 8) if codec == "mp3" and bitrate.isdigit() else mp3_bytes
+    return (STUB_AUDIO * (size // len(STUB_AUDIO) + 1))[:size]
+
+
+def stub_tokens(text: str) -> list:
+    words = text.split(" ")
+    return [word + " " for word in words[:-1]] + words[-1:]
+
+
+def stub_response(text: str) -> dict:
+    return {
+        "id": f"resp_{uuid.uuid4().hex}",
+        "object": "response",
+        "created_at": int(time.time()),
+        "model": "gpt-4o-mini",
+        "status": "completed",
+        "parallel_tool_calls": True,
+        "tool_choice": "auto",
+        "tools": [],
+        "output": [{
+            "type": "message",
+            "id": f"msg_{uuid.uuid4().hex}",
+            "role": "assistant",
+            "status": "completed",
+            "content": [{"type": "output_text", "text": text, "annotations": []}],
+        }],
+    }
+
+
+def stub_file_counts(in_progress: int, completed: int) -> dict:
+    return {"in_progress": in_progress, "completed": completed, "failed": 0, "cancelled": 0,
+            "total": in_progress + completed}
+
+
+def stub_file_batch(vector_store_id: str, batch_id: str, status: str) -> dict:
+    return {
+        "id": batch_id,
+        "object": "vector_store.files_batch",
+        "created_at": int(time.time()),
+        "vector_store_id": vector_store_id,
+        "status": status,
+        "file_counts": stub_file_counts(0, 0),
+    }
+
+
+def start_stub_server(config: StubConfig, host: str = "127.0.0.1", port: int = 0):
+    """Start the stub server in a daemon thread and return (server, base_url)."""
+    server = ThreadingHTTPServer((host, port), make_handler(config))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def make_streaming_handler(config: StubConfig):
+    words = STUB_TRANSCRIPT.split()
+
+    def handler(ws):
+        sample_rate = 16000
+        query = ws.request.path.partition("?")[2]
+        for pair in query.split("&"):
+            key, _, value = pair.partition("=")
+            if key == "sample_rate":
+                sample_rate = int(value)
+        ws.send(json.dumps({"type": "Begin", "id": str(uuid.uuid4())}))
+        received = 0
+        partials = 0
+        for message in ws:
+            if isinstance(message, bytes):
+                received += len(message) // 2
+                due = int(received / sample_rate / config.stt_partial_every)
+                if due > partials:
+                    partials = due
+                    ws.send(json.dumps({
+                        "type": "Turn",
+                        "transcript": " ".join(words[:min(len(words), partials * 2)]),
+                        "end_of_turn": False,
+                        "turn_is_formatted": False,
+                    }))
+            elif json.loads(message).get("type") == "Terminate":
+                pause(config, config.stt_final_latency)
+                ws.send(json.dumps({
+                    "type": "Turn",
+                    "transcript": STUB_TRANSCRIPT,
+                    "end_of_turn": True,
+                    "turn_is_formatted": True,
+                }))
+                ws.send(json.dumps({"type": "Termination"}))
+                return
+
+    return handler
+
+
+def start_stub_streaming_server(config: StubConfig, host: str = "127.0.0.1", port: int = 0):
+    """Start the streaming STT stub in a daemon thread and return (server, ws_url)."""
+    server = serve(make_streaming_handler(config), host, port)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"ws://{host}:{server.socket.getsockname()[1]}/v3/ws"
+
+
+def start_stub_process(config: StubConfig, port: int, ws_port: int) -> subprocess.Popen:
+    """Run the stub servers in their own process so they do not share a GIL with the load generator."""
+    return subprocess.Popen([
+        sys.executable, os.path.abspath(__file__), "--port", str(port), "--ws-port", str(ws_port),
+        "--stt-latency", str(config.stt_latency),
+        "--llm-latency", str(config.llm_latency),
+        "--tts-latency", str(config.tts_latency),
+        "--llm-token-interval", str(config.llm_token_interval),
+        "--tts-char-latency", str(config.tts_char_latency),
+        *(["--tts-stream"] if config.tts_stream else []),
+        "--file-latency", str(config.file_latency),
+        "--file-mb-latency", str(config.file_mb_latency),
+        "--llm-capacity", str(config.llm_capacity),
+        "--error-rate", str(config.error_rate),
+        "--jitter", str(config.jitter),
+    ], stdout=subprocess.DEVNULL)
+
+
+def stub_env(base_url: str, streaming_url: str = "") -> dict:
+    """Environment variables that point main.py at running stub servers."""
+    return {
+        "ASSEMBLYAI_BASE_URL": base_url,
+        "ASSEMBLYAI_STREAMING_URL": streaming_url,
+        "ASSEMBLYAI_API_KEY": "stub",
+        "LLM_BASE_URL": f"{base_url}/v1",
+        "LLM_API_KEY": "stub",
+        "ELEVENLABS_BASE_URL": base_url,
+        "ELEVENLABS_API_KEY": "stub",
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the stub vendor APIs")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--ws-port", type=int, default=9001)
+    parser.add_argument("--stt-latency", type=float, default=StubConfig.stt_latency)
+    parser.add_argument("--llm-latency", type=float, default=StubConfig.llm_latency)
+    parser.add_argument("--tts-latency", type=float, default=StubConfig.tts_latency)
+    parser.add_argument("--llm-token-interval", type=float, default=StubConfig.llm_token_interval)
+    parser.add_argument("--tts-char-latency", type=float, default=StubConfig.tts_char_latency)
+    parser.add_argument("--tts-stream", action="store_true", help="stream TTS audio as it is synthesized")
+    parser.add_argument("--file-latency", type=float, default=StubConfig.file_latency)
+    parser.add_argument("--file-mb-latency", type=float, default=StubConfig.file_mb_latency)
+    parser.add_argument("--llm-capacity", type=int, default=StubConfig.llm_capacity)
+    parser.add_argument("--error-rate", type=float, default=StubConfig.error_rate)
+    parser.add_argument("--jitter", type=float, default=StubConfig.jitter, help="sigma of the log-normal latency factor")
+    args = parser.parse_args()
+
+    config = StubConfig(stt_latency=args.stt_latency, llm_latency=args.llm_latency, tts_latency=args.tts_latency,
+                        llm_token_interval=args.llm_token_interval, tts_char_latency=args.tts_char_latency,
+                        tts_stream=args.tts_stream, file_latency=args.file_latency,
+                        file_mb_latency=args.file_mb_latency, llm_capacity=args.llm_capacity,
+                        error_rate=args.error_rate, jitter=args.jitter)
+    server, base_url = start_stub_server(config, port=args.port)
+    streaming_server, streaming_url = start_stub_streaming_server(config, port=args.ws_port)
+    print(f"Stub vendor APIs listening on {base_url} and {streaming_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+        streaming_server.shutdown()
@@ -0,0 +1,87 @@
+"""Accuracy and throughput of the audio pre-processing in audio.py.
+
+Runs every clip of the synthetic corpus (audio_corpus.py) through
+AudioPreprocessor and checks the decision: clips without speech must be
+rejected, and for clips with speech the trimmed audio must still cover the
+whole speech span (the share of the span that is kept is shown per clip). It reports how much audio was trimmed, and the throughput
+in 20 ms frames per second of CPU time on one core, both for the VAD alone
+and for the whole stage (decode, downmix, resample, VAD, re-encode).
+
+    cd Voice-AI && python benchmarks/vad_bench.py --repeat 20
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from audio import AudioPreprocessor, NoSpeechError, decode_wav, speech_frames, speech_span, to_mono  # noqa: E402
+from audio_corpus import build_corpus  # noqa: E402
+
+
+def check(clip, preprocessor):
+    samples, rate = decode_wav(clip.wav)
+    try:
+        result = preprocessor.process_samples(samples, rate)
+    except NoSpeechError:
+        return clip.speech is None, "rejected", 0.0
+    if clip.speech is None:
+        return False, "kept", result.output_ms / 1000
+
+    mono = to_mono(samples, rate, preprocessor.sample_rate)
+    start, end, _ = speech_span(mono, preprocessor.sample_rate, preprocessor.settings)
+    start_s, end_s = start / preprocessor.sample_rate, end / preprocessor.sample_rate
+    covered = start_s <= clip.speech[0] and end_s >= clip.speech[1]
+    coverage = (min(end_s, clip.speech[1]) - max(start_s, clip.speech[0])) / (clip.speech[1] - clip.speech[0])
+    return covered, f"kept {start_s:.2f}-{end_s:.2f}s {coverage:4.0%}", result.output_ms / 1000
+
+
+def main(args):
+    corpus = build_corpus(args.seed)
+    preprocessor = AudioPreprocessor()
+
+    print(f"{'clip':<40} {'truth':>12} {'result':>23} {'ok':>3}")
+    correct = 0
+    input_seconds = output_seconds = 0.0
+    for clip in corpus:
+        ok, outcome, kept_seconds = check(clip, preprocessor)
+        correct += ok
+        input_seconds += clip.duration
+        output_seconds += kept_seconds
+        truth = f"{clip.speech[0]:.2f}-{clip.speech[1]:.2f}s" if clip.speech else "no speech"
+        print(f"{clip.name:<40} {truth:>12} {outcome:>23} {'yes' if ok else 'NO':>3}")
+    print(f"\n{correct}/{len(corpus)} correct; {input_seconds:.1f}s of audio in, "
+          f"{output_seconds:.1f}s sent to STT ({1 - output_seconds / input_seconds:.0%} trimmed or rejected)")
+
+    # Throughput on one core: CPU time, with the decoded 16 kHz audio already in memory for the VAD-only number
+    decoded = [decode_wav(clip.wav) for clip in corpus]
+    mono = [to_mono(samples, rate, 16000) for samples, rate in decoded]
+    frames = sum(len(m) // 320 for m in mono) * args.repeat
+    audio_seconds = sum(clip.duration for clip in corpus) * args.repeat
+
+    started = time.process_time()
+    for _ in range(args.repeat):
+        for samples in mono:
+            speech_frames(samples, 16000, preprocessor.settings)
+    vad_cpu = time.process_time() - started
+
+    started = time.process_time()
+    for _ in range(args.repeat):
+        for clip in corpus:
+            samples, rate = decode_wav(clip.wav)
+            try:
+                preprocessor.process_samples(samples, rate)
+            except NoSpeechError:
+                pass
+    stage_cpu = time.process_time() - started
+
+    print(f"VAD only:   {frames / vad_cpu:>12,.0f} frames/s per core ({audio_seconds / vad_cpu:,.0f}x real time)")
+    print(f"Full stage: {frames / stage_cpu:>12,.0f} frames/s per core ({audio_seconds / stage_cpu:,.0f}x real time)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark VAD accuracy and throughput")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=7)
+    main(parser.parse_args())
@@ -0,0 +1,157 @@
+"""Throughput against the number of uvicorn workers, and cross-worker events.
+
+For each worker count, starts the app with WORKERS=N uvicorn workers (plus
+the stub vendor server), waits until every worker has a heartbeat in Redis,
+then:
+
+1. throughput: runs `--sessions` concurrent /ws sessions of `--turns` turns
+   each and reports turns per second, turn latency and the speedup over the
+   first worker count. In `audio` mode every turn carries a 2 s WAV
+   utterance, so the VAD and resampling in audio.py add real CPU work per
+   turn. Keep the stub latencies low (the defaults) so the app, not the
+   vendors, is the bottleneck.
+2. delivery: opens `--sockets` sockets of one session (the kernel spreads
+   them over the workers), uploads a file for that session through
+   /api/upload and counts the sockets that see its upload_progress events.
+   Without the Redis session bus only the sockets on the worker that handled
+   the upload would.
+
+Scaling needs as many free cores as workers; `nproc` is printed for context.
+Requires a Redis server on localhost:6379 (used by main.py).
+
+    cd Voice-AI && python benchmarks/worker_scaling.py --workers 1,2,4 --sessions 64 --turns 5
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import time
+
+import httpx
+import numpy as np
+import redis
+import websockets
+
+from audio_corpus import to_wav, utterance
+from load_test import free_port, percentile, start_app, start_stubs, wait_until_up
+from stub_servers import StubConfig
+
+
+async def wait_for_workers(base_url: str, workers: int, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as http:
+        while time.monotonic() < deadline:
+            status = (await http.get(f"{base_url}/api/status/workers")).json()
+            if len(status.get("workers", [])) >= workers:
+                return
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"Only some of the {workers} workers came up")
+
+
+async def run_session(ws_url: str, session_id: str, turns: int, message: dict, latencies: list):
+    async with websockets.connect(ws_url, max_size=None) as ws:
+        for _ in range(turns):
+            started = time.perf_counter()
+            await ws.send(json.dumps({**message, "session_id": session_id}))
+            while True:
+                reply = json.loads(await ws.recv())
+                if reply["type"] in ("tts", "tts_end", "error", "no_speech"):
+                    break
+            latencies.append(time.perf_counter() - started)
+
+
+async def throughput(base_url: str, sessions: int, turns: int, message: dict):
+    ws_url = base_url.replace("http", "ws", 1) + "/ws"
+    latencies = []
+    started = time.perf_counter()
+    await asyncio.gather(*(run_session(ws_url, f"bench-{i}", turns, message, latencies) for i in range(sessions)))
+    return latencies, time.perf_counter() - started
+
+
+async def delivery(base_url: str, sockets: int) -> tuple:
+    """Sockets of one session that received upload progress, and how many workers held them."""
+    session_id = f"bench-bus-{time.monotonic_ns()}"
+    ws_url = base_url.replace("http", "ws", 1) + f"/ws?session_id={session_id}"
+    connections = [await websockets.connect(ws_url, max_size=None) for _ in range(sockets)]
+    received = [False] * sockets
+
+    async def listen(index, ws):
+        async for raw in ws:
+            if json.loads(raw).get("type") == "upload_progress":
+                received[index] = True
+
+    listeners = [asyncio.create_task(listen(i, ws)) for i, ws in enumerate(connections)]
+    try:
+        async with httpx.AsyncClient(timeout=60) as http:
+            # Connections register asynchronously; give the last ones a moment
+            await asyncio.sleep(0.5)
+            status = (await http.get(f"{base_url}/api/status/workers", params={"session_id": session_id})).json()
+            holders = set(status["session_connections"].values())
+            response = await http.post(f"{base_url}/api/upload", data={"session_id": session_id},
+                                       files=[("files", ("doc.txt", os.urandom(4096), "text/plain"))])
+            response.raise_for_status()
+        await asyncio.sleep(1.0)
+    finally:
+        for task in listeners:
+            task.cancel()
+        for ws in connections:
+            await ws.close()
+    return sum(received), len(holders)
+
+
+async def main(args):
+    config = StubConfig(stt_latency=args.stt_latency, llm_latency=args.llm_latency, llm_token_interval=0,
+                        tts_latency=args.tts_latency, tts_char_latency=0)
+    stub, env = start_stubs(config)
+    store = redis.Redis(host="localhost", port=6379)
+    for i in range(args.sessions):
+        store.hset(f"session:bench-{i}", "vector_store_id", "vs_bench")
+        store.expire(f"session:bench-{i}", 3600)
+
+    if args.mode == "audio":
+        speech = utterance(np.random.default_rng(1), 16000, 2.0, -25)
+        wav = to_wav(np.concatenate([np.zeros(8000), speech, np.zeros(8000)]), 16000, 1)
+        message = {"type": "audio", "audio_data": base64.b64encode(wav).decode()}
+    else:
+        message = {"type": "text", "message": "What is latency?"}
+    # Every turn should do the full work: no cached answers or audio
+    app_env = {**env, "ANSWER_CACHE": "0", "TTS_CACHE_MAX_BYTES": "0", "TTS_CACHE_REDIS": "0"}
+
+    print(f"mode={args.mode} sessions={args.sessions} turns/session={args.turns} cores={os.cpu_count()}")
+    print(f"{'workers':>7} {'turns/s':>8} {'speedup':>8} {'p50':>8} {'p95':>8} {'events':>12}")
+    baseline = None
+    try:
+        for workers in (int(n) for n in args.workers.split(",")):
+            port = free_port()
+            app = start_app(port, app_env, workers=workers)
+            base_url = f"http://127.0.0.1:{port}"
+            try:
+                await wait_until_up(base_url)
+                await wait_for_workers(base_url, workers)
+                latencies, elapsed = await throughput(base_url, args.sessions, args.turns, message)
+                rate = len(latencies) / elapsed
+                baseline = baseline or rate
+                got, holders = await delivery(base_url, args.sockets)
+                print(f"{workers:>7} {rate:>8.1f} {rate / baseline:>7.2f}x "
+                      f"{percentile(latencies, 50) * 1000:>6.0f}ms {percentile(latencies, 95) * 1000:>6.0f}ms "
+                      f"{got:>3}/{args.sockets:<3} on {holders}w")
+            finally:
+                app.terminate()
+                app.wait()
+    finally:
+        stub.terminate()
+        stub.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark throughput scaling with uvicorn workers")
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--sessions", type=int, default=64)
+    parser.add_argument("--turns", type=int, default=5)
+    parser.add_argument("--mode", choices=["text", "audio"], default="audio")
+    parser.add_argument("--sockets", type=int, default=8, help="sockets of one session for the delivery check")
+    parser.add_argument("--stt-latency", type=float, default=0.02)
+    parser.add_argument("--llm-latency", type=float, default=0.02)
+    parser.add_argument("--tts-latency", type=float, default=0.02)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,168 @@
+"""Long-lived, connection-pooled HTTP clients for the vendor APIs.
+
+One `httpx.AsyncClient` per provider is opened at startup and shared by every
+request, so turns reuse warm keep-alive (and, when `h2` is installed, HTTP/2)
+connections instead of paying a TCP and TLS handshake per call. Pool size and
+timeouts are configured per provider through environment variables, e.g.
+`OPENAI_POOL_MAX_CONNECTIONS` or `ELEVENLABS_HTTP_TIMEOUT`, falling back to the
+unprefixed `POOL_MAX_CONNECTIONS` / `HTTP_TIMEOUT` defaults.
+
+`warm()` opens a pool's connections ahead of the first request (see warmup.py).
+"""
+import asyncio
+import importlib.util
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+import httpx
+
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+def _env(provider: str, name: str, default: str) -> str:
+    return os.getenv(f"{provider.upper()}_{name}", os.getenv(name, default))
+
+
+@dataclass
+class PoolSettings:
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 30.0
+    connect_timeout: float = 5.0
+    timeout: float = 60.0
+    http2: bool = True
+
+    @classmethod
+    def from_env(cls, provider: str) -> "PoolSettings":
+        return cls(
+            max_connections=int(_env(provider, "POOL_MAX_CONNECTIONS", str(cls.max_connections))),
+            max_keepalive_connections=int(_env(provider, "POOL_MAX_KEEPALIVE", str(cls.max_keepalive_connections))),
+            keepalive_expiry=float(_env(provider, "POOL_KEEPALIVE_EXPIRY", str(cls.keepalive_expiry))),
+            connect_timeout=float(_env(provider, "CONNECT_TIMEOUT", str(cls.connect_timeout))),
+            timeout=float(_env(provider, "HTTP_TIMEOUT", str(cls.timeout))),
+            http2=_env(provider, "HTTP2", "1") not in ("0", "false", "no"),
+        )
+
+    @property
+    def limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+
+    @property
+    def timeouts(self) -> httpx.Timeout:
+        return httpx.Timeout(self.timeout, connect=self.connect_timeout)
+
+
+@dataclass
+class PoolStats:
+    requests: int = 0
+    connections_opened: int = 0
+    # Time from handing a request to the pool until it starts using a connection
+    # (waiting for a free slot plus, for new connections, the TCP/TLS handshake)
+    wait_seconds_total: float = 0.0
+    wait_seconds_max: float = 0.0
+
+    def record_wait(self, seconds: float):
+        self.requests += 1
+        self.wait_seconds_total += seconds
+        self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+
+
+class InstrumentedTransport(httpx.AsyncHTTPTransport):
+    """HTTP transport that records connection acquisition time via httpcore trace events."""
+
+    def __init__(self, stats: PoolStats, **kwargs):
+        super().__init__(**kwargs)
+        self.stats = stats
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        started = time.perf_counter()
+        acquired = False
+        parent_trace = request.extensions.get("trace")
+
+        async def trace(event: str, info: dict):
+            nonlocal acquired
+            if not acquired and event.endswith(("connect_tcp.started", "send_request_headers.started")):
+                acquired = True
+                self.stats.record_wait(time.perf_counter() - started)
+            if event == "connection.connect_tcp.complete":
+                self.stats.connections_opened += 1
+            if parent_trace is not None:
+                await parent_trace(event, info)
+
+        request.extensions["trace"] = trace
+        return await super().handle_async_request(request)
+
+    def connection_counts(self) -> Dict[str, int]:
+        connections = self._pool.connections
+        idle = sum(1 for connection in connections if connection.is_idle())
+        return {"active": len(connections) - idle, "idle": idle}
+
+
+@dataclass
+class ProviderPool:
+    client: httpx.AsyncClient
+    transport: InstrumentedTransport
+    settings: PoolSettings
+    stats: PoolStats = field(default_factory=PoolStats)
+
+
+class ClientRegistry:
+    """Holds one pooled HTTP client per provider for the lifetime of the app."""
+
+    def __init__(self):
+        self.pools: Dict[str, ProviderPool] = {}
+
+    def http_client(self, provider: str, base_url: Optional[str] = None,
+                    headers: Optional[Dict[str, str]] = None) -> httpx.AsyncClient:
+        pool = self.pools.get(provider)
+        if pool is None:
+            settings = PoolSettings.from_env(provider)
+            stats = PoolStats()
+            transport = InstrumentedTransport(
+                stats,
+                limits=settings.limits,
+                http2=settings.http2 and HTTP2_AVAILABLE,
+            )
+            client = httpx.AsyncClient(
+                base_url=base_url or "",
+                headers=headers,
+                timeout=settings.timeouts,
+                transport=transport,
+            )
+            pool = self.pools[provider] = ProviderPool(client, transport, settings, stats)
+        return pool.client
+
+    async def warm(self, provider: str, url: str, connections: int = 1):
+        """Open up to `connections` keep-alive connections to `url`'s host; any response will do.
+        Over HTTP/2 the concurrent requests may share one connection, which is all that is needed."""
+        client = self.pools[provider].client
+        await asyncio.gather(*(client.get(url) for _ in range(connections)))
+
+    def settings(self, provider: str) -> PoolSettings:
+        return self.pools[provider].settings
+
+    def stats(self) -> Dict[str, dict]:
+        report = {}
+        for provider, pool in self.pools.items():
+            stats = pool.stats
+            report[provider] = {
+                **pool.transport.connection_counts(),
+                "max_connections": pool.settings.max_connections,
+                "http2": pool.settings.http2 and HTTP2_AVAILABLE,
+                "requests": stats.requests,
+                "connections_opened": stats.connections_opened,
+                "wait_ms_avg": round(stats.wait_seconds_total / stats.requests * 1000, 3) if stats.requests else 0.0,
+                "wait_ms_max": round(stats.wait_seconds_max * 1000, 3),
+            }
+        return report
+
+    async def aclose(self):
+        for pool in self.pools.values():
+            await pool.client.aclose()
+        self.pools.clear()
@@ -0,0 +1,213 @@
+"""Conversation memory: a session's earlier exchanges, so follow-up questions keep their context.
+
+Stored in Redis next to the session (see session_store.py) and expiring with
+it:
+
+    conversation:{id}            hash: `summary` of the exchanges folded away,
+                                 `chars` of the exchanges still listed
+    conversation:{id}:exchanges  list: one JSON [question, answer] per
+                                 exchange, oldest first
+
+A prompt carries the instructions, the summary and the exchanges before the
+new question (see llm.py), so consecutive turns share a long unchanged
+prefix that the provider's prompt cache can reuse. This is used instead of
+chaining OpenAI responses with previous_response_id: a chained response
+brings every earlier file_search result along and cannot be trimmed.
+
+The listed exchanges are kept within `max_tokens` (estimated at
+CHARS_PER_TOKEN characters each). When a new exchange takes them over it,
+the oldest ones are folded into the summary by the LLM, in the background,
+until they are down to half of it. Folding a batch at a time rather than one
+exchange per turn keeps the prefix unchanged for the turns in between.
+Until a fold lands, or when summarizing is disabled or fails, the oldest
+exchanges are left out of the prompt, so the input stays bounded either way.
+The summary is a background LLM call that gives way to turns (see
+admission.py); a fold that did not get the LLM is retried after the next
+exchange.
+"""
+import json
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, List, Optional
+
+import redis
+import redis.asyncio
+
+from admission import Busy
+from llm import Exchange
+from turns import CHARS_PER_TOKEN
+
+log = logging.getLogger(__name__)
+
+SUMMARY_FIELD = "summary"
+CHARS_FIELD = "chars"
+
+
+def exchange_chars(exchange: Exchange) -> int:
+    return len(exchange.question) + len(exchange.answer)
+
+
+def transcript(summary: str, exchanges: List[Exchange]) -> str:
+    """The text a summary is written from: the previous summary and the exchanges to add to it."""
+    lines = [f"Earlier: {summary}"] if summary else []
+    for exchange in exchanges:
+        lines.append(f"User: {exchange.question}")
+        lines.append(f"Assistant: {exchange.answer}")
+    return "\n".join(lines)
+
+
+@dataclass
+class Conversation:
+    summary: str = ""
+    exchanges: List[Exchange] = field(default_factory=list)
+
+    def tokens(self) -> int:
+        return (len(self.summary) + sum(exchange_chars(exchange) for exchange in self.exchanges)) // CHARS_PER_TOKEN
+
+
+@dataclass
+class ConversationStats:
+    exchanges_recorded: int = 0
+    # Prompts built with earlier exchanges, and the conversation tokens they carried
+    prompts: int = 0
+    prompt_tokens_total: int = 0
+    prompt_tokens_max: int = 0
+    # Prompts that left out exchanges over the budget (a fold had not landed yet)
+    trimmed_prompts: int = 0
+    folds: int = 0
+    exchanges_folded: int = 0
+    fold_failures: int = 0
+    # Folds put off because turns needed the LLM
+    folds_deferred: int = 0
+    fold_seconds_total: float = 0.0
+    clears: int = 0
+
+
+class ConversationStore:
+    def __init__(self, redis_client: redis.asyncio.Redis, ttl: int = 3600, max_tokens: int = 1500,
+                 summary_chars: int = 1200, prefix: str = "conversation:"):
+        # The client must decode responses to str
+        self.redis = redis_client
+        self.ttl = ttl
+        self.max_tokens = max_tokens
+        self.summary_chars = summary_chars
+        self.prefix = prefix
+        self.stats = ConversationStats()
+
+    def key(self, session_id: str) -> str:
+        return self.prefix + session_id
+
+    async def load(self, session_id: str) -> Conversation:
+        """The conversation to put in the next prompt, within `max_tokens`."""
+        key = self.key(session_id)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hget(key, SUMMARY_FIELD)
+            pipe.lrange(key + ":exchanges", 0, -1)
+            pipe.expire(key, self.ttl)
+            pipe.expire(key + ":exchanges", self.ttl)
+            summary, items, _, _ = await pipe.execute()
+        exchanges = [Exchange(*json.loads(item)) for item in items]
+
+        # Newest first, as many as fit; the rest are on their way into the summary
+        budget = self.max_tokens * CHARS_PER_TOKEN
+        kept = len(exchanges)
+        while kept and budget - exchange_chars(exchanges[kept - 1]) >= 0:
+            budget -= exchange_chars(exchanges[kept - 1])
+            kept -= 1
+        if kept:
+            self.stats.trimmed_prompts += 1
+        conversation = Conversation(summary or "", exchanges[kept:])
+        if conversation.exchanges or conversation.summary:
+            tokens = conversation.tokens()
+            self.stats.prompts += 1
+            self.stats.prompt_tokens_total += tokens
+            self.stats.prompt_tokens_max = max(self.stats.prompt_tokens_max, tokens)
+        return conversation
+
+    async def append(self, session_id: str, question: str, answer: str) -> bool:
+        """Record an exchange; True when the listed exchanges are now over the budget and should be folded."""
+        key = self.key(session_id)
+        exchange = Exchange(question, answer)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.rpush(key + ":exchanges", json.dumps([exchange.question, exchange.answer]))
+            pipe.hincrby(key, CHARS_FIELD, exchange_chars(exchange))
+            pipe.expire(key, self.ttl)
+            pipe.expire(key + ":exchanges", self.ttl)
+            _, chars, _, _ = await pipe.execute()
+        self.stats.exchanges_recorded += 1
+        return chars // CHARS_PER_TOKEN > self.max_tokens
+
+    async def fold(self, session_id: str, summarize: Optional[Callable[[str, List[Exchange]], Awaitable[str]]]):
+        """Fold the oldest exchanges into the summary until the rest fit in half the budget.
+
+        Without `summarize` (or if it fails) they are dropped; if it raises Busy
+        they stay for the next fold. One fold per session runs at a time, across
+        workers.
+        """
+        key = self.key(session_id)
+        lock = key + ":folding"
+        if not await self.redis.set(lock, "1", nx=True, ex=120):
+            return
+        started = time.perf_counter()
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.hget(key, SUMMARY_FIELD)
+                pipe.lrange(key + ":exchanges", 0, -1)
+                summary, items = await pipe.execute()
+            exchanges = [Exchange(*json.loads(item)) for item in items]
+            chars = sum(exchange_chars(exchange) for exchange in exchanges)
+            folded = 0
+            while folded < len(exchanges) and chars > self.max_tokens * CHARS_PER_TOKEN // 2:
+                chars -= exchange_chars(exchanges[folded])
+                folded += 1
+            if not folded:
+                return
+
+            summary = summary or ""
+            if summarize is not None:
+                try:
+                    summary = (await summarize(summary, exchanges[:folded])).strip()[:self.summary_chars]
+                except Busy:
+                    self.stats.folds_deferred += 1
+                    return
+                except Exception as e:
+                    self.stats.fold_failures += 1
+                    log.warning(f"Conversation summary failed for session {session_id}: {e}")
+
+            # Exchanges recorded meanwhile were appended after the folded ones and stay
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.hset(key, SUMMARY_FIELD, summary)
+                pipe.ltrim(key + ":exchanges", folded, -1)
+                pipe.hincrby(key, CHARS_FIELD, -sum(exchange_chars(exchange) for exchange in exchanges[:folded]))
+                pipe.expire(key, self.ttl)
+                await pipe.execute()
+            self.stats.folds += 1
+            self.stats.exchanges_folded += folded
+            self.stats.fold_seconds_total += time.perf_counter() - started
+        except redis.RedisError as e:
+            log.warning(f"Conversation fold Redis error: {e}")
+        finally:
+            await self.redis.delete(lock)
+
+    async def clear(self, session_id: str):
+        key = self.key(session_id)
+        await self.redis.delete(key, key + ":exchanges")
+        self.stats.clears += 1
+
+    def report(self) -> dict:
+        stats = self.stats
+        return {
+            "max_tokens": self.max_tokens,
+            "exchanges_recorded": stats.exchanges_recorded,
+            "prompts_with_history": stats.prompts,
+            "history_tokens_avg": round(stats.prompt_tokens_total / stats.prompts, 1) if stats.prompts else 0.0,
+            "history_tokens_max": stats.prompt_tokens_max,
+            "trimmed_prompts": stats.trimmed_prompts,
+            "folds": stats.folds,
+            "exchanges_folded": stats.exchanges_folded,
+            "fold_failures": stats.fold_failures,
+            "folds_deferred": stats.folds_deferred,
+            "fold_ms_avg": round(stats.fold_seconds_total / stats.folds * 1000, 1) if stats.folds else 0.0,
+            "clears": stats.clears,
+        }
@@ -0,0 +1,275 @@
+"""Reply audio on /ws: a format negotiated per connection, cut into frames sized to the client's link.
+
+A client lists the formats it can play, best first, when it connects:
+
+    /ws?protocol=1&formats=opus_48000_32,pcm_16000,mp3_44100_128
+
+and gets the first one the TTS backend supports, or the backend's own format
+when there is none (or the client lists none). A JSON client whose backend
+format is framed gets a whole format instead: WAV at the same sample rate, or
+MP3, whichever the backend supports first. Every turn_start announces it.
+
+There are two kinds of format:
+
+- framed (opus, pcm): the audio is cut into frames the client decodes as
+  they arrive, so a sentence starts playing after its first frame instead of
+  once all of it has been synthesized and sent. A pcm frame is raw 16-bit
+  little-endian samples. An opus frame is whole Opus packets taken out of the
+  Ogg stream, each after its length (2 bytes, big-endian), for a WebCodecs
+  AudioDecoder. Framed formats need binary frames (see protocol.py), so JSON
+  clients are not given one unless the backend supports no whole format.
+- whole (mp3, wav, ...): each sentence, or the whole reply, is one file.
+
+Opus at 32 kbit/s takes a quarter of the bandwidth of the default
+mp3_44100_128.
+
+Frame sizes follow the client's link. The client acknowledges every frame
+(`{"type": "audio_ack", "turn_id": ..., "seq": ...}`). A frame sent before
+the previous one was acknowledged queued behind it, so the gap between the
+two acks is the time the link took to carry it: its size over that gap is a
+throughput sample, smoothed with an EWMA. (Frames sent to an idle link say
+nothing about its capacity and are not sampled.) The first frame of a reply holds `min_ms` of
+audio, for a quick start. Each later frame is at most twice the previous
+one, so it never holds more than the client has queued to play (as long as
+synthesis runs faster than real time), and at most what the link delivers in
+`send_ms`, and never more than `max_ms` of audio. Fast links get fewer,
+larger frames; slow ones keep getting small frames that keep playback going.
+"""
+import struct
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from turns import audio_bytes_per_second
+
+FRAMED_CODECS = ("opus", "pcm")
+# Whole formats tried, after WAV at the backend's sample rate, for JSON clients of a framed backend
+WHOLE_FALLBACKS = ("mp3_44100_128", "mp3_22050_32")
+# Length prefix of each Opus packet in a frame
+PACKET_LENGTH = struct.Struct(">H")
+# Frames remembered per connection until acknowledged; a client that never acks forgets the oldest
+MAX_UNACKED = 64
+# Weight of a new throughput sample
+THROUGHPUT_ALPHA = 0.3
+
+
+def codec(output_format: str) -> str:
+    return output_format.partition("_")[0]
+
+
+def is_framed(output_format: str) -> bool:
+    return codec(output_format) in FRAMED_CODECS
+
+
+def parse_formats(value: Optional[str]) -> List[str]:
+    return [part.strip() for part in (value or "").split(",") if part.strip()]
+
+
+class OggOpusDemuxer:
+    """Opus packets out of an Ogg stream that arrives in arbitrary pieces.
+
+    The header packets (OpusHead, OpusTags) of every logical stream are
+    skipped; page checksums are not verified.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        # A packet that continues on the next page
+        self.packet = bytearray()
+        self.headers_left = 0
+
+    def feed(self, data: bytes) -> List[bytes]:
+        self.buffer += data
+        packets = []
+        while len(self.buffer) >= 27:
+            if self.buffer[:4] != b"OggS":
+                raise ValueError("TTS audio is not an Ogg stream")
+            header_size = 27 + self.buffer[26]
+            if len(self.buffer) < header_size:
+                break
+            lacing = self.buffer[27:header_size]
+            page_size = header_size + sum(lacing)
+            if len(self.buffer) < page_size:
+                break
+            if self.buffer[5] & 0x02:
+                # Beginning of a stream: its first two packets are headers
+                self.headers_left = 2
+                self.packet.clear()
+            offset = header_size
+            for value in lacing:
+                self.packet += self.buffer[offset:offset + value]
+                offset += value
+                if value < 255:
+                    if self.headers_left:
+                        self.headers_left -= 1
+                    elif self.packet:
+                        packets.append(bytes(self.packet))
+                    self.packet.clear()
+            del self.buffer[:page_size]
+        return packets
+
+
+@dataclass
+class DeliveryStats:
+    # Connections, frames, bytes and seconds of audio sent, per negotiated format
+    connections: Counter = field(default_factory=Counter)
+    frames: Counter = field(default_factory=Counter)
+    bytes: Counter = field(default_factory=Counter)
+    audio_seconds: Counter = field(default_factory=Counter)
+    acks: int = 0
+    throughput_samples: int = 0
+    throughput_total: float = 0.0
+
+
+class AudioLink:
+    """One connection's audio format and its measured throughput."""
+
+    def __init__(self, output_format: str, binary: bool, delivery: "Delivery"):
+        self.output_format = output_format
+        self.codec = codec(output_format)
+        self.framed = is_framed(output_format)
+        self.binary = binary
+        self.delivery = delivery
+        self.bytes_per_second = audio_bytes_per_second(output_format)
+        # Bytes per second the client receives, once a frame has been acknowledged
+        self.throughput: Optional[float] = None
+        self.last_ack: Optional[float] = None
+        self.unacked: Dict[Tuple[int, int], Tuple[float, int]] = {}
+
+    def audio_bytes(self, ms: float) -> int:
+        return max(1, int(self.bytes_per_second * ms / 1000))
+
+    def max_frame_bytes(self) -> int:
+        largest = self.audio_bytes(self.delivery.max_ms)
+        if self.throughput is None:
+            return largest
+        deliverable = int(self.throughput * self.delivery.send_ms / 1000)
+        return max(self.audio_bytes(self.delivery.min_ms), min(largest, deliverable))
+
+    def framer(self) -> "Framer":
+        return Framer(self)
+
+    def payload(self, audio: bytes) -> bytes:
+        """A whole reply's audio as one frame."""
+        if self.codec == "opus":
+            return b"".join(PACKET_LENGTH.pack(len(packet)) + packet for packet in OggOpusDemuxer().feed(audio))
+        return audio
+
+    def sent(self, turn_id: Optional[int], seq: int, size: int, sent_at: float):
+        stats = self.delivery.stats
+        stats.frames[self.output_format] += 1
+        stats.bytes[self.output_format] += size
+        stats.audio_seconds[self.output_format] += size / self.bytes_per_second
+        if self.binary and turn_id is not None:
+            self.unacked[(turn_id, seq)] = (sent_at, size)
+            if len(self.unacked) > MAX_UNACKED:
+                del self.unacked[next(iter(self.unacked))]
+
+    def acked(self, turn_id: int, seq: int):
+        sent = self.unacked.pop((turn_id, seq), None)
+        if sent is None:
+            return
+        sent_at, size = sent
+        now = time.perf_counter()
+        last_ack, self.last_ack = self.last_ack, now
+        self.delivery.stats.acks += 1
+        if last_ack is None or sent_at > last_ack:
+            return
+        # One delivered within a millisecond of the previous counts as that fast
+        sample = size / max(now - last_ack, 0.001)
+        self.throughput = sample if self.throughput is None else (
+            THROUGHPUT_ALPHA * sample + (1 - THROUGHPUT_ALPHA) * self.throughput)
+        self.delivery.stats.throughput_samples += 1
+        self.delivery.stats.throughput_total += sample
+
+
+class Framer:
+    """Cuts one reply's audio into frames; `frames()` is called once per sentence, in order."""
+
+    def __init__(self, link: AudioLink):
+        self.link = link
+        self.frame_bytes = link.audio_bytes(link.delivery.min_ms)
+
+    async def frames(self, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        if not self.link.framed:
+            yield b"".join([chunk async for chunk in chunks])
+            return
+        demuxer = OggOpusDemuxer() if self.link.codec == "opus" else None
+        buffer = bytearray()
+        async for chunk in chunks:
+            if demuxer is not None:
+                for packet in demuxer.feed(chunk):
+                    buffer += PACKET_LENGTH.pack(len(packet)) + packet
+            else:
+                buffer += chunk
+            while len(buffer) >= self.frame_bytes:
+                cut = self._cut(buffer)
+                yield bytes(buffer[:cut])
+                del buffer[:cut]
+                self._grow()
+        if demuxer is None:
+            del buffer[len(buffer) - len(buffer) % 2:]
+        if buffer:
+            yield bytes(buffer)
+            self._grow()
+
+    def _cut(self, buffer: bytearray) -> int:
+        if self.link.codec == "pcm":
+            return self.frame_bytes - self.frame_bytes % 2
+        # Whole packets only, at least one
+        offset = 0
+        while offset < len(buffer):
+            end = offset + PACKET_LENGTH.size + PACKET_LENGTH.unpack_from(buffer, offset)[0]
+            if offset and end > self.frame_bytes:
+                break
+            offset = end
+        return offset
+
+    def _grow(self):
+        self.frame_bytes = min(2 * self.frame_bytes, self.link.max_frame_bytes())
+
+
+class Delivery:
+    """Settings and counters shared by the links of every connection."""
+
+    def __init__(self, min_ms: float = 60, max_ms: float = 1000, send_ms: float = 100):
+        self.min_ms = min_ms
+        self.max_ms = max_ms
+        self.send_ms = send_ms
+        self.stats = DeliveryStats()
+
+    def link(self, offered: List[str], supports: Callable[[str], bool], default: str, binary: bool) -> AudioLink:
+        if not binary and is_framed(default):
+            # Frames without binary framing would be unplayable: fall back to whole files
+            rate = default.split("_")[1] if "_" in default else ""
+            default = next((fallback for fallback in (f"wav_{rate}", *WHOLE_FALLBACKS) if supports(fallback)),
+                           default)
+        output_format = next((offer for offer in offered
+                              if supports(offer) and (binary or not is_framed(offer))), default)
+        self.stats.connections[output_format] += 1
+        return AudioLink(output_format, binary, self)
+
+    def report(self) -> dict:
+        stats = self.stats
+        formats = {}
+        for output_format, connections in stats.connections.items():
+            seconds = stats.audio_seconds[output_format]
+            formats[output_format] = {
+                "connections": connections,
+                "frames": stats.frames[output_format],
+                "bytes": stats.bytes[output_format],
+                "audio_seconds": round(seconds, 1),
+                "avg_frame_bytes": round(stats.bytes[output_format] / stats.frames[output_format])
+                if stats.frames[output_format] else 0,
+                "kbit_per_audio_second": round(stats.bytes[output_format] * 8 / 1000 / seconds, 1) if seconds else 0.0,
+            }
+        return {
+            "frame_min_ms": self.min_ms,
+            "frame_max_ms": self.max_ms,
+            "frame_send_ms": self.send_ms,
+            "formats": formats,
+            "acks": stats.acks,
+            "avg_throughput_kbit": round(stats.throughput_total / stats.throughput_samples * 8 / 1000, 1)
+            if stats.throughput_samples else None,
+        }
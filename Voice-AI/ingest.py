@@ -0,0 +1,456 @@
+"""Document ingestion for /api/upload.
+
+The request only spools each upload to a file in the spool directory
+(UploadSpool), hashing it in fixed-size chunks as it is copied (in a worker
+thread, so a large file does not stall the event loop), refuses files over
+the spool's `max_bytes` (a request over UploadSizeLimit's limit is refused
+before it is read at all), and queues an ingest job (see jobs.py) whose payload
+holds each file's spool key and hash, so it returns in about the time it
+takes to receive the files. The spool directory must be shared by every host
+that runs jobs (worker.py). The job sends the files that are new to the
+session to OpenAI, several at a time, streamed straight from their spool
+files, and attaches them to the vector store in one file batch; an
+index_status job then polls the batch until it has been indexed. Memory use
+per file is bounded by the chunk size no matter how large the file is, and a
+multi-file upload takes about as long as its slowest file.
+
+A file uploaded by an ingest job is recorded in the spool as soon as it is,
+so when the job runs again (after a failure or a crash) it only uploads the
+files it had not, and still attaches them all. A file the vendor refuses
+(a 4xx other than 429) is marked failed; a transient error (429, 5xx, a
+timeout or a dropped connection) fails the job instead, which jobs.py runs
+again with backoff, and the spool is kept until the job is done for good.
+
+Every vector store and file created for a session is recorded in the
+session's resources (see session_store.py), and deleted with
+delete_resources once the session has expired, along with a local session's
+document directory.
+
+Progress is reported through an `on_progress` callback as dicts with a
+`stage` of hashing, hashed, uploading, uploaded, skipped, failed, attaching,
+indexing or indexed.
+
+LocalIngestion is used when retrieval is local (see llm.py): it chunks and
+embeds each new file into the session's DocumentStore (retrieval.py) instead
+of uploading it, reading it from the spool as it goes, needs no vector
+store, and the files can be searched as soon as the ingest job has finished.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import time
+from dataclasses import asdict, dataclass
+from typing import TYPE_CHECKING, Awaitable, Callable, BinaryIO, Dict, Iterable, List, Optional, Tuple
+
+import redis.asyncio
+from fastapi import UploadFile
+from fastapi.responses import JSONResponse
+
+from admission import is_retryable
+from metrics import span
+from retrieval import DocumentStore
+from session_store import SessionResources, SessionStore
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+log = logging.getLogger(__name__)
+
+ProgressCallback = Callable[[dict], Awaitable[None]]
+
+
+@dataclass
+class IngestFile:
+    # Key of the spooled copy of the upload (see UploadSpool); goes into the ingest job's payload
+    # with the hash, the content stays in the spool
+    key: str
+    filename: str
+    content_type: Optional[str] = None
+    file_hash: str = ""
+    size: int = 0
+    file_id: Optional[str] = None
+    status: str = "pending"  # uploaded, skipped (same content already in the session) or failed
+    error: Optional[str] = None
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    def summary(self) -> dict:
+        return {"filename": self.filename, "file_hash": self.file_hash, "file_id": self.file_id,
+                "status": self.status, "error": self.error}
+
+
+class UploadTooLarge(ValueError):
+    pass
+
+
+class UploadSizeLimit:
+    """ASGI middleware: refuses requests to `paths` with a body over `max_bytes` with 413.
+
+    FastAPI parses a multipart body into temporary files before the endpoint runs, so the
+    spool's own limit only applies once the whole request has been received. This refuses
+    a request on its Content-Length before reading it, or a chunked one as soon as it has
+    sent too much.
+    """
+
+    def __init__(self, app, paths: Iterable[str], max_bytes: int):
+        self.app = app
+        self.paths = set(paths)
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope.get("path") not in self.paths:
+            await self.app(scope, receive, send)
+            return
+        length = dict(scope["headers"]).get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > self.max_bytes:
+            await self.refuse(scope, receive, send)
+            return
+        received = 0
+        too_large = False
+
+        async def limited_receive():
+            nonlocal received, too_large
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    too_large = True
+                    raise UploadTooLarge(f"Request body larger than {self.max_bytes} bytes")
+            return message
+
+        async def guarded_send(message):
+            # Whatever the app makes of the interrupted body, the client gets the 413
+            if not too_large:
+                await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not too_large:
+                raise
+        if too_large:
+            await self.refuse(scope, receive, send)
+
+    async def refuse(self, scope, receive, send):
+        response = JSONResponse({"error": f"Uploads are limited to {self.max_bytes} bytes"}, status_code=413)
+        await response(scope, receive, send)
+
+
+class UploadSpool:
+    """Uploads kept in a directory until their ingest job is done, and the ones it has uploaded.
+
+    Files, in `directory`, which every host that runs ingest jobs must share (e.g. a network
+    volume mounted at the same path); keys are relative to it:
+
+        {upload_id}/{n}                 the upload's n-th file
+
+    and in Redis, expiring `ttl` seconds after it was last written:
+
+        {prefix}{upload_id}:uploaded    file hash -> file id, for the files the job uploaded
+
+    An upload's directory is removed once its job has finished, or by sweep() once it is
+    `ttl` seconds old if the job never does. Files over `max_bytes` are refused while they
+    are being spooled.
+    """
+
+    def __init__(self, directory: str, redis_client: redis.asyncio.Redis, prefix: str = "uploads:",
+                 chunk_size: int = 1024 * 1024, max_bytes: int = 512 * 1024 * 1024, ttl: int = 24 * 3600):
+        self.directory = directory
+        self.redis = redis_client
+        self.prefix = prefix
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+    def key(self, upload_id: str, n: int) -> str:
+        return f"{upload_id}/{n}"
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def uploaded_key(self, upload_id: str) -> str:
+        return f"{self.prefix}{upload_id}:uploaded"
+
+    async def write(self, key: str, upload: UploadFile) -> Tuple[str, int]:
+        """Copy an upload to `key` chunk by chunk; returns the SHA256 and size of its content."""
+        if upload.size is not None and upload.size > self.max_bytes:
+            raise UploadTooLarge(f"{upload.filename} is larger than {self.max_bytes} bytes")
+        return await asyncio.to_thread(self._write, self.path(key), upload.file, upload.filename)
+
+    def _write(self, path: str, file, filename: Optional[str]) -> Tuple[str, int]:
+        digest = hashlib.sha256()
+        size = 0
+        file.seek(0)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as out:
+            while chunk := file.read(self.chunk_size):
+                size += len(chunk)
+                # The size a client declares is not to be trusted
+                if size > self.max_bytes:
+                    raise UploadTooLarge(f"{filename} is larger than {self.max_bytes} bytes")
+                digest.update(chunk)
+                out.write(chunk)
+        return digest.hexdigest(), size
+
+    def open(self, item: IngestFile) -> BinaryIO:
+        try:
+            return open(self.path(item.key), "rb")
+        except FileNotFoundError:
+            raise FileNotFoundError(f"The spooled copy of {item.filename} is gone (expired, or "
+                                    f"{self.directory} is not shared with this host?)") from None
+
+    async def uploaded(self, upload_id: str) -> Dict[str, str]:
+        return await self.redis.hgetall(self.uploaded_key(upload_id))
+
+    async def record_uploaded(self, upload_id: str, item: IngestFile):
+        key = self.uploaded_key(upload_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, item.file_hash, item.file_id)
+            pipe.expire(key, self.ttl)
+            await pipe.execute()
+
+    async def remove(self, upload_id: str):
+        await asyncio.to_thread(shutil.rmtree, self.path(upload_id), True)
+        await self.redis.delete(self.uploaded_key(upload_id))
+
+    def sweep(self) -> int:
+        """Remove upload directories older than `ttl`, whose job never finished; returns how many."""
+        cutoff = time.time() - self.ttl
+        removed = 0
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return 0
+        for entry in entries:
+            try:
+                if entry.is_dir() and entry.stat().st_mtime < cutoff:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    removed += 1
+            except FileNotFoundError:
+                continue
+        return removed
+
+
+def is_transient(error: Exception) -> bool:
+    # Worth running the job again (429, 5xx, timeouts, dropped connections); anything else fails the file
+    return isinstance(error, TimeoutError) or is_retryable(error)
+
+
+def is_not_found(error: Exception) -> bool:
+    # Deleted already (e.g. by an earlier run of the same job)
+    return getattr(error, "status_code", None) == 404
+
+
+class Ingestion:
+    # Whether the session needs an OpenAI vector store to attach files to
+    needs_vector_store = True
+
+    def __init__(self, client: "AsyncOpenAI", sessions: SessionStore, spool: UploadSpool, concurrency: int = 4,
+                 poll_initial: float = 0.5, poll_max: float = 5.0, index_timeout: float = 600.0):
+        self.client = client
+        self.sessions = sessions
+        self.spool = spool
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.poll_initial = poll_initial
+        self.poll_max = poll_max
+        self.index_timeout = index_timeout
+
+    async def spool_files(self, uploads: List[UploadFile], upload_id: str,
+                          on_progress: ProgressCallback) -> List[IngestFile]:
+        """Copy the uploads into the spool, hashing them on the way."""
+        files = [IngestFile(self.spool.key(upload_id, n), upload.filename or "upload", upload.content_type)
+                 for n, upload in enumerate(uploads)]
+
+        async def spool_one(upload: UploadFile, item: IngestFile):
+            await on_progress({"stage": "hashing", "filename": item.filename})
+            item.file_hash, item.size = await self.spool.write(item.key, upload)
+            await on_progress({"stage": "hashed", "filename": item.filename, "bytes": item.size})
+
+        # Every copy has stopped before a failed upload's files are removed
+        results = await asyncio.gather(*(spool_one(upload, item) for upload, item in zip(uploads, files)),
+                                       return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return files
+
+    async def create_vector_store(self, session_id: str) -> str:
+        """A new vector store for the session, recorded in its resources."""
+        vector_store = await self.client.vector_stores.create(name=f"knowledge_base_{session_id}")
+        await self.sessions.add_resources(session_id, SessionResources(vector_store_ids=[vector_store.id]))
+        return vector_store.id
+
+    async def upload_file(self, session_id: str, upload_id: str, item: IngestFile, on_progress: ProgressCallback):
+        async with self.semaphore:
+            await on_progress({"stage": "uploading", "filename": item.filename, "bytes": item.size})
+            try:
+                # httpx streams the multipart body from the spooled file in small chunks
+                async with span("file_upload"):
+                    with self.spool.open(item) as file:
+                        response = await self.client.files.create(
+                            file=(item.filename, file, item.content_type),
+                            purpose="assistants",
+                        )
+                item.file_id = response.id
+                await self.sessions.add_resources(session_id, SessionResources(file_ids=[item.file_id]))
+                await self.spool.record_uploaded(upload_id, item)
+                item.status = "uploaded"
+                await on_progress({"stage": "uploaded", "filename": item.filename, "file_id": item.file_id})
+            except Exception as e:
+                if is_transient(e):
+                    raise
+                await self.failed(item, e, on_progress)
+
+    async def failed(self, item: IngestFile, error: Exception, on_progress: ProgressCallback):
+        item.status = "failed"
+        item.error = str(error)
+        await on_progress({"stage": "failed", "filename": item.filename, "error": item.error})
+
+    async def ingest(self, session_id: str, upload_id: str, vector_store_id: str, files: List[IngestFile],
+                     existing_file_ids: List[Optional[str]], on_progress: ProgressCallback) -> Optional[str]:
+        """Upload the files not yet in the session and attach them in one batch;
+        returns the file batch id, or None when there was nothing new to attach."""
+        uploaded = await self.upload_new(session_id, upload_id, files, existing_file_ids, on_progress)
+        if not uploaded:
+            return None
+        return await self.attach(session_id, vector_store_id, uploaded, on_progress)
+
+    async def upload_new(self, session_id: str, upload_id: str, files: List[IngestFile],
+                         existing_file_ids: List[Optional[str]], on_progress: ProgressCallback) -> List[IngestFile]:
+        # Uploaded by an earlier run of this job, but not attached yet
+        uploaded_before = await self.spool.uploaded(upload_id)
+        to_upload = []
+        seen = {}
+        for item, existing_file_id in zip(files, existing_file_ids):
+            # Same content already in the session, or earlier in this upload
+            if existing_file_id or item.file_hash in seen:
+                item.file_id = existing_file_id
+                item.status = "skipped"
+                if not existing_file_id:
+                    seen[item.file_hash].append(item)
+                await on_progress({"stage": "skipped", "filename": item.filename})
+                continue
+            seen[item.file_hash] = []
+            to_upload.append(item)
+            if item.file_hash in uploaded_before:
+                item.file_id = uploaded_before[item.file_hash]
+                item.status = "uploaded"
+                await on_progress({"stage": "uploaded", "filename": item.filename, "file_id": item.file_id})
+
+        # A transient error fails the job, to run again later, once the other files are done: the
+        # ones that made it are recorded and not uploaded again
+        results = await asyncio.gather(*(self.upload_file(session_id, upload_id, item, on_progress)
+                                         for item in to_upload if item.status == "pending"),
+                                       return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        for item in to_upload:
+            for duplicate in seen[item.file_hash]:
+                duplicate.file_id = item.file_id
+
+        return [item for item in to_upload if item.status == "uploaded"]
+
+    async def attach(self, session_id: str, vector_store_id: str, uploaded: List[IngestFile],
+                     on_progress: ProgressCallback) -> Optional[str]:
+        await on_progress({"stage": "attaching", "files": len(uploaded)})
+        batch = await self.client.vector_stores.file_batches.create(
+            vector_store_id=vector_store_id,
+            file_ids=[item.file_id for item in uploaded],
+        )
+        await self.sessions.add_files(
+            session_id,
+            [(item.file_id, item.filename, item.file_hash) for item in uploaded],
+            pending_batch=batch.id,
+        )
+        await on_progress({"stage": "indexing", "batch_id": batch.id, "files": len(uploaded)})
+        return batch.id
+
+    async def check_batch(self, session_id: str, vector_store_id: str, batch_id: str, last: bool,
+                          on_progress: ProgressCallback) -> Optional[dict]:
+        """Poll the file batch once; returns its final status once the vector store has indexed it,
+        or on the `last` poll whatever it is, else None. The index_status job backs off between
+        polls like STT polling, from poll_initial to poll_max, for up to index_timeout."""
+        batch = None
+        try:
+            batch = await self.client.vector_stores.file_batches.retrieve(batch_id, vector_store_id=vector_store_id)
+        except Exception as e:
+            log.warning(f"Error polling file batch {batch_id}: {e}")
+        if not last and (batch is None or batch.status == "in_progress"):
+            return None
+        await self.sessions.finish_batch(session_id, batch_id)
+
+        status = batch.status if batch is not None else "unknown"
+        counts = batch.file_counts.model_dump() if batch is not None else {}
+        event = {"stage": "indexed", "batch_id": batch_id, "status": status, "file_counts": counts}
+        await on_progress(event)
+        return event
+
+    async def remove_file(self, session_id: str, vector_store_id: Optional[str], file_id: str):
+        """Take the file out of the session's search; its file object is deleted by a delete_files job."""
+        await self.client.vector_stores.files.delete(vector_store_id=vector_store_id, file_id=file_id)
+
+    async def delete_files(self, file_ids: List[str]):
+        for file_id in file_ids:
+            try:
+                await self.client.files.delete(file_id)
+            except Exception as e:
+                if not is_not_found(e):
+                    raise
+
+    async def delete_resources(self, session_id: str, resources: SessionResources) -> SessionResources:
+        """Delete an expired session's vector stores and files; returns what was deleted."""
+        for vector_store_id in resources.vector_store_ids:
+            try:
+                await self.client.vector_stores.delete(vector_store_id)
+            except Exception as e:
+                if not is_not_found(e):
+                    raise
+        # Deleting a vector store leaves its files behind
+        await self.delete_files(resources.file_ids)
+        return SessionResources(vector_store_ids=resources.vector_store_ids, file_ids=resources.file_ids)
+
+
+class LocalIngestion(Ingestion):
+    needs_vector_store = False
+
+    def __init__(self, store: DocumentStore, sessions: SessionStore, spool: UploadSpool, concurrency: int = 4):
+        super().__init__(None, sessions, spool, concurrency=concurrency)
+        self.store = store
+
+    async def upload_file(self, session_id: str, upload_id: str, item: IngestFile, on_progress: ProgressCallback):
+        async with self.semaphore:
+            await on_progress({"stage": "uploading", "filename": item.filename, "bytes": item.size})
+            try:
+                # Named after the content, like the dedup: the same file always gets the same id
+                item.file_id = f"local_{item.file_hash[:24]}"
+                async with span("file_index"):
+                    with self.spool.open(item) as file:
+                        chunks = await self.store.add_file(session_id, item.file_id, item.filename, file)
+                await self.spool.record_uploaded(upload_id, item)
+                item.status = "uploaded"
+                await on_progress({"stage": "uploaded", "filename": item.filename, "file_id": item.file_id,
+                                   "chunks": chunks})
+            except Exception as e:
+                if is_transient(e):
+                    raise
+                await self.failed(item, e, on_progress)
+
+    async def attach(self, session_id: str, vector_store_id: Optional[str], uploaded: List[IngestFile],
+                     on_progress: ProgressCallback) -> Optional[str]:
+        # Searchable as soon as they are saved: nothing to wait for
+        await self.sessions.add_files(session_id, [(item.file_id, item.filename, item.file_hash) for item in uploaded])
+        await self.sessions.add_resources(session_id, SessionResources(local=True))
+        await on_progress({"stage": "indexed", "status": "completed", "file_counts": {"completed": len(uploaded)}})
+        return None
+
+    async def remove_file(self, session_id: str, vector_store_id: Optional[str], file_id: str):
+        await self.store.remove(session_id, file_id)
+
+    async def delete_resources(self, session_id: str, resources: SessionResources) -> SessionResources:
+        if resources.local:
+            await self.store.drop(session_id)
+        return SessionResources(local=resources.local)
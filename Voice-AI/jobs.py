@@ -0,0 +1,348 @@
+"""Durable background jobs in Redis: document ingestion, indexing status and cleanup.
+
+Work that used to run inside a request (or in a task of the worker that
+served it, lost when that worker restarted) is queued instead, and run by
+consumers in the app workers (JOB_WORKERS per worker) and in standalone
+worker processes (worker.py). A job is a hash, `jobs:job:{job_id}`:
+
+    kind         which handler runs it (ingest, index_status, delete_files, cleanup)
+    payload      its arguments, JSON
+    session_id   the session it reports to, if any
+    status       queued, running, scheduled (to run again later), completed or failed
+    attempts     failed runs so far
+    result       what the handler returned, JSON (error: why the last run failed)
+
+plus timestamps. A finished job expires `job_ttl` seconds later. The ids
+move through:
+
+- `jobs:queue`: a list of jobs ready to run
+- `jobs:delayed`: a sorted set of jobs to run later, by due time. Each
+  consumer moves the due ones to the queue (a Lua script, so two consumers
+  never move the same job twice) before it waits for the next job.
+- `jobs:running:{consumer}`: the jobs a consumer has taken, moved there
+  from the queue in the same command (BLMOVE), so a job is never only in
+  the consumer's memory. Each consumer keeps a heartbeat key,
+  `jobs:consumer:{consumer}`, alive while it runs; the jobs of a consumer
+  whose heartbeat expired (the process died) go back to the queue, and so
+  does a job whose run failed on Redis itself, put back by its consumer
+  once Redis answers again.
+
+A job therefore runs at least once, and may run again after a crash:
+handlers are written so a second run does no harm. A handler that raises is
+retried with exponential backoff, up to `max_attempts` runs; one that raises
+RunLater is run again after the given delay without counting a failure,
+which is how the indexing status is polled and the cleanup repeats.
+
+Every time a job finishes or fails, `on_finished` is called with it (main.py
+pushes it to the session's /ws sockets over the session bus).
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+import redis.asyncio
+
+log = logging.getLogger(__name__)
+
+# Moves up to ARGV[2] jobs due by ARGV[1] from the delayed set to the queue; returns how many
+PROMOTE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, job_id in ipairs(due) do
+    redis.call('ZREM', KEYS[1], job_id)
+    redis.call('LPUSH', KEYS[2], job_id)
+end
+return #due
+"""
+# Moves every job of a consumer's running list back to the queue, to run next; returns how many
+REQUEUE_SCRIPT = """
+local moved = 0
+while redis.call('LMOVE', KEYS[1], KEYS[2], 'RIGHT', 'RIGHT') do
+    moved = moved + 1
+end
+return moved
+"""
+
+FINISHED = ("completed", "failed")
+
+
+class RunLater(Exception):
+    """Raised by a handler to run the job again in `delay` seconds, with `payload` if given."""
+
+    def __init__(self, delay: float, payload: Optional[dict] = None, result: Any = None):
+        super().__init__(f"run again in {delay}s")
+        self.delay = delay
+        self.payload = payload
+        self.result = result
+
+
+class Job:
+    def __init__(self, job_id: str, fields: Dict[str, str]):
+        self.id = job_id
+        self.kind = fields.get("kind", "")
+        self.payload: dict = json.loads(fields.get("payload") or "{}")
+        self.session_id = fields.get("session_id") or None
+        self.status = fields.get("status", "")
+        self.attempts = int(fields.get("attempts") or 0)
+        self.result = json.loads(fields["result"]) if fields.get("result") else None
+        self.error = fields.get("error") or None
+        self.fields = fields
+
+    def to_dict(self) -> dict:
+        timestamps = {name: float(self.fields[name]) for name in ("created", "started", "finished", "due")
+                      if self.fields.get(name)}
+        return {"job_id": self.id, "kind": self.kind, "session_id": self.session_id, "status": self.status,
+                "attempts": self.attempts, "result": self.result, "error": self.error, **timestamps}
+
+
+Handler = Callable[[Job], Awaitable[Any]]
+FinishedCallback = Callable[[Job], Awaitable[None]]
+
+
+class JobQueue:
+    def __init__(self, redis_client: redis.asyncio.Redis, prefix: str = "jobs:", job_ttl: int = 24 * 3600,
+                 max_attempts: int = 5, retry_initial: float = 2.0, retry_max: float = 300.0,
+                 poll: float = 1.0, heartbeat: float = 10.0, ttl: int = 30):
+        # The client must decode responses to str
+        self.redis = redis_client
+        self.prefix = prefix
+        self.job_ttl = job_ttl
+        self.max_attempts = max_attempts
+        self.retry_initial = retry_initial
+        self.retry_max = retry_max
+        self.poll = poll
+        self.heartbeat = heartbeat
+        self.ttl = ttl
+        self.promote_script = redis_client.register_script(PROMOTE_SCRIPT)
+        self.requeue_script = redis_client.register_script(REQUEUE_SCRIPT)
+        self.handlers: Dict[str, Handler] = {}
+        self.on_finished: Optional[FinishedCallback] = None
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        # This process's consumers, and the jobs they are running
+        self.consumers: Set[str] = set()
+        self.running: Dict[str, str] = {}
+        self.tasks: Set[asyncio.Task] = set()
+        self.stopping = False
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        self.rescheduled = 0
+        self.recovered = 0
+
+    def key(self, name: str) -> str:
+        return self.prefix + name
+
+    def job_key(self, job_id: str) -> str:
+        return self.key(f"job:{job_id}")
+
+    def handle(self, kind: str, handler: Handler):
+        self.handlers[kind] = handler
+
+    async def enqueue(self, kind: str, payload: dict, session_id: Optional[str] = None,
+                      job_id: Optional[str] = None, delay: float = 0.0, unique: bool = False) -> str:
+        """Queue a job; returns its id. With `unique`, a job with the same id that has not
+        finished is left as it is instead, only run earlier if it was due later."""
+        job_id = job_id or uuid.uuid4().hex
+        key = self.job_key(job_id)
+        now = time.time()
+        if unique and await self.redis.hget(key, "status") not in (None, *FINISHED):
+            await self.redis.zadd(self.key("delayed"), {job_id: now + delay}, xx=True, lt=True)
+            return job_id
+        fields = {"kind": kind, "payload": json.dumps(payload), "session_id": session_id or "",
+                  "status": "scheduled" if delay > 0 else "queued", "attempts": 0, "created": now}
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(key)
+            pipe.hset(key, mapping=fields)
+            if delay > 0:
+                pipe.hset(key, "due", now + delay)
+                pipe.zadd(self.key("delayed"), {job_id: now + delay})
+            else:
+                pipe.lpush(self.key("queue"), job_id)
+            await pipe.execute()
+        return job_id
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        fields = await self.redis.hgetall(self.job_key(job_id))
+        return Job(job_id, fields) if fields else None
+
+    def start(self, consumers: int):
+        if consumers <= 0:
+            return
+        self.stopping = False
+        for n in range(consumers):
+            consumer = f"{self.worker_id}:{n}"
+            self.consumers.add(consumer)
+            self._spawn(self._consume(consumer))
+        self._spawn(self._beat())
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+
+    async def stop(self):
+        self.stopping = True
+        for task in self.tasks:
+            task.cancel()
+        # A consumer waiting in BLMOVE does not see the cancellation until the command times
+        # out (`poll`), and then stops on the flag
+        if self.tasks:
+            await asyncio.wait(self.tasks, timeout=self.poll + 1)
+        self.tasks.clear()
+        # Jobs cut short go back to the queue for another consumer
+        try:
+            for consumer in self.consumers:
+                await self.requeue_script(keys=[self.key(f"running:{consumer}"), self.key("queue")])
+                await self.redis.delete(self.key(f"consumer:{consumer}"))
+                await self.redis.srem(self.key("consumers"), consumer)
+        except redis.exceptions.RedisError as e:
+            log.warning(f"Could not hand back running jobs: {e}")
+        self.consumers.clear()
+        self.running.clear()
+
+    async def _consume(self, consumer: str):
+        running_key = self.key(f"running:{consumer}")
+        # Whether a job is left in the running list by a run that failed on Redis: this consumer
+        # still beats, so recover() would never requeue it
+        stranded = False
+        while not self.stopping:
+            try:
+                if stranded:
+                    await self.requeue_script(keys=[running_key, self.key("queue")])
+                    stranded = False
+                await self.promote_script(keys=[self.key("delayed"), self.key("queue")], args=[time.time(), 100])
+                job_id = await self.redis.blmove(self.key("queue"), running_key, self.poll, "RIGHT", "LEFT")
+                if job_id is None:
+                    continue
+                self.running[consumer] = job_id
+                stranded = True
+                try:
+                    # A job cut short by shutdown stays in the running list, for stop() to requeue
+                    await self._run(job_id)
+                finally:
+                    self.running.pop(consumer, None)
+                await self.redis.lrem(running_key, 1, job_id)
+                stranded = False
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Redis went away: keep the consumer up, and once it is back hand the job it was
+                # running (if any) back to the queue, to run again from the start
+                log.warning(f"Job consumer error: {e}")
+                await asyncio.sleep(self.poll)
+
+    async def _run(self, job_id: str):
+        key = self.job_key(job_id)
+        fields = await self.redis.hgetall(key)
+        if not fields or fields.get("status") in FINISHED:
+            return
+        job = Job(job_id, fields)
+        handler = self.handlers.get(job.kind)
+        await self.redis.hset(key, mapping={"status": "running", "started": time.time()})
+        try:
+            if handler is None:
+                raise ValueError(f"No handler for {job.kind} jobs")
+            result = await handler(job)
+            encoded = json.dumps(result)
+        except asyncio.CancelledError:
+            raise
+        except RunLater as later:
+            self.rescheduled += 1
+            await self._schedule(job, later.delay, later.payload, {"result": json.dumps(later.result)})
+            return
+        except Exception as e:
+            job.attempts += 1
+            job.error = f"{type(e).__name__}: {e}"
+            if job.attempts < self.max_attempts:
+                self.retried += 1
+                delay = min(self.retry_initial * 2 ** (job.attempts - 1), self.retry_max)
+                log.warning(f"Job {job.kind} {job_id} failed ({job.error}), retrying in {delay:.1f}s")
+                await self._schedule(job, delay, None, {"attempts": job.attempts, "error": job.error})
+                return
+            self.failed += 1
+            log.error(f"Job {job.kind} {job_id} failed for good: {job.error}")
+            await self._finish(job, "failed", {"attempts": job.attempts, "error": job.error})
+            return
+        self.completed += 1
+        job.result = result
+        await self._finish(job, "completed", {"result": encoded})
+
+    async def _schedule(self, job: Job, delay: float, payload: Optional[dict], fields: dict):
+        due = time.time() + delay
+        if payload is not None:
+            fields["payload"] = json.dumps(payload)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(self.job_key(job.id), mapping={"status": "scheduled", "due": due, **fields})
+            pipe.zadd(self.key("delayed"), {job.id: due})
+            await pipe.execute()
+
+    async def _finish(self, job: Job, status: str, fields: dict):
+        job.status = status
+        key = self.job_key(job.id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping={"status": status, "finished": time.time(), **fields})
+            pipe.expire(key, self.job_ttl)
+            await pipe.execute()
+        if self.on_finished is not None:
+            try:
+                await self.on_finished(job)
+            except Exception as e:
+                log.warning(f"Could not report job {job.id}: {e}")
+
+    async def _alive(self, consumer: str):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.set(self.key(f"consumer:{consumer}"), json.dumps({"running": self.running.get(consumer)}),
+                     ex=self.ttl)
+            pipe.sadd(self.key("consumers"), consumer)
+            await pipe.execute()
+
+    async def _beat(self):
+        while not self.stopping:
+            try:
+                for consumer in self.consumers:
+                    await self._alive(consumer)
+                await self.recover()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning(f"Job heartbeat failed: {e}")
+            await asyncio.sleep(self.heartbeat)
+
+    async def recover(self) -> int:
+        """Put the jobs of consumers that stopped beating back in the queue; returns how many."""
+        recovered = 0
+        for consumer in await self.redis.smembers(self.key("consumers")):
+            if await self.redis.exists(self.key(f"consumer:{consumer}")):
+                continue
+            recovered += await self.requeue_script(keys=[self.key(f"running:{consumer}"), self.key("queue")])
+            await self.redis.srem(self.key("consumers"), consumer)
+        if recovered:
+            log.info(f"Requeued {recovered} job(s) of stopped consumers")
+        self.recovered += recovered
+        return recovered
+
+    async def report(self) -> dict:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.llen(self.key("queue"))
+            pipe.zcard(self.key("delayed"))
+            pipe.zrangebyscore(self.key("delayed"), "-inf", "+inf", start=0, num=1, withscores=True)
+            pipe.scard(self.key("consumers"))
+            queued, delayed, next_due, consumers = await pipe.execute()
+        return {
+            "queued": queued,
+            "scheduled": delayed,
+            "next_due_in": round(max(0.0, next_due[0][1] - time.time()), 1) if next_due else None,
+            "consumers": consumers,
+            "this_worker": {
+                "consumers": len(self.consumers),
+                "running": sorted(self.running.values()),
+                "completed": self.completed,
+                "failed": self.failed,
+                "retried": self.retried,
+                "rescheduled": self.rescheduled,
+                "recovered": self.recovered,
+            },
+        }
@@ -0,0 +1,303 @@
+"""LLM backends: answer a question from the session's documents.
+
+OpenAIResponsesBackend searches the documents with the Responses API's
+file_search tool over the session's vector store (`hosted_retrieval`). The
+other backends, and OpenAIResponsesBackend with RETRIEVAL=local, are given
+the passages retrieved locally at question time (see retrieval.py) in the
+prompt instead:
+
+- LlamaCppBackend runs a GGUF model with llama-cpp-python on the CPU, in a
+  worker thread; generation stops at the next token when the turn is
+  cancelled. Only one reply is generated at a time per model.
+- StubLLMBackend answers instantly and deterministically, for tests and
+  benchmarks.
+
+Callers use `respond()` and `stream()`, which apply the backend's gate (see
+admission.py) and record the `llm` span; backends implement `complete()` and
+`generate()`.
+
+A prompt carries the conversation so far (see conversation.py) ahead of the
+new question and its passages, so consecutive turns share a prefix that
+OpenAI's prompt caching and llama.cpp's KV cache can reuse.
+"""
+import asyncio
+import importlib
+import threading
+from contextlib import aclosing, nullcontext
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, AsyncIterator, List, Optional
+
+from admission import Busy, VendorGate
+from metrics import span
+
+if TYPE_CHECKING:
+    # Imported by main.py only when the openai provider is configured
+    from openai import AsyncOpenAI
+
+# What the OpenAI client imports on its first Responses API call
+RESPONSES_MODULES = ("openai.resources.responses", "openai.types.responses")
+
+@dataclass
+class Passage:
+    text: str
+    filename: str = ""
+    score: float = 0.0
+
+
+@dataclass
+class Exchange:
+    question: str
+    answer: str
+
+
+@dataclass
+class Prompt:
+    instructions: str
+    question: str
+    # The session's vector store, for hosted retrieval; passages otherwise
+    vector_store_id: Optional[str] = None
+    passages: List[Passage] = field(default_factory=list)
+    # Earlier exchanges of the conversation, oldest first, and a summary of the ones before them
+    history: List[Exchange] = field(default_factory=list)
+    summary: str = ""
+    # False for prompts that are not about the documents (e.g. summarizing the conversation)
+    retrieval: bool = True
+    # Requests with the same key are routed to the same prompt cache (OpenAI)
+    cache_key: Optional[str] = None
+
+    def context(self) -> str:
+        documents = "\n\n".join(f"[{passage.filename}]\n{passage.text}" for passage in self.passages)
+        return f"Documents:\n{documents or '(none)'}"
+
+    def summary_text(self) -> str:
+        return f"Summary of the conversation so far:\n{self.summary}"
+
+    def exchange_messages(self) -> List[dict]:
+        messages = []
+        for exchange in self.history:
+            messages.append({"role": "user", "content": exchange.question})
+            messages.append({"role": "assistant", "content": exchange.answer})
+        return messages
+
+    def messages(self) -> List[dict]:
+        """Chat messages for local models: the passages go with the question, after the conversation."""
+        # Chat templates of local models generally allow a single system message
+        system = f"{self.instructions}\n\n{self.summary_text()}" if self.summary else self.instructions
+        question = f"{self.context()}\n\nQuestion: {self.question}" if self.retrieval else self.question
+        return [
+            {"role": "system", "content": system},
+            *self.exchange_messages(),
+            {"role": "user", "content": question},
+        ]
+
+
+@dataclass
+class LLMUsage:
+    """Tokens reported by the provider; cached input tokens are prompt prefix reused from earlier requests."""
+    requests: int = 0
+    input_tokens: int = 0
+    cached_input_tokens: int = 0
+    output_tokens: int = 0
+
+    def record(self, usage):
+        if usage is None:
+            return
+        self.requests += 1
+        self.input_tokens += usage.input_tokens
+        self.output_tokens += usage.output_tokens
+        details = getattr(usage, "input_tokens_details", None)
+        self.cached_input_tokens += getattr(details, "cached_tokens", 0) or 0
+
+    def report(self) -> dict:
+        return {
+            "requests": self.requests,
+            "input_tokens": self.input_tokens,
+            "cached_input_tokens": self.cached_input_tokens,
+            "cached_input_ratio": round(self.cached_input_tokens / self.input_tokens, 4) if self.input_tokens else 0.0,
+            "output_tokens": self.output_tokens,
+        }
+
+
+class LLMBackend:
+    # True when the backend searches the vector store itself; otherwise the prompt carries passages
+    hosted_retrieval = False
+    # Admission, deadline and retries (see admission.py)
+    gate: Optional[VendorGate] = None
+    model = ""
+    # Token counts, when the provider reports them
+    usage: Optional[LLMUsage] = None
+
+    async def complete(self, prompt: Prompt) -> str:
+        raise NotImplementedError
+
+    def generate(self, prompt: Prompt) -> AsyncIterator[str]:
+        """Yield the answer text as it is generated."""
+        raise NotImplementedError
+
+    async def respond(self, prompt: Prompt, background: bool = False) -> str:
+        """The whole answer; a `background` request gives way to the others (raises Busy)."""
+        async with self.gate.admit(background) if self.gate else nullcontext():
+            # A preempted background request is not an LLM failure
+            async with span("llm", expected=(Busy,)):
+                if self.gate is None:
+                    return await self.complete(prompt)
+                return await self.gate.call(lambda: self.complete(prompt), preemptible=background)
+
+    async def stream(self, prompt: Prompt) -> AsyncIterator[str]:
+        deltas = self.gate.stream(lambda: self.generate(prompt)) if self.gate else self.generate(prompt)
+        # The span ends when the stream does; its first byte is the first token
+        async with self.gate.admit() if self.gate else nullcontext():
+            async with span("llm") as llm_span, aclosing(deltas):
+                async for delta in deltas:
+                    llm_span.mark_first_byte()
+                    yield delta
+
+    async def warm(self):
+        """Get ready for the first request (see warmup.py)."""
+
+    async def aclose(self):
+        pass
+
+
+class OpenAIResponsesBackend(LLMBackend):
+    def __init__(self, client: "AsyncOpenAI", model: str, hosted_retrieval: bool = True,
+                 gate: Optional[VendorGate] = None, warm_request: bool = False):
+        self.client = client
+        self.model = model
+        self.hosted_retrieval = hosted_retrieval
+        self.gate = gate
+        # Whether warm() makes one real, minimal request
+        self.warm_request = warm_request
+        self.usage = LLMUsage()
+
+    def request(self, prompt: Prompt) -> dict:
+        # Instructions, then the conversation: the part of the input that repeats from turn to turn
+        input = [{"role": "developer", "content": prompt.summary_text()}] if prompt.summary else []
+        input += prompt.exchange_messages()
+        cache = {"prompt_cache_key": prompt.cache_key} if prompt.cache_key else {}
+        if not self.hosted_retrieval or not prompt.retrieval:
+            # The passages go in a message of their own, after the conversation
+            if prompt.retrieval:
+                input.append({"role": "developer", "content": prompt.context()})
+            input.append({"role": "user", "content": prompt.question})
+            return dict(
+                instructions=prompt.instructions,
+                model=self.model,
+                input=input,
+                temperature=0,
+                **cache
+            )
+        input.append({"role": "user", "content": prompt.question})
+        return dict(
+            instructions=prompt.instructions,
+            model=self.model,
+            input=input,
+            tools=[{
+                "type": "file_search",
+                "vector_store_ids": [prompt.vector_store_id]
+            }],
+            temperature=0,
+            **cache
+            # tool_choice="auto"
+        )
+
+    async def warm(self):
+        # The client imports the Responses API and its types on first use, which added ~150 ms
+        # to the first turn: import them now
+        for module in RESPONSES_MODULES:
+            importlib.import_module(module)
+        if self.warm_request:
+            # The rest of the first request's path, end to end, for a few tokens
+            response = await self.client.responses.create(model=self.model, input="Say OK.", max_output_tokens=16)
+            self.usage.record(response.usage)
+
+    async def complete(self, prompt: Prompt) -> str:
+        response = await self.client.responses.create(**self.request(prompt))
+        self.usage.record(response.usage)
+        return response.output_text
+
+    async def generate(self, prompt: Prompt) -> AsyncIterator[str]:
+        stream = await self.client.responses.create(**self.request(prompt), stream=True)
+        # Leaving the block early (the turn was cancelled) closes the HTTP stream, which stops generation
+        async with stream:
+            async for event in stream:
+                if event.type == "response.output_text.delta":
+                    yield event.delta
+                elif event.type == "response.completed":
+                    self.usage.record(event.response.usage)
+
+
+class LlamaCppBackend(LLMBackend):
+    def __init__(self, model_path: str, context_size: int = 4096, threads: Optional[int] = None,
+                 max_tokens: int = 512, gate: Optional[VendorGate] = None):
+        try:
+            from llama_cpp import Llama
+        except ImportError:
+            raise RuntimeError("LLM_PROVIDER=llamacpp needs the llama-cpp-python package") from None
+        if not model_path:
+            raise RuntimeError("LLM_PROVIDER=llamacpp needs LLAMACPP_MODEL_PATH (a GGUF file)")
+        self.llm = Llama(model_path=model_path, n_ctx=context_size, n_threads=threads, verbose=False)
+        self.model = model_path
+        self.max_tokens = max_tokens
+        self.gate = gate
+        # A llama.cpp context runs one generation at a time
+        self.lock = threading.Lock()
+
+    async def complete(self, prompt: Prompt) -> str:
+        return "".join([delta async for delta in self.generate(prompt)])
+
+    async def generate(self, prompt: Prompt) -> AsyncIterator[str]:
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        stop = threading.Event()
+
+        def run():
+            try:
+                with self.lock:
+                    for part in self.llm.create_chat_completion(messages=prompt.messages(), temperature=0,
+                                                                max_tokens=self.max_tokens, stream=True):
+                        if stop.is_set():
+                            break
+                        delta = part["choices"][0]["delta"].get("content")
+                        if delta:
+                            loop.call_soon_threadsafe(queue.put_nowait, delta)
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, None)
+
+        loop.run_in_executor(None, run)
+        try:
+            while (item := await queue.get()) is not None:
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # A cancelled turn stops the generation at the next token
+            stop.set()
+
+
+class StubLLMBackend(LLMBackend):
+    """Answers with the start of the best passage (or a fixed sentence), word by word."""
+
+    model = "stub"
+
+    def __init__(self, answer: str = "This is a stub answer.", token_delay: float = 0.0,
+                 gate: Optional[VendorGate] = None):
+        self.answer = answer
+        self.token_delay = token_delay
+        self.gate = gate
+
+    def answer_for(self, prompt: Prompt) -> str:
+        if prompt.passages:
+            return " ".join(prompt.passages[0].text.split()[:40])
+        return self.answer
+
+    async def complete(self, prompt: Prompt) -> str:
+        return self.answer_for(prompt)
+
+    async def generate(self, prompt: Prompt) -> AsyncIterator[str]:
+        for i, word in enumerate(self.answer_for(prompt).split(" ")):
+            if self.token_delay:
+                await asyncio.sleep(self.token_delay)
+            yield word if i == 0 else " " + word
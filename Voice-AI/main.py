@@ -1,33 +1,106 @@
+import time
+# Startup is measured from here (see warmup.py)
+IMPORT_STARTED = time.perf_counter()
 from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect, UploadFile, File, Form
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi.responses import JSONResponse, HTMLResponse, PlainTextResponse
 from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
-import hashlib
-import requests
+import httpx
 import base64
 import os
-from openai import OpenAI
 import json
-from elevenlabs.client import ElevenLabs
-from elevenlabs import play
-import io
-from tempfile import NamedTemporaryFile
+import logging
 import uuid
-import time
 import redis
 from dotenv import load_dotenv
-from typing import List, Dict, Optional
+from typing import TYPE_CHECKING, List, Dict, Optional, Set, Union
 import uvicorn
-from typing import Iterator, List
+from typing import AsyncIterator, List
 from fastapi.middleware.cors import CORSMiddleware
+import asyncio
+import itertools
+import math
+from collections import deque
+from segmenter import SentenceSegmenter
+from stt import AssemblyAIBackend, STTBackend, STTStream, StubSTTBackend, WhisperBackend
+from llm import Exchange, LLMBackend, LlamaCppBackend, OpenAIResponsesBackend, Prompt, StubLLMBackend
+from tts import ElevenLabsBackend, PiperBackend, StubTTSBackend, TTSBackend, VoiceSettings, media_type
+from providers import ProviderRegistry
+from retrieval import DocumentStore, Embedder, HashingEmbedder, OpenAIEmbedder, SentenceTransformerEmbedder
+from audio import FFMPEG, AudioPreprocessor, NoSpeechError
+from clients import ClientRegistry
+from tts_cache import TTSCache, tts_cache_key
+from answer_cache import AnswerCache, file_set_fingerprint
+from session_store import SessionResources, SessionState, SessionStore
+from conversation import Conversation, ConversationStore, transcript
+from speculation import Speculation, SpeculativeReply, Speculator
+from delivery import AudioLink, Delivery, parse_formats
+from ingest import IngestFile, Ingestion, LocalIngestion, UploadSizeLimit, UploadSpool, UploadTooLarge
+from jobs import Job, JobQueue, RunLater
+from session_bus import SessionBus
+from admission import Admission, Busy
+from turns import CHARS_PER_TOKEN, Turn, TurnStats, audio_bytes_per_second
+import metrics
+from metrics import Trace, current_trace, span
+import redis.asyncio
+from contextlib import aclosing, asynccontextmanager
+from protocol import (FLAG_STREAM, FRAME_AUDIO, FRAME_AUDIO_CHUNK, FRAME_TTS, FRAME_TTS_CHUNK,
+                      PROTOCOL_VERSION, ProtocolError, pack_frame, unpack_frame)
+from warmup import FirstRequestTimer, Warmup
+
+if TYPE_CHECKING:
+    # The vendor SDKs are imported when their provider is built (see get_openai_client)
+    from openai import AsyncOpenAI
+    from elevenlabs.client import AsyncElevenLabs
 
 # Load environment variables
 load_dotenv()
 
+# The modules report through their own loggers (logging.getLogger(__name__))
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(),
+                    format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+log = logging.getLogger(__name__)
+
+# Startup steps, readiness and first-request latency (see warmup.py)
+warmup = Warmup(IMPORT_STARTED)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    warmup.imports_done()
+    if audio_preprocessor is not None and FFMPEG is None:
+        # The browser records webm: without ffmpeg it goes to STT untrimmed and unchecked
+        log.warning("ffmpeg is not on the PATH: only WAV recordings are trimmed and checked for speech (see audio.py)")
+    # Build the configured backends (importing their SDKs, loading local models) before serving
+    with warmup.timed("providers"):
+        get_stt_backend()
+        if not get_llm_backend().hosted_retrieval:
+            get_document_store()
+        turn_stats.audio_bytes_per_second = audio_bytes_per_second(get_tts_backend().voice.output_format)
+    if session_bus is not None:
+        await session_bus.start()
+    await start_jobs(JOB_WORKERS)
+    # The rest warms up while the app serves; /api/status/ready fails until it has finished
+    warmup.start({
+        "redis": ping_redis,
+        "connections": open_vendor_connections,
+        "llm": get_llm_backend().warm,
+        "tts_phrases": preload_tts_phrases,
+    } if WARMUP else {})
+    yield
+    await warmup.stop()
+    await job_queue.stop()
+    if session_bus is not None:
+        await session_bus.stop()
+    await close_vendor_clients()
+    await redis_client.aclose()
+    await redis_pool.disconnect()
+    await redis_binary_client.aclose()
+    await redis_binary_pool.disconnect()
+
 # Create FastAPI app
-app = FastAPI(title="Real-time Voice AI Assistant API")
+app = FastAPI(title="Real-time Voice AI Assistant API", lifespan=lifespan)
 
 
 app.add_middleware(
@@ -38,6 +111,11 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Time the first request to each API endpoint after startup (see warmup.py)
+app.add_middleware(FirstRequestTimer, warmup=warmup,
+                   paths=["/api/transcribe", "/api/transcribe/raw", "/api/llm", "/api/tts", "/api/tts/stream",
+                          "/api/upload"])
+
 # Mount static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
@@ -53,7 +131,7 @@ class TranscriptionResponse(BaseModel):
 
 class LLMRequest(BaseModel):
     message: str
-    # conversation_history: Optional[List[Dict[str, str]]] = []
+    # The conversation so far is kept server-side per session (see conversation.py)
     session_id: str
 
 class LLMResponse(BaseModel):
@@ -61,6 +139,8 @@ class LLMResponse(BaseModel):
 
 class TTSRequest(BaseModel):
     text: str
+    # Any format the TTS backend supports, e.g. opus_48000_32 or pcm_16000 (default: the backend's)
+    output_format: Optional[str] = None
 
 class TTSResponse(BaseModel):
     audio_data: str  # Base64 encoded audio data
@@ -68,25 +148,509 @@ class TTSResponse(BaseModel):
 
 
 
+LLM_INSTRUCTIONS = """You are a helpful assistant that only answers questions based on the 
+    documents provided. If the question cannot be answered using the documents or is outside 
+    their scope, respond with "I don't know" or "I cannot answer this question based on the 
+    documents provided." Do not use any knowledge outside of the provided documents."""
+LLM_MODEL = os.getenv("LLM_MODEL", "gpt-4o-mini")
+SUMMARY_INSTRUCTIONS = """Summarize this conversation between a user and an assistant about the 
+    user's documents, continuing the earlier summary if there is one. Keep the topics, names, 
+    numbers and conclusions a follow-up question could refer to. Use at most 150 words."""
+
+
 # Connect to Redis
-redis_client = redis.StrictRedis(host='localhost', port=6379, decode_responses=True)
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
+# Sessions expire this long after they were last used (see session_store.py)
+SESSION_TTL = int(os.getenv("SESSION_TTL", "3600"))
+redis_pool = redis.asyncio.ConnectionPool(
+    host=REDIS_HOST, port=REDIS_PORT, decode_responses=True, max_connections=REDIS_MAX_CONNECTIONS
+)
+redis_client = redis.asyncio.StrictRedis(connection_pool=redis_pool)
+# For binary values (cached audio), which must not be decoded
+redis_binary_pool = redis.asyncio.ConnectionPool(
+    host=REDIS_HOST, port=REDIS_PORT, max_connections=REDIS_MAX_CONNECTIONS
+)
+redis_binary_client = redis.asyncio.StrictRedis(connection_pool=redis_binary_pool)
+sessions = SessionStore(redis_client, ttl=SESSION_TTL)
+# Earlier exchanges go into each prompt, up to CONVERSATION_MAX_TOKENS; older ones are
+# summarized by the LLM (CONVERSATION_SUMMARY=0 just drops them), see conversation.py
+CONVERSATION_MEMORY = os.getenv("CONVERSATION_MEMORY", "1") not in ("0", "false", "no")
+CONVERSATION_SUMMARY = os.getenv("CONVERSATION_SUMMARY", "1") not in ("0", "false", "no")
+conversations = ConversationStore(
+    redis_client,
+    ttl=SESSION_TTL,
+    max_tokens=int(os.getenv("CONVERSATION_MAX_TOKENS", "1500")),
+    summary_chars=int(os.getenv("CONVERSATION_SUMMARY_CHARS", "1200")),
+)
+# Deliver session events (e.g. upload progress) to sockets held by other workers or hosts
+# through Redis pub/sub (see session_bus.py); only unnecessary with a single worker
+SESSION_BUS = os.getenv("SESSION_BUS", "1") not in ("0", "false", "no")
+
+# Vendor endpoints (overridable so the benchmarks can point at local stub servers)
+ASSEMBLYAI_BASE_URL = os.getenv("ASSEMBLYAI_BASE_URL", "https://api.assemblyai.com")
+LLM_BASE_URL = os.getenv("LLM_BASE_URL")
+ELEVENLABS_BASE_URL = os.getenv("ELEVENLABS_BASE_URL")
+# Live transcription over WebSocket; set to an empty string to fall back to upload-and-poll
+ASSEMBLYAI_STREAMING_URL = os.getenv("ASSEMBLYAI_STREAMING_URL", "wss://streaming.assemblyai.com/v3/ws")
+
+# Upload-and-poll transcription: poll interval backs off from STT_POLL_INITIAL to STT_POLL_MAX
+STT_POLL_INITIAL = float(os.getenv("STT_POLL_INITIAL", "0.25"))
+STT_POLL_MAX = float(os.getenv("STT_POLL_MAX", "2"))
+STT_TIMEOUT = float(os.getenv("STT_TIMEOUT", "60"))
+# Sample rate of the PCM frames the browser streams for live transcription
+STREAM_SAMPLE_RATE = 16000
+# Trim silence from recordings and reject ones without speech before they go to STT (see audio.py)
+AUDIO_PREPROCESS = os.getenv("AUDIO_PREPROCESS", "1") not in ("0", "false", "no")
+audio_preprocessor = AudioPreprocessor(sample_rate=STREAM_SAMPLE_RATE) if AUDIO_PREPROCESS else None
+# Start the reply to a streamed utterance once its partial transcript has been stable for
+# SPECULATION_WINDOW_MS, before the user has finished (see speculation.py); costs the LLM
+# tokens of the guesses that turn out wrong, reported at /api/status/speculation
+SPECULATION = os.getenv("SPECULATION", "0") not in ("0", "false", "no")
+speculation = Speculation(
+    window=float(os.getenv("SPECULATION_WINDOW_MS", "300")) / 1000,
+    min_words=int(os.getenv("SPECULATION_MIN_WORDS", "3")),
+)
+
+# Maximum number of turns a single WebSocket may have queued before we stop reading from it
+TURN_QUEUE_SIZE = int(os.getenv("TURN_QUEUE_SIZE", "4"))
+
+# Admission control (see admission.py): vendor calls per worker and queued behind them,
+# shared vendor rate limits, deadlines and retries, and a turn rate limit per session (off unless
+# SESSION_RATE is set, e.g. 1 turn per second with bursts of SESSION_BURST)
+SESSION_RATE = float(os.getenv("SESSION_RATE", "0"))
+SESSION_BURST = int(os.getenv("SESSION_BURST", "5"))
+admission = Admission(redis_client, session_rate=SESSION_RATE, session_burst=SESSION_BURST)
+
+# STT, LLM and TTS providers, picked with STT_PROVIDER, LLM_PROVIDER and TTS_PROVIDER (see providers.py)
+providers = ProviderRegistry({"stt": "assemblyai", "llm": "openai", "tts": "elevenlabs"})
+# Local models: faster-whisper model name or path, GGUF model for llama.cpp, Piper .onnx voice
+WHISPER_MODEL = os.getenv("WHISPER_MODEL", "base.en")
+WHISPER_COMPUTE_TYPE = os.getenv("WHISPER_COMPUTE_TYPE", "int8")
+LLAMACPP_MODEL_PATH = os.getenv("LLAMACPP_MODEL_PATH", "")
+LLAMACPP_CONTEXT = int(os.getenv("LLAMACPP_CONTEXT", "4096"))
+LLM_MAX_TOKENS = int(os.getenv("LLM_MAX_TOKENS", "512"))
+PIPER_VOICE = os.getenv("PIPER_VOICE", "")
+# Local backends use every core for one call, so they take one call at a time (see admission.py)
+LOCAL_GATE_DEFAULTS = dict(max_concurrency=1, queue_timeout=30, deadline=120, retries=0)
+
+# RETRIEVAL=local searches the documents in-process (see retrieval.py) instead of with OpenAI's
+# file_search; LLM backends without hosted retrieval always do
+RETRIEVAL = os.getenv("RETRIEVAL", "hosted")
+RETRIEVAL_DIR = os.getenv("RETRIEVAL_DIR", "data/documents")
+RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", "4"))
+# hashing (no model), sentence-transformers or openai; RETRIEVAL_MODEL names the model of the latter two
+RETRIEVAL_EMBEDDER = os.getenv("RETRIEVAL_EMBEDDER", "hashing")
+RETRIEVAL_MODEL = os.getenv("RETRIEVAL_MODEL")
+RETRIEVAL_DIM = int(os.getenv("RETRIEVAL_DIM", "1024"))
+# Chunks above which a session's index gets an IVF structure, and the lists a query scores
+RETRIEVAL_IVF_MIN_ROWS = int(os.getenv("RETRIEVAL_IVF_MIN_ROWS", "20000"))
+RETRIEVAL_NPROBE = int(os.getenv("RETRIEVAL_NPROBE", "16"))
+
+# Files uploaded to OpenAI at once per app worker, and the read size used while spooling uploads
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", "4"))
+INGEST_CHUNK_BYTES = int(os.getenv("INGEST_CHUNK_BYTES", str(1024 * 1024)))
+# Uploads wait for their ingest job in UPLOAD_SPOOL_DIR, which every host running jobs must share
+# (e.g. a network volume); larger files than UPLOAD_MAX_BYTES (OpenAI's limit by default) are refused
+UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR", "data/uploads")
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(512 * 1024 * 1024)))
+# Upload requests with a larger body (all files together) are refused before they are read
+UPLOAD_MAX_REQUEST_BYTES = int(os.getenv("UPLOAD_MAX_REQUEST_BYTES", str(UPLOAD_MAX_BYTES)))
+# Uploads are spooled and ingested by background jobs (see jobs.py), run by JOB_WORKERS
+# consumers per app worker (0: only by worker.py) on any host. Every CLEANUP_INTERVAL seconds the
+# vector stores, files and local documents of expired sessions are deleted, unless something was
+# added to them in the last CLEANUP_GRACE seconds; a session whose deletion failed waits longer
+# each time, up to CLEANUP_RETRY_MAX seconds
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "1"))
+JOB_TTL = int(os.getenv("JOB_TTL", str(24 * 3600)))
+CLEANUP_INTERVAL = float(os.getenv("CLEANUP_INTERVAL", "600"))
+CLEANUP_GRACE = float(os.getenv("CLEANUP_GRACE", "600"))
+CLEANUP_RETRY_MAX = float(os.getenv("CLEANUP_RETRY_MAX", str(24 * 3600)))
+job_queue = JobQueue(
+    redis_client,
+    job_ttl=JOB_TTL,
+    max_attempts=int(os.getenv("JOB_MAX_ATTEMPTS", "5")),
+)
+# Spooled uploads are removed once their ingest job has finished (or after JOB_TTL if it never does)
+upload_spool = UploadSpool(UPLOAD_SPOOL_DIR, redis_client, chunk_size=INGEST_CHUNK_BYTES,
+                           max_bytes=UPLOAD_MAX_BYTES, ttl=JOB_TTL)
+# Oversized uploads are refused before FastAPI spools their body to temporary files
+app.add_middleware(UploadSizeLimit, paths=["/api/upload"], max_bytes=UPLOAD_MAX_REQUEST_BYTES)
+
+# Number of sentence segments synthesized in parallel while a streamed reply is being generated
+TTS_STREAM_CONCURRENCY = int(os.getenv("TTS_STREAM_CONCURRENCY", "3"))
+# Reply audio on /ws comes in the format each client asks for (see delivery.py); Opus and PCM
+# are cut into frames of AUDIO_FRAME_MIN_MS of audio at first, then up to what the client's
+# measured throughput delivers in AUDIO_FRAME_SEND_MS, within AUDIO_FRAME_MAX_MS of audio
+delivery = Delivery(
+    min_ms=float(os.getenv("AUDIO_FRAME_MIN_MS", "60")),
+    max_ms=float(os.getenv("AUDIO_FRAME_MAX_MS", "1000")),
+    send_ms=float(os.getenv("AUDIO_FRAME_SEND_MS", "100")),
+)
+
+# ElevenLabs voice settings, overridable with TTS_VOICE_ID, TTS_MODEL_ID and TTS_OUTPUT_FORMAT
+ELEVENLABS_VOICE = VoiceSettings("JBFqnCBsd6RMkjVDRZzb", "eleven_multilingual_v2", "mp3_44100_128")
+
+# Turns started and cancelled by barge-in, and the LLM/TTS work the cancellations avoided
+# (the audio byte rate is set from the TTS backend's format at startup)
+turn_stats = TurnStats()
+
+# Traces of the most recent turns, served at /api/status/traces (see metrics.py)
+TRACE_HISTORY = int(os.getenv("TRACE_HISTORY", "100"))
+recent_traces: deque = deque(maxlen=TRACE_HISTORY)
+# Turn traces and cancellations also go to the voice_ai.turns logger, one JSON line each,
+# at INFO; they are only written with TRACE_LOG=1
+turn_log = logging.getLogger("voice_ai.turns")
+turn_log.setLevel(logging.INFO if os.getenv("TRACE_LOG", "0") not in ("0", "false", "no") else logging.WARNING)
+# Stages that call each vendor, for its health endpoint
+STT_STAGES = ["stt_upload", "stt_poll", "stt_stream_connect", "stt_stream_finish", "stt_local"]
+LLM_STAGES = ["llm", "retrieval"]
+TTS_STAGES = ["tts"]
+
+# Synthesized audio is cached in-process and in Redis (binary values, so the binary client)
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+TTS_CACHE_MAX_ITEM_BYTES = int(os.getenv("TTS_CACHE_MAX_ITEM_BYTES", str(2 * 1024 * 1024)))
+TTS_CACHE_TTL = int(os.getenv("TTS_CACHE_TTL", str(7 * 24 * 3600)))
+TTS_CACHE_REDIS = os.getenv("TTS_CACHE_REDIS", "1") not in ("0", "false", "no")
+# Size of the chunks cached audio is streamed in by /api/tts/stream
+TTS_CACHE_CHUNK_BYTES = 16 * 1024
+
+tts_cache = TTSCache(
+    redis_client=redis_binary_client if TTS_CACHE_REDIS else None,
+    max_bytes=TTS_CACHE_MAX_BYTES,
+    max_item_bytes=TTS_CACHE_MAX_ITEM_BYTES,
+    ttl=TTS_CACHE_TTL,
+)
+
+# Warm-up before the app reports ready (WARMUP=0: ready once the backends are built): keep-alive
+# connections opened per vendor, and phrases synthesized into the TTS cache ("|"-separated,
+# empty for none) in the backend's format and in WARM_TTS_FORMATS (e.g. opus_48000_32)
+WARMUP = os.getenv("WARMUP", "1") not in ("0", "false", "no")
+WARM_CONNECTIONS = int(os.getenv("WARM_CONNECTIONS", "2"))
+WARM_TTS_PHRASES = [phrase.strip() for phrase in os.getenv(
+    "WARM_TTS_PHRASES",
+    "I don't know.|I cannot answer this question based on the documents provided.",
+).split("|") if phrase.strip()]
+WARM_TTS_FORMATS = parse_formats(os.getenv("WARM_TTS_FORMATS"))
+# WARM_LLM_REQUEST=1: the OpenAI LLM backend also makes one minimal request (a few tokens) while warming up
+WARM_LLM_REQUEST = os.getenv("WARM_LLM_REQUEST", "0") not in ("0", "false", "no")
+
+# Answers are cached per document set (see answer_cache.py); ANSWER_CACHE_SIMILARITY > 0
+# also serves near-duplicate questions, e.g. 0.8 for minor rewording. Near duplicates must
+# share their numbers and single letters ("plan A" never gets the answer for "plan B"), but
+# questions that differ only in a longer name ("Acme" vs "Apex") can still get the wrong
+# cached answer: raise the threshold, or leave it at 0, when such names matter
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE", "1") not in ("0", "false", "no")
+answer_cache = AnswerCache(
+    redis_client,
+    ttl=int(os.getenv("ANSWER_CACHE_TTL", "3600")),
+    max_entries=int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "500")),
+    near_duplicate_threshold=float(os.getenv("ANSWER_CACHE_SIMILARITY", "0")),
+)
+
+# Async vendor clients are created once and shared by every request, on top of one
+# pooled keep-alive HTTP client per provider that lives as long as the app
+clients = ClientRegistry()
+_openai_client: Optional["AsyncOpenAI"] = None
+_elevenlabs_client: Optional["AsyncElevenLabs"] = None
+_ingestion: Optional[Ingestion] = None
+_document_store: Optional[DocumentStore] = None
+# Fire-and-forget tasks (e.g. summarizing a conversation's oldest exchanges), kept
+# referenced until they finish
+background_tasks: Set[asyncio.Task] = set()
+
+def get_openai_client() -> "AsyncOpenAI":
+    global _openai_client
+    if _openai_client is None:
+        from openai import AsyncOpenAI
+        _openai_client = AsyncOpenAI(
+            api_key=os.getenv('LLM_API_KEY'),
+            base_url=LLM_BASE_URL,
+            http_client=clients.http_client("openai"),
+            timeout=clients.settings("openai").timeouts,
+            # Retries are left to the LLM backend's gate, which knows the deadline
+            max_retries=0,
+        )
+    return _openai_client
+
+def get_elevenlabs_client() -> "AsyncElevenLabs":
+    global _elevenlabs_client
+    if _elevenlabs_client is None:
+        from elevenlabs.client import AsyncElevenLabs
+        _elevenlabs_client = AsyncElevenLabs(
+            api_key=os.getenv("ELEVENLABS_API_KEY"),
+            base_url=ELEVENLABS_BASE_URL,
+            httpx_client=clients.http_client("elevenlabs"),
+            timeout=clients.settings("elevenlabs").timeout,
+        )
+    return _elevenlabs_client
+
+providers.register("stt", "assemblyai", lambda: AssemblyAIBackend(
+    get_assembly_client(),
+    api_key=os.getenv("ASSEMBLYAI_API_KEY") or "",
+    streaming_url=ASSEMBLYAI_STREAMING_URL,
+    poll_initial=STT_POLL_INITIAL,
+    poll_max=STT_POLL_MAX,
+    timeout=STT_TIMEOUT,
+    preprocessor=audio_preprocessor,
+    gate=admission.gate("assemblyai", "stt", deadline=STT_TIMEOUT),
+))
+providers.register("stt", "whisper", lambda: WhisperBackend(
+    WHISPER_MODEL,
+    compute_type=WHISPER_COMPUTE_TYPE,
+    preprocessor=audio_preprocessor,
+    gate=admission.gate("whisper", "stt", **LOCAL_GATE_DEFAULTS),
+))
+providers.register("stt", "stub", lambda: StubSTTBackend(
+    os.getenv("STUB_TRANSCRIPT", "What do the documents say?"), preprocessor=audio_preprocessor))
+
+providers.register("llm", "openai", lambda: OpenAIResponsesBackend(
+    get_openai_client(), LLM_MODEL, hosted_retrieval=RETRIEVAL != "local", gate=admission.gate("openai", "llm"),
+    warm_request=WARM_LLM_REQUEST))
+providers.register("llm", "llamacpp", lambda: LlamaCppBackend(
+    LLAMACPP_MODEL_PATH,
+    context_size=LLAMACPP_CONTEXT,
+    max_tokens=LLM_MAX_TOKENS,
+    gate=admission.gate("llamacpp", "llm", **LOCAL_GATE_DEFAULTS),
+))
+providers.register("llm", "stub", lambda: StubLLMBackend(token_delay=float(os.getenv("STUB_TOKEN_DELAY", "0"))))
+
+providers.register("tts", "elevenlabs", lambda: ElevenLabsBackend(
+    get_elevenlabs_client(), VoiceSettings.from_env(ELEVENLABS_VOICE), gate=admission.gate("elevenlabs", "tts")))
+providers.register("tts", "piper", lambda: PiperBackend(
+    PIPER_VOICE, gate=admission.gate("piper", "tts", **LOCAL_GATE_DEFAULTS)))
+providers.register("tts", "stub", lambda: StubTTSBackend())
+
+def get_stt_backend() -> STTBackend:
+    return providers.get("stt")
+
+def get_llm_backend() -> LLMBackend:
+    return providers.get("llm")
+
+def get_tts_backend() -> TTSBackend:
+    return providers.get("tts")
+
+def get_assembly_client() -> httpx.AsyncClient:
+    return clients.http_client(
+        "assemblyai",
+        base_url=ASSEMBLYAI_BASE_URL,
+        headers={"authorization": os.getenv("ASSEMBLYAI_API_KEY") or ""},
+    )
+
+def get_ingestion() -> Ingestion:
+    global _ingestion
+    if _ingestion is None:
+        if get_llm_backend().hosted_retrieval:
+            _ingestion = Ingestion(
+                get_openai_client(),
+                sessions,
+                upload_spool,
+                concurrency=INGEST_CONCURRENCY,
+            )
+        else:
+            _ingestion = LocalIngestion(
+                get_document_store(),
+                sessions,
+                upload_spool,
+                concurrency=INGEST_CONCURRENCY,
+            )
+    return _ingestion
+
+def create_embedder() -> Embedder:
+    if RETRIEVAL_EMBEDDER == "sentence-transformers":
+        return SentenceTransformerEmbedder(RETRIEVAL_MODEL or "all-MiniLM-L6-v2")
+    if RETRIEVAL_EMBEDDER == "openai":
+        return OpenAIEmbedder(get_openai_client(), RETRIEVAL_MODEL or "text-embedding-3-small",
+                              dim=RETRIEVAL_DIM, gate=admission.gate("openai", "llm"))
+    return HashingEmbedder(RETRIEVAL_DIM)
+
+def get_document_store() -> DocumentStore:
+    global _document_store
+    if _document_store is None:
+        _document_store = DocumentStore(
+            RETRIEVAL_DIR,
+            create_embedder(),
+            ivf_min_rows=RETRIEVAL_IVF_MIN_ROWS,
+            nprobe=RETRIEVAL_NPROBE,
+        )
+    return _document_store
+
+async def close_vendor_clients():
+    global _openai_client, _elevenlabs_client, _ingestion
+    for task in list(background_tasks):
+        task.cancel()
+    await providers.aclose()
+    await clients.aclose()
+    _openai_client = _elevenlabs_client = _ingestion = None
+
+async def ping_redis():
+    # Sessions live in Redis: not ready until it answers, however long that takes
+    delay = 0.1
+    while True:
+        try:
+            await redis_client.ping()
+            await redis_binary_client.ping()
+            return
+        except redis.RedisError as e:
+            log.warning(f"Redis not reachable yet: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 5)
+
+async def start_jobs(consumers: int):
+    job_queue.start(consumers)
+    if not consumers or CLEANUP_INTERVAL <= 0:
+        return
+    # One cleanup job for all workers, repeating itself (see run_cleanup_job)
+    try:
+        await job_queue.enqueue("cleanup", {}, job_id="cleanup", delay=CLEANUP_INTERVAL, unique=True)
+    except redis.RedisError as e:
+        log.warning(f"Could not schedule the cleanup job: {e}")
+
+async def open_vendor_connections():
+    # A URL on each configured vendor's host; any response leaves a warm connection in its pool
+    urls = {
+        "assemblyai": ASSEMBLYAI_BASE_URL,
+        "openai": LLM_BASE_URL or "https://api.openai.com/v1",
+        "elevenlabs": ELEVENLABS_BASE_URL or "https://api.elevenlabs.io",
+    }
+    await asyncio.gather(*(clients.warm(provider, url, WARM_CONNECTIONS)
+                           for provider, url in urls.items() if provider in clients.pools))
+
+async def preload_tts_phrases():
+    # Only worth it when the TTS cache keeps anything
+    if not WARM_TTS_PHRASES or (not TTS_CACHE_MAX_BYTES and tts_cache.redis is None):
+        return
+    backend = get_tts_backend()
+    output_formats = [backend.voice.output_format] + [
+        output_format for output_format in WARM_TTS_FORMATS
+        if output_format != backend.voice.output_format and backend.supports(output_format)]
+    await asyncio.gather(*(text_to_speech(phrase, output_format)
+                           for phrase in WARM_TTS_PHRASES for output_format in output_formats))
 
 # Connection manager for WebSockets
 class ConnectionManager:
     def __init__(self):
         self.active_connections: List[WebSocket] = []
+        self.send_locks: Dict[WebSocket, asyncio.Lock] = {}
+        # Connections that asked for binary audio frames (see protocol.py), and each one's audio format
+        self.binary_audio: Set[WebSocket] = set()
+        self.links: Dict[WebSocket, AudioLink] = {}
+        # Connections per session id, for events that do not originate on the socket (e.g. upload progress)
+        self.sessions: Dict[str, Set[WebSocket]] = {}
+        self.session_of: Dict[WebSocket, str] = {}
+        # Connection ids in the cross-worker registry, and the bus itself (None: this worker only)
+        self.connection_ids: Dict[WebSocket, str] = {}
+        self.bus: Optional[SessionBus] = None
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
         self.active_connections.append(websocket)
+        self.send_locks[websocket] = asyncio.Lock()
+        if websocket.query_params.get("protocol") == str(PROTOCOL_VERSION):
+            self.binary_audio.add(websocket)
+        backend = get_tts_backend()
+        self.links[websocket] = delivery.link(parse_formats(websocket.query_params.get("formats")),
+                                              backend.supports, backend.voice.output_format,
+                                              binary=websocket in self.binary_audio)
+        self.connection_ids[websocket] = uuid.uuid4().hex
+        if websocket.query_params.get("session_id"):
+            await self.join_session(websocket, websocket.query_params["session_id"])
+
+    async def disconnect(self, websocket: WebSocket):
+        if websocket in self.active_connections:
+            self.active_connections.remove(websocket)
+        self.send_locks.pop(websocket, None)
+        self.binary_audio.discard(websocket)
+        self.links.pop(websocket, None)
+        await self.leave_session(websocket)
+        self.connection_ids.pop(websocket, None)
+
+    async def join_session(self, websocket: WebSocket, session_id: str):
+        if self.session_of.get(websocket) == session_id:
+            return
+        await self.leave_session(websocket)
+        self.session_of[websocket] = session_id
+        self.sessions.setdefault(session_id, set()).add(websocket)
+        if self.bus is not None:
+            await self.bus.register(session_id, self.connection_ids[websocket])
 
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+    async def leave_session(self, websocket: WebSocket):
+        session_id = self.session_of.pop(websocket, None)
+        if session_id is not None:
+            connections = self.sessions.get(session_id, set())
+            connections.discard(websocket)
+            if not connections:
+                self.sessions.pop(session_id, None)
+            if self.bus is not None:
+                await self.bus.unregister(session_id, self.connection_ids[websocket])
+
+    async def send_session(self, session_id: str, payload: dict):
+        # Events may come from a request handled by another worker than the session's sockets
+        if self.bus is not None:
+            await self.bus.publish(session_id, payload)
+        else:
+            await self.deliver_local(session_id, payload)
+
+    async def deliver_local(self, session_id: str, payload: dict) -> int:
+        # Best effort: a closed socket is cleaned up by its own receive loop
+        message = json.dumps(payload)
+        delivered = 0
+        for websocket in list(self.sessions.get(session_id, ())):
+            try:
+                await self._send(websocket, message)
+                delivered += 1
+            except Exception:
+                pass
+        return delivered
+
+    async def _send(self, websocket: WebSocket, data: Union[str, bytes]):
+        # Several tasks may write to the same socket, so serialize the sends
+        lock = self.send_locks.get(websocket)
+        if lock is None:
+            lock = asyncio.Lock()
+        async with lock:
+            if isinstance(data, bytes):
+                await websocket.send_bytes(data)
+            else:
+                await websocket.send_text(data)
 
     async def send_message(self, websocket: WebSocket, message: str):
-        await websocket.send_text(message)
+        await self._send(websocket, message)
+
+    def link(self, websocket: WebSocket) -> AudioLink:
+        return self.links[websocket]
+
+    async def send_audio(self, websocket: WebSocket, frame_type: int, audio: bytes, seq: int = 0,
+                         session_id: str = "", **fields):
+        # Binary clients get the raw audio; others get the base64 JSON message. Timed from
+        # before the send, which may wait for a slow client to read the frames before it
+        sent_at = time.perf_counter()
+        if websocket in self.binary_audio:
+            await self._send(websocket, pack_frame(frame_type, audio, seq=seq, session_id=session_id))
+        else:
+            await self._send(websocket, json.dumps({
+                "type": AUDIO_MESSAGE_TYPES[frame_type],
+                "seq": seq,
+                **fields,
+                "audio_data": base64.b64encode(audio).decode('utf-8')
+            }))
+        # Binary clients acknowledge the frame, which measures their throughput
+        link = self.links.get(websocket)
+        if link is not None:
+            link.sent(fields.get("turn_id"), seq, len(audio), sent_at)
+
+    def audio_ack(self, websocket: WebSocket, message: dict):
+        link = self.links.get(websocket)
+        if link is not None and isinstance(message.get("turn_id"), int) and isinstance(message.get("seq"), int):
+            link.acked(message["turn_id"], message["seq"])
+
+# JSON message types of the audio frames, for clients that did not negotiate binary frames
+AUDIO_MESSAGE_TYPES = {FRAME_TTS: "tts", FRAME_TTS_CHUNK: "tts_chunk"}
 
 manager = ConnectionManager()
+session_bus = SessionBus(redis_client, manager.deliver_local) if SESSION_BUS else None
+manager.bus = session_bus
 
 @app.get('/api/config')
 async def get_config():
@@ -96,6 +660,193 @@ async def get_config():
     })
 
 
+@app.get('/api/status/tts-cache')
+async def get_tts_cache_status():
+    # Hit ratio and vendor bytes saved by the TTS audio cache
+    return JSONResponse(content=tts_cache.report())
+
+
+@app.get('/api/status/answer-cache')
+async def get_answer_cache_status():
+    # Hit ratio and LLM step latency for cache hits vs misses
+    return JSONResponse(content=answer_cache.report())
+
+@app.get('/api/status/speculation')
+async def get_speculation_status():
+    # Hit rate of replies started on partial transcripts, and the LLM work wasted on wrong guesses
+    return JSONResponse(content={"enabled": SPECULATION, **speculation.report()})
+
+@app.get('/api/status/conversation')
+async def get_conversation_status():
+    # Conversation size per prompt, folds into the summary, and the provider's prompt cache hits
+    usage = get_llm_backend().usage
+    return JSONResponse(content={
+        "enabled": CONVERSATION_MEMORY,
+        **conversations.report(),
+        "llm_usage": usage.report() if usage else None,
+    })
+
+
+@app.get('/api/status/audio')
+async def get_audio_status():
+    # Silence trimmed and recordings rejected before STT
+    if audio_preprocessor is None:
+        return JSONResponse(content={"enabled": False})
+    return JSONResponse(content={"enabled": True, **audio_preprocessor.report()})
+
+
+@app.get('/api/status/turns')
+async def get_turn_status():
+    # Turns cancelled by barge-in and the LLM tokens and TTS audio that were not generated
+    return JSONResponse(content=turn_stats.report())
+
+@app.get('/api/status/delivery')
+async def get_delivery_status():
+    # Negotiated audio formats, bytes per second of audio sent, and the clients' measured throughput
+    return JSONResponse(content=delivery.report())
+
+
+@app.get('/metrics')
+async def get_metrics():
+    # Prometheus text format: latency histograms per pipeline stage, stage errors and turn durations
+    return PlainTextResponse(metrics.render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+def vendor_status(kind: str, vendor: str, api_key_env: str, stages: List[str]) -> JSONResponse:
+    # Healthy when configured and the latest call did not fail; no vendor call is made here.
+    # Local and stub providers need no API key.
+    provider = providers.name(kind)
+    error = metrics.stage_failing(stages)
+    if provider == vendor and not os.getenv(api_key_env):
+        status = "not_configured"
+    elif error is not None:
+        status = "failing"
+    else:
+        status = "ok"
+    return JSONResponse(status_code=200 if status == "ok" else 503, content={
+        "status": status,
+        "provider": provider,
+        "last_error": error,
+        "stages": metrics.stage_report(stages),
+    })
+
+
+@app.get('/api/status/assembly')
+async def get_assembly_status():
+    return vendor_status("stt", "assemblyai", "ASSEMBLYAI_API_KEY", STT_STAGES)
+
+
+@app.get('/api/status/llm')
+async def get_llm_status():
+    return vendor_status("llm", "openai", "LLM_API_KEY", LLM_STAGES)
+
+
+@app.get('/api/status/tts')
+async def get_tts_status():
+    return vendor_status("tts", "elevenlabs", "ELEVENLABS_API_KEY", TTS_STAGES)
+
+
+@app.get('/api/status/traces')
+async def get_traces():
+    # Per-stage timings of the most recent /ws turns, newest first
+    return JSONResponse(content={"traces": list(reversed(recent_traces))})
+
+
+@app.get('/api/status/workers')
+async def get_worker_status(session_id: Optional[str] = None):
+    # Workers sharing this Redis (from their heartbeats), this worker's counters and,
+    # for a session id, which worker holds each of its connections
+    if session_bus is None:
+        return JSONResponse(content={"bus": False, "connections": len(manager.active_connections)})
+    status = {
+        "bus": True,
+        "this_worker": session_bus.report(),
+        "workers": await session_bus.workers(),
+    }
+    if session_id:
+        status["session_connections"] = await session_bus.connections(session_id)
+    return JSONResponse(content=status)
+
+
+@app.get('/api/status/jobs')
+async def get_job_status():
+    # Background jobs queued and scheduled, live consumers, and this worker's consumers
+    return JSONResponse(content=await job_queue.report())
+
+
+@app.get('/api/status/admission')
+async def get_admission_status():
+    # Vendor calls in flight and queued on this worker, calls and turns turned away, retries
+    return JSONResponse(content=admission.report())
+
+
+@app.get('/api/status/providers')
+async def get_provider_status():
+    # Backend chosen for each stage, whether it is loaded yet, and the alternatives
+    return JSONResponse(content=providers.report())
+
+
+@app.get('/api/status/retrieval')
+async def get_retrieval_status():
+    # Local retrieval: documents and chunks indexed, IVF builds, search latency
+    if _document_store is None:
+        return JSONResponse(content={"enabled": not get_llm_backend().hosted_retrieval})
+    return JSONResponse(content={"enabled": True, **_document_store.report()})
+
+
+@app.get('/api/status/ready')
+async def get_readiness():
+    # Readiness probe: 503 until the warm-up has finished (see warmup.py)
+    return JSONResponse(status_code=200 if warmup.ready else 503,
+                        content={"ready": warmup.ready, "pending": sorted(warmup.pending)})
+
+
+@app.get('/api/status/startup')
+async def get_startup_status():
+    # Import time, each warm-up step, time until ready, and the latency of the first requests
+    return JSONResponse(content=warmup.report())
+
+
+@app.get('/api/status/pools')
+async def get_pool_status():
+    # Connection pool usage per vendor: active/idle connections and time spent acquiring one
+    return JSONResponse(content=clients.stats())
+
+
+def busy_error(e: Busy) -> HTTPException:
+    return HTTPException(status_code=e.status_code, detail=str(e),
+                         headers={"Retry-After": str(math.ceil(e.retry_after))})
+
+
+def busy_message(e: Busy, turn_id: Optional[int] = None) -> dict:
+    message = {"type": "busy", "scope": e.scope, "reason": e.reason, "retry_after": round(e.retry_after, 2),
+               "error": str(e)}
+    if turn_id is not None:
+        message["turn_id"] = turn_id
+    return message
+
+
+def check_output_format(output_format: Optional[str]):
+    if output_format and not get_tts_backend().supports(output_format):
+        raise HTTPException(status_code=400, detail=f"Unsupported output format: {output_format}")
+
+
+def client_key(request: Request) -> str:
+    # REST calls are charged to the caller's session (X-Session-Id header or session_id query
+    # parameter), like its /ws turns; only callers that send none share a bucket per address
+    session_id = request.headers.get("x-session-id") or request.query_params.get("session_id")
+    if session_id:
+        return session_id
+    return f"client:{request.client.host if request.client else 'unknown'}"
+
+
+async def prepend(first_chunk: bytes, stream: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    if first_chunk:
+        yield first_chunk
+    async for chunk in stream:
+        yield chunk
+
+
 # Routes
 @app.get("/", response_class=HTMLResponse)
 async def get_html(request: Request):
@@ -103,153 +854,195 @@ async def get_html(request: Request):
 
 # Improved error handling for REST API endpoints
 @app.post("/api/transcribe", response_model=TranscriptionResponse)
-async def transcribe(request: TranscriptionRequest):
+async def transcribe(request: TranscriptionRequest, http_request: Request):
     try:
+        await admission.check_session(client_key(http_request))
+        
         # Decode base64 audio data
         audio_bytes = base64.b64decode(request.audio_data)
         
-        # Transcribe using AssemblyAI
-        transcription = transcribe_audio(audio_bytes)
+        # Transcribe with the configured STT backend
+        transcription = await transcribe_audio(audio_bytes)
+        
+        return TranscriptionResponse(text=transcription)
+    except NoSpeechError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except Busy as e:
+        raise busy_error(e)
+    except Exception as e:
+        log.exception(f"Transcription error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Transcription error: {str(e)}")
+
+@app.post("/api/transcribe/raw", response_model=TranscriptionResponse)
+async def transcribe_raw(request: Request):
+    # Same as /api/transcribe, but the request body is the recording itself instead of base64 JSON
+    try:
+        await admission.check_session(client_key(request))
+        audio_bytes = await request.body()
+        
+        transcription = await transcribe_audio(audio_bytes)
         
         return TranscriptionResponse(text=transcription)
+    except NoSpeechError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except Busy as e:
+        raise busy_error(e)
     except Exception as e:
-        print(f"Transcription error: {str(e)}")
+        log.exception(f"Transcription error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Transcription error: {str(e)}")
 
 @app.post("/api/llm", response_model=LLMResponse)
 async def get_llm(request: LLMRequest):
     try:
+        await admission.check_session(request.session_id)
+        
         # Get response from LLM
-        response = get_llm_response(user_input=request.message, session_id=request.session_id)
+        response = await get_llm_response(user_input=request.message, session_id=request.session_id)
         
         return LLMResponse(response=response)
+    except Busy as e:
+        raise busy_error(e)
     except Exception as e:
-        print(f"LLM error: {str(e)}")
+        log.exception(f"LLM error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"LLM error: {str(e)}")
 
 @app.post("/api/tts", response_model=TTSResponse)
-async def text_to_speech_endpoint(request: TTSRequest):
+async def text_to_speech_endpoint(request: TTSRequest, http_request: Request):
+    check_output_format(request.output_format)
     try:
+        await admission.check_session(client_key(http_request))
+        
         # Convert text to speech
-        audio_data = text_to_speech(request.text)
+        audio_data = await text_to_speech(request.text, request.output_format)
         
         # Encode audio data as base64
         encoded_audio = base64.b64encode(audio_data).decode('utf-8')
         
         return TTSResponse(audio_data=encoded_audio)
+    except Busy as e:
+        raise busy_error(e)
     except Exception as e:
-        print(f"TTS error: {str(e)}")
+        log.exception(f"TTS error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"TTS error: {str(e)}")
 
 @app.post("/api/tts/stream")
-async def text_to_speech_stream(request: TTSRequest):
+async def text_to_speech_stream(request: TTSRequest, http_request: Request):
+    check_output_format(request.output_format)
     try:
+        await admission.check_session(client_key(http_request))
+        output_format = request.output_format or get_tts_backend().voice.output_format
+        
         # Get streaming audio generator
-        audio_stream = text_to_speech_streaming(request.text)
+        audio_stream = text_to_speech_streaming(request.text, output_format)
+        # Wait for the first chunk, so a busy or failing vendor still gets an error status
+        first_chunk = await anext(audio_stream, b"")
         
         # Return a streaming response
         return StreamingResponse(
-            audio_stream,
-            media_type="audio/mpeg",
+            prepend(first_chunk, audio_stream),
+            media_type=media_type(output_format),
             headers={
-                "Content-Disposition": "attachment; filename=speech.mp3",
+                "Content-Disposition": f"attachment; filename=speech.{output_format.partition('_')[0]}",
                 "Transfer-Encoding": "chunked"
             }
         )
+    except Busy as e:
+        raise busy_error(e)
     except Exception as e:
-        print(f"TTS streaming error: {str(e)}")
+        log.exception(f"TTS streaming error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"TTS streaming error: {str(e)}")
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await manager.connect(websocket)
+    turns = TurnRunner(websocket)
+    # Live transcription session of the utterance currently being streamed, if any, and the
+    # speculative reply to its partial transcript
+    stt_stream: Optional[STTStream] = None
+    speculator: Optional[Speculator] = None
     try:
         while True:
             # Receive data from client
-            data = await websocket.receive_text()
-            
-            # Parse the JSON message
-            message = json.loads(data)
+            data = await websocket.receive()
+            if data["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(data.get("code", 1000))
             
             try:
-                if message["type"] == "audio":
-                    # Process audio input
-                    # Decode base64 audio data
-                    audio_bytes = base64.b64decode(message["audio_data"])
-                    
-                    # Transcribe audio
-                    transcription = transcribe_audio(audio_bytes)
-                    
-                    # Send transcription back to client
-                    await manager.send_message(websocket, json.dumps({
-                        "type": "transcription",
-                        "text": transcription
-                    }))
-                    
-                    # Get LLM response
-                    session_id = message.get("session_id", "")
-                    # conversation_history = message.get("conversation_history", [])
-                    llm_response = get_llm_response(transcription, session_id)
-                    
-                    # Send LLM response back to client
-                    await manager.send_message(websocket, json.dumps({
-                        "type": "llm_response",
-                        "text": llm_response
-                    }))
-                    
-                    # Generate TTS audio
-                    audio_data = text_to_speech(llm_response)
-                    encoded_audio = base64.b64encode(audio_data).decode('utf-8')
-                    
-                    # Send TTS audio back to client
-                    await manager.send_message(websocket, json.dumps({
-                        "type": "tts",
-                        "audio_data": encoded_audio
-                    }))
-                
-                elif message["type"] == "text":
-                    # Process text input
-                    user_message = message["message"]
-                    # conversation_history = message.get("conversation_history", [])
-                    session_id = message.get("session_id", "")
-                    
-                    # Get LLM response
-                    llm_response = get_llm_response(user_message, session_id)
-                    
-                    # Send LLM response back to client
-                    await manager.send_message(websocket, json.dumps({
-                        "type": "llm_response",
-                        "text": llm_response
-                    }))
-                    
-                    # Generate TTS audio
-                    audio_data = text_to_speech(llm_response)
-                    encoded_audio = base64.b64encode(audio_data).decode('utf-8')
-                    
-                    # Send TTS audio back to client
-                    await manager.send_message(websocket, json.dumps({
-                        "type": "tts",
-                        "audio_data": encoded_audio
-                    }))
-                
+                if data.get("bytes") is not None:
+                    # Binary audio frame
+                    message = decode_audio_frame(data["bytes"])
                 else:
-                    # Unknown message type
-                    await manager.send_message(websocket, json.dumps({
-                        "type": "error",
-                        "error": f"Unknown message type: {message['type']}"
-                    }))
-            
-            except Exception as e:
-                # Send error message back to client
+                    # Parse the JSON message
+                    message = decode_json_message(data["text"])
+            except ProtocolError as e:
                 await manager.send_message(websocket, json.dumps({
                     "type": "error",
-                    "error": str(e)
+                    "error": f"Protocol error: {str(e)}"
                 }))
+                continue
+            
+            # Follow the client's current session for upload progress and other session events
+            if message.get("session_id"):
+                await manager.join_session(websocket, message["session_id"])
+            if message["type"] == "session":
+                continue
+            if message["type"] == "interrupt":
+                # The user talked over the reply (barge-in): stop it
+                await turns.interrupt()
+                continue
+            if message["type"] == "audio_ack":
+                manager.audio_ack(websocket, message)
+                continue
+            
+            # Streamed audio is handled right here rather than queued behind the
+            # current turn, so transcription keeps up while the user is talking
+            if message["type"] in ("audio_start", "audio_chunk", "audio_end"):
+                try:
+                    if message["type"] == "audio_start":
+                        if stt_stream is not None:
+                            await stt_stream.close()
+                        if speculator is not None:
+                            speculator.close()
+                        stt_stream = speculator = None
+                        # Over the session's turn rate limit the utterance is dropped
+                        if not await turns.admit():
+                            continue
+                        # The user started talking again: whatever is still being said is stale
+                        await turns.interrupt()
+                        if SPECULATION:
+                            speculator = open_speculator(message.get("session_id")
+                                                         or manager.session_of.get(websocket, ""))
+                        stt_stream = await open_stt_stream(websocket, speculator)
+                    elif stt_stream is None:
+                        continue
+                    elif message["type"] == "audio_chunk":
+                        await stt_stream.send_audio(message_audio(message))
+                    else:
+                        if speculator is not None:
+                            speculator.end_of_speech()
+                        await turns.submit({**message, "stt_stream": stt_stream, "speculator": speculator})
+                        stt_stream = speculator = None
+                except (WebSocketDisconnect, asyncio.CancelledError):
+                    raise
+                except Exception as e:
+                    # Drop the broken transcription session; the next audio_start opens a new one
+                    if stt_stream is not None:
+                        await stt_stream.close()
+                        stt_stream = None
+                    if speculator is not None:
+                        speculator.close()
+                        speculator = None
+                    await manager.send_message(websocket, json.dumps({
+                        "type": "error",
+                        "error": f"Transcription error: {str(e)}"
+                    }))
+            else:
+                await turns.submit(message)
                 
     except WebSocketDisconnect:
-        manager.disconnect(websocket)
+        pass
     except Exception as e:
-        print(f"WebSocket error: {str(e)}")
+        log.exception(f"WebSocket error: {str(e)}")
         try:
             await manager.send_message(websocket, json.dumps({
                 "type": "error",
@@ -257,217 +1050,713 @@ async def websocket_endpoint(websocket: WebSocket):
             }))
         except:
             pass
-        manager.disconnect(websocket)
+    finally:
+        await turns.close()
+        if stt_stream is not None:
+            await stt_stream.close()
+        if speculator is not None:
+            speculator.close()
+        await manager.disconnect(websocket)
+
+
+def decode_audio_frame(data: bytes) -> dict:
+    # Map a binary frame onto the equivalent JSON message, carrying raw bytes instead of base64
+    frame = unpack_frame(data)
+    if frame.type == FRAME_AUDIO_CHUNK:
+        return {"type": "audio_chunk", "audio_bytes": frame.payload}
+    if frame.type == FRAME_AUDIO:
+        return {
+            "type": "audio",
+            "audio_bytes": bytes(frame.payload),
+            "session_id": frame.session_id,
+            "stream": bool(frame.flags & FLAG_STREAM)
+        }
+    raise ProtocolError(f"Unexpected frame type {frame.type:#04x}")
 
 
-def create_vector_store(client):
+def decode_json_message(text: str) -> dict:
+    # A bad message is answered with an error, like a bad binary frame, instead of closing the socket
     try:
-        vector_store = client.vector_stores.create(name=f"knowledge_base_{uuid.uuid4()}")
-        return vector_store.id
-    except Exception as e:
-        return None
+        message = json.loads(text)
+    except ValueError as e:
+        raise ProtocolError(f"Invalid JSON: {e}") from None
+    if not isinstance(message, dict):
+        raise ProtocolError("A message must be a JSON object")
+    if not isinstance(message.get("type"), str):
+        raise ProtocolError('A message needs a string "type"')
+    if not isinstance(message.get("session_id") or "", str):
+        raise ProtocolError('"session_id" must be a string')
+    return message
+
+
+def message_audio(message: dict) -> bytes:
+    if "audio_bytes" in message:
+        return message["audio_bytes"]
+    # Decode base64 audio data
+    return base64.b64decode(message["audio_data"])
+
+
+def open_speculator(session_id: str) -> Speculator:
+    def start(text: str, on_complete) -> AsyncIterator[str]:
+        return stream_llm_response(text, session_id, on_complete)
+    return speculation.speculator(start)
+
+
+async def open_stt_stream(websocket: WebSocket, speculator: Optional[Speculator] = None) -> STTStream:
+    async def on_transcript(text: str, is_final: bool):
+        if speculator is not None:
+            speculator.observe(text, is_final)
+        # Partial results let the client show the words as they are recognized
+        if not is_final:
+            await manager.send_message(websocket, json.dumps({
+                "type": "partial_transcription",
+                "text": text
+            }))
+
+    stt_stream = get_stt_backend().open_stream(STREAM_SAMPLE_RATE, on_transcript)
+    await stt_stream.start()
+    return stt_stream
+
+
+# Messages that start a new turn and so cancel the one in progress (barge-in)
+BARGE_IN_MESSAGE_TYPES = {"audio", "audio_end", "text"}
+# Messages charged to the session's turn rate limit; a streamed utterance is charged at audio_start
+RATE_LIMITED_MESSAGE_TYPES = {"audio", "audio_start", "text"}
+
+
+class TurnRunner:
+    # Turns are handled one at a time by a per-connection worker task, so the
+    # receive loop (and every other connection on this worker) keeps running
+    # while the vendor calls are in flight. Each turn runs in its own task and
+    # is cancelled when a newer turn arrives or the client sends `interrupt`.
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=TURN_QUEUE_SIZE)
+        self.turn_ids = itertools.count(1)
+        self.current: Optional[Turn] = None
+        self.current_task: Optional[asyncio.Task] = None
+        self.worker = asyncio.create_task(self.run())
+
+    async def admit(self) -> bool:
+        # A turn over the session's rate limit is refused without interrupting the current one
+        key = manager.session_of.get(self.websocket) or manager.connection_ids[self.websocket]
+        try:
+            await admission.check_session(key)
+        except Busy as e:
+            await manager.send_message(self.websocket, json.dumps(busy_message(e)))
+            return False
+        return True
+
+    async def submit(self, message: dict):
+        if message["type"] in RATE_LIMITED_MESSAGE_TYPES and not await self.admit():
+            return
+        if message["type"] in BARGE_IN_MESSAGE_TYPES:
+            await self.interrupt()
+        turn_stats.record_turn()
+        await self.queue.put((Turn(next(self.turn_ids)), message))
+
+    async def interrupt(self):
+        # Turns still waiting for the worker never start
+        while not self.queue.empty():
+            turn, message = self.queue.get_nowait()
+            if "stt_stream" in message:
+                await message["stt_stream"].close()
+            if message.get("speculator") is not None:
+                message["speculator"].close()
+            turn_stats.record_cancelled(turn, queued=True)
+        # The running one is cancelled; the worker reports it before starting the next
+        if self.current_task is not None and not self.current_task.done():
+            self.current.cancelled_at = time.perf_counter()
+            self.current_task.cancel()
+
+    async def run(self):
+        while True:
+            turn, message = await self.queue.get()
+            task = asyncio.create_task(self.handle(turn, message))
+            self.current, self.current_task = turn, task
+            await asyncio.wait([task])
+            self.current = self.current_task = None
+            if not task.cancelled():
+                turn_stats.record_completed(turn)
+                continue
+            avoided = turn_stats.record_cancelled(turn)
+            turn_log.info(json.dumps({"event": "turn_cancelled", "turn_id": turn.id, **avoided}))
+            try:
+                await manager.send_message(self.websocket, json.dumps({
+                    "type": "turn_cancelled",
+                    "turn_id": turn.id,
+                    **avoided
+                }))
+            except Exception:
+                return
+
+    async def handle(self, turn: Turn, message: dict):
+        turn.started = time.perf_counter()
+        # Spans of the vendor calls below end up in this turn's trace (the task has its own context)
+        trace = Trace(turn.id, message.get("session_id", ""), queued=turn.queued)
+        current_trace.set(trace)
+        metrics.stage_seconds.observe(turn.started - turn.queued, "queue_wait")
+        outcome = "completed"
+        link = manager.link(self.websocket)
+        turn.audio_bytes_per_second = link.bytes_per_second
+        try:
+            # Audio sent from here on belongs to this turn; the client drops audio of older ones
+            await manager.send_message(self.websocket, json.dumps({
+                "type": "turn_start",
+                "turn_id": turn.id,
+                "format": link.output_format,
+                "media_type": media_type(link.output_format)
+            }))
+            await handle_message(self.websocket, message, turn)
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            raise
+        except Busy as e:
+            # A vendor is out of capacity: tell the client to try again rather than wait
+            outcome = "busy"
+            try:
+                await manager.send_message(self.websocket, json.dumps(busy_message(e, turn.id)))
+            except Exception:
+                pass
+        except Exception as e:
+            outcome = "error"
+            # Send error message back to client
+            try:
+                await manager.send_message(self.websocket, json.dumps({
+                    "type": "error",
+                    "turn_id": turn.id,
+                    "error": str(e)
+                }))
+            except Exception:
+                pass
+        finally:
+            finish_trace(trace, outcome, turn, message["type"])
+
+    async def close(self):
+        # The connection is gone: cancel everything, there is nobody left to send to
+        self.worker.cancel()
+        await self.interrupt()
+        await asyncio.wait([self.worker])
+        if self.current_task is not None:
+            await asyncio.wait([self.current_task])
+            if self.current_task.cancelled():
+                turn_stats.record_cancelled(self.current)
+            else:
+                turn_stats.record_completed(self.current)
+
+
+def finish_trace(trace: Trace, outcome: str, turn: Turn, message_type: str):
+    time_to_first_audio = turn.first_audio - turn.started if turn.first_audio else None
+    summary = trace.to_dict(outcome, type=message_type, time_to_first_audio_ms=(
+        round(time_to_first_audio * 1000, 1) if time_to_first_audio is not None else None))
+    metrics.turn_seconds.observe(summary["total_ms"] / 1000, outcome)
+    if time_to_first_audio is not None:
+        metrics.turn_first_audio_seconds.observe(time_to_first_audio)
+    recent_traces.append(summary)
+    warmup.first_request("/ws", summary["total_ms"] / 1000, time_to_first_audio_ms=summary["time_to_first_audio_ms"])
+    turn_log.info(json.dumps({"event": "turn", **summary}))
+
+
+async def handle_message(websocket: WebSocket, message: dict, turn: Turn):
+    if message["type"] == "audio":
+        # Process audio input
+        audio_bytes = message_audio(message)
+        
+        # Transcribe audio
+        try:
+            transcription = await transcribe_audio(audio_bytes)
+        except NoSpeechError:
+            transcription = ""
+        if not transcription.strip():
+            await manager.send_message(websocket, json.dumps({"type": "no_speech", "turn_id": turn.id}))
+            return
+        
+        # Send transcription back to client
+        await manager.send_message(websocket, json.dumps({
+            "type": "transcription",
+            "turn_id": turn.id,
+            "text": transcription
+        }))
+        
+        # Get LLM response
+        session_id = message.get("session_id", "")
+        if message.get("stream"):
+            await respond_streaming(websocket, transcription, session_id, turn)
+        else:
+            await respond(websocket, transcription, session_id, turn)
     
-async def upload_file_to_openai(uploaded_file, client):
-    with NamedTemporaryFile(delete=False, suffix=f"_{uploaded_file.filename}") as tmp_file:
-        # Await the read() coroutine
-        file_content = await uploaded_file.read()
-        tmp_file.write(file_content)
-        tmp_file_path = tmp_file.name
+    elif message["type"] == "audio_end":
+        # End of a streamed utterance: the transcript is (almost) ready already
+        speculator = message.get("speculator")
+        try:
+            try:
+                transcription = await message["stt_stream"].finish()
+            except NoSpeechError:
+                transcription = ""
+            if not transcription.strip():
+                await manager.send_message(websocket, json.dumps({"type": "no_speech", "turn_id": turn.id}))
+                return
+            
+            # Send transcription back to client
+            await manager.send_message(websocket, json.dumps({
+                "type": "transcription",
+                "turn_id": turn.id,
+                "text": transcription
+            }))
+            
+            # A reply started on the partial transcript is kept if the user said what it guessed
+            speculative = speculator.take(transcription) if speculator is not None else None
+            if speculative is not None:
+                trace = current_trace.get()
+                if trace is not None:
+                    trace.add("speculation", speculative.started, time.perf_counter())
+            session_id = message.get("session_id", "")
+            if message.get("stream"):
+                await respond_streaming(websocket, transcription, session_id, turn, speculative)
+            else:
+                await respond(websocket, transcription, session_id, turn, speculative)
+        finally:
+            if speculator is not None:
+                speculator.close()
     
-    try:
-        with open(tmp_file_path, "rb") as file_content:
-            response = client.files.create(file=file_content, purpose="assistants")
-        os.remove(tmp_file_path)
-        return response.id
-    except Exception as e:
-        if os.path.exists(tmp_file_path):
-            os.remove(tmp_file_path)
-        return None
+    elif message["type"] == "text":
+        # Process text input
+        user_message = message["message"]
+        session_id = message.get("session_id", "")
+        
+        if message.get("stream"):
+            await respond_streaming(websocket, user_message, session_id, turn)
+        else:
+            await respond(websocket, user_message, session_id, turn)
     
-def add_file_to_vector_store(vector_store_id, file_id, client):
-    try:
-        result = client.vector_stores.files.create(
-            vector_store_id=vector_store_id, file_id=file_id
-        )
-        return result
-    except Exception as e:
-        return None
+    else:
+        # Unknown message type
+        await manager.send_message(websocket, json.dumps({
+            "type": "error",
+            "turn_id": turn.id,
+            "error": f"Unknown message type: {message['type']}"
+        }))
 
 
+async def respond(websocket: WebSocket, user_message: str, session_id: str, turn: Turn,
+                  speculative: Optional[SpeculativeReply] = None):
+    # Get LLM response
+    turn.llm_started = True
+    if speculative is not None:
+        async with aclosing(take_over(speculative, session_id, user_message)) as deltas:
+            llm_response = "".join([delta async for delta in deltas])
+    else:
+        llm_response = await get_llm_response(user_message, session_id)
+    turn.llm_finished(len(llm_response) // CHARS_PER_TOKEN)
+    
+    # Send LLM response back to client
+    await manager.send_message(websocket, json.dumps({
+        "type": "llm_response",
+        "turn_id": turn.id,
+        "text": llm_response
+    }))
+    
+    # Generate TTS audio in the connection's format
+    link = manager.link(websocket)
+    turn.tts_chars_pending = len(llm_response)
+    audio_data = link.payload(await text_to_speech(llm_response, link.output_format))
+    turn.tts_chars_pending = 0
+    turn.audio_bytes_unsent = len(audio_data)
+    
+    # Send TTS audio back to client
+    await manager.send_audio(websocket, FRAME_TTS, audio_data, session_id=session_id, turn_id=turn.id)
+    turn.first_audio = time.perf_counter()
+    turn.audio_bytes_unsent = 0
+
 
+async def respond_streaming(websocket: WebSocket, user_message: str, session_id: str, turn: Turn,
+                            speculative: Optional[SpeculativeReply] = None):
+    # Cut the reply into sentences as it streams in and synthesize each one right
+    # away, so the first sentence can play while the rest is still being generated.
+    # Segments are synthesized concurrently but always sent in order: whole, or for
+    # framed formats (see delivery.py) in frames as their audio streams in.
+    segmenter = SentenceSegmenter()
+    synthesis_slots = asyncio.Semaphore(TTS_STREAM_CONCURRENCY)
+    pending: asyncio.Queue = asyncio.Queue()
+    link = manager.link(websocket)
+    framer = link.framer()
 
-@app.post("/api/upload")
-async def upload_files(files: List[UploadFile] = File(...), session_id: str = Form(...)):
+    async def synthesize(segment: str, audio: asyncio.Queue):
+        # Chunks go to the sender as they arrive; None ends the segment
+        try:
+            async with synthesis_slots:
+                async with aclosing(text_to_speech_streaming(segment, link.output_format)) as chunks:
+                    async for chunk in chunks:
+                        turn.audio_bytes_unsent += len(chunk)
+                        audio.put_nowait(chunk)
+            turn.tts_chars_pending -= len(segment)
+        finally:
+            audio.put_nowait(None)
+
+    async def segment_audio(audio: asyncio.Queue, task: asyncio.Task) -> AsyncIterator[bytes]:
+        while (chunk := await audio.get()) is not None:
+            turn.audio_bytes_unsent -= len(chunk)
+            yield chunk
+        # Raises if the synthesis failed
+        await task
+
+    async def send_audio():
+        segments = seq = 0
+        while True:
+            item = await pending.get()
+            if item is None:
+                return segments, seq
+            segment, audio, task = item
+            first_frame = seq
+            async with aclosing(framer.frames(segment_audio(audio, task))) as frames:
+                async for frame in frames:
+                    # The segment's text goes with its first frame
+                    fields = {"text": segment} if seq == first_frame else {}
+                    await manager.send_audio(websocket, FRAME_TTS_CHUNK, frame, seq=seq,
+                                             session_id=session_id, turn_id=turn.id, **fields)
+                    if turn.first_audio is None:
+                        turn.first_audio = time.perf_counter()
+                    seq += 1
+            segments += 1
+
+    def schedule(segment: str):
+        audio: asyncio.Queue = asyncio.Queue()
+        pending.put_nowait((segment, audio, asyncio.create_task(synthesize(segment, audio))))
+
+    await manager.send_message(websocket, json.dumps({"type": "tts_start", "turn_id": turn.id}))
+    sender = asyncio.create_task(send_audio())
+    reply = []
+    generated_chars = 0
+    turn.llm_started = turn.llm_streamed = True
     try:
-        client = OpenAI(api_key=os.getenv('LLM_API_KEY'))
-        vector_store_id = redis_client.get(session_id)
-
-        if not vector_store_id:
-            vector_store_id = create_vector_store(client)
-            if not vector_store_id:
-                return JSONResponse(content={"error": "Failed to create vector store"}, status_code=500)
-            redis_client.set(session_id, vector_store_id, ex=3600)
-
-        file_ids = []
-        for uploaded_file in files:
-            # Compute hash of file content
-            file_content = await uploaded_file.read()
-            file_hash = hashlib.sha256(file_content).hexdigest()  # Use SHA256 for uniqueness
-            uploaded_file.file.seek(0)  # Reset file pointer after reading
-            # Log file details
-            print(f"Uploading file: {uploaded_file.filename}")
-            print(f"MIME Type: {uploaded_file.content_type}")
-            print(f"First 100 bytes: {file_content[:100]}")
-            # Check if the exact file already exists (hash comparison)
-            existing_file_id = redis_client.hget(f"session:{session_id}:file_hashes", file_hash)
-            if existing_file_id:
-                file_ids.append(existing_file_id)  # Skip re-upload
-                continue
+        # Closing the generator right away on cancellation also closes the LLM stream
+        llm_stream = (take_over(speculative, session_id, user_message) if speculative is not None
+                      else stream_llm_response(user_message, session_id))
+        async with aclosing(llm_stream) as deltas:
+            async for delta in deltas:
+                reply.append(delta)
+                # Generated text counts as speech still to synthesize until its segment's audio is back
+                generated_chars += len(delta)
+                turn.llm_tokens = generated_chars // CHARS_PER_TOKEN
+                turn.tts_chars_pending += len(delta)
+                await manager.send_message(websocket, json.dumps({
+                    "type": "llm_delta",
+                    "turn_id": turn.id,
+                    "text": delta
+                }))
+                for segment in segmenter.feed(delta):
+                    schedule(segment)
+        turn.llm_finished(generated_chars // CHARS_PER_TOKEN)
+        last_segment = segmenter.flush()
+        if last_segment:
+            schedule(last_segment)
+        pending.put_nowait(None)
 
-            # Upload file to OpenAI
-            file_id = await upload_file_to_openai(uploaded_file, client)
-            if file_id:
-                file_ids.append(file_id)
-                add_file_to_vector_store(vector_store_id, file_id, client)
+        # Send the full LLM response back to client
+        await manager.send_message(websocket, json.dumps({
+            "type": "llm_response",
+            "turn_id": turn.id,
+            "text": "".join(reply)
+        }))
+        segments, frames = await sender
+    except BaseException:
+        sender.cancel()
+        while not pending.empty():
+            item = pending.get_nowait()
+            if item is not None:
+                item[2].cancel()
+        raise
 
-                # Store filename, file ID, and hash in Redis
-                redis_client.hset(f"session:{session_id}:files", file_id, uploaded_file.filename)
-                redis_client.hset(f"session:{session_id}:file_hashes", file_hash, file_id)
+    time_to_first_audio_ms = round((turn.first_audio - turn.started) * 1000) if turn.first_audio else None
+    await manager.send_message(websocket, json.dumps({
+        "type": "tts_end",
+        "turn_id": turn.id,
+        "segments": segments,
+        "frames": frames,
+        "time_to_first_audio_ms": time_to_first_audio_ms
+    }))
 
+
+def upload_progress(session_id: str, upload_id: str):
+    # Progress of an upload goes to the session's /ws connections, from whichever process runs its jobs
+    async def on_progress(event):
+        await manager.send_session(session_id, {"type": "upload_progress", "upload_id": upload_id, **event})
+    return on_progress
+
+@app.post("/api/upload")
+async def upload_files(files: List[UploadFile] = File(...), session_id: str = Form(...)):
+    # The upload's id is its ingest job's id
+    job_id = uuid.uuid4().hex
+
+    try:
+        # Spool and hash the files (SHA256 for uniqueness); the rest happens in the ingest job
+        items = await get_ingestion().spool_files(files, job_id, upload_progress(session_id, job_id))
+        await job_queue.enqueue("ingest", {"files": [item.to_dict() for item in items]},
+                                session_id=session_id, job_id=job_id)
         return JSONResponse(
-            content={"message": f"Successfully uploaded {len(file_ids)} new file(s)", "session_id": session_id},
-            status_code=200
+            content={
+                "message": f"Queued {len(items)} file(s) for ingestion",
+                "session_id": session_id,
+                "upload_id": job_id,
+                "job_id": job_id,
+                "files": [item.summary() for item in items],
+            },
+            status_code=202
         )
 
+    except UploadTooLarge as e:
+        await remove_spooled(job_id)
+        return JSONResponse(content={"error": str(e)}, status_code=413)
     except redis.exceptions.RedisError as e:
+        await remove_spooled(job_id)
         return JSONResponse(content={"error": f"Redis error: {str(e)}"}, status_code=500)
     except Exception as e:
+        await remove_spooled(job_id)
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
 
+async def remove_spooled(upload_id: str):
+    try:
+        await upload_spool.remove(upload_id)
+    except (OSError, redis.exceptions.RedisError) as e:
+        # The cleanup job sweeps them up once they are JOB_TTL old
+        log.warning(f"Could not remove spooled upload {upload_id}: {e}")
+
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    # Status of a background job, e.g. an upload's ingestion; kept for JOB_TTL after it finished
+    job = await job_queue.get(job_id)
+    if job is None:
+        return JSONResponse(content={"error": "Job not found"}, status_code=404)
+    return JSONResponse(content=job.to_dict())
+
+
 @app.delete("/api/delete-file")
 async def delete_file(filename: str, file_hash: str, session_id: str):
     try:
-        client = OpenAI(api_key=os.getenv('LLM_API_KEY'))
-        vector_store_id = redis_client.get(session_id)
+        ingestion = get_ingestion()
+        # Find the vector store and the file_id using the provided hash
+        vector_store_id, (file_id,) = await sessions.find_files(session_id, [file_hash])
 
-        if not vector_store_id:
+        if ingestion.needs_vector_store and not vector_store_id:
             return JSONResponse(content={"error": "Vector store not found"}, status_code=404)
 
-        # Find the file_id using the provided hash
-        file_id = redis_client.hget(f"session:{session_id}:file_hashes", file_hash)
-
         if not file_id:
             return JSONResponse(content={"error": "File not found"}, status_code=404)
 
-        # Remove file from OpenAI vector store
-        client.vector_stores.files.delete(vector_store_id=vector_store_id, file_id=file_id)
+        # Remove file from the OpenAI vector store (or the local document store)
+        await ingestion.remove_file(session_id, vector_store_id, file_id)
 
         # Remove file ID and hash from Redis
-        redis_client.hdel(f"session:{session_id}:files", file_id)
-        redis_client.hdel(f"session:{session_id}:file_hashes", file_hash)
-        print(f'sucessfully deleted {file_id}')
-        return JSONResponse(content={"message": "File deleted successfully"}, status_code=200)
+        await sessions.remove_file(session_id, file_id, file_hash)
+
+        # The OpenAI file object itself is deleted in the background, retried until it is
+        job_id = None
+        if ingestion.needs_vector_store:
+            job_id = await job_queue.enqueue("delete_files", {"file_ids": [file_id]}, session_id=session_id)
+        log.info(f'Successfully deleted {file_id}')
+        return JSONResponse(content={"message": "File deleted successfully", "job_id": job_id}, status_code=200)
 
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
-# Function to transcribe audio using AssemblyAI
-def transcribe_audio(audio_bytes):
-    # Set up AssemblyAI API
-    assembly_api_key = os.getenv("ASSEMBLYAI_API_KEY")
-    headers = {
-        "authorization": assembly_api_key,
-        "content-type": "application/json"
-    }
-    
-    # Upload the audio file to AssemblyAI
-    upload_endpoint = "https://api.assemblyai.com/v2/upload"
-    upload_response = requests.post(
-        upload_endpoint,
-        headers=headers,
-        data=audio_bytes
-    )
-    
-    if upload_response.status_code != 200:
-        raise Exception(f"Upload failed: {upload_response.text}")
-        
-    audio_url = upload_response.json()["upload_url"]
-    
-    # Request transcription
-    transcript_endpoint = "https://api.assemblyai.com/v2/transcript"
-    transcript_request = {
-        "audio_url": audio_url,
-        "language_code": "en"  # Change as needed for other languages
+async def run_ingest_job(job: Job) -> dict:
+    # Upload the new files in parallel and attach them to the vector store in one batch. Runs
+    # again from the start after a failure: files already in the session are skipped, and the
+    # ones an earlier run uploaded are attached without being uploaded again
+    session_id = job.session_id
+    on_progress = upload_progress(session_id, job.id)
+    ingestion = get_ingestion()
+    items = [IngestFile(**item) for item in job.payload["files"]]
+
+    # One round trip for the vector store and every hash already uploaded in this session
+    vector_store_id, existing_file_ids = await sessions.find_files(session_id, [item.file_hash for item in items])
+
+    # Files searched locally (see retrieval.py) need no vector store
+    if ingestion.needs_vector_store and not vector_store_id:
+        created = await ingestion.create_vector_store(session_id)
+        vector_store_id = await sessions.claim_vector_store(session_id, created)
+        if vector_store_id != created:
+            # A concurrent upload created the session's vector store first
+            await sessions.forget_resources(
+                session_id, await ingestion.delete_resources(session_id, SessionResources(vector_store_ids=[created])))
+
+    batch_id = await ingestion.ingest(session_id, job.id, vector_store_id, items, existing_file_ids, on_progress)
+    index_job_id = None
+    if batch_id:
+        index_job_id = await job_queue.enqueue(
+            "index_status",
+            {"vector_store_id": vector_store_id, "batch_id": batch_id, "upload_id": job.id,
+             "delay": ingestion.poll_initial, "deadline": time.time() + ingestion.index_timeout},
+            session_id=session_id,
+            delay=ingestion.poll_initial,
+        )
+
+    uploaded = sum(1 for item in items if item.status == "uploaded")
+    return {
+        "message": f"Successfully uploaded {uploaded} new file(s)",
+        "upload_id": job.id,
+        "batch_id": batch_id,
+        "index_job_id": index_job_id,
+        "files": [item.summary() for item in items],
     }
-    transcript_response = requests.post(
-        transcript_endpoint,
-        json=transcript_request,
-        headers=headers
-    )
-    
-    if transcript_response.status_code != 200:
-        raise Exception(f"Transcription request failed: {transcript_response.text}")
-        
-    transcript_id = transcript_response.json()["id"]
-    
-    # Poll for transcription completion
-    polling_endpoint = f"https://api.assemblyai.com/v2/transcript/{transcript_id}"
-    while True:
-        polling_response = requests.get(polling_endpoint, headers=headers)
-        polling_response_json = polling_response.json()
-        
-        if polling_response_json["status"] == "completed":
-            return polling_response_json["text"]
-        elif polling_response_json["status"] == "error":
-            raise Exception(f"Transcription error: {polling_response_json['error']}")
-        
-        time.sleep(1)
-# New streaming function
-def text_to_speech_streaming(text: str) -> Iterator[bytes]:
-    client = ElevenLabs(
-        api_key=os.getenv("ELEVENLABS_API_KEY"),
-    )
-    
-    # Use the streaming option
-    audio_stream = client.text_to_speech.convert(
-        text=text,
-        voice_id="JBFqnCBsd6RMkjVDRZzb",
-        model_id="eleven_multilingual_v2",
-        output_format="mp3_44100_128",
-        stream=True  # Enable streaming
-    )
-    
-    # Simply yield chunks as they come
-    for chunk in audio_stream:
-        yield chunk
 
-# Alternative version with chunking and ID3 header handling
-def text_to_speech_streaming_with_headers(text: str) -> Iterator[bytes]:
-    client = ElevenLabs(
-        api_key=os.getenv("ELEVENLABS_API_KEY"),
-    )
-    
-    audio_stream = client.text_to_speech.convert(
-        text=text,
-        voice_id="JBFqnCBsd6RMkjVDRZzb",
-        model_id="eleven_multilingual_v2",
-        output_format="mp3_44100_128",
-        stream=True
-    )
+async def run_index_status_job(job: Job) -> dict:
+    # Poll the file batch once; until the vector store has indexed it, again later, backing off
+    payload = job.payload
+    ingestion = get_ingestion()
+    delay = min(payload["delay"] * 2, ingestion.poll_max)
+    result = await ingestion.check_batch(job.session_id, payload["vector_store_id"], payload["batch_id"],
+                                         time.time() + delay > payload["deadline"],
+                                         upload_progress(job.session_id, payload["upload_id"]))
+    if result is None:
+        raise RunLater(delay, {**payload, "delay": delay})
+    return result
+
+async def run_delete_files_job(job: Job) -> dict:
+    file_ids = job.payload["file_ids"]
+    await get_ingestion().delete_files(file_ids)
+    await sessions.forget_resources(job.session_id, SessionResources(file_ids=file_ids))
+    return {"deleted": len(file_ids)}
+
+async def run_cleanup_job(job: Job):
+    # Delete what expired sessions left behind, then run again in CLEANUP_INTERVAL whatever
+    # happened, so the job never fails for good. A session whose deletion failed is tried
+    # again later, backing off from CLEANUP_INTERVAL to CLEANUP_RETRY_MAX
+    cleaned = {"sessions": 0, "vector_stores": 0, "files": 0, "local": 0, "errors": 0, "uploads": 0}
+    try:
+        ingestion = get_ingestion()
+        for session_id, resources in await sessions.expired_resources(CLEANUP_GRACE):
+            try:
+                deleted = await ingestion.delete_resources(session_id, resources)
+                await sessions.forget_resources(session_id, deleted)
+            except Exception as e:
+                log.warning(f"Could not clean up session {session_id}: {e}")
+                cleaned["errors"] += 1
+                await sessions.postpone_cleanup(session_id, CLEANUP_INTERVAL, CLEANUP_RETRY_MAX)
+                continue
+            cleaned["sessions"] += 1
+            cleaned["vector_stores"] += len(deleted.vector_store_ids)
+            cleaned["files"] += len(deleted.file_ids)
+            cleaned["local"] += deleted.local
+    except Exception as e:
+        log.error(f"Cleanup of expired sessions stopped: {e}")
+        cleaned["errors"] += 1
+    try:
+        # Spooled uploads whose ingest job never finished
+        cleaned["uploads"] = await asyncio.to_thread(upload_spool.sweep)
+    except OSError as e:
+        log.warning(f"Could not sweep the upload spool: {e}")
+        cleaned["errors"] += 1
+    if cleaned["sessions"] or cleaned["errors"] or cleaned["uploads"]:
+        log.info(f"Cleaned up expired sessions: {cleaned}")
+    raise RunLater(CLEANUP_INTERVAL, result=cleaned)
+
+async def report_job(job: Job):
+    if job.kind == "ingest":
+        # Done with the spooled uploads, whether the job succeeded or gave up
+        await remove_spooled(job.id)
+    if job.session_id:
+        await manager.send_session(job.session_id, {"type": "job", **job.to_dict()})
+
+job_queue.handle("ingest", run_ingest_job)
+job_queue.handle("index_status", run_index_status_job)
+job_queue.handle("delete_files", run_delete_files_job)
+job_queue.handle("cleanup", run_cleanup_job)
+job_queue.on_finished = report_job
+
+@app.delete("/api/conversation")
+async def clear_conversation(session_id: str):
+    # Start over: later questions no longer see the earlier exchanges
+    try:
+        await conversations.clear(session_id)
+        return JSONResponse(content={"message": "Conversation cleared"}, status_code=200)
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+
+# Function to transcribe audio with the configured STT backend
+async def transcribe_audio(audio_bytes):
+    return await get_stt_backend().transcribe_recording(audio_bytes)
+
+# New streaming function
+async def text_to_speech_streaming(text: str, output_format: Optional[str] = None) -> AsyncIterator[bytes]:
+    backend = get_tts_backend()
+    output_format = output_format or backend.voice.output_format
+    cache_key = tts_cache_key(text, backend.voice.voice_id, backend.voice.model_id, output_format)
+    async with span("tts_cache"):
+        cached_audio = await tts_cache.get(cache_key)
+    if cached_audio is not None:
+        # Serve cached audio in chunks, like the live stream
+        for offset in range(0, len(cached_audio), TTS_CACHE_CHUNK_BYTES):
+            yield cached_audio[offset:offset + TTS_CACHE_CHUNK_BYTES]
+        return
     
-    # First chunk needs special handling to include headers
-    first_chunk = True
-    for chunk in audio_stream:
-        if first_chunk:
-            # The first chunk contains necessary MP3 headers
-            first_chunk = False
-            yield chunk
-        else:
-            # Subsequent chunks
+    # Simply yield chunks as they come, keeping a copy for the cache
+    chunks = []
+    async with aclosing(backend.stream(text, output_format)) as audio_stream:
+        async for chunk in audio_stream:
+            chunks.append(chunk)
             yield chunk
+    await tts_cache.put(cache_key, b"".join(chunks))
+
+# Answers can be reused while the session's document set is unchanged; None disables the cache
+def answer_fingerprint(state: SessionState, conversation: Conversation):
+    # Answers given while files are still being indexed may miss them, so they are not cached.
+    # Nor are follow-ups: their answer depends on the conversation, not just the question
+    if not ANSWER_CACHE_ENABLED or not state.file_hashes or state.pending_batches:
+        return None
+    if conversation.exchanges or conversation.summary:
+        return None
+    backend = get_llm_backend()
+    # The same model answers differently from locally retrieved passages
+    model = backend.model if backend.hosted_retrieval else f"{backend.model}+local"
+    return file_set_fingerprint(state.file_hashes, model, LLM_INSTRUCTIONS)
+
+def has_documents(backend: LLMBackend, state: SessionState) -> bool:
+    return bool(state.vector_store_id if backend.hosted_retrieval else state.files)
+
+async def load_session(session_id: str):
+    """The session's documents and its conversation so far, in one round trip's time."""
+    if not CONVERSATION_MEMORY:
+        return await sessions.load(session_id), Conversation()
+    return await asyncio.gather(sessions.load(session_id), conversations.load(session_id))
+
+async def build_prompt(backend: LLMBackend, state: SessionState, conversation: Conversation,
+                       session_id: str, user_input: str) -> Prompt:
+    history = dict(history=conversation.exchanges, summary=conversation.summary, cache_key=session_id)
+    if backend.hosted_retrieval:
+        return Prompt(LLM_INSTRUCTIONS, user_input, vector_store_id=state.vector_store_id, **history)
+    # Local backends are given the best matching chunks of the session's documents; a follow-up
+    # ("and how long does it take?") is searched together with the question before it
+    query = user_input
+    if conversation.exchanges:
+        query = f"{conversation.exchanges[-1].question} {user_input}"
+    async with span("retrieval"):
+        passages = await get_document_store().search(session_id, query, RETRIEVAL_K)
+    return Prompt(LLM_INSTRUCTIONS, user_input, passages=passages, **history)
+
+async def summarize_conversation(summary: str, exchanges: List[Exchange]) -> str:
+    prompt = Prompt(SUMMARY_INSTRUCTIONS, transcript(summary, exchanges), retrieval=False)
+    # Turns go first: the summary waits for an idle LLM and gives it up when a turn needs it
+    return await get_llm_backend().respond(prompt, background=True)
+
+async def remember(session_id: str, user_input: str, answer: str):
+    """Add a completed exchange to the conversation, folding old ones into the summary when it is too long."""
+    if not CONVERSATION_MEMORY or not session_id:
+        return
+    try:
+        if await conversations.append(session_id, user_input, answer):
+            # Off the turn's path; the next prompts leave the oldest exchanges out until it is done
+            fold_task = asyncio.create_task(conversations.fold(
+                session_id, summarize_conversation if CONVERSATION_SUMMARY else None))
+            background_tasks.add(fold_task)
+            fold_task.add_done_callback(background_tasks.discard)
+    except redis.RedisError as e:
+        log.warning(f"Conversation Redis error: {e}")
+
 # Function to get response from LLM
-def get_llm_response(user_input, session_id):
+async def get_llm_response(user_input, session_id):
     # CHAT_WEBHOOK_URL = "http://localhost:5678/webhook/invoke_agent"
     # Fetch the OpenAI API key from environment variables
     # openai_api_key = os.getenv("LLM_API_KEY")  
@@ -498,59 +1787,113 @@ def get_llm_response(user_input, session_id):
     # # Extract the assistant's reply from the response
     # assistant_response = response_json["choices"][0]["message"]["content"]
     # return assistant_response
-    print(session_id)
+    started = time.perf_counter()
     try:
-        client = OpenAI(api_key=os.getenv('LLM_API_KEY'))
-        if redis_client.exists(session_id):
-            vector_store_id = redis_client.get(session_id)
-            print(f"Vector store ID: {vector_store_id}")
-        else:
-            print("No vector store ID found for session ID.")
+        backend = get_llm_backend()
+        async with span("session_load"):
+            state, conversation = await load_session(session_id)
+        if not has_documents(backend, state):
+            log.info("No documents found for session ID.")
             return 'Please upload and process documents first.'
         
-        response = client.responses.create(
-            instructions="""You are a helpful assistant that only answers questions based on the 
-                documents provided. If the question cannot be answered using the documents or is outside 
-                their scope, respond with "I don't know" or "I cannot answer this question based on the 
-                documents provided." Do not use any knowledge outside of the provided documents.""",
-            model="gpt-4o-mini",
-            input=user_input,
-            tools=[{
-                "type": "file_search", 
-                "vector_store_ids": [vector_store_id]
-            }],
-            temperature=0
-            # tool_choice="auto"
-        )
-        print(f"Response received: {response.output_text}")
+        fingerprint = answer_fingerprint(state, conversation)
+        if fingerprint:
+            async with span("answer_cache"):
+                cached_answer = await answer_cache.get(fingerprint, user_input)
+            if cached_answer is not None:
+                answer_cache.record(True, started)
+                await remember(session_id, user_input, cached_answer)
+                return cached_answer
+        
+        prompt = await build_prompt(backend, state, conversation, session_id, user_input)
+        answer = await backend.respond(prompt)
+        if fingerprint:
+            await answer_cache.put(fingerprint, user_input, answer)
+            answer_cache.record(False, started)
+        await remember(session_id, user_input, answer)
+    except Busy:
+        # The caller tells the client to try again
+        raise
     except Exception as e:
-        import traceback
-        print(f"Error processing request: {e}")
-        print(traceback.format_exc())
+        log.exception(f"Error processing request: {e}")
         return 'An error occurred while processing your request.'
     # Display the response
-    return response.output_text
+    return answer
 
-# Function to convert text to speech using AssemblyAI
-def text_to_speech(text):
-    client = ElevenLabs(
-        api_key=os.getenv("ELEVENLABS_API_KEY"),
-    )
-    audio = client.text_to_speech.convert(
-        text=text,
-        voice_id="JBFqnCBsd6RMkjVDRZzb",
-        model_id="eleven_multilingual_v2",
-        output_format="mp3_44100_128",
-    )
-    # play(audio)
+# Streaming variant of get_llm_response: yields the answer text as it is generated. A complete
+# answer is passed to on_complete, which adds it to the conversation unless told otherwise
+async def stream_llm_response(user_input, session_id, on_complete=None) -> AsyncIterator[str]:
+    started = time.perf_counter()
+    if on_complete is None:
+        on_complete = lambda answer: remember(session_id, user_input, answer)
+    try:
+        backend = get_llm_backend()
+        async with span("session_load"):
+            state, conversation = await load_session(session_id)
+        if not has_documents(backend, state):
+            log.info("No documents found for session ID.")
+            yield 'Please upload and process documents first.'
+            return
+        
+        fingerprint = answer_fingerprint(state, conversation)
+        if fingerprint:
+            async with span("answer_cache"):
+                cached_answer = await answer_cache.get(fingerprint, user_input)
+            if cached_answer is not None:
+                answer_cache.record(True, started)
+                yield cached_answer
+                await on_complete(cached_answer)
+                return
+        
+        prompt = await build_prompt(backend, state, conversation, session_id, user_input)
+        answer = []
+        # Closing the stream early (the turn was cancelled) stops generation
+        async with aclosing(backend.stream(prompt)) as deltas:
+            async for delta in deltas:
+                answer.append(delta)
+                yield delta
+        if fingerprint:
+            await answer_cache.put(fingerprint, user_input, "".join(answer))
+            answer_cache.record(False, started)
+        # Only replies that were generated in full are remembered; a barged-in one is not
+        await on_complete("".join(answer))
+    except Busy:
+        raise
+    except Exception as e:
+        log.exception(f"Error processing request: {e}")
+        # Not part of the answer, which may be half said already: the turn stops its reply
+        # and sends the client an error event instead
+        raise RuntimeError('An error occurred while processing your request.') from e
+
+# A speculative reply (see speculation.py) continued by the turn whose transcript it guessed
+async def take_over(reply: SpeculativeReply, session_id: str, user_input: str) -> AsyncIterator[str]:
+    async with aclosing(reply.replay()) as deltas:
+        async for delta in deltas:
+            yield delta
+    if reply.answer is not None:
+        await remember(session_id, user_input, reply.answer)
+
+# Function to convert text to speech with the configured TTS backend
+async def text_to_speech(text, output_format: Optional[str] = None):
+    backend = get_tts_backend()
+    output_format = output_format or backend.voice.output_format
+    cache_key = tts_cache_key(text, backend.voice.voice_id, backend.voice.model_id, output_format)
+    async with span("tts_cache"):
+        cached_audio = await tts_cache.get(cache_key)
+    if cached_audio is not None:
+        return cached_audio
     
-    if audio:
-        # Convert generator to bytes
-        audio_bytes = b"".join(audio)
+    # The backend collects the audio stream into bytes
+    audio_bytes = await backend.synthesize(text, output_format)
+    if audio_bytes:
+        await tts_cache.put(cache_key, audio_bytes)
         return audio_bytes
     else:
         raise Exception(f"TTS API Error")
 
-# For local development
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    # Local development: one auto-reloading worker. Production: set WORKERS=N (one per core)
+    # and run several hosts against the same Redis behind a load balancer
+    workers = int(os.getenv("WORKERS", "1"))
+    uvicorn.run("main:app", host=os.getenv("HOST", "0.0.0.0"), port=int(os.getenv("PORT", "8000")),
+                workers=workers, reload=workers == 1 and os.getenv("RELOAD", "1") not in ("0", "false", "no"))
\ No newline at end of file
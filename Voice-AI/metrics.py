@@ -0,0 +1,251 @@
+"""Latency metrics and per-turn tracing for the voice pipeline.
+
+Each stage of a turn (queue wait, STT upload and polling, session load, the
+LLM call, TTS synthesis, ...) is timed with `span(stage)`. A span observes
+its duration in a Prometheus histogram and, for streams, the time to the
+first byte (`mark_first_byte()`); failures are counted per stage.
+
+Spans opened while a turn is being handled are also added to that turn's
+Trace, which is found through a context variable, so the vendor helpers do
+not need to pass it around. Tasks started by the turn (e.g. the concurrent
+TTS requests) inherit it.
+
+The histograms are rendered in the Prometheus text format by
+render_metrics() (served at /metrics). They also keep a window of recent
+samples for the percentiles of stage_report() (served at /api/status/*).
+"""
+import bisect
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RECENT_SAMPLES = 1024
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+def format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def percentile(samples: List[float], pct: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+class HistogramSeries:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.recent: Deque[float] = deque(maxlen=RECENT_SAMPLES)
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.series: Dict[Tuple[str, ...], HistogramSeries] = {}
+
+    def observe(self, value: float, *labelvalues: str):
+        series = self.series.get(labelvalues)
+        if series is None:
+            series = self.series[labelvalues] = HistogramSeries(self.buckets)
+        # Buckets are rendered cumulatively; store the count of the first bucket that fits
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series.bucket_counts[index] += 1
+        series.count += 1
+        series.sum += value
+        series.recent.append(value)
+
+    def summary(self, *labelvalues: str) -> Optional[dict]:
+        series = self.series.get(labelvalues)
+        if series is None:
+            return None
+        recent = list(series.recent)
+        return {
+            "count": series.count,
+            "recent": len(recent),
+            **{f"p{pct}_ms": round(percentile(recent, pct) * 1000, 1) for pct in (50, 95, 99)},
+        }
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labelvalues, series in sorted(self.series.items()):
+            labels = dict(zip(self.labelnames, labelvalues))
+            cumulative = 0
+            for bound, count in zip(self.buckets, series.bucket_counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels({**labels, 'le': format_value(bound)})} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels({**labels, 'le': '+Inf'})} {series.count}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {format_value(series.sum)}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {series.count}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        # By convention the name ends in _total
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labelvalues: str, amount: float = 1):
+        self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def get(self, *labelvalues: str) -> float:
+        return self.values.get(labelvalues, 0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labelvalues, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{format_labels(dict(zip(self.labelnames, labelvalues)))} {format_value(value)}")
+        return lines
+
+
+stage_seconds = Histogram("voice_stage_duration_seconds", "Duration of a pipeline stage.", ("stage",))
+stage_first_byte_seconds = Histogram(
+    "voice_stage_first_byte_seconds", "Time until a streaming stage produced its first output.", ("stage",))
+stage_errors = Counter("voice_stage_errors_total", "Pipeline stages that failed.", ("stage",))
+turn_seconds = Histogram("voice_turn_duration_seconds", "Duration of a /ws turn, by outcome.", ("outcome",))
+turn_first_audio_seconds = Histogram(
+    "voice_turn_first_audio_seconds", "Time from the start of a /ws turn until its first audio was sent.")
+admission_rejected = Counter(
+    "voice_admission_rejected_total", "Calls and turns turned away by admission control.", ("scope", "reason"))
+vendor_retries = Counter("voice_vendor_retries_total", "Vendor calls retried after a transient failure.", ("provider",))
+METRICS = [stage_seconds, stage_first_byte_seconds, stage_errors, turn_seconds, turn_first_audio_seconds,
+           admission_rejected, vendor_retries]
+
+# Last success and last failure (time, message) per stage, for the health endpoints
+last_ok: Dict[str, float] = {}
+last_error: Dict[str, Tuple[float, str]] = {}
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def stage_report(stages: Iterable[str]) -> dict:
+    """Recent latency percentiles and errors of the given stages."""
+    report = {}
+    for stage in stages:
+        duration = stage_seconds.summary(stage)
+        first_byte = stage_first_byte_seconds.summary(stage)
+        report[stage] = {
+            **(duration or {"count": 0}),
+            "errors": int(stage_errors.get(stage)),
+            **({"first_byte": first_byte} if first_byte else {}),
+        }
+    return report
+
+
+def stage_failing(stages: Iterable[str]) -> Optional[str]:
+    """The error of the most recent call of these stages, if that call failed."""
+    latest_ok = max((last_ok.get(stage, 0.0) for stage in stages), default=0.0)
+    failures = [last_error[stage] for stage in stages if stage in last_error]
+    if not failures:
+        return None
+    at, error = max(failures)
+    return error if at > latest_ok else None
+
+
+class Trace:
+    def __init__(self, turn_id: int, session_id: str = "", queued: Optional[float] = None):
+        # Offsets are relative to when the turn was queued, if known
+        now = time.perf_counter()
+        self.turn_id = turn_id
+        self.session_id = session_id
+        self.started = queued if queued is not None else now
+        self.spans: List[dict] = []
+        if queued is not None:
+            self.add("queue_wait", queued, now)
+
+    def add(self, stage: str, start: float, end: float, first_byte: Optional[float] = None,
+            error: Optional[str] = None):
+        entry = {
+            "stage": stage,
+            "start_ms": round((start - self.started) * 1000, 1),
+            "duration_ms": round((end - start) * 1000, 1),
+        }
+        if first_byte is not None:
+            entry["first_byte_ms"] = round((first_byte - start) * 1000, 1)
+        if error is not None:
+            entry["error"] = error
+        self.spans.append(entry)
+
+    def to_dict(self, outcome: str, **fields) -> dict:
+        return {
+            "turn_id": self.turn_id,
+            "session_id": self.session_id,
+            "outcome": outcome,
+            "total_ms": round((time.perf_counter() - self.started) * 1000, 1),
+            **fields,
+            "spans": self.spans,
+        }
+
+
+current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+
+
+class span:
+    """Time a stage: `async with span("llm") as s: ... s.mark_first_byte() ...` (or a plain `with`).
+    Exceptions in `expected` end the stage normally, e.g. NoSpeechError for the audio check."""
+
+    def __init__(self, stage: str, expected: Tuple[type, ...] = ()):
+        self.stage = stage
+        self.expected = expected
+        self.start = 0.0
+        self.first_byte: Optional[float] = None
+
+    def mark_first_byte(self):
+        if self.first_byte is None:
+            self.first_byte = time.perf_counter()
+            stage_first_byte_seconds.observe(self.first_byte - self.start, self.stage)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        stage_seconds.observe(end - self.start, self.stage)
+        error = None
+        if exc_type is None or issubclass(exc_type, self.expected):
+            last_ok[self.stage] = time.time()
+            if exc_type is not None:
+                error = exc_type.__name__
+        elif issubclass(exc_type, Exception):
+            error = f"{exc_type.__name__}: {exc}"
+            stage_errors.inc(self.stage)
+            last_error[self.stage] = (time.time(), error)
+        else:
+            # Cancellation (barge-in) is not a failure of the stage
+            error = "cancelled"
+        trace = current_trace.get()
+        if trace is not None:
+            trace.add(self.stage, self.start, end, self.first_byte, error)
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return self.__exit__(exc_type, exc, tb)
@@ -0,0 +1,68 @@
+"""Binary WebSocket frames for audio on /ws.
+
+Control messages stay JSON text frames; audio travels as binary frames with a
+small header so it no longer has to be base64-encoded inside JSON:
+
+    offset  size  field
+    0       1     protocol version (PROTOCOL_VERSION)
+    1       1     frame type (FRAME_*)
+    2       1     flags (FLAG_*)
+    3       1     session id length in bytes (n)
+    4       4     sequence number, unsigned
+    8       n     session id, UTF-8
+    8 + n   ...   raw audio
+
+All integers are big-endian. A client opts in by connecting to
+`/ws?protocol=<version>`; without it the server keeps sending base64 JSON.
+"""
+import struct
+from typing import NamedTuple
+
+PROTOCOL_VERSION = 1
+
+HEADER = struct.Struct(">BBBBI")
+
+# Client -> server
+FRAME_AUDIO = 0x01        # A whole recording, like the JSON "audio" message
+FRAME_AUDIO_CHUNK = 0x02  # One PCM frame of a streamed utterance (between audio_start and audio_end)
+# Server -> client
+FRAME_TTS = 0x10          # The whole reply's audio, like the JSON "tts" message
+FRAME_TTS_CHUNK = 0x11    # One frame of a streamed reply's audio (see delivery.py); seq counts the reply's frames from 0
+
+# The server should stream its reply (same as "stream": true in JSON messages)
+FLAG_STREAM = 0x01
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+class Frame(NamedTuple):
+    type: int
+    flags: int
+    seq: int
+    session_id: str
+    payload: memoryview
+
+
+def pack_frame(frame_type: int, payload: bytes, seq: int = 0, session_id: str = "", flags: int = 0) -> bytes:
+    session = session_id.encode("utf-8")
+    if len(session) > 255:
+        raise ProtocolError("Session id longer than 255 bytes")
+    return b"".join((HEADER.pack(PROTOCOL_VERSION, frame_type, flags, len(session), seq), session, payload))
+
+
+def unpack_frame(data: bytes) -> Frame:
+    if len(data) < HEADER.size:
+        raise ProtocolError(f"Frame shorter than the {HEADER.size} byte header")
+    version, frame_type, flags, session_length, seq = HEADER.unpack_from(data)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+    body = memoryview(data)[HEADER.size:]
+    if len(body) < session_length:
+        raise ProtocolError("Frame truncated inside the session id")
+    try:
+        session_id = str(body[:session_length], "utf-8")
+    except UnicodeDecodeError:
+        raise ProtocolError("Session id is not valid UTF-8") from None
+    return Frame(frame_type, flags, seq, session_id, body[session_length:])
@@ -0,0 +1,55 @@
+"""Configuration-driven choice of the STT, LLM and TTS backends.
+
+Each kind of backend has named providers, registered with a factory, and
+the one used is picked by `{KIND}_PROVIDER`:
+
+- STT_PROVIDER: assemblyai (default), whisper (faster-whisper) or stub
+- LLM_PROVIDER: openai (default), llamacpp (llama-cpp-python) or stub
+- TTS_PROVIDER: elevenlabs (default), piper (piper-tts) or stub
+
+The local providers run on the CPU in the app process, with no network
+round trip and no per-call cost; with all three the app works offline (the
+local LLM answers from documents indexed locally at upload, see
+retrieval.py). The stubs are instant and deterministic, for tests and
+benchmarks. Their packages are optional and only imported when selected.
+
+A backend is created on first use and kept for the life of the app.
+"""
+import os
+from typing import Any, Callable, Dict
+
+
+class ProviderRegistry:
+    def __init__(self, defaults: Dict[str, str]):
+        self.defaults = defaults
+        self.factories: Dict[str, Dict[str, Callable[[], Any]]] = {kind: {} for kind in defaults}
+        self.backends: Dict[str, Any] = {}
+
+    def register(self, kind: str, name: str, factory: Callable[[], Any]):
+        self.factories[kind][name] = factory
+
+    def name(self, kind: str) -> str:
+        return os.getenv(f"{kind.upper()}_PROVIDER", self.defaults[kind]).lower()
+
+    def get(self, kind: str) -> Any:
+        backend = self.backends.get(kind)
+        if backend is None:
+            name = self.name(kind)
+            factory = self.factories[kind].get(name)
+            if factory is None:
+                raise ValueError(f"Unknown {kind.upper()}_PROVIDER {name!r}, "
+                                 f"expected one of {', '.join(sorted(self.factories[kind]))}")
+            backend = self.backends[kind] = factory()
+        return backend
+
+    async def aclose(self):
+        backends = list(self.backends.values())
+        self.backends.clear()
+        for backend in backends:
+            await backend.aclose()
+
+    def report(self) -> dict:
+        return {
+            kind: {"provider": self.name(kind), "loaded": kind in self.backends, "available": sorted(factories)}
+            for kind, factories in self.factories.items()
+        }
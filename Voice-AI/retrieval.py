@@ -0,0 +1,588 @@
+"""Local document retrieval: chunk, embed and search a session's documents in-process.
+
+Used instead of OpenAI's hosted file_search with RETRIEVAL=local, and always
+for LLM backends without hosted retrieval (see llm.py). At upload, a
+document's text is extracted (plain text; PDF with pypdf when it is
+installed), split into chunks of about `chunk_chars` characters that overlap
+by `overlap_chars`, and embedded, reading the file as it goes and indexing
+`batch_chunks` chunks at a time. A question is embedded the same way and the
+`k` chunks closest to it (cosine similarity) go into the prompt. Documents
+are searchable as soon as the upload's ingest job has finished (see ingest.py).
+
+Each session has an append-only directory, `{root}/{session_id}/` (ids that
+are not a plain file name are hashed, see session_dir):
+
+- vectors.i8: one row per chunk, the L2-normalized embedding quantized to
+  int8, memory-mapped (a quarter of float32, and much cheaper to score
+  than float16, which NumPy converts in software)
+- rows.bin: per chunk, its document number, its quantization scale and
+  where its text is in texts.bin
+- texts.bin: the chunk texts, UTF-8
+- df.bin: for lexical embedders, the number of chunks using each dimension,
+  to weight the query's rare words up (like IDF)
+- documents.json: the embedder that built the index, and per document its
+  file id, filename and whether it was removed (or is still being indexed)
+- ivf.npz: with at least `ivf_min_rows` chunks, an IVF index (k-means
+  centroids and the rows of each list) so a query only scores the `nprobe`
+  lists closest to it. Rows added after it was built are scanned in full; it
+  is rebuilt once the index has grown by half.
+
+Removing a document only flags it: its rows are skipped until the session's
+directory is deleted, by the cleanup job once the session has expired. Workers on one host share the directory (appends take
+a file lock); several hosts need it on a shared volume.
+
+Embedders: `hashing` (feature-hashed words; NumPy only, no model to load,
+lexical), `sentence-transformers` (optional package) or `openai` (the
+embeddings API).
+"""
+import asyncio
+import codecs
+import fcntl
+import hashlib
+import io
+import json
+import math
+import os
+import re
+import shutil
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from admission import VendorGate
+from llm import Passage
+
+WORD = re.compile(r"[a-z0-9]+")
+# Session ids used as they are for their directory names
+SESSION_DIR_NAME = re.compile(r"[A-Za-z0-9_-][A-Za-z0-9_.-]{0,127}")
+# Too common to tell chunks apart
+STOPWORDS = frozenset("""a an and are as at be but by can did do does for from had has have how i if in
+    into is it its me my no not of on or our so than that the their them then there these they this
+    to was we were what when where which who why will with you your""".split())
+# Per chunk in rows.bin: document number, int8 scale, offset and length of its text in texts.bin
+ROW = np.dtype([("document", "<u4"), ("scale", "<f4"), ("offset", "<u8"), ("length", "<u4")])
+# Rows scored per block, bounding the float32 copy of the int8 vectors
+SEARCH_BLOCK = 4096
+
+
+def words(text: str) -> List[str]:
+    return WORD.findall(text.lower())
+
+
+def iter_text(filename: str, file: BinaryIO, read_bytes: int = 64 * 1024) -> Iterator[str]:
+    """A document's text piece by piece: a PDF page by page, plain text `read_bytes` at a time."""
+    if filename.lower().endswith(".pdf"):
+        try:
+            from pypdf import PdfReader
+        except ImportError:
+            raise RuntimeError("Reading PDF files locally needs the pypdf package") from None
+        # pypdf seeks to the objects each page needs instead of reading the whole file
+        for page in PdfReader(file).pages:
+            yield page.extract_text() or ""
+            yield "\n"
+        return
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    while block := file.read(read_bytes):
+        yield decoder.decode(block)
+    yield decoder.decode(b"", final=True)
+
+
+class ChunkSplitter:
+    """Split on whitespace into chunks of about `chunk_chars`, each repeating the end of the last.
+
+    Text is fed in pieces, and each chunk is returned as soon as the text after it has
+    arrived, so only the text of the chunk being filled is kept.
+    """
+
+    def __init__(self, chunk_chars: int, overlap_chars: int):
+        self.chunk_chars = chunk_chars
+        self.overlap_chars = overlap_chars
+        # Whitespace-normalized text from the start of the next chunk; it only ever grows at the
+        # end, so a chunk that ends before its last character is final
+        self.text = ""
+        # Whether the last piece ended inside a word, which the next piece may continue
+        self.in_word = False
+
+    def feed(self, piece: str) -> List[str]:
+        parts = piece.split()
+        if parts and self.in_word and not piece[0].isspace():
+            self.text += parts.pop(0)
+        if parts:
+            self.text += (" " if self.text else "") + " ".join(parts)
+        if piece:
+            self.in_word = not piece[-1].isspace()
+        return self._cut(final=False)
+
+    def flush(self) -> List[str]:
+        chunks = self._cut(final=True)
+        self.text = ""
+        self.in_word = False
+        return chunks
+
+    def _cut(self, final: bool) -> List[str]:
+        text = self.text
+        chunks = []
+        start = 0
+        while start < len(text):
+            end = min(start + self.chunk_chars, len(text))
+            if end < len(text):
+                space = text.rfind(" ", start + self.chunk_chars // 2, end)
+                end = space if space > 0 else end
+            elif not final:
+                # Where this chunk ends depends on text still to come
+                break
+            chunks.append(text[start:end])
+            if end >= len(text):
+                break
+            start = max(end - self.overlap_chars, start + 1)
+            # Start the next chunk on a word
+            space = text.find(" ", start, end)
+            start = space + 1 if 0 <= space < end else start
+        self.text = text[start:]
+        return chunks
+
+
+def split_chunks(text: str, chunk_chars: int, overlap_chars: int) -> List[str]:
+    splitter = ChunkSplitter(chunk_chars, overlap_chars)
+    return splitter.feed(text) + splitter.flush()
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def quantize(vectors: np.ndarray):
+    """int8 rows and the per-row scale that maps them back."""
+    scale = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127
+    return np.round(vectors / scale[:, None]).astype(np.int8), scale.astype(np.float32)
+
+
+class Embedder:
+    # Recorded in the index: vectors of different embedders cannot be compared
+    name = ""
+    dim = 0
+    # Dimensions stand for words, so rare ones can be weighted up at query time
+    lexical = False
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        """L2-normalized float32 rows, one per text."""
+        raise NotImplementedError
+
+
+class HashingEmbedder(Embedder):
+    """Words hashed into `dim` signed buckets, weighted 1 + log(count)."""
+
+    lexical = True
+
+    def __init__(self, dim: int = 1024):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def embed_sync(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            # Word pairs were tried too: at these sizes their collisions cost more recall than they add
+            features = Counter(word for word in words(text) if word not in STOPWORDS)
+            for feature, count in features.items():
+                bucket = zlib.crc32(feature.encode())
+                vectors[i, bucket % self.dim] += (1 + math.log(count)) * (1 if bucket & 0x80000000 else -1)
+        return normalize(vectors)
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        # Microseconds for a question; an upload's chunks go to a thread
+        if len(texts) == 1:
+            return self.embed_sync(texts)
+        return await asyncio.to_thread(self.embed_sync, texts)
+
+
+class SentenceTransformerEmbedder(Embedder):
+    def __init__(self, model: str = "all-MiniLM-L6-v2"):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise RuntimeError("RETRIEVAL_EMBEDDER=sentence-transformers needs the sentence-transformers "
+                               "package") from None
+        self.model = SentenceTransformer(model, device="cpu")
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self.name = f"sentence-transformers-{model}"
+        self.lock = threading.Lock()
+
+    def embed_sync(self, texts: List[str]) -> np.ndarray:
+        with self.lock:
+            return normalize(self.model.encode(texts, convert_to_numpy=True))
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        return await asyncio.to_thread(self.embed_sync, texts)
+
+
+class OpenAIEmbedder(Embedder):
+    def __init__(self, client, model: str = "text-embedding-3-small", dim: int = 256, batch_size: int = 256,
+                 gate: Optional[VendorGate] = None):
+        self.client = client
+        self.model = model
+        self.dim = dim
+        self.name = f"openai-{model}-{dim}"
+        self.batch_size = batch_size
+        self.gate = gate
+
+    async def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        response = await self.client.embeddings.create(model=self.model, input=texts, dimensions=self.dim)
+        return [item.embedding for item in response.data]
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        rows = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = texts[start:start + self.batch_size]
+            if self.gate is None:
+                rows.extend(await self._embed_batch(batch))
+                continue
+            async with self.gate.admit():
+                rows.extend(await self.gate.call(lambda: self._embed_batch(batch)))
+        return normalize(np.array(rows, dtype=np.float32).reshape(len(texts), self.dim))
+
+
+def kmeans(vectors: np.ndarray, lists: int, iterations: int = 8, seed: int = 0) -> np.ndarray:
+    """Spherical k-means: unit centroids, rows assigned by the largest dot product."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        empty = np.linalg.norm(sums, axis=1) == 0
+        # An empty list takes a random row instead
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        centroids = normalize(sums)
+    return centroids
+
+
+class SessionIndex:
+    """One session's index files, memory-mapped, and remapped when a worker has changed them."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.version = None
+        self.rows = np.zeros(0, dtype=ROW)
+        self.vectors = np.zeros((0, 0), dtype=np.int8)
+        self.texts = b""
+        self.df: Optional[np.ndarray] = None
+        self.documents: List[dict] = []
+        self.live = np.zeros(0, dtype=bool)
+        self.ivf = None
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _stat(self, name: str):
+        try:
+            stat = os.stat(self.path(name))
+            return stat.st_size, stat.st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _read_meta(self) -> Optional[dict]:
+        try:
+            with open(self.path("documents.json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write_meta(self, meta: dict):
+        with open(self.path("documents.json.tmp"), "w") as f:
+            json.dump(meta, f)
+        os.replace(self.path("documents.json.tmp"), self.path("documents.json"))
+
+    def refresh(self):
+        """Map the files again if another worker (or this one) has changed them."""
+        version = tuple(self._stat(name) for name in ("rows.bin", "documents.json", "ivf.npz", "df.bin"))
+        with self.lock:
+            if version == self.version:
+                return
+            meta = self._read_meta()
+            if meta is None or not version[0] or not version[0][0]:
+                self.version = version
+                return
+            dim = meta["dim"]
+            rows = np.memmap(self.path("rows.bin"), dtype=ROW, mode="r")
+            count = min(len(rows), os.path.getsize(self.path("vectors.i8")) // dim)
+            self.rows = rows[:count]
+            self.vectors = np.memmap(self.path("vectors.i8"), dtype=np.int8, mode="r", shape=(count, dim))
+            self.df = np.fromfile(self.path("df.bin"), dtype="<i8") if version[3] else None
+            self.texts = np.memmap(self.path("texts.bin"), dtype=np.uint8, mode="r")
+            self.documents = meta["documents"]
+            # Documents still being indexed are hidden, and so are rows of a document added to
+            # documents.json after it was read here (the last entry stands for all of those)
+            hidden = np.array([document["removed"] or document.get("indexing", False)
+                               for document in self.documents] + [True], dtype=bool)
+            self.live = ~hidden[np.minimum(self.rows["document"], len(self.documents))]
+            self.ivf = None
+            if version[2]:
+                with np.load(self.path("ivf.npz")) as ivf:
+                    if ivf["centroids"].shape[1] == dim and int(ivf["rows"]) <= count:
+                        self.ivf = {name: ivf[name] for name in ("centroids", "order", "bounds", "rows")}
+            self.version = version
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def add_document(self, file_id: str, filename: str, embedder: str, dim: int) -> int:
+        """Number a new document, hidden until finish_document; its rows can then be appended."""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path("lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            meta = self._read_meta() or {"embedder": embedder, "dim": dim, "documents": []}
+            if meta["embedder"] != embedder:
+                raise RuntimeError(f"The session's documents were indexed with {meta['embedder']}, not {embedder}")
+            meta["documents"].append({"file_id": file_id, "filename": filename, "removed": False, "indexing": True})
+            self._write_meta(meta)
+            return len(meta["documents"]) - 1
+
+    def append(self, document: int, chunks: List[str], vectors: np.ndarray, lexical: bool = False):
+        with open(self.path("lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            meta = self._read_meta()
+            quantized, scale = quantize(vectors)
+            rows = np.zeros(len(chunks), dtype=ROW)
+            rows["document"] = document
+            rows["scale"] = scale
+            with open(self.path("texts.bin"), "ab") as f:
+                for i, chunk in enumerate(chunks):
+                    encoded = chunk.encode()
+                    rows[i]["offset"], rows[i]["length"] = f.tell(), len(encoded)
+                    f.write(encoded)
+            try:
+                count = os.path.getsize(self.path("rows.bin")) // ROW.itemsize
+            except FileNotFoundError:
+                count = 0
+            with open(self.path("vectors.i8"), "ab") as f:
+                # Drop vectors of an append that did not finish
+                f.truncate(count * meta["dim"])
+                f.write(quantized.tobytes())
+            if lexical:
+                # Counts of the rows written so far: may run ahead of rows.bin after a crash, which
+                # only skews the weights slightly
+                try:
+                    df = np.fromfile(self.path("df.bin"), dtype="<i8")
+                except FileNotFoundError:
+                    df = np.zeros(meta["dim"], dtype="<i8")
+                df += (quantized != 0).sum(axis=0)
+                df.tofile(self.path("df.tmp"))
+                os.replace(self.path("df.tmp"), self.path("df.bin"))
+            # Rows last: a row is only visible once its text and vector are written
+            with open(self.path("rows.bin"), "ab") as f:
+                f.write(rows.tobytes())
+
+    def finish_document(self, document: int):
+        with open(self.path("lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            meta = self._read_meta()
+            meta["documents"][document].pop("indexing", None)
+            self._write_meta(meta)
+
+    def remove(self, file_id: str):
+        if not os.path.isdir(self.directory):
+            return
+        with open(self.path("lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            meta = self._read_meta()
+            if meta is None:
+                return
+            for document in meta["documents"]:
+                if document["file_id"] == file_id:
+                    document["removed"] = True
+            self._write_meta(meta)
+
+    def needs_ivf(self, min_rows: int) -> bool:
+        count = len(self)
+        return count >= min_rows and (self.ivf is None or count >= 1.5 * int(self.ivf["rows"]))
+
+    def build_ivf(self, sample_size: int = 20000, seed: int = 0):
+        count = len(self)
+        lists = min(1024, max(1, int(math.sqrt(count))))
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(count, min(count, sample_size), replace=False))
+        centroids = kmeans(normalize(self.vectors[sample]), lists, seed=seed)
+        assignment = np.empty(count, dtype=np.int32)
+        for start in range(0, count, SEARCH_BLOCK):
+            block = self.vectors[start:start + SEARCH_BLOCK].astype(np.float32)
+            assignment[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        order = np.argsort(assignment, kind="stable").astype(np.int32)
+        bounds = np.searchsorted(assignment[order], np.arange(lists + 1))
+        with open(self.path("ivf.tmp.npz"), "wb") as f:
+            np.savez(f, centroids=centroids, order=order, bounds=bounds, rows=count)
+        os.replace(self.path("ivf.tmp.npz"), self.path("ivf.npz"))
+
+    def search(self, query: np.ndarray, k: int, nprobe: int) -> List[Passage]:
+        """The `k` live rows closest to the unit vector `query`; nprobe=0 scans every row."""
+        count = len(self)
+        if not count:
+            return []
+        if self.df is not None:
+            # Words in few chunks say more about which chunk is meant
+            idf = np.log((count + 1) / (self.df + 1)) + 1
+            query = normalize((query * idf)[None])[0]
+        if self.ivf is not None and nprobe > 0:
+            ivf = self.ivf
+            probe = np.argsort(ivf["centroids"] @ query)[-nprobe:]
+            candidates = np.concatenate(
+                [ivf["order"][ivf["bounds"][c]:ivf["bounds"][c + 1]] for c in probe]
+                + [np.arange(int(ivf["rows"]), count, dtype=np.int32)])
+            candidates.sort()
+            scores = (self.vectors[candidates].astype(np.float32) @ query) * self.rows["scale"][candidates]
+        else:
+            candidates = np.arange(count)
+            scores = np.empty(count, dtype=np.float32)
+            for start in range(0, count, SEARCH_BLOCK):
+                block = self.vectors[start:start + SEARCH_BLOCK].astype(np.float32)
+                scores[start:start + len(block)] = block @ query
+            scores *= self.rows["scale"]
+        scores[~self.live[candidates]] = -np.inf
+        top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        passages = []
+        for i in top:
+            if scores[i] == -np.inf:
+                break
+            row = self.rows[candidates[i]]
+            offset, length = int(row["offset"]), int(row["length"])
+            passages.append(Passage(bytes(self.texts[offset:offset + length]).decode(),
+                                    self.documents[row["document"]]["filename"], round(float(scores[i]), 4)))
+        return passages
+
+
+class DocumentStore:
+    def __init__(self, root: str, embedder: Embedder, chunk_chars: int = 1200, overlap_chars: int = 200,
+                 ivf_min_rows: int = 20000, nprobe: int = 16, max_open: int = 256, batch_chunks: int = 256,
+                 read_bytes: int = 64 * 1024):
+        self.root = root
+        self.embedder = embedder
+        self.chunk_chars = chunk_chars
+        self.overlap_chars = overlap_chars
+        self.batch_chunks = batch_chunks
+        self.read_bytes = read_bytes
+        self.ivf_min_rows = ivf_min_rows
+        self.nprobe = nprobe
+        self.max_open = max_open
+        # Recently used sessions' mapped indexes
+        self.indexes: "OrderedDict[str, SessionIndex]" = OrderedDict()
+        self.documents_added = 0
+        self.chunks_added = 0
+        self.ivf_builds = 0
+        self.searches = 0
+        self.search_seconds = 0.0
+        self.search_seconds_max = 0.0
+
+    def session_dir(self, session_id: str) -> str:
+        # Session ids come from clients: a plain one names its directory, any other (empty, ".",
+        # "..", hidden, with a separator or too long) is hashed, so it is always one directory
+        # of its own below the root, never the root or anything above it
+        name = session_id
+        if not SESSION_DIR_NAME.fullmatch(name):
+            name = "session-" + hashlib.sha256(session_id.encode()).hexdigest()
+        path = os.path.join(self.root, name)
+        if os.path.dirname(os.path.abspath(path)) != os.path.abspath(self.root):
+            raise ValueError(f"Session id {session_id!r} does not name a directory of its own")
+        return path
+
+    def index(self, session_id: str) -> SessionIndex:
+        index = self.indexes.get(session_id)
+        if index is None:
+            index = self.indexes[session_id] = SessionIndex(self.session_dir(session_id))
+            while len(self.indexes) > self.max_open:
+                self.indexes.popitem(last=False)
+        self.indexes.move_to_end(session_id)
+        return index
+
+    def _next_batch(self, pieces: Iterator[str], splitter: ChunkSplitter) -> Tuple[List[str], bool]:
+        # At least batch_chunks chunks, unless the text ends first; and whether it has
+        chunks = []
+        for piece in pieces:
+            chunks.extend(splitter.feed(piece))
+            if len(chunks) >= self.batch_chunks:
+                return chunks, False
+        return chunks + splitter.flush(), True
+
+    def _append(self, index: SessionIndex, document: int, chunks: List[str], vectors: np.ndarray):
+        index.append(document, chunks, vectors, self.embedder.lexical)
+        index.refresh()
+        if index.needs_ivf(self.ivf_min_rows):
+            index.build_ivf()
+            index.refresh()
+            self.ivf_builds += 1
+
+    async def add(self, session_id: str, file_id: str, filename: str, data: bytes) -> int:
+        """Extract, chunk, embed and index a document; returns the number of chunks."""
+        return await self.add_file(session_id, file_id, filename, io.BytesIO(data))
+
+    async def add_file(self, session_id: str, file_id: str, filename: str, file: BinaryIO) -> int:
+        """Like add, reading the document from a file as it goes: its text is chunked, embedded
+        and indexed `batch_chunks` chunks at a time, so memory use does not grow with its size.
+        It can be searched once all of it has been indexed."""
+        index = self.index(session_id)
+        pieces = iter_text(filename, file, self.read_bytes)
+        splitter = ChunkSplitter(self.chunk_chars, self.overlap_chars)
+        document = None
+        count = 0
+        done = False
+        while not done:
+            chunks, done = await asyncio.to_thread(self._next_batch, pieces, splitter)
+            if not chunks:
+                continue
+            vectors = await self.embedder.embed(chunks)
+            if document is None:
+                document = await asyncio.to_thread(index.add_document, file_id, filename, self.embedder.name,
+                                                   vectors.shape[1])
+            await asyncio.to_thread(self._append, index, document, chunks, vectors)
+            count += len(chunks)
+        if document is None:
+            return 0
+        await asyncio.to_thread(index.finish_document, document)
+        self.documents_added += 1
+        self.chunks_added += count
+        return count
+
+    async def remove(self, session_id: str, file_id: str):
+        await asyncio.to_thread(self.index(session_id).remove, file_id)
+
+    async def drop(self, session_id: str):
+        """Delete the session's directory and everything in it."""
+        self.indexes.pop(session_id, None)
+        await asyncio.to_thread(shutil.rmtree, self.session_dir(session_id), True)
+
+    def _search(self, index: SessionIndex, query: np.ndarray, k: int, nprobe: int) -> List[Passage]:
+        index.refresh()
+        return index.search(query, k, nprobe)
+
+    async def search(self, session_id: str, question: str, k: int = 4,
+                     nprobe: Optional[int] = None) -> List[Passage]:
+        """The `k` chunks closest to the question; nprobe=0 searches exhaustively."""
+        started = time.perf_counter()
+        query = (await self.embedder.embed([question]))[0]
+        index = self.index(session_id)
+        nprobe = self.nprobe if nprobe is None else nprobe
+        # Off the event loop even for small indexes: refreshing reads files, and the rows and texts
+        # are memory-mapped, so any of it may wait on the disk
+        passages = await asyncio.to_thread(self._search, index, query, k, nprobe)
+        elapsed = time.perf_counter() - started
+        self.searches += 1
+        self.search_seconds += elapsed
+        self.search_seconds_max = max(self.search_seconds_max, elapsed)
+        return passages
+
+    def report(self) -> dict:
+        return {
+            "embedder": self.embedder.name,
+            "sessions_open": len(self.indexes),
+            "documents_added": self.documents_added,
+            "chunks_added": self.chunks_added,
+            "ivf_builds": self.ivf_builds,
+            "searches": self.searches,
+            "avg_search_ms": round(self.search_seconds / self.searches * 1000, 2) if self.searches else None,
+            "max_search_ms": round(self.search_seconds_max * 1000, 2),
+        }
@@ -0,0 +1,62 @@
+import re
+from typing import List, Optional
+
+# A sentence ends at . ! ? (optionally followed by closing quotes/brackets) and whitespace
+SENTENCE_END = re.compile(r"""[.!?]+["')\]]*\s+""")
+# Clause boundaries we are willing to cut at once a segment gets long
+CLAUSE_END = re.compile(r"""[,;:]\s+""")
+# Abbreviations that end in a period but do not end a sentence
+ABBREVIATIONS = {"e.g.", "i.e.", "etc.", "vs.", "mr.", "mrs.", "ms.", "dr.", "st.", "no.", "fig."}
+
+
+class SentenceSegmenter:
+    """Cuts streamed LLM text into sentence/clause segments for incremental TTS.
+
+    Text is fed in as it arrives; complete segments are returned as soon as a
+    boundary is seen. Segments shorter than `min_chars` are merged with the
+    next one so the TTS voice does not get choppy, and segments that grow past
+    `max_chars` without a sentence end are cut at the last clause boundary.
+    """
+
+    def __init__(self, min_chars: int = 20, max_chars: int = 200):
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.buffer = ""
+
+    def feed(self, text: str) -> List[str]:
+        self.buffer += text
+        segments = []
+        while True:
+            segment = self._next_segment()
+            if segment is None:
+                return segments
+            segments.append(segment)
+
+    def flush(self) -> Optional[str]:
+        segment = self.buffer.strip()
+        self.buffer = ""
+        return segment or None
+
+    def _next_segment(self) -> Optional[str]:
+        for match in SENTENCE_END.finditer(self.buffer):
+            end = match.end()
+            if end < self.min_chars:
+                continue
+            last_word = self.buffer[:match.start() + 1].rsplit(None, 1)[-1].lower()
+            if last_word in ABBREVIATIONS:
+                continue
+            return self._cut(end)
+
+        if len(self.buffer) > self.max_chars:
+            clauses = [m.end() for m in CLAUSE_END.finditer(self.buffer, 0, self.max_chars) if m.end() >= self.min_chars]
+            if clauses:
+                return self._cut(clauses[-1])
+            # No punctuation at all: fall back to the last word boundary
+            space = self.buffer.rfind(" ", self.min_chars, self.max_chars)
+            if space != -1:
+                return self._cut(space + 1)
+        return None
+
+    def _cut(self, end: int) -> str:
+        segment, self.buffer = self.buffer[:end].strip(), self.buffer[end:]
+        return segment
@@ -0,0 +1,191 @@
+"""Cross-worker delivery of session events, and the connection registry.
+
+With several uvicorn workers (or hosts) behind a load balancer, the /ws
+socket of a session and the request or job that produces an event for it
+(e.g. upload progress from an ingest job, see jobs.py) often run on different
+workers. Each worker therefore:
+
+- registers its sockets in Redis, in one hash per session,
+  `ws:session:{session_id}` (connection id -> worker id), and subscribes to
+  the session's channel `ws:events:{session_id}` while it holds at least
+  one socket of that session
+- delivers an event to its own sockets directly and publishes it on the
+  session channel, tagged with its worker id so it skips its own messages
+- keeps a heartbeat key, `ws:worker:{worker_id}`, with its connection
+  counts. The same heartbeat refreshes the TTL of the registry hashes, so
+  entries left behind by a crashed worker expire.
+
+Delivery is best effort, like pub/sub itself: a worker that is not
+subscribed when the event is published does not see it.
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+import redis.asyncio
+
+log = logging.getLogger(__name__)
+
+# Sends a payload to this worker's sockets of a session; returns how many got it
+LocalDelivery = Callable[[str, dict], Awaitable[int]]
+
+
+class SessionBus:
+    def __init__(self, redis_client: redis.asyncio.Redis, deliver: LocalDelivery, prefix: str = "ws:",
+                 heartbeat: float = 10.0, ttl: int = 60):
+        # The client must decode responses to str
+        self.redis = redis_client
+        self.deliver = deliver
+        self.prefix = prefix
+        self.heartbeat = heartbeat
+        self.ttl = ttl
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.started = time.time()
+        # This worker's connections per session, and the session channels it is subscribed to
+        self.local: Dict[str, Set[str]] = {}
+        self.subscribed: Set[str] = set()
+        self.subscription_lock = asyncio.Lock()
+        self.pubsub = None
+        self.tasks: Set[asyncio.Task] = set()
+        self.published = 0
+        self.received = 0
+        self.delivered_remote = 0
+
+    def channel(self, session_id: str) -> str:
+        return f"{self.prefix}events:{session_id}"
+
+    def registry_key(self, session_id: str) -> str:
+        return f"{self.prefix}session:{session_id}"
+
+    def worker_key(self, worker_id: Optional[str] = None) -> str:
+        return f"{self.prefix}worker:{worker_id or self.worker_id}"
+
+    async def start(self):
+        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        # The worker's own channel keeps the subscription open while it holds no sockets
+        await self.pubsub.subscribe(self.worker_key())
+        for coroutine in (self._listen(), self._beat()):
+            task = asyncio.create_task(coroutine)
+            self.tasks.add(task)
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks.clear()
+        if self.pubsub is not None:
+            await self.pubsub.aclose()
+            self.pubsub = None
+        self.subscribed.clear()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for session_id, connections in self.local.items():
+                pipe.hdel(self.registry_key(session_id), *connections)
+            pipe.delete(self.worker_key())
+            await pipe.execute()
+        self.local.clear()
+
+    async def register(self, session_id: str, connection_id: str):
+        self.local.setdefault(session_id, set()).add(connection_id)
+        key = self.registry_key(session_id)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hset(key, connection_id, self.worker_id)
+            pipe.expire(key, self.ttl)
+            await pipe.execute()
+        await self._update_subscription(session_id)
+
+    async def unregister(self, session_id: str, connection_id: str):
+        connections = self.local.get(session_id)
+        if connections is None or connection_id not in connections:
+            return
+        connections.discard(connection_id)
+        if not connections:
+            del self.local[session_id]
+        await self.redis.hdel(self.registry_key(session_id), connection_id)
+        await self._update_subscription(session_id)
+
+    async def _update_subscription(self, session_id: str):
+        # Sockets of a session come and go concurrently; subscribe or unsubscribe to match
+        # the current state rather than the change that triggered the call
+        async with self.subscription_lock:
+            if self.pubsub is None or (session_id in self.local) == (session_id in self.subscribed):
+                return
+            if session_id in self.local:
+                await self.pubsub.subscribe(self.channel(session_id))
+                self.subscribed.add(session_id)
+            else:
+                await self.pubsub.unsubscribe(self.channel(session_id))
+                self.subscribed.discard(session_id)
+
+    async def publish(self, session_id: str, payload: dict) -> int:
+        """Deliver to this worker's sockets and to the other workers holding the session;
+        returns the number of local sockets reached plus the number of other workers."""
+        delivered = await self.deliver(session_id, payload) if session_id in self.local else 0
+        message = json.dumps({"origin": self.worker_id, "payload": payload})
+        receivers = await self.redis.publish(self.channel(session_id), message)
+        self.published += 1
+        # This worker is one of the receivers when it is subscribed itself
+        return delivered + receivers - (1 if session_id in self.subscribed else 0)
+
+    async def connections(self, session_id: str) -> Dict[str, str]:
+        """All registered connections of a session, on any worker (connection id -> worker id)."""
+        return await self.redis.hgetall(self.registry_key(session_id))
+
+    async def workers(self) -> list:
+        """Live workers, from their heartbeat keys."""
+        keys = [key async for key in self.redis.scan_iter(match=self.worker_key("*"), count=100)]
+        if not keys:
+            return []
+        values = await self.redis.mget(keys)
+        return sorted((json.loads(value) for value in values if value), key=lambda worker: worker["worker_id"])
+
+    async def _listen(self):
+        while True:
+            try:
+                async for message in self.pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    data = json.loads(message["data"])
+                    if data["origin"] == self.worker_id:
+                        continue
+                    self.received += 1
+                    channel = message["channel"]
+                    session_id = channel[len(self.channel("")):]
+                    if session_id in self.local:
+                        self.delivered_remote += await self.deliver(session_id, data["payload"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Redis went away: keep the worker up and resubscribe once it is back
+                log.warning(f"Session bus error: {e}")
+                await asyncio.sleep(1)
+
+    async def _beat(self):
+        while True:
+            try:
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    pipe.set(self.worker_key(), json.dumps(self.report()), ex=self.ttl)
+                    for session_id in self.local:
+                        pipe.expire(self.registry_key(session_id), self.ttl)
+                    await pipe.execute()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning(f"Session bus heartbeat failed: {e}")
+            await asyncio.sleep(self.heartbeat)
+
+    def report(self) -> dict:
+        return {
+            "worker_id": self.worker_id,
+            "pid": os.getpid(),
+            "uptime": round(time.time() - self.started),
+            "sessions": len(self.local),
+            "connections": sum(len(connections) for connections in self.local.values()),
+            "published": self.published,
+            "received": self.received,
+            "delivered_remote": self.delivered_remote,
+        }
@@ -0,0 +1,249 @@
+"""Per-session document state in Redis.
+
+Everything about a session lives in one hash, `session:{id}`:
+
+    vector_store_id    the session's OpenAI vector store
+    file:{file_id}     original filename of an uploaded file
+    hash:{sha256}      file id of the upload with that content
+    batch:{batch_id}   a vector store file batch that is still being indexed
+
+Each operation is a single round trip (a pipeline, or a MULTI transaction
+where the result depends on concurrent writers) and refreshes the TTL of the
+whole hash, so a session expires as one unit `ttl` seconds after it was last
+used.
+
+What a session created at OpenAI (or on disk) outlives it: a separate hash
+without a TTL, `resources:{id}`, lists it until the cleanup job (see main.py)
+has deleted it after the session expired:
+
+    vector_store:{id}  a vector store created for the session
+    file:{file_id}     an uploaded file object
+    local              the session has a local document directory (retrieval.py)
+    updated            when an entry was last added (unix time)
+    failures           cleanups of the expired session that failed so far
+    retry_after        when the next one may be tried (unix time), backing off
+
+and the set `resource_owners` holds the ids of the sessions that have one.
+"""
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import redis.asyncio
+
+VECTOR_STORE_FIELD = "vector_store_id"
+FILE_PREFIX = "file:"
+HASH_PREFIX = "hash:"
+BATCH_PREFIX = "batch:"
+VECTOR_STORE_PREFIX = "vector_store:"
+LOCAL_FIELD = "local"
+UPDATED_FIELD = "updated"
+FAILURES_FIELD = "failures"
+RETRY_AFTER_FIELD = "retry_after"
+
+# Deletes the given fields of a resources hash, and the hash and its owner entry once only
+# `updated` and the cleanup backoff are left (in one step, so an entry added concurrently is
+# never orphaned)
+FORGET_SCRIPT = """
+if #ARGV > 1 then
+    redis.call('HDEL', KEYS[1], unpack(ARGV, 2))
+end
+local left = redis.call('HLEN', KEYS[1])
+for _, name in ipairs({'updated', 'failures', 'retry_after'}) do
+    left = left - redis.call('HEXISTS', KEYS[1], name)
+end
+if left <= 0 then
+    redis.call('DEL', KEYS[1])
+    redis.call('SREM', KEYS[2], ARGV[1])
+end
+"""
+# Counts a failed cleanup of a resources hash that still exists and sets when to try again,
+# ARGV[2] * 2^(failures - 1) seconds after ARGV[1], at most ARGV[3]; returns the delay
+POSTPONE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return nil
+end
+local failures = redis.call('HINCRBY', KEYS[1], 'failures', 1)
+local delay = math.min(tonumber(ARGV[2]) * 2 ^ (failures - 1), tonumber(ARGV[3]))
+redis.call('HSET', KEYS[1], 'retry_after', tonumber(ARGV[1]) + delay)
+return tostring(delay)
+"""
+
+
+@dataclass
+class SessionState:
+    vector_store_id: Optional[str] = None
+    files: Dict[str, str] = field(default_factory=dict)        # file id -> filename
+    file_hashes: Dict[str, str] = field(default_factory=dict)  # content hash -> file id
+    pending_batches: List[str] = field(default_factory=list)   # file batches still being indexed
+
+
+@dataclass
+class SessionResources:
+    vector_store_ids: List[str] = field(default_factory=list)
+    file_ids: List[str] = field(default_factory=list)
+    local: bool = False
+    updated: float = 0.0
+
+    def fields(self) -> List[str]:
+        return ([VECTOR_STORE_PREFIX + vector_store_id for vector_store_id in self.vector_store_ids]
+                + [FILE_PREFIX + file_id for file_id in self.file_ids] + ([LOCAL_FIELD] if self.local else []))
+
+
+class SessionStore:
+    def __init__(self, redis_client: redis.asyncio.Redis, ttl: int = 3600, prefix: str = "session:",
+                 resources_prefix: str = "resources:", owners_key: str = "resource_owners"):
+        # The client must decode responses to str
+        self.redis = redis_client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.resources_prefix = resources_prefix
+        self.owners_key = owners_key
+        self.forget_script = redis_client.register_script(FORGET_SCRIPT)
+        self.postpone_script = redis_client.register_script(POSTPONE_SCRIPT)
+
+    def key(self, session_id: str) -> str:
+        return self.prefix + session_id
+
+    async def load(self, session_id: str) -> SessionState:
+        key = self.key(session_id)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hgetall(key)
+            pipe.expire(key, self.ttl)
+            fields, _ = await pipe.execute()
+
+        state = SessionState(vector_store_id=fields.get(VECTOR_STORE_FIELD))
+        for name, value in fields.items():
+            if name.startswith(FILE_PREFIX):
+                state.files[name[len(FILE_PREFIX):]] = value
+            elif name.startswith(HASH_PREFIX):
+                state.file_hashes[name[len(HASH_PREFIX):]] = value
+            elif name.startswith(BATCH_PREFIX):
+                state.pending_batches.append(name[len(BATCH_PREFIX):])
+        return state
+
+    async def vector_store_id(self, session_id: str) -> Optional[str]:
+        key = self.key(session_id)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hget(key, VECTOR_STORE_FIELD)
+            pipe.expire(key, self.ttl)
+            vector_store_id, _ = await pipe.execute()
+        return vector_store_id
+
+    async def claim_vector_store(self, session_id: str, vector_store_id: str) -> str:
+        """Record the session's vector store unless a concurrent request already did;
+        returns the vector store the session ends up with."""
+        key = self.key(session_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hsetnx(key, VECTOR_STORE_FIELD, vector_store_id)
+            pipe.hget(key, VECTOR_STORE_FIELD)
+            pipe.expire(key, self.ttl)
+            _, current, _ = await pipe.execute()
+        return current
+
+    async def find_files(self, session_id: str, file_hashes: List[str]) -> Tuple[Optional[str], List[Optional[str]]]:
+        """The session's vector store and, for each content hash, the id of an
+        already uploaded file with that content (or None)."""
+        if not file_hashes:
+            return await self.vector_store_id(session_id), []
+        key = self.key(session_id)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hmget(key, [VECTOR_STORE_FIELD] + [HASH_PREFIX + file_hash for file_hash in file_hashes])
+            pipe.expire(key, self.ttl)
+            values, _ = await pipe.execute()
+        return values[0], values[1:]
+
+    async def add_files(self, session_id: str, files: Iterable[Tuple[str, str, str]],
+                        pending_batch: Optional[str] = None):
+        """Record uploaded files given as (file id, filename, content hash), and
+        optionally the file batch that is indexing them."""
+        mapping = {}
+        for file_id, filename, file_hash in files:
+            mapping[FILE_PREFIX + file_id] = filename
+            mapping[HASH_PREFIX + file_hash] = file_id
+        if pending_batch:
+            mapping[BATCH_PREFIX + pending_batch] = "in_progress"
+        if not mapping:
+            return
+        key = self.key(session_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping=mapping)
+            pipe.expire(key, self.ttl)
+            await pipe.execute()
+
+    async def remove_file(self, session_id: str, file_id: str, file_hash: str):
+        key = self.key(session_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hdel(key, FILE_PREFIX + file_id, HASH_PREFIX + file_hash)
+            pipe.expire(key, self.ttl)
+            await pipe.execute()
+
+    async def finish_batch(self, session_id: str, batch_id: str):
+        key = self.key(session_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hdel(key, BATCH_PREFIX + batch_id)
+            pipe.expire(key, self.ttl)
+            await pipe.execute()
+
+    def resources_key(self, session_id: str) -> str:
+        return self.resources_prefix + session_id
+
+    async def add_resources(self, session_id: str, resources: SessionResources):
+        """Record resources created for the session, to delete once it has expired."""
+        fields = resources.fields()
+        if not fields:
+            return
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(self.resources_key(session_id), mapping={**dict.fromkeys(fields, 1), UPDATED_FIELD: time.time()})
+            pipe.sadd(self.owners_key, session_id)
+            await pipe.execute()
+
+    async def forget_resources(self, session_id: str, resources: SessionResources):
+        """The resources have been deleted."""
+        await self.forget_script(keys=[self.resources_key(session_id), self.owners_key],
+                                 args=[session_id, *resources.fields()])
+
+    async def postpone_cleanup(self, session_id: str, delay: float, max_delay: float) -> Optional[float]:
+        """Deleting the session's resources failed: leave it out of expired_resources for `delay`
+        seconds, doubling with each failure up to `max_delay`; returns the delay."""
+        delay = await self.postpone_script(keys=[self.resources_key(session_id)],
+                                           args=[time.time(), delay, max_delay])
+        return float(delay) if delay is not None else None
+
+    async def expired_resources(self, min_age: float, limit: int = 100) -> List[Tuple[str, SessionResources]]:
+        """Up to `limit` expired sessions with resources, none added in the last `min_age` seconds
+        (a new session's vector store is created before the session is) and none whose cleanup
+        was postponed (see postpone_cleanup), so sessions that keep failing do not hide the rest."""
+        expired = []
+        now = time.time()
+        async for chunk in self._owner_chunks():
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for session_id in chunk:
+                    pipe.exists(self.key(session_id))
+                    pipe.hgetall(self.resources_key(session_id))
+                values = await pipe.execute()
+            for session_id, exists, fields in zip(chunk, values[::2], values[1::2]):
+                if exists or now - float(fields.get(UPDATED_FIELD) or 0) < min_age:
+                    continue
+                if float(fields.get(RETRY_AFTER_FIELD) or 0) > now:
+                    continue
+                resources = SessionResources(local=LOCAL_FIELD in fields, updated=float(fields.get(UPDATED_FIELD) or 0))
+                for name in fields:
+                    if name.startswith(VECTOR_STORE_PREFIX):
+                        resources.vector_store_ids.append(name[len(VECTOR_STORE_PREFIX):])
+                    elif name.startswith(FILE_PREFIX):
+                        resources.file_ids.append(name[len(FILE_PREFIX):])
+                expired.append((session_id, resources))
+                if len(expired) >= limit:
+                    return expired
+        return expired
+
+    async def _owner_chunks(self, size: int = 100):
+        chunk = []
+        async for session_id in self.redis.sscan_iter(self.owners_key, count=size):
+            chunk.append(session_id)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
@@ -0,0 +1,215 @@
+"""Speculative replies: start the LLM on a partial transcript before the user has finished.
+
+With streaming STT the words arrive while the user talks. Once the partial
+transcript has not changed for `window` seconds (or the provider marks the
+turn final), a reply to it is started in the background: session load,
+retrieval and the LLM stream, but not TTS, which is only worth paying for
+once the question is known. When the final transcript comes in:
+
+- it matches the speculated one (compared like the answer cache does: case,
+  punctuation and whitespace folded): the turn takes over the reply, with
+  whatever has been generated so far, instead of starting its own
+- it does not: the speculative reply is cancelled and the turn starts over
+
+A transcript that changes while a speculative reply runs cancels it too.
+The reply's exchange is only remembered (see conversation.py) once a turn
+has taken it over.
+
+Each cancelled reply wasted an LLM request and the tokens it had generated
+(estimated at CHARS_PER_TOKEN characters each); a short window speculates
+earlier and more often, so it wins more latency and wastes more tokens.
+"""
+import asyncio
+import time
+from contextlib import aclosing
+from dataclasses import dataclass
+from typing import AsyncIterator, Awaitable, Callable, List, Optional
+
+from answer_cache import normalize_query
+from turns import CHARS_PER_TOKEN
+
+# Starts a reply to a transcript; the callback gets the answer once it is complete
+ReplyStarter = Callable[[str, Callable[[str], Awaitable[None]]], AsyncIterator[str]]
+
+
+@dataclass
+class SpeculationStats:
+    # Utterances that ended with a speculative reply whose transcript matched, did not, or had none
+    hits: int = 0
+    misses: int = 0
+    no_speculation: int = 0
+    # Replies started, and those cancelled because the transcript changed before the end
+    started: int = 0
+    cancelled_early: int = 0
+    wasted_requests: int = 0
+    wasted_tokens: int = 0
+    # How long before the final transcript a matching reply had been started
+    head_start_seconds_total: float = 0.0
+    head_start_seconds_max: float = 0.0
+
+    @property
+    def hit_ratio(self) -> float:
+        utterances = self.hits + self.misses + self.no_speculation
+        return self.hits / utterances if utterances else 0.0
+
+
+class SpeculativeReply:
+    def __init__(self, text: str, start: ReplyStarter):
+        self.text = text
+        self.key = normalize_query(text)
+        self.started = time.perf_counter()
+        self.deltas: List[str] = []
+        # The complete answer to remember, once the reply has one (None for errors and the like)
+        self.answer: Optional[str] = None
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.progress = asyncio.Event()
+        self.task = asyncio.create_task(self._run(start))
+
+    async def _run(self, start: ReplyStarter):
+        try:
+            # Closing the stream on cancellation stops the generation
+            async with aclosing(start(self.text, self._complete)) as deltas:
+                async for delta in deltas:
+                    self.deltas.append(delta)
+                    self.progress.set()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self.progress.set()
+
+    async def _complete(self, answer: str):
+        self.answer = answer
+
+    def tokens(self) -> int:
+        return sum(len(delta) for delta in self.deltas) // CHARS_PER_TOKEN
+
+    def cancel(self):
+        self.task.cancel()
+
+    async def replay(self) -> AsyncIterator[str]:
+        """What has been generated so far, then the rest as it comes."""
+        sent = 0
+        try:
+            while True:
+                while sent < len(self.deltas):
+                    yield self.deltas[sent]
+                    sent += 1
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                self.progress.clear()
+                await self.progress.wait()
+        finally:
+            # The turn was cancelled (barge-in): so is the reply
+            if not self.done:
+                self.task.cancel()
+
+
+class Speculation:
+    """Settings and counters shared by the speculators of every utterance."""
+
+    def __init__(self, window: float = 0.3, min_words: int = 3):
+        self.window = window
+        self.min_words = min_words
+        self.stats = SpeculationStats()
+
+    def speculator(self, start: ReplyStarter) -> "Speculator":
+        return Speculator(start, self.stats, self.window, self.min_words)
+
+    def report(self) -> dict:
+        stats = self.stats
+        return {
+            "window_ms": round(self.window * 1000),
+            "min_words": self.min_words,
+            "hits": stats.hits,
+            "misses": stats.misses,
+            "no_speculation": stats.no_speculation,
+            "hit_ratio": round(stats.hit_ratio, 4),
+            "started": stats.started,
+            "cancelled_early": stats.cancelled_early,
+            "wasted_requests": stats.wasted_requests,
+            "wasted_tokens": stats.wasted_tokens,
+            "head_start_ms_avg": round(stats.head_start_seconds_total / stats.hits * 1000, 1) if stats.hits else 0.0,
+            "head_start_ms_max": round(stats.head_start_seconds_max * 1000, 1),
+        }
+
+
+class Speculator:
+    """Watches one utterance's transcripts and keeps at most one speculative reply going."""
+
+    def __init__(self, start: ReplyStarter, stats: SpeculationStats, window: float, min_words: int):
+        self.start = start
+        self.stats = stats
+        self.window = window
+        self.min_words = min_words
+        self.text = ""
+        self.key = ""
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.reply: Optional[SpeculativeReply] = None
+        # Set at the end of speech: the turn itself starts right after, so no new replies
+        self.ended = False
+
+    def observe(self, text: str, is_final: bool = False):
+        """Called with every transcript of the utterance so far."""
+        if self.ended:
+            return
+        key = normalize_query(text)
+        if key != self.key:
+            self.text, self.key = text, key
+            self._stop_timer()
+            if self.reply is not None and self.reply.key != key:
+                self.stats.cancelled_early += 1
+                self._discard(self.reply)
+                self.reply = None
+            if len(key.split()) >= self.min_words:
+                self.timer = asyncio.get_running_loop().call_later(self.window, self._speculate)
+        if is_final:
+            # The provider has closed the turn: no reason to wait for the window
+            self._speculate()
+
+    def end_of_speech(self):
+        self.ended = True
+        self._stop_timer()
+
+    def _speculate(self):
+        self._stop_timer()
+        if self.reply is None and not self.ended and len(self.key.split()) >= self.min_words:
+            self.reply = SpeculativeReply(self.text, self.start)
+            self.stats.started += 1
+
+    def take(self, final_text: str) -> Optional[SpeculativeReply]:
+        """The speculative reply to use for the final transcript, if it matches; cancels it otherwise."""
+        self._stop_timer()
+        reply, self.reply = self.reply, None
+        if reply is None:
+            self.stats.no_speculation += 1
+            return None
+        if reply.key != normalize_query(final_text) or reply.error is not None:
+            self.stats.misses += 1
+            self._discard(reply)
+            return None
+        head_start = time.perf_counter() - reply.started
+        self.stats.hits += 1
+        self.stats.head_start_seconds_total += head_start
+        self.stats.head_start_seconds_max = max(self.stats.head_start_seconds_max, head_start)
+        return reply
+
+    def close(self):
+        """The utterance was abandoned (barge-in, disconnect, a new utterance)."""
+        self._stop_timer()
+        if self.reply is not None:
+            self._discard(self.reply)
+            self.reply = None
+
+    def _stop_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def _discard(self, reply: SpeculativeReply):
+        self.stats.wasted_requests += 1
+        self.stats.wasted_tokens += reply.tokens()
+        reply.cancel()
@@ -28,6 +28,43 @@ document.addEventListener('DOMContentLoaded', () => {
     let isRecording = false;
     let socket;
     let conversationHistory = [];
+    // Streaming replies: the assistant message being filled in and the queued audio segments
+    let streamingAssistantMessage = null;
+    let audioQueue = [];
+    let audioQueuePlaying = false;
+    // Live transcription: PCM frames are streamed to the server while recording
+    const STREAM_SAMPLE_RATE = 16000;
+    let pcmProcessor = null;
+    let pcmChunkSeq = 0;
+    let partialUserMessage = null;
+    let currentAudioUrl = null;
+    // Barge-in: the turn the server is answering, and the last turn whose reply was interrupted
+    let currentTurnId = 0;
+    let interruptedTurnId = 0;
+    // Audio format of the replies, announced at the start of each turn
+    let audioMediaType = 'audio/mpeg';
+    let audioFormat = null;
+    // Reply formats this browser can play, best first (see delivery.py): Opus packets through
+    // WebCodecs and raw PCM through Web Audio, both played frame by frame, else whole MP3 files
+    const AUDIO_FORMATS = [
+        ...(typeof AudioDecoder !== 'undefined' ? ['opus_48000_32'] : []),
+        'pcm_16000', 'pcm_22050', 'pcm_24000', 'mp3_44100_128'
+    ];
+    // Frame-by-frame playback: scheduled buffers, when the next one starts, and the Opus decoder
+    let playbackContext = null;
+    let playbackTime = 0;
+    let playbackSources = [];
+    let opusDecoder = null;
+    let opusTimestamp = 0;
+    
+    // Binary audio frames on /ws (must match protocol.py)
+    const PROTOCOL_VERSION = 1;
+    const FRAME_AUDIO = 0x01;
+    const FRAME_AUDIO_CHUNK = 0x02;
+    const FRAME_TTS = 0x10;
+    const FRAME_TTS_CHUNK = 0x11;
+    const FLAG_STREAM = 0x01;
+    const FRAME_HEADER_SIZE = 8;
 
     
     
@@ -330,8 +367,8 @@ async function loadApiKeys() {
             const message = `Files uploaded: ${fileNames}`;
             addMessageToConversation('system', message);
             
-            // Reset status
-            statusText.textContent = 'Files uploaded successfully';
+            // Ingestion runs in the background; its progress and result come over the socket
+            statusText.textContent = 'Processing files...';
             
             // Clear the file input to allow uploading the same file again
             fileUpload.value = '';
@@ -440,8 +477,8 @@ async function handleFileUpload(event) {
         const message = `Files uploaded: ${fileNames}`;
         addMessageToConversation('system', message);
         
-        // Reset status
-        statusText.textContent = 'Files uploaded successfully';
+        // Ingestion runs in the background; its progress and result come over the socket
+        statusText.textContent = 'Processing files...';
         
         // Clear the file input to allow uploading the same file again
         fileUpload.value = '';
@@ -519,35 +556,121 @@ function displayFiles(files) {
     // Connect to WebSocket
     function connectWebSocket() {
         const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-        const wsUrl = `${protocol}//${window.location.host}/ws`;
+        const wsUrl = `${protocol}//${window.location.host}/ws?protocol=${PROTOCOL_VERSION}&formats=${AUDIO_FORMATS.join(',')}&session_id=${encodeURIComponent(sessionId)}`;
         
         socket = new WebSocket(wsUrl);
+        socket.binaryType = 'arraybuffer';
         
         socket.onopen = () => {
             console.log('WebSocket connection established');
         };
         
         socket.onmessage = (event) => {
+            if (event.data instanceof ArrayBuffer) {
+                handleAudioFrame(event.data);
+                return;
+            }
             const message = JSON.parse(event.data);
             
             switch (message.type) {
+                case 'turn_start':
+                    currentTurnId = message.turn_id;
+                    if (message.media_type) {
+                        audioMediaType = message.media_type;
+                    }
+                    audioFormat = message.format || null;
+                    break;
+                    
+                case 'turn_cancelled':
+                    interruptedTurnId = Math.max(interruptedTurnId, message.turn_id);
+                    console.log(`Turn ${message.turn_id} cancelled: ${message.llm_tokens_avoided} token(s), ${message.audio_seconds_avoided}s of audio avoided`);
+                    break;
+                    
+                case 'partial_transcription':
+                    if (!partialUserMessage) {
+                        partialUserMessage = addMessageToConversation('user', '');
+                    }
+                    partialUserMessage.textContent = message.text;
+                    break;
+                    
                 case 'transcription':
-                    addMessageToConversation('user', message.text);
+                    if (partialUserMessage) {
+                        partialUserMessage.textContent = message.text;
+                        partialUserMessage = null;
+                    } else {
+                        addMessageToConversation('user', message.text);
+                    }
                     addToConversationHistory('user', message.text);
                     statusText.textContent = 'Getting response...';
                     break;
                     
+                case 'no_speech':
+                    if (partialUserMessage) {
+                        partialUserMessage.remove();
+                        partialUserMessage = null;
+                    }
+                    statusText.textContent = 'No speech detected';
+                    break;
+                    
+                case 'llm_delta':
+                    if (isInterrupted()) break;
+                    if (!streamingAssistantMessage) {
+                        streamingAssistantMessage = addMessageToConversation('assistant', '');
+                    }
+                    streamingAssistantMessage.textContent += message.text;
+                    conversationContainer.scrollTop = conversationContainer.scrollHeight;
+                    break;
+                    
                 case 'llm_response':
-                    addMessageToConversation('assistant', message.text);
+                    if (streamingAssistantMessage) {
+                        streamingAssistantMessage.textContent = message.text;
+                        streamingAssistantMessage = null;
+                    } else {
+                        addMessageToConversation('assistant', message.text);
+                        statusText.textContent = 'Generating speech...';
+                    }
                     addToConversationHistory('assistant', message.text);
-                    statusText.textContent = 'Generating speech...';
                     break;
                     
                 case 'tts':
-                    playAudio(message.audio_data);
+                    if (isInterrupted()) break;
+                    playAudio(`data:${audioMediaType};base64,` + message.audio_data);
                     statusText.textContent = 'Not recording';
                     break;
                     
+                case 'tts_start':
+                    audioQueue.forEach(url => url.startsWith('blob:') && URL.revokeObjectURL(url));
+                    audioQueue = [];
+                    stopFramePlayback();
+                    break;
+                    
+                case 'tts_chunk':
+                    if (isInterrupted()) break;
+                    enqueueAudio(`data:${audioMediaType};base64,` + message.audio_data);
+                    break;
+                    
+                case 'tts_end':
+                    console.log(`Streamed ${message.segments} audio segment(s), time to first audio: ${message.time_to_first_audio_ms} ms`);
+                    break;
+                    
+                case 'upload_progress':
+                    showUploadProgress(message);
+                    break;
+                    
+                case 'job':
+                    showJobResult(message);
+                    break;
+                    
+                case 'busy':
+                    // Over the rate limit or out of vendor capacity; nothing was answered
+                    if (partialUserMessage) {
+                        partialUserMessage.remove();
+                        partialUserMessage = null;
+                    }
+                    console.warn('Server busy:', message.error);
+                    statusText.textContent = `Busy, please try again in ${Math.ceil(message.retry_after)}s`;
+                    break;
+                    
                 case 'error':
                         console.error('Server error:', message.error);
                         statusText.textContent = 'Error: ' + message.error;
@@ -570,6 +693,87 @@ function displayFiles(files) {
         };
     }
 
+    // Ingestion progress for /api/upload, pushed over the socket while the upload runs
+    function showUploadProgress(message) {
+        switch (message.stage) {
+            case 'hashing':
+            case 'uploading':
+                statusText.textContent = `${message.stage === 'hashing' ? 'Reading' : 'Uploading'} ${message.filename}...`;
+                break;
+            case 'failed':
+                addMessageToConversation('system', `Failed to upload ${message.filename}: ${message.error}`);
+                break;
+            case 'attaching':
+            case 'indexing':
+                statusText.textContent = `Indexing ${message.files} file(s)...`;
+                break;
+            case 'indexed':
+                statusText.textContent = message.status === 'completed'
+                    ? 'Documents ready'
+                    : `Indexing ${message.status}`;
+                break;
+        }
+    }
+
+    // A background job finished, e.g. the ingestion of an upload
+    function showJobResult(message) {
+        if (message.kind !== 'ingest') return;
+        if (message.status === 'failed') {
+            statusText.textContent = 'File upload failed';
+            addMessageToConversation('system', `Failed to process the upload: ${message.error}`);
+        } else if (!message.result.files.some(file => file.status === 'uploaded')) {
+            // Nothing new to index
+            statusText.textContent = 'Files already uploaded';
+        }
+    }
+
+    // Encode a binary audio frame: fixed header, session id, then the raw audio
+    function encodeFrame(frameType, flags, seq, payload) {
+        const session = new TextEncoder().encode(sessionId);
+        const body = new Uint8Array(payload);
+        const frame = new Uint8Array(FRAME_HEADER_SIZE + session.length + body.length);
+        const view = new DataView(frame.buffer);
+        view.setUint8(0, PROTOCOL_VERSION);
+        view.setUint8(1, frameType);
+        view.setUint8(2, flags);
+        view.setUint8(3, session.length);
+        view.setUint32(4, seq);
+        frame.set(session, FRAME_HEADER_SIZE);
+        frame.set(body, FRAME_HEADER_SIZE + session.length);
+        return frame.buffer;
+    }
+    
+    // Play TTS audio received as a binary frame
+    function handleAudioFrame(data) {
+        const view = new DataView(data);
+        if (view.getUint8(0) !== PROTOCOL_VERSION) {
+            console.warn('Unsupported audio frame version:', view.getUint8(0));
+            return;
+        }
+        const frameType = view.getUint8(1);
+        // Acknowledge every frame: the server sizes the next ones to this connection's throughput
+        socket.send(JSON.stringify({ type: 'audio_ack', turn_id: currentTurnId, seq: view.getUint32(4) }));
+        if (isInterrupted()) return;
+        const sessionLength = view.getUint8(3);
+        const payload = data.slice(FRAME_HEADER_SIZE + sessionLength);
+        if (isFramedFormat(audioFormat)) {
+            playFrame(payload);
+            return;
+        }
+        const audio = new Blob([payload], { type: audioMediaType });
+        const url = URL.createObjectURL(audio);
+        
+        if (frameType === FRAME_TTS) {
+            playAudio(url);
+            statusText.textContent = 'Not recording';
+        } else if (frameType === FRAME_TTS_CHUNK) {
+            enqueueAudio(url);
+        } else {
+            URL.revokeObjectURL(url);
+            console.warn('Unknown audio frame type:', frameType);
+        }
+    }
+
     // Initialize audio context and setup
     function initAudio() {
         audioContext = new (window.AudioContext || window.webkitAudioContext)();
@@ -587,6 +791,8 @@ function displayFiles(files) {
 
     // Start recording audio
     async function startRecording() {
+        // Talking over the assistant stops its reply
+        interruptReply();
         try {
             audioStream = await navigator.mediaDevices.getUserMedia({ audio: true });
             
@@ -596,18 +802,24 @@ function displayFiles(files) {
             const source = audioContext.createMediaStreamSource(audioStream);
             source.connect(analyser);
             
-            // Create recorder
-            recorder = new RecordRTC(audioStream, {
-                type: 'audio',
-                mimeType: 'audio/webm',
-                recorderType: RecordRTC.StereoAudioRecorder,
-                numberOfAudioChannels: 1,
-                sampleRate: 44100,
-                desiredSampRate: 16000 // Better for speech recognition
-            });
-            
-            // Start recording
-            recorder.startRecording();
+            if (socket && socket.readyState === WebSocket.OPEN) {
+                // Stream the audio so it is transcribed while the user is talking
+                await audioContext.resume();
+                startPcmStreaming(source);
+            } else {
+                // Create recorder
+                recorder = new RecordRTC(audioStream, {
+                    type: 'audio',
+                    mimeType: 'audio/webm',
+                    recorderType: RecordRTC.StereoAudioRecorder,
+                    numberOfAudioChannels: 1,
+                    sampleRate: 44100,
+                    desiredSampRate: 16000 // Better for speech recognition
+                });
+                
+                // Start recording
+                recorder.startRecording();
+            }
             isRecording = true;
             
             // Update UI
@@ -627,6 +839,19 @@ function displayFiles(files) {
 
     // Stop recording and process audio
     function stopRecording() {
+        if (pcmProcessor) {
+            stopPcmStreaming();
+            audioStream.getTracks().forEach(track => track.stop());
+            
+            // Update UI
+            isRecording = false;
+            startRecordingBtn.disabled = false;
+            stopRecordingBtn.disabled = true;
+            statusIndicator.classList.remove('recording');
+            statusText.textContent = 'Processing...';
+            cancelAnimationFrame(animationFrame);
+            return;
+        }
         if (!recorder) return;
         
         recorder.stopRecording(() => {
@@ -651,47 +876,81 @@ function displayFiles(files) {
         });
     }
 
-    // Process recorded audio
-    function processAudio(audioBlob) {
-        // Convert blob to base64
-        const reader = new FileReader();
-        reader.readAsDataURL(audioBlob);
-        reader.onloadend = function() {
-            const base64data = reader.result.split(',')[1];
-            
-            if (socket && socket.readyState === WebSocket.OPEN) {
-                // Send via WebSocket
-                socket.send(JSON.stringify({
-                    type: 'audio',
-                    audio_data: base64data,
-                    conversation_history: conversationHistory,
-                    session_id: sessionId
-                }));
-            } else {
-                // Fallback to REST API if WebSocket is not available
-                processAudioViaRESTAPI(base64data);
-            }
+    // Send microphone audio as 16 kHz 16-bit PCM frames over the WebSocket
+    function startPcmStreaming(source) {
+        socket.send(JSON.stringify({
+            type: 'audio_start',
+            session_id: sessionId
+        }));
+        
+        pcmChunkSeq = 0;
+        pcmProcessor = audioContext.createScriptProcessor(4096, 1, 1);
+        pcmProcessor.onaudioprocess = (event) => {
+            if (!socket || socket.readyState !== WebSocket.OPEN) return;
+            const pcm = downsampleToInt16(event.inputBuffer.getChannelData(0), audioContext.sampleRate, STREAM_SAMPLE_RATE);
+            socket.send(encodeFrame(FRAME_AUDIO_CHUNK, 0, pcmChunkSeq++, pcm.buffer));
         };
+        source.connect(pcmProcessor);
+        // The processor only runs while connected to the graph; its output is silence
+        pcmProcessor.connect(audioContext.destination);
+    }
+    
+    function stopPcmStreaming() {
+        pcmProcessor.onaudioprocess = null;
+        pcmProcessor.disconnect();
+        pcmProcessor = null;
+        
+        if (socket && socket.readyState === WebSocket.OPEN) {
+            socket.send(JSON.stringify({
+                type: 'audio_end',
+                conversation_history: conversationHistory,
+                session_id: sessionId,
+                stream: true
+            }));
+        }
+    }
+    
+    function downsampleToInt16(samples, fromRate, toRate) {
+        const ratio = fromRate / toRate;
+        const length = Math.floor(samples.length / ratio);
+        const pcm = new Int16Array(length);
+        for (let i = 0; i < length; i++) {
+            const sample = Math.max(-1, Math.min(1, samples[Math.floor(i * ratio)]));
+            pcm[i] = sample < 0 ? sample * 0x8000 : sample * 0x7fff;
+        }
+        return pcm;
+    }
+    
+    // Process recorded audio
+    async function processAudio(audioBlob) {
+        if (socket && socket.readyState === WebSocket.OPEN) {
+            // Send the recording as a binary frame via WebSocket
+            socket.send(encodeFrame(FRAME_AUDIO, FLAG_STREAM, 0, await audioBlob.arrayBuffer()));
+        } else {
+            // Fallback to REST API if WebSocket is not available
+            processAudioViaRESTAPI(audioBlob);
+        }
     }
 
     // Process audio using the REST API endpoints
-    async function processAudioViaRESTAPI(base64data) {
+    async function processAudioViaRESTAPI(audioBlob) {
         try {
             // Step 1: Transcribe audio
             statusText.textContent = 'Transcribing...';
-            const transcriptionResponse = await fetch('/api/transcribe', {
+            const transcriptionResponse = await fetch('/api/transcribe/raw', {
                 method: 'POST',
                 headers: {
-                    'Content-Type': 'application/json'
+                    'Content-Type': audioBlob.type || 'application/octet-stream',
+                    'X-Session-Id': sessionId
                 },
-                body: JSON.stringify({
-                    audio_data: base64data
-                })
+                body: audioBlob
             });
             
             if (!transcriptionResponse.ok) {
                 if (transcriptionResponse.status === 401) {
                     statusText.textContent = 'Error: Credits over';
+                } else if (transcriptionResponse.status === 422) {
+                    statusText.textContent = 'No speech detected';
                 } else {
                     statusText.textContent = 'Error: Transcription failed';
                 }
@@ -740,7 +999,8 @@ function displayFiles(files) {
             const response = await fetch('/api/tts/stream', {
                 method: 'POST',
                 headers: {
-                    'Content-Type': 'application/json'
+                    'Content-Type': 'application/json',
+                    'X-Session-Id': sessionId
                 },
                 body: JSON.stringify({
                     text: assistantResponse
@@ -814,6 +1074,7 @@ function displayFiles(files) {
         
         conversationContainer.appendChild(messageDiv);
         conversationContainer.scrollTop = conversationContainer.scrollHeight;
+        return messageDiv;
     }
 
     // Add message to conversation history
@@ -821,18 +1082,161 @@ function displayFiles(files) {
         conversationHistory.push({ role, content });
     }
 
-    // Play audio from base64 string
-    function playAudio(base64Audio) {
-        const audioSrc = 'data:audio/mp3;base64,' + base64Audio;
-        audioPlayer.src = audioSrc;
+    // Play audio from a data: or blob: URL
+    function playAudio(url) {
+        // Blob URLs of received frames are released once they have been replaced
+        if (currentAudioUrl && currentAudioUrl.startsWith('blob:')) {
+            URL.revokeObjectURL(currentAudioUrl);
+        }
+        currentAudioUrl = url;
+        audioPlayer.src = url;
         audioPlayer.play();
     }
 
+    // Queue a streamed audio segment; segments play back to back in arrival order
+    function enqueueAudio(url) {
+        audioQueue.push(url);
+        if (!audioQueuePlaying) {
+            playNextAudio();
+        }
+    }
+
+    function playNextAudio() {
+        const next = audioQueue.shift();
+        if (!next) {
+            audioQueuePlaying = false;
+            statusText.textContent = 'Not recording';
+            return;
+        }
+        audioQueuePlaying = true;
+        statusText.textContent = 'Playing audio...';
+        audioPlayer.onended = playNextAudio;
+        playAudio(next);
+    }
+
+    // Opus and PCM replies come in frames that play as soon as they arrive
+    function isFramedFormat(format) {
+        return !!format && (format.startsWith('opus_') || format.startsWith('pcm_'));
+    }
+
+    function ensurePlaybackContext() {
+        if (!playbackContext) {
+            playbackContext = new (window.AudioContext || window.webkitAudioContext)();
+        }
+        if (playbackContext.state === 'suspended') {
+            playbackContext.resume();
+        }
+        return playbackContext;
+    }
+
+    function playFrame(payload) {
+        ensurePlaybackContext();
+        if (audioFormat.startsWith('pcm_')) {
+            // 16-bit little-endian samples
+            const view = new DataView(payload);
+            const samples = new Float32Array(Math.floor(payload.byteLength / 2));
+            for (let i = 0; i < samples.length; i++) {
+                samples[i] = view.getInt16(i * 2, true) / 32768;
+            }
+            schedulePlayback(samples, parseInt(audioFormat.split('_')[1], 10));
+        } else {
+            decodeOpusFrame(payload);
+        }
+    }
+
+    // An Opus frame is a run of packets, each after its 2-byte big-endian length
+    function decodeOpusFrame(payload) {
+        if (!opusDecoder) {
+            opusDecoder = new AudioDecoder({
+                output: (data) => {
+                    const samples = new Float32Array(data.numberOfFrames);
+                    data.copyTo(samples, { planeIndex: 0, format: 'f32-planar' });
+                    schedulePlayback(samples, data.sampleRate);
+                    data.close();
+                },
+                error: (error) => console.error('Opus decoder error:', error)
+            });
+            opusDecoder.configure({ codec: 'opus', sampleRate: 48000, numberOfChannels: 1 });
+            opusTimestamp = 0;
+        }
+        const view = new DataView(payload);
+        let offset = 0;
+        while (offset + 2 <= payload.byteLength) {
+            const length = view.getUint16(offset);
+            offset += 2;
+            opusDecoder.decode(new EncodedAudioChunk({
+                type: 'key',
+                timestamp: opusTimestamp,
+                data: new Uint8Array(payload, offset, length)
+            }));
+            offset += length;
+            // Microseconds; the packets are 20 ms each
+            opusTimestamp += 20000;
+        }
+    }
+
+    function schedulePlayback(samples, sampleRate) {
+        const buffer = playbackContext.createBuffer(1, samples.length, sampleRate);
+        buffer.copyToChannel(samples, 0);
+        const source = playbackContext.createBufferSource();
+        source.buffer = buffer;
+        source.connect(playbackContext.destination);
+        // Back to back, with a small lead when starting (or after running dry)
+        playbackTime = Math.max(playbackTime, playbackContext.currentTime + 0.05);
+        source.start(playbackTime);
+        playbackTime += buffer.duration;
+        playbackSources.push(source);
+        statusText.textContent = 'Playing audio...';
+        source.onended = () => {
+            playbackSources = playbackSources.filter(playing => playing !== source);
+            if (!playbackSources.length) {
+                statusText.textContent = 'Not recording';
+            }
+        };
+    }
+
+    function stopFramePlayback() {
+        playbackSources.forEach(source => {
+            source.onended = null;
+            source.stop();
+        });
+        playbackSources = [];
+        playbackTime = 0;
+        if (opusDecoder && opusDecoder.state !== 'closed') {
+            opusDecoder.close();
+        }
+        opusDecoder = null;
+    }
+
+    // Audio of an interrupted turn that is still in flight is dropped
+    function isInterrupted() {
+        return currentTurnId <= interruptedTurnId;
+    }
+
+    // Stop the reply being played and ask the server to cancel the rest of it
+    function interruptReply() {
+        if (socket && socket.readyState === WebSocket.OPEN) {
+            socket.send(JSON.stringify({ type: 'interrupt' }));
+        }
+        interruptedTurnId = currentTurnId;
+        audioQueue.forEach(url => url.startsWith('blob:') && URL.revokeObjectURL(url));
+        audioQueue = [];
+        audioQueuePlaying = false;
+        audioPlayer.onended = null;
+        audioPlayer.pause();
+        stopFramePlayback();
+        // Called on a click, so the browser lets the context play the next reply
+        ensurePlaybackContext();
+        streamingAssistantMessage = null;
+    }
+
     // Send text message
     function sendTextMessage() {
         const text = textInput.value.trim();
         if (!text) return;
         
+        interruptReply();
+        
         // Add message to conversation
         addMessageToConversation('user', text);
         addToConversationHistory('user', text);
@@ -846,7 +1250,8 @@ function displayFiles(files) {
                 type: 'text',
                 message: text,
                 conversation_history: conversationHistory,
-                session_id: sessionId
+                session_id: sessionId,
+                stream: true
             }));
         } else {
             // Use REST API
@@ -892,7 +1297,8 @@ function displayFiles(files) {
             const response = await fetch('/api/tts/stream', {
             method: 'POST',
             headers: {
-                'Content-Type': 'application/json'
+                'Content-Type': 'application/json',
+                'X-Session-Id': sessionId
             },
             body: JSON.stringify({
                 text: assistantResponse
@@ -933,6 +1339,10 @@ function displayFiles(files) {
 }
     function resetSession() {
         sessionId = generateSessionId();
+        // Follow the new session's upload progress on the open socket
+        if (socket && socket.readyState === WebSocket.OPEN) {
+            socket.send(JSON.stringify({ type: 'session', session_id: sessionId }));
+        }
         conversationHistory = [];
         conversationContainer.innerHTML = '';
 }
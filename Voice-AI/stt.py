@@ -0,0 +1,276 @@
+import asyncio
+import io
+import json
+import logging
+import threading
+from contextlib import AsyncExitStack
+from typing import Awaitable, Callable, List, Optional
+
+import httpx
+import websockets
+
+from admission import VendorError, VendorGate
+from audio import AudioPreprocessor, NoSpeechError, pcm_to_wav
+from metrics import span
+
+log = logging.getLogger(__name__)
+
+# Called with (text so far, is_final) whenever the backend recognizes more speech
+TranscriptCallback = Callable[[str, bool], Awaitable[None]]
+
+
+class STTStream:
+    """A live transcription session fed with 16-bit mono PCM while the user talks."""
+
+    async def start(self):
+        pass
+
+    async def send_audio(self, chunk: bytes):
+        raise NotImplementedError
+
+    async def finish(self) -> str:
+        """Signal end of speech and return the final transcript."""
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class STTBackend:
+    """Speech-to-text provider. Subclasses implement batch transcription and may
+    override `open_stream` with a real streaming session."""
+
+    # Trims silence and rejects recordings without speech before they are sent (see audio.py)
+    preprocessor: Optional[AudioPreprocessor] = None
+    # Admission, deadline and retries for the provider's API (see admission.py)
+    gate: Optional[VendorGate] = None
+    # Whether transcribe() retries each of its own requests, rather than being retried as a whole
+    retries_requests = False
+
+    async def transcribe(self, audio_bytes: bytes) -> str:
+        raise NotImplementedError
+
+    async def transcribe_recording(self, audio_bytes: bytes) -> str:
+        """Transcribe a whole recording, pre-processed first; raises NoSpeechError for silence
+        and admission.Busy when the provider has no capacity left."""
+        if self.preprocessor is not None:
+            async with span("stt_preprocess", expected=(NoSpeechError,)):
+                audio_bytes = (await self.preprocessor.process(audio_bytes)).audio
+        if self.gate is None:
+            return await self.transcribe(audio_bytes)
+        async with self.gate.admit():
+            return await self.gate.call(lambda: self.transcribe(audio_bytes), retry=not self.retries_requests)
+
+    def open_stream(self, sample_rate: int, on_transcript: TranscriptCallback) -> STTStream:
+        # Fallback for providers without streaming: buffer the audio, transcribe on finish
+        return BufferedSTTStream(self, sample_rate, on_transcript)
+
+    async def aclose(self):
+        pass
+
+
+class BufferedSTTStream(STTStream):
+    def __init__(self, backend: STTBackend, sample_rate: int, on_transcript: TranscriptCallback):
+        self.backend = backend
+        self.sample_rate = sample_rate
+        self.on_transcript = on_transcript
+        self.buffer = bytearray()
+
+    async def send_audio(self, chunk: bytes):
+        self.buffer.extend(chunk)
+
+    async def finish(self) -> str:
+        text = await self.backend.transcribe_recording(pcm_to_wav(bytes(self.buffer), self.sample_rate))
+        await self.on_transcript(text, True)
+        return text
+
+
+class AssemblyAIBackend(STTBackend):
+    """AssemblyAI: upload-and-poll for whole recordings, Universal Streaming for live audio."""
+
+    # A failed poll is retried on its own, without uploading the audio and transcribing it again
+    retries_requests = True
+
+    def __init__(self, http: httpx.AsyncClient, api_key: str, streaming_url: Optional[str] = None,
+                 poll_initial: float = 0.25, poll_max: float = 2.0, timeout: float = 60.0,
+                 preprocessor: Optional[AudioPreprocessor] = None, gate: Optional[VendorGate] = None):
+        self.http = http
+        self.api_key = api_key
+        self.streaming_url = streaming_url
+        self.poll_initial = poll_initial
+        self.poll_max = poll_max
+        self.timeout = timeout
+        self.preprocessor = preprocessor
+        self.gate = gate
+
+    async def transcribe(self, audio_bytes: bytes) -> str:
+        # Upload the audio file to AssemblyAI
+        async with span("stt_upload"):
+            upload_response = await self._request("Upload", "POST", "/v2/upload", content=audio_bytes)
+            audio_url = upload_response.json()["upload_url"]
+
+        async with span("stt_poll"):
+            return await self._wait_for_transcript(audio_url)
+
+    async def _wait_for_transcript(self, audio_url: str) -> str:
+        # Request transcription
+        transcript_response = await self._request("Transcription request", "POST", "/v2/transcript", json={
+            "audio_url": audio_url,
+            "language_code": "en"  # Change as needed for other languages
+        })
+        transcript_id = transcript_response.json()["id"]
+
+        # Poll for completion, backing off from poll_initial up to poll_max, until the deadline
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        delay = self.poll_initial
+        while True:
+            polling_response = await self._request("Polling", "GET", f"/v2/transcript/{transcript_id}")
+            polling_response_json = polling_response.json()
+
+            if polling_response_json["status"] == "completed":
+                return polling_response_json["text"] or ""
+            elif polling_response_json["status"] == "error":
+                raise Exception(f"Transcription error: {polling_response_json['error']}")
+
+            if loop.time() + delay > deadline:
+                raise TimeoutError(f"Transcription {transcript_id} not ready after {self.timeout:.0f}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.poll_max)
+
+    async def _request(self, what: str, method: str, url: str, **kwargs) -> httpx.Response:
+        # One request, retried on its own by the gate when it fails transiently (429, 5xx)
+        async def send() -> httpx.Response:
+            response = await self.http.request(method, url, **kwargs)
+            if response.status_code != 200:
+                raise VendorError(f"{what} failed: {response.text}", response.status_code, response.headers)
+            return response
+        if self.gate is None:
+            return await send()
+        return await self.gate.call(send)
+
+    def open_stream(self, sample_rate: int, on_transcript: TranscriptCallback) -> STTStream:
+        if not self.streaming_url:
+            return super().open_stream(sample_rate, on_transcript)
+        return AssemblyAIStream(self.streaming_url, self.api_key, sample_rate, on_transcript, gate=self.gate)
+
+
+class WhisperBackend(STTBackend):
+    """faster-whisper on the CPU, in a worker thread: no upload, no polling. Live audio is
+    buffered and transcribed when the user stops talking."""
+
+    def __init__(self, model: str = "base.en", compute_type: str = "int8", threads: int = 0,
+                 language: Optional[str] = "en", preprocessor: Optional[AudioPreprocessor] = None,
+                 gate: Optional[VendorGate] = None):
+        try:
+            from faster_whisper import WhisperModel
+        except ImportError:
+            raise RuntimeError("STT_PROVIDER=whisper needs the faster-whisper package") from None
+        self.model = WhisperModel(model, device="cpu", compute_type=compute_type, cpu_threads=threads)
+        self.language = language
+        self.preprocessor = preprocessor
+        self.gate = gate
+        # The model's CPU threads are shared, so recordings are transcribed one at a time
+        self.lock = threading.Lock()
+
+    def _transcribe(self, audio_bytes: bytes) -> str:
+        with self.lock:
+            segments, _ = self.model.transcribe(io.BytesIO(audio_bytes), language=self.language, beam_size=1)
+            return " ".join(segment.text.strip() for segment in segments)
+
+    async def transcribe(self, audio_bytes: bytes) -> str:
+        async with span("stt_local"):
+            return await asyncio.to_thread(self._transcribe, audio_bytes)
+
+
+class StubSTTBackend(STTBackend):
+    """Returns the same transcript for every recording, for tests and benchmarks."""
+
+    def __init__(self, transcript: str = "What do the documents say?",
+                 preprocessor: Optional[AudioPreprocessor] = None, gate: Optional[VendorGate] = None):
+        self.transcript = transcript
+        self.preprocessor = preprocessor
+        self.gate = gate
+
+    async def transcribe(self, audio_bytes: bytes) -> str:
+        return self.transcript
+
+
+class AssemblyAIStream(STTStream):
+    """One AssemblyAI Universal Streaming (v3) WebSocket session.
+
+    With a gate, the session holds one of the provider's slots from `start()` to
+    `close()`, and connecting is under the gate's deadline and retries.
+    """
+
+    def __init__(self, url: str, api_key: str, sample_rate: int, on_transcript: TranscriptCallback,
+                 finish_timeout: float = 5.0, gate: Optional[VendorGate] = None):
+        self.url = f"{url}?sample_rate={sample_rate}&encoding=pcm_s16le&format_turns=true"
+        self.api_key = api_key
+        self.on_transcript = on_transcript
+        self.finish_timeout = finish_timeout
+        self.final_turns: List[str] = []
+        self.current_turn = ""
+        self.ws = None
+        self.reader: Optional[asyncio.Task] = None
+        self.gate = gate
+        # Releases the gate's slot on close
+        self.admission = AsyncExitStack()
+
+    @property
+    def text(self) -> str:
+        return " ".join(part for part in self.final_turns + [self.current_turn] if part)
+
+    async def start(self):
+        def connect():
+            return websockets.connect(self.url, additional_headers={"Authorization": self.api_key})
+
+        try:
+            if self.gate is not None:
+                await self.admission.enter_async_context(self.gate.admit())
+            async with span("stt_stream_connect"):
+                self.ws = await (self.gate.call(connect) if self.gate else connect())
+        except BaseException:
+            await self.admission.aclose()
+            raise
+        self.reader = asyncio.create_task(self._read())
+
+    async def _read(self):
+        async for raw in self.ws:
+            message = json.loads(raw)
+            if message["type"] == "Turn":
+                if message.get("end_of_turn") and message.get("turn_is_formatted"):
+                    self.final_turns.append(message["transcript"])
+                    self.current_turn = ""
+                    await self.on_transcript(self.text, True)
+                elif not message.get("end_of_turn"):
+                    self.current_turn = message["transcript"]
+                    await self.on_transcript(self.text, False)
+            elif message["type"] == "Termination":
+                return
+
+    async def send_audio(self, chunk: bytes):
+        await self.ws.send(chunk)
+
+    async def finish(self) -> str:
+        # Ask the server to flush the last turn; it answers with a Termination message
+        async with span("stt_stream_finish"):
+            await self.ws.send(json.dumps({"type": "Terminate"}))
+            try:
+                await asyncio.wait_for(self.reader, self.finish_timeout)
+            except asyncio.TimeoutError:
+                # Keep what was recognized so far rather than losing the whole turn
+                log.warning(f"STT stream did not terminate within {self.finish_timeout}s, using the partial transcript")
+            finally:
+                await self.close()
+        return self.text
+
+    async def close(self):
+        if self.reader and not self.reader.done():
+            self.reader.cancel()
+        try:
+            if self.ws is not None:
+                await self.ws.close()
+        finally:
+            await self.admission.aclose()
+
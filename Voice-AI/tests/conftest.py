@@ -0,0 +1,58 @@
+"""The app under test: stub STT, LLM and TTS providers and an in-process Redis (fakeredis).
+
+main.py reads its settings and connects its Redis pool at import, so both
+are set up here, before any test imports it.
+
+    cd Voice-AI && pip install -r requirements-dev.txt && python -m pytest tests
+"""
+import os
+import sys
+import tempfile
+
+import fakeredis
+import pytest
+import redis.asyncio
+from fakeredis import FakeAsyncRedisConnection
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = tempfile.mkdtemp(prefix="voice-ai-tests-")
+
+os.environ.update({
+    "STT_PROVIDER": "stub",
+    "LLM_PROVIDER": "stub",
+    "TTS_PROVIDER": "stub",
+    "RETRIEVAL_DIR": os.path.join(DATA_DIR, "documents"),
+    "UPLOAD_SPOOL_DIR": os.path.join(DATA_DIR, "uploads"),
+    "UPLOAD_MAX_REQUEST_BYTES": str(1024 * 1024),
+    # Every turn runs the LLM and TTS, one worker, nothing in the background
+    "ANSWER_CACHE": "0",
+    "CONVERSATION_SUMMARY": "0",
+    "TTS_CACHE_REDIS": "0",
+    "SESSION_BUS": "0",
+    "SESSION_RATE": "0",
+    "JOB_WORKERS": "0",
+    "WARMUP": "0",
+})
+
+redis_server = fakeredis.FakeServer()
+
+
+class FakeConnectionPool(redis.asyncio.ConnectionPool):
+    def __init__(self, **kwargs):
+        super().__init__(connection_class=FakeAsyncRedisConnection, server=redis_server, **kwargs)
+
+
+redis.asyncio.ConnectionPool = FakeConnectionPool
+# main.py mounts static/ and templates/ relative to the working directory
+os.chdir(APP_DIR)
+sys.path.insert(0, APP_DIR)
+
+import main  # noqa: E402
+
+
+@pytest.fixture
+def client():
+    from fastapi.testclient import TestClient
+
+    with TestClient(main.app) as test_client:
+        yield test_client
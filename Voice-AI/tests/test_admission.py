@@ -0,0 +1,197 @@
+"""Vendor gates (see admission.py): queue bounds, retries, a shared rate limit; background LLM calls give way to turns."""
+import asyncio
+
+import fakeredis
+import pytest
+
+from admission import Busy, GateSettings, RateLimiter, VendorError, VendorGate
+from conversation import ConversationStore
+from llm import Prompt, StubLLMBackend
+
+
+def make_gate(server=None, **settings) -> VendorGate:
+    redis_client = fakeredis.FakeAsyncRedis(server=server or fakeredis.FakeServer(), decode_responses=True)
+    return VendorGate("vendor", "llm", GateSettings(**settings), RateLimiter(redis_client))
+
+
+def test_calls_beyond_the_queue_are_refused_right_away():
+    async def run():
+        gate = make_gate(max_concurrency=1, max_queue=1)
+        release = asyncio.Event()
+
+        async def hold():
+            async with gate.admit():
+                await release.wait()
+
+        holding = asyncio.create_task(hold())
+        await asyncio.sleep(0.01)
+        waiting = asyncio.create_task(hold())
+        await asyncio.sleep(0.01)
+        with pytest.raises(Busy) as refused:
+            async with gate.admit():
+                pass
+        release.set()
+        await asyncio.gather(holding, waiting)
+        return refused.value, gate
+
+    refused, gate = asyncio.run(run())
+    assert refused.reason == "queue_full" and refused.status_code == 503
+    assert gate.admitted == 2 and gate.rejected["queue_full"] == 1 and gate.in_flight == 0
+
+
+def test_a_call_that_waits_too_long_for_a_slot_gives_up():
+    async def run():
+        gate = make_gate(max_concurrency=1, queue_timeout=0.05)
+        async with gate.admit():
+            with pytest.raises(Busy) as refused:
+                async with gate.admit():
+                    pass
+        return refused.value
+
+    assert asyncio.run(run()).reason == "queue_timeout"
+
+
+def test_transient_errors_are_retried_and_others_are_not():
+    async def run():
+        gate = make_gate(retries=2, retry_base_delay=0.01)
+        attempts = []
+
+        async def overloaded_twice():
+            attempts.append("overloaded")
+            if len(attempts) < 3:
+                raise VendorError("Service unavailable", 503)
+            return "answer"
+
+        async def bad_request():
+            attempts.append("bad request")
+            raise VendorError("Bad request", 400)
+
+        answer = await gate.call(overloaded_twice)
+        with pytest.raises(VendorError):
+            await gate.call(bad_request)
+        return answer, attempts, gate.retries
+
+    answer, attempts, retries = asyncio.run(run())
+    assert answer == "answer"
+    assert attempts == ["overloaded"] * 3 + ["bad request"]
+    assert retries == 2
+
+
+def test_a_call_stops_at_its_deadline():
+    async def run():
+        gate = make_gate(deadline=0.1, retries=5, retry_base_delay=0.01)
+        attempts = []
+
+        async def slow():
+            attempts.append(1)
+            await asyncio.sleep(1)
+
+        started = asyncio.get_running_loop().time()
+        with pytest.raises(TimeoutError):
+            await gate.call(slow)
+        return asyncio.get_running_loop().time() - started, attempts, gate.deadline_exceeded
+
+    elapsed, attempts, exceeded = asyncio.run(run())
+    assert elapsed < 0.5 and len(attempts) == 1 and exceeded == 1
+
+
+def test_a_stream_is_retried_only_before_its_first_item():
+    async def run():
+        gate = make_gate(retries=2, retry_base_delay=0.01)
+        opened = []
+
+        async def tokens():
+            opened.append(1)
+            if len(opened) == 1:
+                raise VendorError("Too many requests", 429)
+            yield "first"
+            raise VendorError("Service unavailable", 503)
+
+        received = []
+        with pytest.raises(VendorError):
+            async for token in gate.stream(tokens):
+                received.append(token)
+        return received, len(opened)
+
+    assert asyncio.run(run()) == (["first"], 2)
+
+
+def test_the_rate_limit_is_shared_by_every_worker():
+    async def run():
+        server = fakeredis.FakeServer()
+        workers = [make_gate(server, rate=1, burst=2, queue_timeout=0.2) for _ in range(2)]
+        for gate in workers:
+            async with gate.admit():
+                pass
+        with pytest.raises(Busy) as refused:
+            async with workers[0].admit():
+                pass
+        return refused.value
+
+    refused = asyncio.run(run())
+    assert refused.reason == "rate_limited" and refused.retry_after > 0.5
+
+
+class SlowLLMBackend(StubLLMBackend):
+    async def complete(self, prompt):
+        await asyncio.sleep(0.5)
+        return await super().complete(prompt)
+
+
+def single_slot_backend():
+    gate = VendorGate("llamacpp", "llm", GateSettings(max_concurrency=1),
+                      RateLimiter(fakeredis.FakeAsyncRedis(decode_responses=True)))
+    return SlowLLMBackend(gate=gate)
+
+
+def test_a_turn_preempts_a_background_call():
+    async def run():
+        backend = single_slot_backend()
+        background = asyncio.create_task(backend.respond(Prompt("", "summary"), background=True))
+        await asyncio.sleep(0.05)
+        started = asyncio.get_running_loop().time()
+        answer = await backend.respond(Prompt("", "turn"))
+        with pytest.raises(Busy):
+            await background
+        return answer, asyncio.get_running_loop().time() - started, backend.gate
+
+    answer, elapsed, gate = asyncio.run(run())
+    assert answer == "This is a stub answer."
+    # The turn waited for its own call only, not the background one before it
+    assert elapsed < 0.9
+    assert gate.rejected["preempted"] == 1 and gate.semaphore._value == 1
+
+
+def test_a_background_call_waits_for_the_turns():
+    async def run():
+        backend = single_slot_backend()
+        order = []
+
+        async def respond(name, background=False):
+            await backend.respond(Prompt("", name), background=background)
+            order.append(name)
+
+        turn = asyncio.create_task(respond("turn"))
+        await asyncio.sleep(0.05)
+        await asyncio.gather(respond("summary", background=True), turn)
+        return order
+
+    assert asyncio.run(run()) == ["turn", "summary"]
+
+
+def test_a_fold_that_gives_way_keeps_its_exchanges():
+    async def run():
+        store = ConversationStore(fakeredis.FakeAsyncRedis(decode_responses=True), max_tokens=20)
+        for i in range(4):
+            await store.append("session", f"question {i} " * 5, f"answer {i} " * 5)
+
+        async def preempted(summary, exchanges):
+            raise Busy("llamacpp", "preempted", 0.0)
+
+        await store.fold("session", preempted)
+        exchanges = await store.redis.llen("conversation:session:exchanges")
+        return exchanges, store.stats
+
+    exchanges, stats = asyncio.run(run())
+    assert exchanges == 4
+    assert (stats.folds, stats.folds_deferred, stats.fold_failures) == (0, 1, 0)
@@ -0,0 +1,47 @@
+"""Answer cache lookups (see answer_cache.py): normalized questions, per file set; near duplicates name the same thing."""
+import asyncio
+
+import fakeredis
+
+from answer_cache import AnswerCache, file_set_fingerprint
+
+
+def test_a_question_is_found_whatever_its_case_and_punctuation():
+    async def run():
+        cache = AnswerCache(fakeredis.FakeAsyncRedis(decode_responses=True))
+        await cache.put("files", "What is the price of plan A?", "Plan A costs $10.")
+        return [
+            await cache.get("files", "what is the  price of plan A"),
+            await cache.get("other files", "What is the price of plan A?"),
+            await cache.get("files", "What is the price of plan A in euros?"),
+        ], cache.stats
+
+    answers, stats = asyncio.run(run())
+    assert answers == ["Plan A costs $10.", None, None]
+    assert (stats.exact_hits, stats.near_hits, stats.misses) == (1, 0, 2)
+
+
+def test_the_fingerprint_follows_the_file_set():
+    one_file = file_set_fingerprint(["hash-a"], "model", "instructions")
+    two_files = file_set_fingerprint(["hash-a", "hash-b"], "model", "instructions")
+    # Another session with the same documents shares the answers
+    shared = file_set_fingerprint(["hash-b", "hash-a"], "model", "instructions")
+    other_model = file_set_fingerprint(["hash-a", "hash-b"], "other model", "instructions")
+    assert len({one_file, two_files, other_model}) == 3
+    assert shared == two_files
+
+
+def test_a_near_duplicate_must_have_the_same_numbers_and_letters():
+    async def run():
+        cache = AnswerCache(fakeredis.FakeAsyncRedis(decode_responses=True), near_duplicate_threshold=0.7)
+        await cache.put("files", "What is the price of plan A?", "Plan A costs $10.")
+        await cache.put("files", "How many seats were sold in 2023?", "1,200 seats.")
+        return [
+            await cache.get("files", "what's the price of plan A"),
+            await cache.get("files", "What is the price of plan B?"),
+            await cache.get("files", "How many seats were sold in 2024?"),
+        ], cache.stats
+
+    answers, stats = asyncio.run(run())
+    assert answers == ["Plan A costs $10.", None, None]
+    assert (stats.near_hits, stats.misses) == (1, 2)
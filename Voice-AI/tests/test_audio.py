@@ -0,0 +1,104 @@
+"""Recording pre-processing (see audio.py): silence trimmed, speechless recordings refused, audio resampled.
+
+The recordings are synthetic WAV, so the tests do not need ffmpeg.
+"""
+import asyncio
+import io
+import wave
+
+import numpy as np
+import pytest
+
+import audio
+from audio import AudioPreprocessor, NoSpeechError, decode_wav, to_mono
+
+RATE = 16000
+rng = np.random.default_rng(0)
+
+
+def encode_wav(samples: np.ndarray, rate: int) -> bytes:
+    """16-bit WAV of float samples shaped (frames,) or (frames, channels)."""
+    samples = samples.reshape(len(samples), -1)
+    out = io.BytesIO()
+    with wave.open(out, "wb") as wav:
+        wav.setnchannels(samples.shape[1])
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes((np.clip(samples, -1, 1) * 32767).astype("<i2").tobytes())
+    return out.getvalue()
+
+
+def voice(seconds: float, rate: int = RATE) -> np.ndarray:
+    """Something speech-like: a 150 Hz voice with harmonics and a syllable-rate envelope."""
+    t = np.arange(int(seconds * rate)) / rate
+    harmonics = sum(np.sin(2 * np.pi * 150 * n * t) / n for n in range(1, 6))
+    return (0.2 * harmonics * (0.6 + 0.4 * np.sin(2 * np.pi * 4 * t))).astype(np.float32)
+
+
+def noise(seconds: float, level: float, rate: int = RATE) -> np.ndarray:
+    return (rng.normal(0, level, int(seconds * rate))).astype(np.float32)
+
+
+def process(data: bytes, preprocessor: AudioPreprocessor = None):
+    return asyncio.run((preprocessor or AudioPreprocessor(RATE)).process(data))
+
+
+@pytest.mark.parametrize("background", [0.0, 0.003])
+def test_silence_around_speech_is_trimmed(background):
+    recording = np.concatenate([noise(1.0, background), voice(0.6), noise(1.5, background)])
+    result = process(encode_wav(recording, RATE))
+
+    samples, rate = decode_wav(result.audio)
+    assert rate == RATE and samples.shape[1] == 1
+    assert result.input_ms == pytest.approx(3100)
+    # The speech and 200 ms of padding on each side, to a frame or two
+    assert result.output_ms == pytest.approx(600 + 2 * 200, abs=60)
+    assert result.speech_ms == pytest.approx(600, abs=60)
+    assert len(samples) == round(result.output_ms * RATE / 1000)
+
+
+@pytest.mark.parametrize("recording", [np.zeros(RATE * 2, dtype=np.float32), noise(2.0, 0.003)],
+                         ids=["silence", "background noise"])
+def test_a_recording_without_speech_is_refused(recording):
+    preprocessor = AudioPreprocessor(RATE)
+    with pytest.raises(NoSpeechError):
+        process(encode_wav(recording, RATE), preprocessor)
+    assert preprocessor.report()["rejected_no_speech"] == 1
+
+
+def test_a_click_is_not_speech():
+    recording = np.zeros(RATE * 2, dtype=np.float32)
+    recording[RATE:RATE + 40] = 0.9
+    with pytest.raises(NoSpeechError):
+        process(encode_wav(recording, RATE))
+
+
+@pytest.mark.parametrize("rate", [44100, 48000])
+def test_stereo_recordings_are_downmixed_and_resampled(rate):
+    recording = np.concatenate([np.zeros(rate // 2, dtype=np.float32), voice(1.0, rate),
+                                np.zeros(rate // 2, dtype=np.float32)])
+    stereo = np.stack([recording, recording], axis=1)
+    result = process(encode_wav(stereo, rate))
+
+    samples, out_rate = decode_wav(result.audio)
+    assert out_rate == RATE and samples.shape[1] == 1
+    assert result.input_ms == pytest.approx(2000, abs=1)
+    # The voice's fundamental is still where it was
+    spectrum = np.abs(np.fft.rfft(samples[:, 0]))
+    assert np.fft.rfftfreq(len(samples), 1 / RATE)[np.argmax(spectrum)] == pytest.approx(150, abs=5)
+
+
+def test_resampling_filters_out_what_the_target_rate_cannot_hold():
+    t = np.arange(48000) / 48000
+    heard, too_high = np.sin(2 * np.pi * 1000 * t), np.sin(2 * np.pi * 10000 * t)
+    # Without the low-pass, 10 kHz would fold back to 6 kHz at 16 kHz
+    assert np.abs(to_mono(too_high, 48000, RATE)[100:-100]).max() < 0.05
+    assert np.abs(to_mono(heard, 48000, RATE)[100:-100]).max() > 0.9
+
+
+def test_audio_that_cannot_be_decoded_is_passed_through(monkeypatch):
+    monkeypatch.setattr(audio, "FFMPEG", None)
+    preprocessor = AudioPreprocessor(RATE)
+    result = process(b"\x1aE\xdf\xa3 not really webm", preprocessor)
+    assert result.audio == b"\x1aE\xdf\xa3 not really webm" and not result.decoded
+    assert preprocessor.report()["undecodable"] == 1
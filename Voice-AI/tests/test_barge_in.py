@@ -0,0 +1,153 @@
+"""Barge-in: a new message or an `interrupt` cancels the turn being answered (see turns.py)."""
+import asyncio
+import json
+
+import pytest
+
+import main
+from llm import StubLLMBackend
+
+SESSION_ID = "test-barge-in"
+# The stub LLM answers with the start of the best passage: several sentences, so a reply is
+# still being generated while the audio of its first sentence is sent
+DOCUMENT = " ".join(f"Sentence number {n} of the test document." for n in range(1, 9))
+
+
+@pytest.fixture(autouse=True)
+def session(client, monkeypatch):
+    monkeypatch.setitem(main.providers.backends, "llm", StubLLMBackend(token_delay=0.02))
+
+    async def index_document():
+        await main.get_document_store().add(SESSION_ID, "local_test", "test.txt", DOCUMENT.encode())
+        await main.sessions.add_files(SESSION_ID, [("local_test", "test.txt", "test")])
+
+    client.portal.call(index_document)
+    return SESSION_ID
+
+
+def text_turn(message: str = "What do the documents say?") -> dict:
+    return {"type": "text", "message": message, "session_id": SESSION_ID, "stream": True}
+
+
+def receive_until(ws, done) -> list:
+    """Messages up to and including the first one `done` accepts."""
+    messages = []
+    while True:
+        message = ws.receive_json()
+        messages.append(message)
+        if done(message):
+            return messages
+
+
+def is_type(kind: str, turn_id: int):
+    return lambda message: message["type"] == kind and message.get("turn_id") == turn_id
+
+
+def audio_of(messages: list, turn_id: int) -> list:
+    return [message for message in messages if message["type"] == "tts_chunk" and message.get("turn_id") == turn_id]
+
+
+def test_interrupt_cancels_the_running_turn(client):
+    cancelled_before = main.turn_stats.cancelled
+    with client.websocket_connect("/ws") as ws:
+        ws.send_json(text_turn())
+        receive_until(ws, is_type("tts_chunk", 1))
+        ws.send_json({"type": "interrupt"})
+        messages = receive_until(ws, lambda message: message.get("turn_id") == 1
+                                 and message["type"] in ("turn_cancelled", "tts_end"))
+        assert messages[-1]["type"] == "turn_cancelled"
+        assert "llm_tokens_avoided" in messages[-1]
+
+        ws.send_json(text_turn())
+        messages = receive_until(ws, is_type("tts_end", 2))
+    assert messages[0]["type"] == "turn_start" and messages[0]["turn_id"] == 2
+    assert not audio_of(messages, 1)
+    assert audio_of(messages, 2)
+    assert main.turn_stats.cancelled == cancelled_before + 1
+
+
+def test_new_message_cancels_the_turn_before_the_next_starts(client):
+    with client.websocket_connect("/ws") as ws:
+        ws.send_json(text_turn())
+        receive_until(ws, is_type("tts_chunk", 1))
+        ws.send_json(text_turn("And what else?"))
+        messages = receive_until(ws, is_type("tts_end", 2))
+    types = [(message["type"], message.get("turn_id")) for message in messages]
+    cancelled = types.index(("turn_cancelled", 1))
+    assert cancelled < types.index(("turn_start", 2))
+    # Nothing of the cancelled turn comes after its cancellation, and it never finishes
+    assert not audio_of(messages[cancelled:], 1)
+    assert ("tts_end", 1) not in types
+    assert ("llm_response", 1) not in types
+
+
+class RecordingSocket:
+    """Stands in for a client's WebSocket: keeps the JSON messages sent to it."""
+
+    def __init__(self):
+        self.query_params = {}
+        self.messages = []
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, data: str):
+        self.messages.append(json.loads(data))
+
+    async def send_bytes(self, data: bytes):
+        raise AssertionError("binary frames were not negotiated")
+
+
+def test_queued_turns_are_dropped(client):
+    async def burst():
+        websocket = RecordingSocket()
+        await main.manager.connect(websocket)
+        turns = main.TurnRunner(websocket)
+        stats_before = main.turn_stats.report()
+        try:
+            # Three messages in one burst: each one cancels the turns queued before it
+            for n in range(3):
+                await turns.submit(text_turn(f"Question {n}?"))
+            async def replied():
+                while not any(is_type("tts_end", 3)(message) for message in websocket.messages):
+                    await asyncio.sleep(0.01)
+            await asyncio.wait_for(replied(), 10)
+        finally:
+            await turns.close()
+            await main.manager.disconnect(websocket)
+        return websocket.messages, stats_before, main.turn_stats.report()
+
+    messages, before, after = client.portal.call(burst)
+    started = [message["turn_id"] for message in messages if message["type"] == "turn_start"]
+    assert started == [3]
+    assert {message.get("turn_id") for message in messages} == {3}
+    assert after["cancelled_before_start"] == before["cancelled_before_start"] + 2
+    assert after["completed"] == before["completed"] + 1
+
+
+def test_closing_the_connection_cancels_the_turn(client):
+    async def close_mid_reply():
+        websocket = RecordingSocket()
+        await main.manager.connect(websocket)
+        turns = main.TurnRunner(websocket)
+        stats_before = main.turn_stats.report()
+        try:
+            await turns.submit(text_turn())
+
+            async def speaking():
+                while not audio_of(websocket.messages, 1):
+                    await asyncio.sleep(0.01)
+            await asyncio.wait_for(speaking(), 10)
+        finally:
+            await turns.close()
+            await main.manager.disconnect(websocket)
+        sent = len(websocket.messages)
+        await asyncio.sleep(0.2)
+        return websocket.messages, sent, stats_before, main.turn_stats.report()
+
+    messages, sent, before, after = client.portal.call(close_mid_reply)
+    # Nothing is sent once the connection is closed, not even turn_cancelled
+    assert len(messages) == sent
+    assert not any(message["type"] in ("tts_end", "turn_cancelled") for message in messages)
+    assert after["cancelled"] == before["cancelled"] + 1
+    assert after["completed"] == before["completed"]
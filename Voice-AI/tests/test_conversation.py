@@ -0,0 +1,66 @@
+"""Conversation memory (see conversation.py): the exchanges a prompt carries, and folding them into a summary."""
+import asyncio
+
+import fakeredis
+
+from conversation import ConversationStore
+from llm import Exchange
+
+# 40 characters, 10 tokens each: a budget of 20 tokens holds two
+EXCHANGES = [(f"Question number {i}...", f"Answer number {i}.....") for i in range(3)]
+
+
+def store() -> ConversationStore:
+    return ConversationStore(fakeredis.FakeAsyncRedis(decode_responses=True), max_tokens=20)
+
+
+def test_a_prompt_carries_the_newest_exchanges_that_fit():
+    async def run():
+        conversations = store()
+        over_budget = [await conversations.append("s", *exchange) for exchange in EXCHANGES]
+        return over_budget, await conversations.load("s"), conversations.stats
+
+    over_budget, conversation, stats = asyncio.run(run())
+    assert over_budget == [False, False, True]
+    assert conversation.summary == ""
+    assert conversation.exchanges == [Exchange(*exchange) for exchange in EXCHANGES[1:]]
+    assert stats.trimmed_prompts == 1
+
+
+def test_the_oldest_exchanges_are_folded_into_the_summary():
+    async def run():
+        conversations = store()
+        for exchange in EXCHANGES:
+            await conversations.append("s", *exchange)
+        folded = []
+
+        async def summarize(summary, exchanges):
+            folded.append((summary, exchanges))
+            return "They asked two questions."
+
+        await conversations.fold("s", summarize)
+        return folded, await conversations.load("s"), conversations.stats
+
+    folded, conversation, stats = asyncio.run(run())
+    # Down to half the budget: the two oldest go into the summary
+    assert folded == [("", [Exchange(*exchange) for exchange in EXCHANGES[:2]])]
+    assert conversation.summary == "They asked two questions."
+    assert conversation.exchanges == [Exchange(*EXCHANGES[2])]
+    assert (stats.folds, stats.exchanges_folded, stats.trimmed_prompts) == (1, 2, 0)
+
+
+def test_a_failed_summary_drops_the_exchanges_it_was_for():
+    async def run():
+        conversations = store()
+        for exchange in EXCHANGES:
+            await conversations.append("s", *exchange)
+
+        async def failing(summary, exchanges):
+            raise ConnectionError("LLM unavailable")
+
+        await conversations.fold("s", failing)
+        return await conversations.load("s"), conversations.stats
+
+    conversation, stats = asyncio.run(run())
+    assert conversation.summary == "" and conversation.exchanges == [Exchange(*EXCHANGES[2])]
+    assert stats.fold_failures == 1
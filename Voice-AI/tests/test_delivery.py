@@ -0,0 +1,99 @@
+"""Reply audio delivery (see delivery.py): the format a client gets, and frames sized to its link."""
+import asyncio
+import json
+import struct
+
+import delivery
+from delivery import Delivery, OggOpusDemuxer
+from protocol import FRAME_TTS_CHUNK, PROTOCOL_VERSION, unpack_frame
+
+ELEVENLABS = {"mp3_44100_128", "pcm_16000", "opus_48000_32"}
+
+
+def test_a_client_gets_the_first_format_it_offers_that_can_be_sent_to_it():
+    formats = Delivery()
+
+    def negotiate(offered, binary=True):
+        return formats.link(offered, ELEVENLABS.__contains__, "mp3_44100_128", binary).output_format
+
+    assert negotiate(["opus_48000_32", "pcm_16000"]) == "opus_48000_32"
+    assert negotiate(["flac_48000", "pcm_16000"]) == "pcm_16000"
+    assert negotiate([]) == "mp3_44100_128"
+    # Framed formats need binary frames
+    assert negotiate(["opus_48000_32", "pcm_16000"], binary=False) == "mp3_44100_128"
+
+
+def test_a_json_client_of_a_framed_backend_gets_a_whole_format():
+    formats = Delivery()
+
+    def negotiate(supported, default):
+        return formats.link(["opus_48000_32"], set(supported).__contains__, default, binary=False).output_format
+
+    assert negotiate({"pcm_16000", "wav_16000", "mp3_44100_128"}, "pcm_16000") == "wav_16000"
+    assert negotiate({"opus_48000_32", "mp3_44100_128"}, "opus_48000_32") == "mp3_44100_128"
+    # Nothing whole to fall back to
+    assert negotiate({"pcm_16000"}, "pcm_16000") == "pcm_16000"
+
+
+async def split(audio: bytes, size: int):
+    for offset in range(0, len(audio), size):
+        yield audio[offset:offset + size]
+
+
+def frame_sizes(link, audio: bytes):
+    async def run():
+        return [len(frame) async for frame in link.framer().frames(split(audio, 1000))]
+    return asyncio.run(run())
+
+
+def test_pcm_frames_start_small_and_double_up_to_the_maximum():
+    link = Delivery(min_ms=60, max_ms=1000).link(["pcm_16000"], ELEVENLABS.__contains__, "mp3_44100_128", True)
+    # 2 s of 16 kHz audio, 32000 bytes a second: 60 ms is 1920 bytes, 1 s is 32000
+    assert frame_sizes(link, bytes(64000)) == [1920, 3840, 7680, 15360, 30720, 4480]
+
+
+def test_a_slow_link_keeps_getting_small_frames(monkeypatch):
+    link = Delivery(min_ms=60, max_ms=1000, send_ms=100).link(["pcm_16000"], ELEVENLABS.__contains__,
+                                                              "mp3_44100_128", True)
+    # Two frames sent back to back, acknowledged half a second apart: 2000 bytes a second
+    link.sent(1, 0, 1000, 0.0)
+    link.sent(1, 1, 1000, 0.0)
+    clock = iter([1.0, 1.5])
+    monkeypatch.setattr(delivery.time, "perf_counter", lambda: next(clock))
+    link.acked(1, 0)
+    link.acked(1, 1)
+    assert link.throughput == 2000
+    assert frame_sizes(link, bytes(9600)) == [1920] * 5
+
+
+def ogg_page(packets, first: bool = False) -> bytes:
+    lacing = b"".join(bytes([255] * (len(packet) // 255) + [len(packet) % 255]) for packet in packets)
+    header = b"OggS" + bytes([0, 0x02 if first else 0]) + struct.pack("<qIII", 0, 1, 0, 0) + bytes([len(lacing)])
+    return header + lacing + b"".join(packets)
+
+
+def test_opus_packets_are_taken_out_of_the_ogg_stream_in_whatever_pieces_it_comes():
+    packets = [b"a" * 100, b"b" * 300, b"c" * 20]
+    stream = ogg_page([b"OpusHead" + bytes(11)], first=True) + ogg_page([b"OpusTags" + bytes(8)]) + ogg_page(packets)
+    demuxer = OggOpusDemuxer()
+    demuxed = []
+    for offset in range(0, len(stream), 7):
+        demuxed += demuxer.feed(stream[offset:offset + 7])
+    assert demuxed == packets
+
+
+def test_a_binary_client_gets_its_reply_as_pcm_frames(client):
+    with client.websocket_connect(f"/ws?protocol={PROTOCOL_VERSION}&formats=opus_48000_32,pcm_16000") as ws:
+        ws.send_json({"type": "text", "message": "Hello?", "session_id": "test-delivery", "stream": True})
+        frames, messages = [], []
+        while (message := ws.receive()).get("text") is None or json.loads(message["text"])["type"] != "tts_end":
+            if message.get("bytes") is not None:
+                frames.append(unpack_frame(message["bytes"]))
+            else:
+                messages.append(json.loads(message["text"]))
+    # The stub TTS backend has no Opus
+    turn_start = next(m for m in messages if m["type"] == "turn_start")
+    assert turn_start["format"] == "pcm_16000" and turn_start["media_type"] == "audio/pcm"
+    assert frames and all(frame.type == FRAME_TTS_CHUNK for frame in frames)
+    assert len(frames[0].payload) == 1920
+    assert all(len(frame.payload) % 2 == 0 for frame in frames)
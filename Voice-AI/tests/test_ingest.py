@@ -0,0 +1,160 @@
+"""Uploads: spooled by /api/upload, ingested by a job that may run more than once (see ingest.py)."""
+import os
+import uuid
+
+import pytest
+
+import main
+from admission import VendorError
+
+FILES = [("a.txt", b"The first document is about latency. " * 50),
+         ("b.txt", b"The second document is about bandwidth. " * 50)]
+
+
+def upload(client, session_id: str, files=FILES) -> str:
+    response = client.post("/api/upload", data={"session_id": session_id},
+                           files=[("files", (name, content, "text/plain")) for name, content in files])
+    assert response.status_code == 202
+    return response.json()["job_id"]
+
+
+def test_a_finished_job_is_reported_to_the_session(client):
+    session_id = uuid.uuid4().hex
+    with client.websocket_connect(f"/ws?session_id={session_id}") as ws:
+        job_id = upload(client, session_id, FILES[:1])
+        assert client.get(f"/api/jobs/{job_id}").json()["status"] == "queued"
+        client.portal.call(main.job_queue._run, job_id)
+        while (message := ws.receive_json())["type"] != "job":
+            pass
+    assert message["job_id"] == job_id and message["status"] == "completed"
+    assert [item["status"] for item in message["result"]["files"]] == ["uploaded"]
+    state = client.portal.call(main.sessions.load, session_id)
+    assert list(state.files.values()) == ["a.txt"]
+
+
+def test_the_same_file_again_is_skipped(client):
+    session_id = uuid.uuid4().hex
+    for expected in ("uploaded", "skipped"):
+        job_id = upload(client, session_id, FILES[:1])
+        client.portal.call(main.job_queue._run, job_id)
+        job = client.get(f"/api/jobs/{job_id}").json()
+        assert [item["status"] for item in job["result"]["files"]] == [expected]
+
+
+def test_upload_is_spooled_until_its_job_has_run(client):
+    job_id = upload(client, uuid.uuid4().hex)
+
+    async def run_job():
+        job = await main.job_queue.get(job_id)
+        items = [main.IngestFile(**item) for item in job.payload["files"]]
+        spooled = []
+        for item in items:
+            with main.upload_spool.open(item) as file:
+                spooled.append(file.read())
+        result = await main.run_ingest_job(job)
+        await main.report_job(job)
+        return items, spooled, result
+
+    items, spooled, result = client.portal.call(run_job)
+    assert spooled == [content for _, content in FILES]
+    assert [item["status"] for item in result["files"]] == ["uploaded", "uploaded"]
+    assert not any(os.path.exists(main.upload_spool.path(item.key)) for item in items)
+
+
+def test_uploads_over_the_limit_are_refused(client, monkeypatch):
+    monkeypatch.setattr(main.upload_spool, "max_bytes", 1000)
+    spooled = set(os.listdir(main.upload_spool.directory))
+    response = client.post("/api/upload", data={"session_id": uuid.uuid4().hex},
+                           files=[("files", (name, content, "text/plain")) for name, content in FILES])
+    assert response.status_code == 413
+    assert set(os.listdir(main.upload_spool.directory)) == spooled
+
+
+def test_a_retried_job_does_not_upload_its_files_again(client, monkeypatch):
+    session_id = uuid.uuid4().hex
+    job_id = upload(client, session_id)
+    ingestion = main.get_ingestion()
+    added = []
+    add_file, attach = ingestion.store.add_file, ingestion.attach
+
+    async def counting_add_file(session_id, file_id, filename, file):
+        added.append(filename)
+        return await add_file(session_id, file_id, filename, file)
+
+    async def failing_attach(*args):
+        # The job dies after uploading, before the files are in the session
+        monkeypatch.setattr(ingestion, "attach", attach)
+        raise RuntimeError("crashed")
+
+    monkeypatch.setattr(ingestion.store, "add_file", counting_add_file)
+    monkeypatch.setattr(ingestion, "attach", failing_attach)
+
+    async def run_twice():
+        job = await main.job_queue.get(job_id)
+        with pytest.raises(RuntimeError):
+            await main.run_ingest_job(job)
+        result = await main.run_ingest_job(job)
+        state = await main.sessions.load(session_id)
+        return result, state
+
+    result, state = client.portal.call(run_twice)
+    assert sorted(added) == ["a.txt", "b.txt"]
+    assert [item["status"] for item in result["files"]] == ["uploaded", "uploaded"]
+    assert sorted(state.files.values()) == ["a.txt", "b.txt"]
+
+
+def test_a_transient_error_runs_the_job_again(client, monkeypatch):
+    session_id = uuid.uuid4().hex
+    job_id = upload(client, session_id)
+    ingestion = main.get_ingestion()
+    add_file = ingestion.store.add_file
+    calls = []
+
+    async def overloaded_once(session_id, file_id, filename, file):
+        calls.append(filename)
+        if len(calls) == 1:
+            raise VendorError("Too many requests", 429)
+        return await add_file(session_id, file_id, filename, file)
+
+    monkeypatch.setattr(ingestion.store, "add_file", overloaded_once)
+    monkeypatch.setattr(main.job_queue, "retry_initial", 0)
+
+    async def run_until_done():
+        statuses = []
+        for _ in range(2):
+            await main.job_queue._run(job_id)
+            job = await main.job_queue.get(job_id)
+            statuses.append((job.status, os.path.isdir(main.upload_spool.path(job_id))))
+        return statuses, job, await main.sessions.load(session_id)
+
+    statuses, job, state = client.portal.call(run_until_done)
+    # Scheduled again with its spool, then done and the spool gone
+    assert statuses == [("scheduled", True), ("completed", False)]
+    assert [item["status"] for item in job.result["files"]] == ["uploaded", "uploaded"]
+    assert sorted(state.files.values()) == ["a.txt", "b.txt"]
+    assert len(calls) == 3
+
+
+def test_an_oversized_request_is_refused_before_it_is_read(client, monkeypatch):
+    received = []
+
+    async def spool_files(*args):
+        received.append(args)
+
+    monkeypatch.setattr(main.get_ingestion(), "spool_files", spool_files)
+    os.makedirs(main.upload_spool.directory, exist_ok=True)
+    spooled = set(os.listdir(main.upload_spool.directory))
+    too_large = b"x" * (main.UPLOAD_MAX_REQUEST_BYTES + 1)
+    response = client.post("/api/upload", data={"session_id": uuid.uuid4().hex},
+                           files=[("files", ("big.txt", too_large, "text/plain"))])
+    assert response.status_code == 413
+
+    # Without a Content-Length, as soon as it has sent too much
+    def chunked():
+        for _ in range(4):
+            yield b"y" * (main.UPLOAD_MAX_REQUEST_BYTES // 2)
+
+    response = client.post("/api/upload", content=chunked(),
+                           headers={"content-type": "multipart/form-data; boundary=x"})
+    assert response.status_code == 413
+    assert not received and set(os.listdir(main.upload_spool.directory)) == spooled
@@ -0,0 +1,186 @@
+"""Background jobs (see jobs.py): retries, RunLater, recovery, Redis failures, and the cleanup job."""
+import asyncio
+import uuid
+
+import fakeredis
+import pytest
+import redis.asyncio
+
+import main
+from jobs import Job, JobQueue, RunLater
+from session_store import SessionResources
+
+
+def queue(**kwargs) -> JobQueue:
+    return JobQueue(fakeredis.FakeAsyncRedis(decode_responses=True), poll=0.05, **kwargs)
+
+
+async def finished(jobs: JobQueue, job_id: str):
+    for _ in range(100):
+        job = await jobs.get(job_id)
+        if job.status in ("completed", "failed"):
+            return job
+        await asyncio.sleep(0.05)
+    raise AssertionError(f"job {job_id} is still {job.status}")
+
+
+def test_a_job_runs_and_is_reported_once_it_finishes():
+    async def run():
+        jobs, reported = queue(), []
+
+        async def handler(job):
+            return {"echo": job.payload["text"]}
+
+        async def on_finished(job):
+            reported.append((job.id, job.status))
+
+        jobs.handle("echo", handler)
+        jobs.on_finished = on_finished
+        job_id = await jobs.enqueue("echo", {"text": "hello"}, session_id="s")
+        jobs.start(1)
+        job = await finished(jobs, job_id)
+        await jobs.stop()
+        return job_id, job, reported
+
+    job_id, job, reported = asyncio.run(run())
+    assert job.status == "completed" and job.result == {"echo": "hello"} and job.session_id == "s"
+    assert reported == [(job_id, "completed")]
+
+
+def test_a_failing_job_is_retried_then_given_up():
+    async def run():
+        jobs, runs = queue(max_attempts=3, retry_initial=0.01), []
+
+        async def handler(job):
+            runs.append(job.attempts)
+            raise ConnectionError("vendor down")
+
+        jobs.handle("flaky", handler)
+        job_id = await jobs.enqueue("flaky", {})
+        jobs.start(1)
+        job = await finished(jobs, job_id)
+        await jobs.stop()
+        return job, runs, jobs
+
+    job, runs, jobs = asyncio.run(run())
+    assert job.status == "failed" and job.attempts == 3 and job.error == "ConnectionError: vendor down"
+    assert runs == [0, 1, 2] and jobs.retried == 2 and jobs.failed == 1
+
+
+def test_run_later_runs_the_job_again_without_counting_a_failure():
+    async def run():
+        jobs = queue()
+
+        async def handler(job):
+            polls = job.payload["polls"] + 1
+            if polls < 3:
+                raise RunLater(0.01, {"polls": polls})
+            return {"polls": polls}
+
+        jobs.handle("poll", handler)
+        job_id = await jobs.enqueue("poll", {"polls": 0})
+        jobs.start(1)
+        job = await finished(jobs, job_id)
+        await jobs.stop()
+        return job, jobs
+
+    job, jobs = asyncio.run(run())
+    assert job.status == "completed" and job.result == {"polls": 3} and job.attempts == 0
+    assert jobs.rescheduled == 2
+
+
+def test_the_jobs_of_a_consumer_that_stopped_beating_go_back_to_the_queue():
+    async def run():
+        jobs = queue()
+        job_id = await jobs.enqueue("echo", {})
+        # A consumer took the job, then its process died: its heartbeat key is gone
+        await jobs.redis.lmove(jobs.key("queue"), jobs.key("running:dead"), "RIGHT", "LEFT")
+        await jobs.redis.sadd(jobs.key("consumers"), "dead")
+        recovered = await jobs.recover()
+        return job_id, recovered, await jobs.redis.lrange(jobs.key("queue"), 0, -1), \
+            await jobs.redis.smembers(jobs.key("consumers"))
+
+    job_id, recovered, queued, consumers = asyncio.run(run())
+    assert recovered == 1 and queued == [job_id] and consumers == set()
+
+
+def test_a_job_whose_run_fails_on_redis_goes_back_to_the_queue():
+    async def run():
+        client = fakeredis.FakeAsyncRedis(decode_responses=True)
+        queue = JobQueue(client, poll=0.05)
+        runs = []
+        finish = queue._finish
+
+        async def handler(job):
+            runs.append(job.id)
+            return {"run": len(runs)}
+
+        async def failing_finish(*args):
+            # Redis goes away once, after the handler has run
+            queue._finish = finish
+            raise redis.exceptions.ConnectionError("Connection reset by peer")
+
+        queue.handle("test", handler)
+        queue._finish = failing_finish
+        job_id = await queue.enqueue("test", {})
+        queue.start(1)
+        for _ in range(100):
+            job = await queue.get(job_id)
+            if job.status == "completed":
+                break
+            await asyncio.sleep(0.05)
+        running = dict(queue.running)
+        await queue.stop()
+        return job, runs, running, await client.keys("jobs:running:*")
+
+    job, runs, running, running_lists = asyncio.run(run())
+    assert job.status == "completed" and job.result == {"run": 2}
+    assert len(runs) == 2
+    assert running == {} and running_lists == []
+
+
+def test_sessions_whose_cleanup_fails_do_not_hold_up_the_others(client, monkeypatch):
+    ingestion = main.get_ingestion()
+    run = uuid.uuid4().hex
+    bad = [f"bad-{run}-{n}" for n in range(120)]
+    good = f"good-{run}"
+    delete_resources = ingestion.delete_resources
+
+    async def failing_delete_resources(session_id, resources):
+        if session_id.startswith("bad-"):
+            raise RuntimeError("vendor is down")
+        return await delete_resources(session_id, resources)
+
+    monkeypatch.setattr(main, "CLEANUP_GRACE", 0)
+    monkeypatch.setattr(ingestion, "delete_resources", failing_delete_resources)
+
+    async def clean_up():
+        for session_id in bad + [good]:
+            await main.sessions.add_resources(session_id, SessionResources(local=True))
+        results = []
+        for _ in range(2):
+            with pytest.raises(RunLater) as later:
+                await main.run_cleanup_job(Job("cleanup", {"kind": "cleanup"}))
+            results.append(later.value.result)
+        return results, await main.redis_client.exists(main.sessions.resources_key(good)), \
+            await main.redis_client.hget(main.sessions.resources_key(bad[0]), "retry_after")
+
+    results, good_left, retry_after = client.portal.call(clean_up)
+    assert sum(result["errors"] for result in results) == len(bad)
+    assert sum(result["sessions"] for result in results) >= 1
+    assert not good_left and retry_after
+
+
+def test_the_cleanup_job_runs_again_when_redis_fails(client, monkeypatch):
+    async def failing_expired_resources(min_age):
+        raise redis.exceptions.ConnectionError("Connection refused")
+
+    monkeypatch.setattr(main.sessions, "expired_resources", failing_expired_resources)
+
+    async def clean_up():
+        with pytest.raises(RunLater) as later:
+            await main.run_cleanup_job(Job("cleanup", {"kind": "cleanup"}))
+        return later.value
+
+    later = client.portal.call(clean_up)
+    assert later.delay == main.CLEANUP_INTERVAL and later.result["errors"] == 1
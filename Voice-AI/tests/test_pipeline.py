@@ -0,0 +1,63 @@
+"""The whole pipeline on the stub providers (see providers.py): upload a document, ask by voice, hear the reply."""
+import io
+import json
+import uuid
+import wave
+
+import numpy as np
+
+import main
+from protocol import FLAG_STREAM, FRAME_AUDIO, FRAME_TTS_CHUNK, PROTOCOL_VERSION, pack_frame, unpack_frame
+
+DOCUMENT = (b"Latency is the time between the end of a question and the first audio of its answer. "
+            b"Each stage of the pipeline adds to it.")
+
+
+def recording(seconds: float = 0.8, rate: int = 16000) -> bytes:
+    """A WAV of something speech-like between two silences, so it is not refused as speechless."""
+    t = np.arange(int(seconds * rate)) / rate
+    voice = 0.2 * sum(np.sin(2 * np.pi * 150 * n * t) / n for n in range(1, 6))
+    samples = np.concatenate([np.zeros(rate // 2), voice, np.zeros(rate // 2)])
+    out = io.BytesIO()
+    with wave.open(out, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes((samples * 32767).astype("<i2").tobytes())
+    return out.getvalue()
+
+
+def test_upload_then_ask_by_voice(client):
+    session_id = uuid.uuid4().hex
+    response = client.post("/api/upload", data={"session_id": session_id},
+                           files=[("files", ("latency.txt", DOCUMENT, "text/plain"))])
+    assert response.status_code == 202
+    job_id = response.json()["job_id"]
+    client.portal.call(main.job_queue._run, job_id)
+    job = client.get(f"/api/jobs/{job_id}").json()
+    assert [item["status"] for item in job["result"]["files"]] == ["uploaded"]
+
+    with client.websocket_connect(f"/ws?protocol={PROTOCOL_VERSION}") as ws:
+        ws.send_bytes(pack_frame(FRAME_AUDIO, recording(), session_id=session_id, flags=FLAG_STREAM))
+        messages, frames = [], []
+        while True:
+            message = ws.receive()
+            if message.get("bytes") is not None:
+                frames.append(unpack_frame(message["bytes"]))
+                continue
+            messages.append(json.loads(message["text"]))
+            if messages[-1]["type"] in ("tts_end", "error", "no_speech"):
+                break
+
+    by_type = {message["type"]: message for message in messages}
+    assert by_type["transcription"]["text"] == "What do the documents say?"
+    # The stub LLM answers with the start of the passage it was given
+    reply = by_type["llm_response"]["text"]
+    assert reply and reply in DOCUMENT.decode()
+    assert "".join(message["text"] for message in messages if message["type"] == "llm_delta") == reply
+    assert by_type["tts_end"]["segments"] == len(frames) > 0
+    assert [frame.seq for frame in frames] == list(range(len(frames)))
+    for frame in frames:
+        assert frame.type == FRAME_TTS_CHUNK and frame.session_id == session_id
+        with wave.open(io.BytesIO(bytes(frame.payload))) as wav:
+            assert wav.getframerate() == 16000 and wav.getnframes() > 0
@@ -0,0 +1,147 @@
+"""Local retrieval (see retrieval.py): what a search finds, and where a session's documents are kept."""
+import asyncio
+import io
+import os
+import threading
+
+import pytest
+
+from retrieval import ChunkSplitter, DocumentStore, HashingEmbedder, SessionIndex, split_chunks
+
+
+@pytest.fixture
+def store(tmp_path):
+    return DocumentStore(str(tmp_path / "documents"), HashingEmbedder(64))
+
+
+def test_a_question_finds_the_document_about_it(store):
+    async def add_and_search():
+        await store.add("s", "local_1", "latency.txt", b"Latency is the delay before the first audio is heard.")
+        await store.add("s", "local_2", "bandwidth.txt", b"Bandwidth is how many bytes a link carries per second.")
+        await store.add("s", "local_3", "jitter.txt", b"Jitter is how much the packet delay varies.")
+        return await store.search("s", "How many bytes per second does a link carry?", k=2)
+
+    passages = asyncio.run(add_and_search())
+    assert passages[0].filename == "bandwidth.txt" and len(passages) == 2
+
+
+def test_a_removed_document_is_not_searched(store):
+    async def add_remove_and_search():
+        await store.add("s", "local_1", "a.txt", b"The first document is about latency.")
+        await store.add("s", "local_2", "b.txt", b"The second document is about latency too.")
+        await store.remove("s", "local_1")
+        return await store.search("s", "latency"), await store.search("other", "latency")
+
+    passages, other_session = asyncio.run(add_remove_and_search())
+    assert [passage.filename for passage in passages] == ["b.txt"]
+    assert other_session == []
+
+
+def test_the_ivf_index_finds_what_a_full_scan_finds(tmp_path):
+    store = DocumentStore(str(tmp_path / "documents"), HashingEmbedder(256), ivf_min_rows=300)
+    topics = [f"topic{n} keyword{n % 7} subject{n % 11}" for n in range(400)]
+
+    async def add_and_search():
+        for n, topic in enumerate(topics):
+            await store.add("s", f"local_{n}", f"{n}.txt", topic.encode())
+        results = {}
+        for n in range(0, 400, 37):
+            question = f"topic{n} keyword{n % 7}"
+            ivf = await store.search("s", question, k=1)
+            full = await store.search("s", question, k=1, nprobe=0)
+            results[f"{n}.txt"] = (ivf[0].filename, full[0].filename)
+        return results
+
+    results = asyncio.run(add_and_search())
+    assert store.ivf_builds == 1
+    assert all(ivf == full == expected for expected, (ivf, full) in results.items())
+
+
+@pytest.mark.parametrize("session_id", ["", ".", "..", "...", ".hidden", "../data", "a/../..", "x" * 200])
+def test_session_dir_stays_below_the_root(store, session_id):
+    path = store.session_dir(session_id)
+    assert os.path.dirname(os.path.abspath(path)) == os.path.abspath(store.root)
+    assert os.path.basename(path) not in ("", ".", "..")
+
+
+def test_plain_session_ids_name_their_directory(store):
+    assert store.session_dir("abc-123_x.y") == os.path.join(store.root, "abc-123_x.y")
+    assert store.session_dir("a/b") != store.session_dir("a_b")
+
+
+def test_dropping_a_session_keeps_the_others(store):
+    async def add_and_drop():
+        await store.add("kept", "local_1", "a.txt", b"Documents that must survive.")
+        await store.add("..", "local_2", "b.txt", b"Documents of a session with a bad id.")
+        await store.drop("..")
+        return await store.search("kept", "survive")
+
+    passages = asyncio.run(add_and_drop())
+    assert passages and os.path.isdir(store.session_dir("kept"))
+
+
+def test_rows_of_a_document_still_being_appended_are_not_searched(store):
+    async def add_and_search():
+        await store.add("s", "local_1", "a.txt", b"The first document is about latency.")
+        await store.add("s", "local_2", "b.txt", b"The second document is about bandwidth.")
+        # What a reader sees between the second append's rows and its documents.json
+        index = store.index("s")
+        meta = index._read_meta()
+        meta["documents"].pop()
+        index._write_meta(meta)
+        return await store.search("s", "bandwidth")
+
+    passages = asyncio.run(add_and_search())
+    assert [passage.filename for passage in passages] == ["a.txt"]
+
+
+def test_text_fed_in_pieces_is_chunked_like_the_whole_text():
+    text = "Latency adds up across every stage of the pipeline.\n\n" * 40
+    splitter = ChunkSplitter(120, 30)
+    chunks = []
+    for start in range(0, len(text), 7):
+        chunks += splitter.feed(text[start:start + 7])
+    assert chunks + splitter.flush() == split_chunks(text, 120, 30)
+
+
+def test_a_large_document_is_indexed_in_batches(tmp_path):
+    store = DocumentStore(str(tmp_path / "documents"), HashingEmbedder(64), chunk_chars=200, overlap_chars=20,
+                          batch_chunks=4, read_bytes=100)
+    text = "Filler about nothing in particular. " * 200 + "The answer is bandwidth."
+
+    async def add_and_search():
+        chunks = await store.add_file("s", "local_1", "big.txt", io.BytesIO(text.encode()))
+        return chunks, await store.search("s", "answer bandwidth", k=1)
+
+    chunks, passages = asyncio.run(add_and_search())
+    assert chunks == len(split_chunks(text, 200, 20)) > 4
+    assert "bandwidth" in passages[0].text
+
+
+def test_a_document_is_hidden_until_all_of_it_is_indexed(store):
+    index = store.index("s")
+    vectors = store.embedder.embed_sync(["The document is about latency."])
+    document = index.add_document("local_1", "a.txt", store.embedder.name, vectors.shape[1])
+    index.append(document, ["The document is about latency."], vectors, store.embedder.lexical)
+
+    assert asyncio.run(store.search("s", "latency")) == []
+    index.finish_document(document)
+    assert [passage.filename for passage in asyncio.run(store.search("s", "latency"))] == ["a.txt"]
+
+
+def test_a_search_reads_the_index_off_the_event_loop(store, monkeypatch):
+    threads = []
+    refresh = SessionIndex.refresh
+
+    def recording_refresh(index):
+        threads.append(threading.get_ident())
+        refresh(index)
+
+    monkeypatch.setattr(SessionIndex, "refresh", recording_refresh)
+
+    async def add_and_search():
+        await store.add("small", "local_1", "a.txt", b"A small index, searched often.")
+        return await store.search("small", "small index"), threading.get_ident()
+
+    passages, loop_thread = asyncio.run(add_and_search())
+    assert passages and threads and loop_thread not in threads
@@ -0,0 +1,77 @@
+"""Session events across workers (see session_bus.py), with two buses on one fakeredis server."""
+import asyncio
+
+import fakeredis
+
+from session_bus import SessionBus
+
+
+class Worker:
+    """A bus and the events its own sockets got."""
+
+    def __init__(self, server: fakeredis.FakeServer):
+        self.delivered = []
+        self.bus = SessionBus(fakeredis.FakeAsyncRedis(server=server, decode_responses=True), self.deliver)
+
+    async def deliver(self, session_id: str, payload: dict) -> int:
+        self.delivered.append((session_id, payload))
+        return 1
+
+
+async def until(condition, timeout: float = 2.0):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("timed out")
+
+
+def test_an_event_reaches_the_socket_on_another_worker():
+    async def run():
+        server = fakeredis.FakeServer()
+        a, b = Worker(server), Worker(server)
+        await a.bus.start()
+        await b.bus.start()
+        try:
+            await a.bus.register("s", "connection-a")
+            reached = await b.bus.publish("s", {"type": "upload_progress"})
+            await until(lambda: a.delivered)
+            connections = await b.bus.connections("s")
+            await a.bus.unregister("s", "connection-a")
+            unreached = await b.bus.publish("s", {"type": "upload_progress"})
+            await asyncio.sleep(0.1)
+        finally:
+            await a.bus.stop()
+            await b.bus.stop()
+        return reached, unreached, connections, a, b
+
+    reached, unreached, connections, a, b = asyncio.run(run())
+    assert (reached, unreached) == (1, 0)
+    assert a.delivered == [("s", {"type": "upload_progress"})] and b.delivered == []
+    assert connections == {"connection-a": a.bus.worker_id}
+
+
+def test_a_worker_delivers_its_own_events_once():
+    async def run():
+        server = fakeredis.FakeServer()
+        a, b = Worker(server), Worker(server)
+        await a.bus.start()
+        await b.bus.start()
+        try:
+            await a.bus.register("s", "connection-a")
+            await b.bus.register("s", "connection-b")
+            reached = await a.bus.publish("s", {"type": "job_done"})
+            await until(lambda: b.delivered)
+            await asyncio.sleep(0.1)
+            workers = await a.bus.workers()
+        finally:
+            await a.bus.stop()
+            await b.bus.stop()
+        return reached, workers, a, b, await a.bus.redis.keys("ws:*")
+
+    reached, workers, a, b, keys = asyncio.run(run())
+    assert reached == 2
+    assert a.delivered == b.delivered == [("s", {"type": "job_done"})]
+    assert sorted(worker["worker_id"] for worker in workers) == sorted([a.bus.worker_id, b.bus.worker_id])
+    # Stopped workers leave nothing behind
+    assert keys == []
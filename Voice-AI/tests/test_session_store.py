@@ -0,0 +1,44 @@
+"""Session state in one Redis hash (see session_store.py)."""
+import asyncio
+
+import fakeredis
+
+from session_store import SessionStore
+
+
+def test_a_session_is_one_hash_that_expires_as_a_unit():
+    async def run():
+        store = SessionStore(fakeredis.FakeAsyncRedis(decode_responses=True), ttl=60)
+        await store.add_files("s", [("file-a", "a.txt", "hash-a"), ("file-b", "b.txt", "hash-b")])
+        await store.remove_file("s", "file-b", "hash-b")
+        await store.redis.expire(store.key("s"), 5)
+        state = await store.load("s")
+        return state, await store.redis.keys("*"), await store.redis.ttl(store.key("s"))
+
+    state, keys, ttl = asyncio.run(run())
+    assert state.files == {"file-a": "a.txt"} and state.file_hashes == {"hash-a": "file-a"}
+    assert keys == ["session:s"]
+    # Loading the session refreshed its TTL
+    assert 5 < ttl <= 60
+
+
+def test_the_first_vector_store_claimed_wins():
+    async def run():
+        store = SessionStore(fakeredis.FakeAsyncRedis(decode_responses=True))
+        claims = await asyncio.gather(store.claim_vector_store("s", "vs-1"), store.claim_vector_store("s", "vs-2"))
+        return claims, await store.vector_store_id("s")
+
+    claims, vector_store_id = asyncio.run(run())
+    assert claims == ["vs-1", "vs-1"] and vector_store_id == "vs-1"
+
+
+def test_uploads_already_in_the_session_are_found_by_content():
+    async def run():
+        store = SessionStore(fakeredis.FakeAsyncRedis(decode_responses=True))
+        await store.claim_vector_store("s", "vs-1")
+        await store.add_files("s", [("file-a", "a.txt", "hash-a")])
+        return await store.find_files("s", ["hash-b", "hash-a"]), await store.find_files("new", ["hash-a"])
+
+    found, new = asyncio.run(run())
+    assert found == ("vs-1", [None, "file-a"])
+    assert new == (None, [None])
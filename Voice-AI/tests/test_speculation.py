@@ -0,0 +1,62 @@
+"""Speculative replies (see speculation.py): started on a stable partial transcript, kept or thrown away."""
+import asyncio
+
+from speculation import Speculation
+
+
+def starter(started: list, delay: float = 0.01):
+    async def start(text, complete):
+        started.append(text)
+        for word in ("It is ", "ten ", "o'clock."):
+            await asyncio.sleep(delay)
+            yield word
+        await complete("It is ten o'clock.")
+    return start
+
+
+def test_a_matching_final_transcript_takes_over_the_reply():
+    async def run():
+        speculation, started = Speculation(window=0.05), []
+        speculator = speculation.speculator(starter(started))
+        speculator.observe("what time is")
+        speculator.observe("what time is it")
+        await asyncio.sleep(0.1)
+        speculator.end_of_speech()
+        reply = speculator.take("What time is it?")
+        return started, "".join([delta async for delta in reply.replay()]), reply.answer, speculation.stats
+
+    started, text, answer, stats = asyncio.run(run())
+    # The first partial changed before the window was up
+    assert started == ["what time is it"]
+    assert text == answer == "It is ten o'clock."
+    assert stats.started == 1 and stats.hits == 1 and stats.wasted_requests == 0
+
+
+def test_a_different_final_transcript_cancels_the_reply():
+    async def run():
+        speculation, started = Speculation(window=0.05), []
+        # Still generating when the final transcript comes in
+        speculator = speculation.speculator(starter(started, delay=1))
+        speculator.observe("what time is it")
+        await asyncio.sleep(0.1)
+        reply = speculator.reply
+        speculator.end_of_speech()
+        taken = speculator.take("What time is it in Tokyo?")
+        await asyncio.sleep(0)
+        return taken, reply, speculation.stats
+
+    taken, reply, stats = asyncio.run(run())
+    assert taken is None and reply.task.cancelled()
+    assert stats.misses == 1 and stats.wasted_requests == 1 and stats.hits == 0
+
+
+def test_short_transcripts_are_not_speculated_on():
+    async def run():
+        speculation, started = Speculation(window=0.01, min_words=3), []
+        speculator = speculation.speculator(starter(started))
+        speculator.observe("what time", is_final=True)
+        await asyncio.sleep(0.05)
+        return started, speculator.take("what time"), speculation.stats
+
+    started, taken, stats = asyncio.run(run())
+    assert started == [] and taken is None and stats.no_speculation == 1
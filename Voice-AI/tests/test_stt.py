@@ -0,0 +1,148 @@
+"""Streaming STT (see stt.py) against a local fake of AssemblyAI's Universal Streaming server."""
+import asyncio
+import io
+import json
+import wave
+
+import fakeredis
+import pytest
+import websockets
+
+from admission import Busy, GateSettings, RateLimiter, VendorGate
+from stt import AssemblyAIStream, STTBackend
+
+
+class FakeStreamingServer:
+    """Answers every audio chunk with the next of `turns`; Terminate gets a Termination, unless `terminate` is off."""
+
+    def __init__(self, turns, terminate: bool = True):
+        self.turns = list(turns)
+        self.terminate = terminate
+        self.audio = []
+        self.closed = asyncio.Event()
+
+    async def handle(self, ws):
+        try:
+            async for message in ws:
+                if isinstance(message, bytes):
+                    self.audio.append(message)
+                    if self.turns:
+                        await ws.send(json.dumps({"type": "Turn", **self.turns.pop(0)}))
+                elif json.loads(message)["type"] == "Terminate" and self.terminate:
+                    await ws.send(json.dumps({"type": "Termination"}))
+        finally:
+            self.closed.set()
+
+    async def __aenter__(self):
+        self.server = await websockets.serve(self.handle, "127.0.0.1", 0)
+        port = self.server.sockets[0].getsockname()[1]
+        self.url = f"ws://127.0.0.1:{port}/v3/ws"
+        return self
+
+    async def __aexit__(self, *exc):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+def partial(text: str) -> dict:
+    return {"transcript": text, "end_of_turn": False}
+
+
+def final(text: str) -> dict:
+    return {"transcript": text, "end_of_turn": True, "turn_is_formatted": True}
+
+
+async def stream_audio(server, chunks: int, **kwargs):
+    transcripts = []
+
+    async def on_transcript(text, is_final):
+        transcripts.append((text, is_final))
+
+    stream = AssemblyAIStream(server.url, "key", 16000, on_transcript, **kwargs)
+    await stream.start()
+    for _ in range(chunks):
+        await stream.send_audio(b"\x00\x00" * 160)
+    return stream, transcripts
+
+
+def test_partial_and_final_transcripts():
+    async def run():
+        turns = [partial("what"), partial("what is"), final("What is it?"), partial("and")]
+        async with FakeStreamingServer(turns) as server:
+            stream, transcripts = await stream_audio(server, 4)
+            text = await stream.finish()
+            return text, transcripts, len(server.audio)
+
+    text, transcripts, chunks = asyncio.run(run())
+    assert text == "What is it? and"
+    assert transcripts == [("what", False), ("what is", False), ("What is it?", True), ("What is it? and", False)]
+    assert chunks == 4
+
+
+def test_finish_keeps_the_partial_transcript_when_the_stream_does_not_terminate():
+    async def run():
+        async with FakeStreamingServer([final("First part."), partial("and the")], terminate=False) as server:
+            stream, _ = await stream_audio(server, 2, finish_timeout=0.2)
+            started = asyncio.get_running_loop().time()
+            text = await stream.finish()
+            return text, asyncio.get_running_loop().time() - started
+
+    text, elapsed = asyncio.run(run())
+    assert text == "First part. and the"
+    assert elapsed < 1
+
+
+def test_closing_a_stream_stops_reading_and_disconnects():
+    async def run():
+        async with FakeStreamingServer([partial("what")]) as server:
+            stream, _ = await stream_audio(server, 1)
+            await stream.close()
+            await asyncio.wait_for(server.closed.wait(), 1)
+            return stream.reader
+
+    reader = asyncio.run(run())
+    assert reader.done()
+
+
+class RecordingBackend(STTBackend):
+    async def transcribe(self, audio_bytes):
+        with wave.open(io.BytesIO(audio_bytes)) as wav:
+            self.received = (wav.getframerate(), wav.readframes(wav.getnframes()))
+        return "Transcribed."
+
+
+def test_a_backend_without_streaming_transcribes_the_buffered_audio_on_finish():
+    async def run():
+        backend = RecordingBackend()
+        transcripts = []
+
+        async def on_transcript(text, is_final):
+            transcripts.append((text, is_final))
+
+        stream = backend.open_stream(16000, on_transcript)
+        await stream.start()
+        for n in range(3):
+            await stream.send_audio(bytes([n, 0]) * 160)
+        return await stream.finish(), transcripts, backend.received
+
+    text, transcripts, (rate, pcm) = asyncio.run(run())
+    assert text == "Transcribed." and transcripts == [("Transcribed.", True)]
+    assert rate == 16000 and pcm == b"".join(bytes([n, 0]) * 160 for n in range(3))
+
+
+def test_a_stream_holds_a_gate_slot_until_it_is_closed():
+    async def run():
+        gate = VendorGate("assemblyai", "stt", GateSettings(max_concurrency=1, max_queue=0),
+                          RateLimiter(fakeredis.FakeAsyncRedis(decode_responses=True)))
+        async with FakeStreamingServer([final("Hello.")]) as server:
+            stream, _ = await stream_audio(server, 1, gate=gate)
+            with pytest.raises(Busy):
+                await stream_audio(server, 0, gate=gate)
+            text = await stream.finish()
+            second, _ = await stream_audio(server, 0, gate=gate)
+            await second.close()
+            return text, gate
+
+    text, gate = asyncio.run(run())
+    assert text == "Hello."
+    assert gate.admitted == 2 and gate.rejected["queue_full"] == 1 and gate.in_flight == 0
@@ -0,0 +1,96 @@
+"""The TTS cache (see tts_cache.py): two tiers, keyed by everything that determines the audio."""
+import asyncio
+
+import fakeredis
+import pytest
+
+import tts_cache
+from tts_cache import TTSCache, tts_cache_key
+
+KEY = tts_cache_key("Hello there.", "voice", "model", "mp3_44100_128")
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+def test_a_miss_then_hits_from_memory_and_from_redis(server):
+    async def run():
+        cache = TTSCache(fakeredis.FakeAsyncRedis(server=server))
+        results = [await cache.get(KEY)]
+        await cache.put(KEY, b"audio")
+        results.append(await cache.get(KEY))
+        # Another worker: nothing in its memory yet, but the audio is in Redis
+        other = TTSCache(fakeredis.FakeAsyncRedis(server=server))
+        results += [await other.get(KEY), await other.get(KEY)]
+        return results, cache.stats, other.stats
+
+    results, stats, other = asyncio.run(run())
+    assert results == [None, b"audio", b"audio", b"audio"]
+    assert (stats.misses, stats.memory_hits, stats.stores) == (1, 1, 1)
+    assert (other.redis_hits, other.memory_hits, other.misses) == (1, 1, 0)
+    assert other.bytes_saved == 2 * len(b"audio")
+
+
+def test_the_key_covers_everything_that_changes_the_audio():
+    keys = {
+        KEY,
+        tts_cache_key("Hello there!", "voice", "model", "mp3_44100_128"),
+        tts_cache_key("Hello there.", "other voice", "model", "mp3_44100_128"),
+        tts_cache_key("Hello there.", "voice", "other model", "mp3_44100_128"),
+        tts_cache_key("Hello there.", "voice", "model", "pcm_16000"),
+        # The fields are not simply concatenated
+        tts_cache_key("Hello there.v", "oice", "model", "mp3_44100_128"),
+    }
+    assert len(keys) == 6
+    assert tts_cache_key("Hello there.", "voice", "model", "mp3_44100_128") == KEY
+
+
+def test_entries_expire_after_the_ttl(server, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(tts_cache.time, "monotonic", lambda: now[0])
+
+    async def run():
+        redis_client = fakeredis.FakeAsyncRedis(server=server)
+        cache = TTSCache(None, ttl=60)
+        await cache.put(KEY, b"audio")
+        now[0] += 59
+        fresh = await cache.get(KEY)
+        now[0] += 2
+        expired = await cache.get(KEY)
+        shared = TTSCache(redis_client, ttl=60)
+        await shared.put(KEY, b"audio")
+        return fresh, expired, cache.entries, await redis_client.ttl(shared.prefix + KEY)
+
+    fresh, expired, entries, redis_ttl = asyncio.run(run())
+    assert fresh == b"audio" and expired is None and not entries
+    assert 0 < redis_ttl <= 60
+
+
+def test_the_least_recently_used_audio_is_evicted_first():
+    async def run():
+        cache = TTSCache(None, max_bytes=10, max_item_bytes=5)
+        await cache.put("a", b"aaaa")
+        await cache.put("b", b"bbbb")
+        await cache.get("a")
+        await cache.put("c", b"cccc")
+        await cache.put("too large", b"x" * 6)
+        return [await cache.get(key) for key in ("a", "b", "c", "too large")], cache.size, cache.stats
+
+    audio, size, stats = asyncio.run(run())
+    assert audio == [b"aaaa", None, b"cccc", None]
+    assert size == 8 and stats.evictions == 1
+
+
+def test_without_redis_the_cache_falls_back_to_memory(server):
+    async def run():
+        cache = TTSCache(fakeredis.FakeAsyncRedis(server=server))
+        server.connected = False
+        missed = await cache.get(KEY)
+        await cache.put(KEY, b"audio")
+        return missed, await cache.get(KEY), cache.stats
+
+    missed, audio, stats = asyncio.run(run())
+    assert missed is None and audio == b"audio"
+    assert (stats.misses, stats.memory_hits, stats.redis_hits) == (1, 1, 0)
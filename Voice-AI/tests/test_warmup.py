@@ -0,0 +1,46 @@
+"""Warm startup (see warmup.py): not ready until every warm-up step has finished, failed or not."""
+import asyncio
+import sys
+import time
+
+from warmup import Warmup
+
+
+def test_ready_once_every_step_has_finished():
+    async def run():
+        warmup = Warmup(time.perf_counter())
+        warmup.imports_done()
+        released = asyncio.Event()
+
+        async def redis():
+            await released.wait()
+
+        async def connections():
+            raise ConnectionError("vendor down")
+
+        warmup.start({"redis": redis, "connections": connections})
+        await asyncio.sleep(0.01)
+        before = warmup.report()
+        released.set()
+        await warmup.task
+        return before, warmup.report()
+
+    before, after = asyncio.run(run())
+    # A failed step is reported, and does not hold up readiness
+    assert not before["ready"] and before["pending"] == ["redis"]
+    assert before["steps"]["connections"]["error"] == "ConnectionError: vendor down"
+    assert after["ready"] and after["pending"] == [] and set(after["steps"]) == {"redis", "connections"}
+    assert after["ready_ms"] >= after["import_ms"]
+
+
+def test_the_readiness_probe_and_the_startup_report(client):
+    # WARMUP=0: ready once the backends are built
+    assert client.get("/api/status/ready").json() == {"ready": True, "pending": []}
+    assert client.post("/api/tts", json={"text": "Hello."}).status_code == 200
+    startup = client.get("/api/status/startup").json()
+    assert "providers" in startup["steps"] and startup["ready"]
+    assert startup["first_requests"]["/api/tts"]["status"] == 200
+
+
+def test_stub_providers_import_no_vendor_sdk():
+    assert not {"openai", "elevenlabs", "faster_whisper"} & set(sys.modules)
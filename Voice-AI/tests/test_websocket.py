@@ -0,0 +1,164 @@
+"""/ws: each connection's turns run in their own task, so a slow turn holds up no other connection.
+
+With "stream", the reply is spoken sentence by sentence while it is generated;
+with ?protocol=1, audio travels in binary frames (see protocol.py). Messages
+and frames the server cannot use, and replies that fail, are answered with an
+error; the connection stays up.
+"""
+import asyncio
+import base64
+import json
+
+import pytest
+
+import main
+from llm import StubLLMBackend
+from protocol import FLAG_STREAM, FRAME_AUDIO, FRAME_TTS_CHUNK, HEADER, PROTOCOL_VERSION, pack_frame, unpack_frame
+
+
+def reply_text(ws) -> str:
+    """The text of the reply to a turn, once its audio has come."""
+    while (message := ws.receive_json())["type"] != "tts":
+        if message["type"] == "llm_response":
+            text = message["text"]
+    return text
+
+
+def test_a_slow_turn_does_not_hold_up_other_connections(client, monkeypatch):
+    released = asyncio.Event()
+
+    async def get_llm_response(user_input, session_id):
+        if user_input == "slow":
+            await released.wait()
+        return f"Answer to {user_input}"
+
+    async def text_to_speech(text, output_format=None):
+        return text.encode()
+
+    monkeypatch.setattr(main, "get_llm_response", get_llm_response)
+    monkeypatch.setattr(main, "text_to_speech", text_to_speech)
+    with client.websocket_connect("/ws") as slow, client.websocket_connect("/ws") as fast:
+        slow.send_json({"type": "text", "message": "slow", "session_id": "test-slow"})
+        fast.send_json({"type": "text", "message": "fast", "session_id": "test-fast"})
+        assert reply_text(fast) == "Answer to fast"
+        client.portal.call(released.set)
+        assert reply_text(slow) == "Answer to slow"
+
+
+def test_closing_the_connection_cancels_its_turn(client, monkeypatch):
+    started, cancelled = asyncio.Event(), asyncio.Event()
+
+    async def get_llm_response(user_input, session_id):
+        started.set()
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    monkeypatch.setattr(main, "get_llm_response", get_llm_response)
+    with client.websocket_connect("/ws") as ws:
+        ws.send_json({"type": "text", "message": "Hello?", "session_id": "test-close"})
+        client.portal.call(started.wait)
+    client.portal.call(asyncio.wait_for, cancelled.wait(), 5)
+
+
+REPLY = "The first sentence is here. The second one follows it! And a third?"
+SENTENCES = ["The first sentence is here.", "The second one follows it!", "And a third?"]
+
+
+def speak_reply(monkeypatch):
+    """Vendors that stream REPLY word by word and "synthesize" each text as its own bytes."""
+    async def stream_llm_response(user_input, session_id):
+        for i, word in enumerate(REPLY.split(" ")):
+            yield word if i == 0 else " " + word
+
+    async def text_to_speech_streaming(text, output_format=None):
+        yield text.encode()
+
+    monkeypatch.setattr(main, "stream_llm_response", stream_llm_response)
+    monkeypatch.setattr(main, "text_to_speech_streaming", text_to_speech_streaming)
+
+
+def test_a_streamed_reply_is_spoken_sentence_by_sentence(client, monkeypatch):
+    speak_reply(monkeypatch)
+    with client.websocket_connect("/ws") as ws:
+        ws.send_json({"type": "text", "message": "Hello?", "session_id": "test-stream", "stream": True})
+        messages = []
+        while (message := ws.receive_json())["type"] != "tts_end":
+            messages.append(message)
+    chunks = [m for m in messages if m["type"] == "tts_chunk"]
+    assert [chunk["text"] for chunk in chunks] == SENTENCES
+    assert [base64.b64decode(chunk["audio_data"]) for chunk in chunks] == [chunk["text"].encode() for chunk in chunks]
+    assert "".join(m["text"] for m in messages if m["type"] == "llm_delta") == REPLY
+    assert message["segments"] == 3
+
+
+def test_binary_clients_send_and_get_audio_in_frames(client, monkeypatch):
+    speak_reply(monkeypatch)
+    recordings = []
+
+    async def transcribe_audio(audio_bytes):
+        recordings.append(audio_bytes)
+        return "Hello?"
+
+    monkeypatch.setattr(main, "transcribe_audio", transcribe_audio)
+    with client.websocket_connect(f"/ws?protocol={PROTOCOL_VERSION}") as ws:
+        ws.send_bytes(pack_frame(FRAME_AUDIO, b"recording", session_id="test-frames", flags=FLAG_STREAM))
+        frames = []
+        while (message := ws.receive()).get("text") is None or json.loads(message["text"])["type"] != "tts_end":
+            if message.get("bytes") is not None:
+                frames.append(unpack_frame(message["bytes"]))
+    assert recordings == [b"recording"]
+    assert [(frame.type, frame.seq, frame.session_id) for frame in frames] == \
+        [(FRAME_TTS_CHUNK, seq, "test-frames") for seq in range(3)]
+    assert [bytes(frame.payload).decode() for frame in frames] == SENTENCES
+
+
+@pytest.mark.parametrize("text", ["{not json", "[1, 2]", '"text"', '{"message": "no type"}', '{"type": 1}',
+                                  '{"type": "text", "session_id": 5}'])
+def test_a_bad_message_is_an_error_not_a_disconnect(client, text):
+    with client.websocket_connect("/ws") as ws:
+        ws.send_text(text)
+        error = ws.receive_json()
+        assert error["type"] == "error" and error["error"].startswith("Protocol error")
+        ws.send_json({"type": "text", "message": "Hello?", "session_id": "test-websocket", "stream": True})
+        while (message := ws.receive_json())["type"] != "tts_end":
+            assert message["type"] != "error"
+
+
+def test_a_frame_with_a_bad_session_id_is_an_error_not_a_disconnect(client):
+    frame = HEADER.pack(PROTOCOL_VERSION, FRAME_AUDIO, 0, 2, 0) + b"\xff\xfe" + b"\x00" * 320
+    with client.websocket_connect(f"/ws?protocol={PROTOCOL_VERSION}") as ws:
+        ws.send_bytes(frame)
+        error = ws.receive_json()
+        assert error["type"] == "error" and "UTF-8" in error["error"]
+        ws.send_json({"type": "text", "message": "Hello?", "session_id": "test-websocket", "stream": True})
+        # Audio now comes in binary frames
+        while (message := ws.receive()).get("text") is None or json.loads(message["text"])["type"] != "tts_end":
+            assert message.get("text") is None or json.loads(message["text"])["type"] != "error"
+
+
+class FailingLLMBackend(StubLLMBackend):
+    async def generate(self, prompt):
+        yield "The answer"
+        raise ConnectionError("stream reset")
+
+
+def test_an_llm_error_mid_reply_stops_it_with_an_error_event(client, monkeypatch):
+    monkeypatch.setitem(main.providers.backends, "llm", FailingLLMBackend())
+    session_id = "test-websocket-llm-error"
+
+    async def add_document():
+        await main.get_document_store().add(session_id, "local_test", "test.txt", b"Anything at all.")
+        await main.sessions.add_files(session_id, [("local_test", "test.txt", "test")])
+
+    client.portal.call(add_document)
+    with client.websocket_connect("/ws") as ws:
+        ws.send_json({"type": "text", "message": "Hello?", "session_id": session_id, "stream": True})
+        messages = []
+        while (message := ws.receive_json())["type"] not in ("error", "tts_end"):
+            messages.append(message)
+    assert message["type"] == "error" and message["turn_id"] == 1 and "error occurred" in message["error"]
+    assert [m["text"] for m in messages if m["type"] == "llm_delta"] == ["The answer"]
+    assert not any(m["type"] in ("llm_response", "tts_end") for m in messages)
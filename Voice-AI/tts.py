@@ -0,0 +1,187 @@
+"""TTS backends: synthesize a reply (or one sentence of it) to audio.
+
+- ElevenLabsBackend streams MP3 (or whatever TTS_OUTPUT_FORMAT asks for)
+  from the ElevenLabs API.
+- PiperBackend runs a Piper voice (ONNX) on the CPU in a worker thread and
+  returns WAV, with no network round trip.
+- StubTTSBackend returns silent WAV of about the length the text would take
+  to say, instantly, for tests and benchmarks.
+
+Callers use `stream()` and `synthesize()`, which apply the backend's gate
+(see admission.py) and record the `tts` span; backends implement
+`generate()` (and `convert()` when the provider has a separate request for
+whole replies). The voice settings are part of the TTS cache key.
+
+The voice's output format is the default; a caller may ask for any other
+format the backend `supports()` (see delivery.py, which picks one per
+WebSocket client). Formats are named like ElevenLabs' `output_format`:
+codec, sample rate and, for compressed ones, bitrate (`opus_48000_32`,
+`pcm_16000`, `mp3_44100_128`). pcm is raw 16-bit little-endian mono.
+"""
+import asyncio
+import io
+import os
+import threading
+import wave
+from contextlib import aclosing, nullcontext
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, AsyncIterator, Optional
+
+from admission import VendorGate
+from audio import pcm_to_wav
+from metrics import span
+
+if TYPE_CHECKING:
+    # Imported by main.py only when the elevenlabs provider is configured
+    from elevenlabs.client import AsyncElevenLabs
+
+
+@dataclass
+class VoiceSettings:
+    voice_id: str
+    model_id: str
+    output_format: str
+
+    @classmethod
+    def from_env(cls, defaults: "VoiceSettings") -> "VoiceSettings":
+        return cls(
+            voice_id=os.getenv("TTS_VOICE_ID", defaults.voice_id),
+            model_id=os.getenv("TTS_MODEL_ID", defaults.model_id),
+            output_format=os.getenv("TTS_OUTPUT_FORMAT", defaults.output_format),
+        )
+
+
+# Output formats of the ElevenLabs API (some need a paid plan)
+ELEVENLABS_FORMATS = frozenset([
+    "mp3_22050_32", "mp3_44100_32", "mp3_44100_64", "mp3_44100_96", "mp3_44100_128", "mp3_44100_192",
+    "pcm_8000", "pcm_16000", "pcm_22050", "pcm_24000", "pcm_44100",
+    "opus_48000_32", "opus_48000_64", "opus_48000_96", "opus_48000_128", "opus_48000_192",
+    "ulaw_8000", "alaw_8000",
+])
+
+
+def media_type(output_format: str) -> str:
+    codec = output_format.partition("_")[0]
+    return {"mp3": "audio/mpeg", "wav": "audio/wav", "opus": "audio/ogg", "ulaw": "audio/basic",
+            "pcm": "audio/pcm"}.get(codec, "application/octet-stream")
+
+
+def sample_rate(output_format: str) -> Optional[int]:
+    rate = output_format.split("_")[1:2]
+    return int(rate[0]) if rate and rate[0].isdigit() else None
+
+
+class TTSBackend:
+    voice: VoiceSettings
+    # Admission, deadline and retries (see admission.py)
+    gate: Optional[VendorGate] = None
+
+    @property
+    def media_type(self) -> str:
+        return media_type(self.voice.output_format)
+
+    def supports(self, output_format: str) -> bool:
+        return output_format == self.voice.output_format
+
+    def generate(self, text: str, output_format: str) -> AsyncIterator[bytes]:
+        raise NotImplementedError
+
+    def convert(self, text: str, output_format: str) -> AsyncIterator[bytes]:
+        return self.generate(text, output_format)
+
+    async def stream(self, text: str, output_format: Optional[str] = None) -> AsyncIterator[bytes]:
+        async for chunk in self._run(self.generate, text, output_format or self.voice.output_format):
+            yield chunk
+
+    async def synthesize(self, text: str, output_format: Optional[str] = None) -> bytes:
+        async with aclosing(self._run(self.convert, text, output_format or self.voice.output_format)) as chunks:
+            return b"".join([chunk async for chunk in chunks])
+
+    async def _run(self, request, text: str, output_format: str) -> AsyncIterator[bytes]:
+        if not self.supports(output_format):
+            raise ValueError(f"Unsupported TTS output format {output_format}")
+        chunks = self.gate.stream(lambda: request(text, output_format)) if self.gate else request(text, output_format)
+        async with self.gate.admit() if self.gate else nullcontext():
+            async with span("tts") as tts_span, aclosing(chunks):
+                async for chunk in chunks:
+                    tts_span.mark_first_byte()
+                    yield chunk
+
+    async def aclose(self):
+        pass
+
+
+class ElevenLabsBackend(TTSBackend):
+    def __init__(self, client: "AsyncElevenLabs", voice: VoiceSettings, gate: Optional[VendorGate] = None):
+        self.client = client
+        self.voice = voice
+        self.gate = gate
+
+    def supports(self, output_format: str) -> bool:
+        return output_format in ELEVENLABS_FORMATS or output_format == self.voice.output_format
+
+    def generate(self, text: str, output_format: str) -> AsyncIterator[bytes]:
+        # The request is made as the stream is consumed
+        return self.client.text_to_speech.stream(
+            text=text,
+            voice_id=self.voice.voice_id,
+            model_id=self.voice.model_id,
+            output_format=output_format,
+        )
+
+    def convert(self, text: str, output_format: str) -> AsyncIterator[bytes]:
+        return self.client.text_to_speech.convert(
+            text=text,
+            voice_id=self.voice.voice_id,
+            model_id=self.voice.model_id,
+            output_format=output_format,
+        )
+
+
+class PiperBackend(TTSBackend):
+    def __init__(self, model_path: str, gate: Optional[VendorGate] = None):
+        try:
+            from piper import PiperVoice
+        except ImportError:
+            raise RuntimeError("TTS_PROVIDER=piper needs the piper-tts package") from None
+        if not model_path:
+            raise RuntimeError("TTS_PROVIDER=piper needs PIPER_VOICE (an .onnx voice)")
+        self.piper = PiperVoice.load(model_path)
+        self.voice = VoiceSettings(model_path, "piper", f"wav_{self.piper.config.sample_rate}")
+        self.gate = gate
+        self.lock = threading.Lock()
+
+    def supports(self, output_format: str) -> bool:
+        # The voice's own sample rate, as WAV or raw PCM
+        return output_format in (self.voice.output_format, f"pcm_{self.piper.config.sample_rate}")
+
+    def _synthesize(self, text: str, output_format: str) -> bytes:
+        out = io.BytesIO()
+        with self.lock, wave.open(out, "wb") as wav:
+            self.piper.synthesize_wav(text, wav)
+        if output_format.startswith("pcm_"):
+            with wave.open(io.BytesIO(out.getvalue()), "rb") as wav:
+                return wav.readframes(wav.getnframes())
+        return out.getvalue()
+
+    async def generate(self, text: str, output_format: str) -> AsyncIterator[bytes]:
+        # Replies are synthesized a sentence at a time, so one WAV per call is small
+        yield await asyncio.to_thread(self._synthesize, text, output_format)
+
+
+class StubTTSBackend(TTSBackend):
+    def __init__(self, sample_rate: int = 16000, chars_per_second: float = 15.0,
+                 gate: Optional[VendorGate] = None):
+        self.voice = VoiceSettings("stub", "stub", f"wav_{sample_rate}")
+        self.sample_rate = sample_rate
+        self.chars_per_second = chars_per_second
+        self.gate = gate
+
+    def supports(self, output_format: str) -> bool:
+        # Silence comes at any sample rate
+        return output_format.partition("_")[0] in ("wav", "pcm") and sample_rate(output_format) is not None
+
+    async def generate(self, text: str, output_format: str) -> AsyncIterator[bytes]:
+        rate = sample_rate(output_format)
+        pcm = bytes(2 * int(len(text) / self.chars_per_second * rate))
+        yield pcm if output_format.startswith("pcm_") else pcm_to_wav(pcm, rate)
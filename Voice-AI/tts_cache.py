@@ -0,0 +1,125 @@
+"""Content-addressed cache for synthesized speech.
+
+Audio is keyed by a hash of everything that determines it (text, voice,
+model, output format). Lookups go to a bounded in-process LRU first, then to
+a shared Redis tier so every worker benefits from audio synthesized by the
+others. Both tiers expire entries after a TTL; the LRU additionally evicts
+the least recently used entries once its total size exceeds `max_bytes`.
+"""
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+import redis
+import redis.asyncio
+
+log = logging.getLogger(__name__)
+
+
+def tts_cache_key(text: str, voice_id: str, model_id: str, output_format: str) -> str:
+    material = json.dumps([text, voice_id, model_id, output_format], ensure_ascii=False)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class TTSCacheStats:
+    memory_hits: int = 0
+    redis_hits: int = 0
+    misses: int = 0
+    stores: int = 0
+    evictions: int = 0
+    bytes_saved: int = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.memory_hits + self.redis_hits + self.misses
+        return (self.memory_hits + self.redis_hits) / lookups if lookups else 0.0
+
+
+class TTSCache:
+    def __init__(self, redis_client: Optional[redis.asyncio.Redis] = None, max_bytes: int = 64 * 1024 * 1024,
+                 max_item_bytes: int = 2 * 1024 * 1024, ttl: int = 7 * 24 * 3600, prefix: str = "tts:"):
+        self.redis = redis_client
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.ttl = ttl
+        self.prefix = prefix
+        self.entries: "OrderedDict[str, Tuple[bytes, float]]" = OrderedDict()
+        self.size = 0
+        self.stats = TTSCacheStats()
+
+    async def get(self, key: str) -> Optional[bytes]:
+        audio = self._get_local(key)
+        if audio is not None:
+            self.stats.memory_hits += 1
+            self.stats.bytes_saved += len(audio)
+            return audio
+
+        if self.redis is not None:
+            try:
+                audio = await self.redis.get(self.prefix + key)
+            except redis.RedisError as e:
+                log.warning(f"TTS cache Redis error: {e}")
+                audio = None
+            if audio is not None:
+                self.stats.redis_hits += 1
+                self.stats.bytes_saved += len(audio)
+                self._put_local(key, audio)
+                return audio
+
+        self.stats.misses += 1
+        return None
+
+    async def put(self, key: str, audio: bytes):
+        if not audio or len(audio) > self.max_item_bytes:
+            return
+        self.stats.stores += 1
+        self._put_local(key, audio)
+        if self.redis is not None:
+            try:
+                await self.redis.set(self.prefix + key, audio, ex=self.ttl)
+            except redis.RedisError as e:
+                log.warning(f"TTS cache Redis error: {e}")
+
+    def _get_local(self, key: str) -> Optional[bytes]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        audio, expires_at = entry
+        if expires_at < time.monotonic():
+            self._remove_local(key)
+            return None
+        self.entries.move_to_end(key)
+        return audio
+
+    def _put_local(self, key: str, audio: bytes):
+        if key in self.entries:
+            self._remove_local(key)
+        self.entries[key] = (audio, time.monotonic() + self.ttl)
+        self.size += len(audio)
+        while self.size > self.max_bytes and self.entries:
+            self._remove_local(next(iter(self.entries)))
+            self.stats.evictions += 1
+
+    def _remove_local(self, key: str):
+        audio, _ = self.entries.pop(key)
+        self.size -= len(audio)
+
+    def report(self) -> dict:
+        stats = self.stats
+        return {
+            "memory_hits": stats.memory_hits,
+            "redis_hits": stats.redis_hits,
+            "misses": stats.misses,
+            "hit_ratio": round(stats.hit_ratio, 4),
+            "bytes_saved": stats.bytes_saved,
+            "stores": stats.stores,
+            "evictions": stats.evictions,
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+        }
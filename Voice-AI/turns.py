@@ -0,0 +1,140 @@
+"""Turn bookkeeping for barge-in.
+
+Every message that produces a reply on /ws is one turn with an increasing
+id per connection. When the user starts talking again (or sends a new text
+message, or an explicit `interrupt`), the running turn is cancelled: its LLM
+stream is closed, its TTS requests are cancelled and audio it has not sent
+yet is dropped.
+
+A Turn records how far it got, so a cancellation can be turned into an
+estimate of the work that was avoided (tokens are estimated from the text,
+CHARS_PER_TOKEN characters each, which also covers cached answers):
+
+    llm_tokens_avoided     completion tokens that were not generated: the
+                           average completion length so far, minus what the
+                           turn had already streamed
+    audio_seconds_avoided  speech that was never synthesized, from the text
+                           that had not been sent to TTS (plus the text the
+                           avoided tokens would have been)
+    audio_seconds_dropped  speech that was synthesized but not sent
+"""
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+CHARS_PER_TOKEN = 4
+# Typical speaking rate of the TTS voices, ~170 words per minute
+SPEECH_CHARS_PER_SECOND = 15
+
+
+def audio_bytes_per_second(output_format: str) -> int:
+    """Byte rate of an output format such as mp3_44100_128, opus_48000_32, pcm_16000 or wav_22050 (16-bit mono)."""
+    codec, _, rest = output_format.partition("_")
+    numbers = [int(part) for part in rest.split("_") if part.isdigit()]
+    if codec in ("mp3", "opus") and len(numbers) == 2:
+        return numbers[1] * 1000 // 8
+    if codec in ("pcm", "wav") and numbers:
+        return numbers[0] * 2
+    if codec in ("ulaw", "alaw") and numbers:
+        return numbers[0]
+    return 16000
+
+
+@dataclass
+class Turn:
+    id: int
+    # When the turn was queued, started, sent its first audio and was asked to stop
+    queued: float = field(default_factory=time.perf_counter)
+    started: float = field(default_factory=time.perf_counter)
+    first_audio: Optional[float] = None
+    cancelled_at: Optional[float] = None
+    # LLM progress: requested, streamed, completion tokens so far, finished
+    llm_started: bool = False
+    llm_streamed: bool = False
+    llm_tokens: int = 0
+    llm_done: bool = False
+    # Text handed to TTS whose audio has not come back yet, and audio not sent yet
+    tts_chars_pending: int = 0
+    audio_bytes_unsent: int = 0
+    # Byte rate of the connection's audio format (None: the TTS backend's)
+    audio_bytes_per_second: Optional[int] = None
+
+    def llm_finished(self, tokens: int):
+        self.llm_tokens = tokens
+        self.llm_done = True
+
+
+class TurnStats:
+    def __init__(self, audio_bytes_per_second: int = 16000):
+        self.audio_bytes_per_second = audio_bytes_per_second
+        self.turns = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.cancelled_queued = 0
+        self.llm_calls = 0
+        self.llm_tokens = 0
+        self.llm_tokens_avoided = 0
+        self.audio_seconds_avoided = 0.0
+        self.audio_seconds_dropped = 0.0
+        self.cancel_ms_total = 0.0
+        self.cancel_ms_max = 0.0
+
+    def average_completion_tokens(self) -> float:
+        return self.llm_tokens / self.llm_calls if self.llm_calls else 0.0
+
+    def record_turn(self):
+        self.turns += 1
+
+    def record_completed(self, turn: Turn):
+        self.completed += 1
+        if turn.llm_done:
+            self.record_llm(turn.llm_tokens)
+
+    def record_llm(self, tokens: int):
+        self.llm_calls += 1
+        self.llm_tokens += tokens
+
+    def record_cancelled(self, turn: Turn, queued: bool = False) -> dict:
+        """Account for a cancelled turn; returns its share of the avoided work."""
+        cancel_ms = (time.perf_counter() - turn.cancelled_at) * 1000 if turn.cancelled_at else 0.0
+        self.cancelled += 1
+        if queued:
+            self.cancelled_queued += 1
+        if turn.llm_done:
+            self.record_llm(turn.llm_tokens)
+        tokens_avoided = 0
+        if not turn.llm_started:
+            tokens_avoided = round(self.average_completion_tokens())
+        elif turn.llm_streamed and not turn.llm_done:
+            # Closing a stream stops generation; a plain request runs to the end anyway
+            tokens_avoided = max(round(self.average_completion_tokens()) - turn.llm_tokens, 0)
+        unsynthesized_chars = max(turn.tts_chars_pending, 0) + tokens_avoided * CHARS_PER_TOKEN
+        audio_avoided = unsynthesized_chars / SPEECH_CHARS_PER_SECOND
+        audio_dropped = turn.audio_bytes_unsent / (turn.audio_bytes_per_second or self.audio_bytes_per_second)
+
+        self.llm_tokens_avoided += tokens_avoided
+        self.audio_seconds_avoided += audio_avoided
+        self.audio_seconds_dropped += audio_dropped
+        self.cancel_ms_total += cancel_ms
+        self.cancel_ms_max = max(self.cancel_ms_max, cancel_ms)
+        return {
+            "llm_tokens_avoided": tokens_avoided,
+            "audio_seconds_avoided": round(audio_avoided, 2),
+            "audio_seconds_dropped": round(audio_dropped, 2),
+        }
+
+    def report(self) -> dict:
+        cancelled_running = self.cancelled - self.cancelled_queued
+        return {
+            "turns": self.turns,
+            "completed": self.completed,
+            "cancelled": self.cancelled,
+            "cancelled_before_start": self.cancelled_queued,
+            "llm_calls": self.llm_calls,
+            "avg_completion_tokens": round(self.average_completion_tokens(), 1),
+            "llm_tokens_avoided": self.llm_tokens_avoided,
+            "audio_seconds_avoided": round(self.audio_seconds_avoided, 2),
+            "audio_seconds_dropped": round(self.audio_seconds_dropped, 2),
+            "avg_cancel_ms": round(self.cancel_ms_total / cancelled_running, 2) if cancelled_running else None,
+            "max_cancel_ms": round(self.cancel_ms_max, 2),
+        }
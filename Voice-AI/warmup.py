@@ -0,0 +1,130 @@
+"""Warm startup: what the app does before it reports ready, and how long it took.
+
+The lifespan builds the configured STT, LLM and TTS backends before the
+server accepts connections. Each vendor's SDK is only imported then, by the
+provider that needs it (openai, elevenlabs, faster-whisper, ...), so a
+deployment on local or stub providers never pays for the others. The rest of
+the warm-up runs in the background while the app already answers, and the
+readiness probe (/api/status/ready) fails until all of it has finished, so a
+load balancer only sends traffic to a warm worker:
+
+- redis: Redis answers a PING, retried until it does (sessions live there)
+- connections: the pooled client of each configured vendor has
+  WARM_CONNECTIONS keep-alive connections open, with their DNS, TCP and TLS
+  setup done (see clients.py)
+- llm: the LLM backend gets ready for its first request (the OpenAI backend
+  imports the SDK modules its client would load on first use and, with
+  WARM_LLM_REQUEST, makes one minimal request)
+- tts_phrases: phrases the assistant says often, such as its "I don't know"
+  answers, are synthesized into the TTS cache
+
+A failed step other than redis is reported and not retried: readiness does
+not wait for a vendor that is down (its health endpoint reports that).
+
+/api/status/startup reports how long main.py took to import, each step, the
+time until ready, and the latency of the first request to each API endpoint
+and of the first /ws turn, which is where cold clients used to show.
+"""
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Set
+
+log = logging.getLogger(__name__)
+
+Step = Callable[[], Awaitable[None]]
+
+
+class Warmup:
+    def __init__(self, started: float):
+        # When main.py started importing, and when the lifespan took over
+        self.started = started
+        self.imported: Optional[float] = None
+        self.ready_at: Optional[float] = None
+        self.steps: Dict[str, dict] = {}
+        self.pending: Set[str] = set()
+        self.first_requests: Dict[str, dict] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.ready_at is not None
+
+    def imports_done(self):
+        self.imported = time.perf_counter()
+
+    @contextmanager
+    def timed(self, name: str):
+        """Time a step that runs before the app serves; its exceptions stop the startup."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps[name] = {"ms": round((time.perf_counter() - started) * 1000, 1)}
+
+    def start(self, steps: Dict[str, Step]):
+        """Run the steps concurrently in the background; ready once all have finished."""
+        self.pending = set(steps)
+        self.task = asyncio.create_task(self._run(steps))
+
+    async def stop(self):
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self, steps: Dict[str, Step]):
+        await asyncio.gather(*(self._step(name, run) for name, run in steps.items()))
+        self.ready_at = time.perf_counter()
+        log.info(f"Ready {(self.ready_at - self.started) * 1000:.0f} ms after start: {self.steps}")
+
+    async def _step(self, name: str, run: Step):
+        started = time.perf_counter()
+        result = {}
+        try:
+            await run()
+        except Exception as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+            log.warning(f"Warm-up step {name} failed: {result['error']}")
+        self.steps[name] = {"ms": round((time.perf_counter() - started) * 1000, 1), **result}
+        self.pending.discard(name)
+
+    def first_request(self, name: str, seconds: float, **fields):
+        if name not in self.first_requests:
+            self.first_requests[name] = {"ms": round(seconds * 1000, 1), "before_ready": not self.ready, **fields}
+
+    def report(self) -> dict:
+        return {
+            "ready": self.ready,
+            "pending": sorted(self.pending),
+            "import_ms": round((self.imported - self.started) * 1000, 1) if self.imported else None,
+            "ready_ms": round((self.ready_at - self.started) * 1000, 1) if self.ready_at else None,
+            "steps": self.steps,
+            "first_requests": self.first_requests,
+        }
+
+
+class FirstRequestTimer:
+    """ASGI middleware: times the first request to each of `paths`, up to its response headers."""
+
+    def __init__(self, app, warmup: Warmup, paths: Iterable[str]):
+        self.app = app
+        self.warmup = warmup
+        self.paths = set(paths)
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path")
+        if scope["type"] != "http" or path not in self.paths or path in self.warmup.first_requests:
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+
+        async def timed_send(message):
+            if message["type"] == "http.response.start":
+                self.warmup.first_request(path, time.perf_counter() - started, status=message["status"])
+            await send(message)
+
+        await self.app(scope, receive, timed_send)
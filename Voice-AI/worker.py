@@ -0,0 +1,44 @@
+"""Standalone job worker: runs the background jobs (see jobs.py) outside the app's workers.
+
+Ingestion, indexing status polling and cleanup can then be scaled apart from
+the /ws and API traffic, e.g. with JOB_WORKERS=0 on the app, so no job ever
+runs on a worker serving a conversation. It uses main.py's settings (the same
+environment as the app) and needs the app's Redis, its UPLOAD_SPOOL_DIR (where
+uploads wait to be ingested, so on another host a shared volume) and, with
+local retrieval, its RETRIEVAL_DIR. Upload progress and job completion
+reach the session's sockets through the session bus (see session_bus.py), so
+SESSION_BUS must be on.
+
+    cd Voice-AI && python worker.py --consumers 4
+"""
+import argparse
+import asyncio
+import logging
+import os
+import signal
+
+import main
+
+log = logging.getLogger(__name__)
+
+
+async def run(consumers: int):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    await main.start_jobs(consumers)
+    log.info(f"Job worker {main.job_queue.worker_id} running {consumers} consumer(s)")
+    await stop.wait()
+    # Jobs cut short go back to the queue
+    await main.job_queue.stop()
+    await main.close_vendor_clients()
+    await main.redis_client.aclose()
+    await main.redis_binary_client.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run background jobs")
+    parser.add_argument("--consumers", type=int, default=int(os.getenv("JOB_WORKERS", "1")) or 1,
+                        help="jobs run at once (default: JOB_WORKERS)")
+    asyncio.run(run(parser.parse_args().consumers))